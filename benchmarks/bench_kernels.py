@@ -0,0 +1,359 @@
+"""
+Benchmark suite for the core terrain kernels in terrain_editor.py.
+
+terrain_editor.py is a Streamlit script, so importing it would run the whole
+app. load_kernels() instead parses the file and executes only its imports,
+module-level constants and function/class definitions, which gives access to
+the real kernels without starting a Streamlit session.
+
+Usage:
+    python benchmarks/bench_kernels.py                      # run and compare against baseline
+    python benchmarks/bench_kernels.py --save-baseline      # (re)write the baseline
+    python benchmarks/bench_kernels.py --sizes 256 512 --repeat 5
+
+Each kernel is timed on Data/dem.tif and on synthetic DEMs of increasing size.
+Results (median wall time, throughput, peak traced memory) are written to
+benchmarks/results.json. When benchmarks/baseline.json exists, any kernel that
+is slower or uses more memory than the baseline by more than the tolerance is
+reported and the script exits with status 1.
+"""
+
+import argparse
+import ast
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+import types
+from pathlib import Path
+
+import numpy as np
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+APP_PATH = REPO_DIR / "terrain_editor.py"
+BENCH_DIR = Path(__file__).resolve().parent
+DEFAULT_BASELINE = BENCH_DIR / "baseline.json"
+DEFAULT_RESULTS = BENCH_DIR / "results.json"
+DEFAULT_SIZES = [256, 512, 1024]
+
+KERNELS = [
+    "compute_hillshade",
+    "sample_dem_at_points",
+    "sample_line_at_spacing",
+    "cross_section_preview",
+    "apply_corridor_to_dem",
+    "apply_basin_to_dem",
+    "calculate_dem_volume",
+    "calculate_dem_volume_uncertainty",
+]
+
+
+# ============================================================================
+# KERNEL LOADING
+# ============================================================================
+
+def _is_definition(node):
+    """Top-level statements that are safe to execute outside Streamlit."""
+    if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)):
+        return True
+    if isinstance(node, ast.Try):
+        # Optional-dependency blocks: try/except containing only imports, flag assignments
+        # and fallback definitions
+        body = node.body + [n for h in node.handlers for n in h.body]
+        return all(isinstance(n, (ast.Import, ast.ImportFrom, ast.Assign, ast.Try, ast.FunctionDef)) for n in body)
+    if isinstance(node, ast.Assign):
+        # UPPER_CASE module constants only
+        return all(isinstance(t, ast.Name) and t.id.isupper() for t in node.targets)
+    return False
+
+
+def load_kernels(app_path=APP_PATH):
+    """Return a module holding the imports, constants and functions of terrain_editor.py."""
+    source = Path(app_path).read_text(encoding="utf-8")
+    tree = ast.parse(source, filename=str(app_path))
+    tree.body = [node for node in tree.body if _is_definition(node)]
+    module = types.ModuleType("terrain_kernels")
+    module.__file__ = str(app_path)
+    # Sibling modules (section_sheets) resolve as they do under `streamlit run`
+    app_dir = str(Path(app_path).resolve().parent)
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
+    exec(compile(tree, str(app_path), "exec"), module.__dict__)
+    return module
+
+
+# ============================================================================
+# INPUTS
+# ============================================================================
+
+def synthetic_dem(size, cell_size=1.0, seed=0):
+    """Fractal test terrain (tilted plane + value noise) with a few nodata holes."""
+    from synthetic_data import generate_dem
+
+    return generate_dem(size, kind="fractal", cell_size=cell_size, holes=3, seed=seed)
+
+
+def load_inputs(kernels, sizes, dem_path):
+    """List of (name, dem, transform, nodata, crs) benchmark inputs."""
+    inputs = []
+    if dem_path is not None and Path(dem_path).exists():
+        import rasterio
+        with rasterio.open(dem_path) as ds:
+            dem, _ = kernels.read_dem_band(ds)
+            crs = ds.crs
+            transform, nodata = ds.transform, ds.nodata
+        if crs is not None and crs.is_geographic:
+            # Kernels work in a projected CRS; mirror the app's UTM reprojection
+            from rasterio.warp import calculate_default_transform, reproject, Resampling
+            from pyproj import CRS
+            bounds = ds.bounds
+            lon, lat = (bounds.left + bounds.right) / 2, (bounds.bottom + bounds.top) / 2
+            zone = int((lon + 180.0) / 6.0) + 1
+            utm = CRS.from_epsg(32600 + zone if lat >= 0 else 32700 + zone)
+            dst_transform, w, h = calculate_default_transform(crs, utm, ds.width, ds.height, *bounds)
+            projected = np.full((h, w), np.nan if nodata is None else nodata, dtype=np.float32)
+            reproject(dem, projected, src_transform=transform, src_crs=crs, src_nodata=nodata,
+                      dst_transform=dst_transform, dst_crs=utm, dst_nodata=nodata,
+                      resampling=Resampling.bilinear)
+            dem, transform, crs = projected, dst_transform, utm
+        inputs.append(("dem.tif", dem, transform, nodata, crs))
+    for size in sizes:
+        dem, transform, nodata, crs = synthetic_dem(size)
+        inputs.append((f"synthetic_{size}", dem, transform, nodata, crs))
+    return inputs
+
+
+def build_cases(kernels, dem, transform, nodata, crs):
+    """Callable + work size for each kernel on one DEM."""
+    from shapely.geometry import LineString
+
+    h, w = dem.shape
+    cell = abs(transform.a)
+    valid = kernels.dem_valid_mask(dem, nodata)
+    x0, y0 = transform * (0, 0)
+    x1, y1 = transform * (w, h)
+    xmin, xmax, ymin, ymax = min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1)
+    span_x, span_y = xmax - xmin, ymax - ymin
+
+    def at(fx, fy):
+        return (xmin + fx * span_x, ymin + fy * span_y)
+
+    rng = np.random.default_rng(1)
+    n_points = 20000
+    pts_xy = np.column_stack([rng.uniform(xmin, xmax, n_points), rng.uniform(ymin, ymax, n_points)])
+
+    # Profile line across the middle of the DEM with a few corner vertices
+    line = LineString([at(0.2, 0.3), at(0.4, 0.45), at(0.6, 0.5), at(0.8, 0.7)])
+    samples = kernels.extract_profile_from_line(line)
+    tangents, normals = kernels.compute_tangents_normals(samples)
+    z_exist = kernels.sample_dem_at_points(dem, transform, nodata, samples[:, 1:3], valid=valid)
+    z_design = np.where(np.isnan(z_exist), np.nanmean(dem[valid]), z_exist) + 1.0
+    template_params = {
+        "berm_height": 1.5, "berm_crest_width": 1.0, "berm_upstream_slope": 1.5,
+        "berm_downstream_slope": 1.5, "ditch_width": 2.0, "ditch_depth": 1.5,
+        "ditch_side_slope": 1.5, "ditch_side": "left",
+    }
+    influence = max(12.0, 12 * cell)
+
+    # Square basin in the centre of the DEM
+    basin = [at(0.35, 0.35), at(0.65, 0.35), at(0.65, 0.65), at(0.35, 0.65), at(0.35, 0.35)]
+    basin_depth = max(2.0, 0.02 * span_x)
+    modified, _ = kernels.apply_basin_to_dem(dem, transform, nodata, basin, basin_depth, 2.0, 1.0, None, valid=valid)
+    basin_cells = int(0.09 * h * w)
+
+    return {
+        "compute_hillshade": (
+            lambda: kernels.compute_hillshade(dem, cell, abs(transform.e), valid=valid), h * w),
+        "sample_dem_at_points": (
+            lambda: kernels.sample_dem_at_points(dem, transform, nodata, pts_xy, valid=valid), n_points),
+        "sample_line_at_spacing": (
+            lambda: kernels.sample_line_at_spacing(line, cell), int(line.length / cell) + 1),
+        "cross_section_preview": (
+            lambda: kernels.cross_section_preview(dem, transform, nodata, len(samples) // 2, samples, normals,
+                                                  z_design, "berm_ditch", template_params, influence, "both",
+                                                  valid=valid), 201),
+        "apply_corridor_to_dem": (
+            lambda: kernels.apply_corridor_to_dem(dem, transform, nodata, samples, z_design, "berm_ditch",
+                                                  template_params, tangents, normals, influence, "both",
+                                                  valid=valid), h * w),
+        "apply_basin_to_dem": (
+            lambda: kernels.apply_basin_to_dem(dem, transform, nodata, basin, basin_depth, 2.0, 1.0, None,
+                                               valid=valid), basin_cells),
+        "calculate_dem_volume": (
+            lambda: kernels.calculate_dem_volume(dem, modified, transform, nodata, basin, valid=valid), h * w),
+        "calculate_dem_volume_uncertainty": (
+            lambda: kernels.calculate_dem_volume_uncertainty(dem, modified, transform, nodata, basin, crs,
+                                                             cell_sizes=[cell, 2 * cell, 4 * cell]), basin_cells),
+    }
+
+
+# ============================================================================
+# CORRECTNESS CHECKS
+# ============================================================================
+
+def check_alignment_field(kernels, tolerance=1e-3):
+    """
+    Compare alignment_field() with shapely's line.distance / line.project on a
+    switchback line, where the nearest vertex is often not on the nearest segment.
+    Returns a list of failure messages (empty when the field is correct).
+    """
+    import shapely
+    from rasterio.transform import from_origin
+    from shapely.geometry import LineString
+
+    line = LineString([(20, 20), (180, 20), (180, 35), (20, 35), (20, 50), (180, 50), (100, 120)])
+    transform = from_origin(0, 140, 0.5, 0.5)
+    influence = 12.0
+    samples = kernels.extract_profile_from_line(line)
+    field = kernels.alignment_field(transform, (280, 400), samples, influence)
+    row_min, row_max, col_min, col_max = field["window"]
+    rows, cols = np.mgrid[row_min:row_max + 1, col_min:col_max + 1]
+    px, py = kernels.pixel_centers(transform, rows.ravel(), cols.ravel())
+    points = shapely.points(px, py)
+    chainage = field["chainage"].ravel().astype(np.float64)
+    offset = field["offset"].ravel().astype(np.float64)
+    inside = ~np.isnan(chainage)
+
+    failures = []
+    distance = shapely.distance(line, points)
+    # Corridor pixels must sit at the true distance from the line...
+    bad_offset = inside & (np.abs(np.abs(offset) - distance) > tolerance)
+    # ...and at a chainage whose line point is that close (ties between segments allowed)
+    at_chainage = shapely.distance(shapely.line_interpolate_point(line, np.where(inside, chainage, 0.0)), points)
+    bad_chainage = inside & (at_chainage > distance + tolerance)
+    # Pixels within the influence width that project inside the line must be in the corridor
+    projected = shapely.line_locate_point(line, points)
+    interior = (distance < influence - tolerance) & (projected > tolerance) & (projected < line.length - tolerance)
+    missing = interior & ~inside
+    for label, bad in (("offset != line.distance", bad_offset), ("chainage off the nearest point", bad_chainage),
+                       ("corridor pixel missing", missing)):
+        if bad.any():
+            k = int(np.flatnonzero(bad)[0])
+            failures.append(f"alignment_field: {int(bad.sum())} pixels with {label} "
+                            f"(e.g. offset {offset[k]:.2f} / chainage {chainage[k]:.1f}, "
+                            f"expected distance {distance[k]:.2f} / chainage {projected[k]:.1f})")
+    return failures
+
+
+# ============================================================================
+# MEASUREMENT
+# ============================================================================
+
+def measure(func, work, repeat):
+    """Median wall time over `repeat` runs plus peak traced memory of one run."""
+    func()  # warm-up (imports, caches)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    wall = statistics.median(times)
+    return {
+        "wall_s": wall,
+        "throughput_per_s": work / wall if wall > 0 else None,
+        "peak_mb": peak / 1e6,
+        "work_units": work,
+    }
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance, min_wall_s):
+    """List of human-readable regressions against the baseline."""
+    regressions = []
+    for key, current in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        # Very short kernels are dominated by timer noise; only compare above min_wall_s
+        if max(current["wall_s"], reference["wall_s"]) >= min_wall_s:
+            limit = reference["wall_s"] * (1.0 + time_tolerance)
+            if current["wall_s"] > limit:
+                regressions.append(
+                    f"{key}: wall {current['wall_s']:.4f}s > {limit:.4f}s "
+                    f"(baseline {reference['wall_s']:.4f}s +{time_tolerance:.0%})")
+        mem_limit = reference["peak_mb"] * (1.0 + memory_tolerance) + 1.0  # 1 MB slack
+        if current["peak_mb"] > mem_limit:
+            regressions.append(
+                f"{key}: peak {current['peak_mb']:.1f} MB > {mem_limit:.1f} MB "
+                f"(baseline {reference['peak_mb']:.1f} MB +{memory_tolerance:.0%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="*", default=DEFAULT_SIZES,
+                        help="Synthetic DEM edge lengths in cells (default: %(default)s)")
+    parser.add_argument("--dem", default=str(REPO_DIR / "Data" / "dem.tif"),
+                        help="Real DEM to include (default: Data/dem.tif); pass '' to skip")
+    parser.add_argument("--kernels", nargs="*", default=KERNELS, choices=KERNELS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+    parser.add_argument("--results", default=str(DEFAULT_RESULTS))
+    parser.add_argument("--save-baseline", action="store_true", help="Write results as the new baseline")
+    parser.add_argument("--time-tolerance", type=float, default=0.25)
+    parser.add_argument("--memory-tolerance", type=float, default=0.25)
+    parser.add_argument("--min-wall", type=float, default=0.005,
+                        help="Ignore timing regressions for kernels faster than this (seconds)")
+    args = parser.parse_args(argv)
+
+    kernels = load_kernels()
+    failures = check_alignment_field(kernels)
+    if failures:
+        print("CHECK FAILURES:")
+        for line in failures:
+            print(f"  {line}")
+        return 1
+
+    results = {}
+    for name, dem, transform, nodata, crs in load_inputs(kernels, args.sizes, args.dem or None):
+        cases = build_cases(kernels, dem, transform, nodata, crs)
+        for kernel in args.kernels:
+            func, work = cases[kernel]
+            stats = measure(func, work, args.repeat)
+            stats["cells"] = int(dem.size)
+            key = f"{kernel}@{name}"
+            results[key] = stats
+            print(f"{key:<55} {stats['wall_s'] * 1e3:10.2f} ms  "
+                  f"{stats['throughput_per_s'] or 0:14,.0f} /s  {stats['peak_mb']:8.1f} MB")
+
+    payload = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "machine": platform.platform(),
+        "results": results,
+    }
+    Path(args.results).write_text(json.dumps(payload, indent=2), encoding="utf-8")
+
+    if args.save_baseline:
+        Path(args.baseline).write_text(json.dumps(payload, indent=2), encoding="utf-8")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    baseline_path = Path(args.baseline)
+    if not baseline_path.exists():
+        print(f"No baseline at {baseline_path}; run with --save-baseline to create one.")
+        return 0
+
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8")).get("results", {})
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance, args.min_wall)
+    if regressions:
+        print("\nREGRESSIONS:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print("\nNo regressions against baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
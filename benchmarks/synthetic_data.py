@@ -0,0 +1,309 @@
+"""
+Synthetic DEM and geometry generators for scaling tests.
+
+Produces reproducible terrains far larger than the bundled Data/dem.tif
+(1k² to 20k² cells and beyond), written tile by tile so memory stays bounded,
+plus matching profile lines, basin polygons and channel lines as Shapefile
+(ZIP), KML and KMZ for the upload processors.
+
+Terrain kinds:
+    planar   Analytic tilted plane (exact reference volumes available)
+    fractal  Tilted plane plus multi-octave value noise (deterministic per seed)
+
+Because the basin cut is applied relative to existing ground, the exact cut
+volume of the generated rectangular basin is known for both kinds as long as no
+nodata hole falls inside it (holes are placed outside the basin). For planar
+terrain the volume of ground above the datum inside the basin is exact as well.
+
+Usage:
+    python benchmarks/synthetic_data.py --size 4096 --kind fractal --out synthetic/
+    python benchmarks/synthetic_data.py --size 20000 --kind planar --holes 12 --crs EPSG:32611
+"""
+
+import argparse
+import json
+import math
+import sys
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_NODATA = -9999.0
+
+# Basin geometry as fractions of the DEM extent, and design parameters
+BASIN_EXTENT = (0.40, 0.44, 0.60, 0.56)   # (fx_min, fy_min, fx_max, fy_max)
+BASIN_DEPTH = 3.0
+BASIN_SIDE_SLOPE = 2.0
+
+
+# ============================================================================
+# TERRAIN
+# ============================================================================
+
+def _lattice_noise(ix, iy, seed):
+    """Deterministic pseudo-random values in [-1, 1] on an integer lattice (splitmix-style hash)."""
+    h = (ix.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) ^ \
+        (iy.astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)) ^ \
+        np.uint64((seed * 0x165667B19E3779F9) & 0xFFFFFFFFFFFFFFFF)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xFF51AFD7ED558CCD)
+    h ^= h >> np.uint64(33)
+    return (h >> np.uint64(11)).astype(np.float64) / float(1 << 53) * 2.0 - 1.0
+
+
+def _value_noise(rows, cols, wavelength, seed):
+    """Smooth value noise with the given wavelength (cells), evaluated at global row/col indices."""
+    fx, fy = cols / wavelength, rows / wavelength
+    ix, iy = np.floor(fx).astype(np.int64), np.floor(fy).astype(np.int64)
+    tx, ty = fx - ix, fy - iy
+    tx, ty = tx * tx * (3 - 2 * tx), ty * ty * (3 - 2 * ty)
+    v00 = _lattice_noise(ix, iy, seed)
+    v10 = _lattice_noise(ix + 1, iy, seed)
+    v01 = _lattice_noise(ix, iy + 1, seed)
+    v11 = _lattice_noise(ix + 1, iy + 1, seed)
+    return (v00 * (1 - tx) + v10 * tx) * (1 - ty) + (v01 * (1 - tx) + v11 * tx) * ty
+
+
+def terrain_params(size, kind="fractal", cell_size=1.0, slope=0.05, relief=40.0, seed=0):
+    """Parameters shared by every tile of one terrain."""
+    return {
+        "size": size, "kind": kind, "cell_size": cell_size, "base": 500.0,
+        # Plane falls towards +x (downstream) and gently towards +row
+        "gx": -slope, "gy": -0.4 * slope,
+        "relief": relief, "seed": seed,
+        "wavelength": max(8.0, size / 4.0), "persistence": 0.5,
+    }
+
+
+def terrain_tile(rows, cols, params):
+    """Elevations (float32) at global row/col index arrays; x grows with col, y grows with row upwards."""
+    cell = params["cell_size"]
+    x_m = (cols + 0.5) * cell
+    y_m = (params["size"] - rows - 0.5) * cell
+    z = params["base"] + params["gx"] * x_m - params["gy"] * y_m
+    if params["kind"] == "fractal":
+        amplitude, wavelength, octave = params["relief"], params["wavelength"], 0
+        while wavelength >= 2.0:
+            z = z + amplitude * _value_noise(rows, cols, wavelength, params["seed"] + octave)
+            amplitude *= params["persistence"]
+            wavelength /= 2.0
+            octave += 1
+    return z.astype(np.float32)
+
+
+def nodata_holes(size, count, seed=0, avoid=BASIN_EXTENT):
+    """Circular nodata holes (row, col, radius) placed outside the basin area."""
+    rng = np.random.default_rng(seed + 7919)
+    holes = []
+    fx0, fy0, fx1, fy1 = avoid
+    while len(holes) < count:
+        r, c = rng.uniform(0, size, 2)
+        radius = rng.uniform(size / 200.0, size / 60.0) + 1.0
+        # Rows grow downwards, fractions of the extent grow upwards
+        fx, fy = c / size, 1.0 - r / size
+        margin = radius / size
+        if fx0 - margin <= fx <= fx1 + margin and fy0 - margin <= fy <= fy1 + margin:
+            continue
+        holes.append((float(r), float(c), float(radius)))
+    return holes
+
+
+def apply_holes(tile, rows, cols, holes, nodata):
+    for r, c, radius in holes:
+        tile[(rows - r) ** 2 + (cols - c) ** 2 <= radius ** 2] = nodata
+    return tile
+
+
+def dem_transform(size, cell_size, crs, origin=None):
+    """North-up transform; default origins are inside UTM zone 11N or near Kelowna for geographic CRSs."""
+    from pyproj import CRS
+    from rasterio.transform import from_origin
+
+    if origin is None:
+        origin = (-119.5, 49.9) if CRS.from_user_input(crs).is_geographic else (500000.0, 5500000.0)
+    left, bottom = origin
+    return from_origin(left, bottom + size * cell_size, cell_size, cell_size)
+
+
+def generate_dem(size, kind="fractal", cell_size=1.0, holes=3, nodata=DEFAULT_NODATA, crs="EPSG:32611",
+                 seed=0, slope=0.05, relief=40.0, origin=None):
+    """
+    In-memory synthetic DEM (for sizes that fit in RAM).
+
+    Returns:
+        dem (float32), transform, nodata, crs
+    """
+    params = terrain_params(size, kind, cell_size, slope, relief, seed)
+    rows, cols = np.mgrid[0:size, 0:size]
+    dem = terrain_tile(rows.astype(np.float64), cols.astype(np.float64), params)
+    apply_holes(dem, rows, cols, nodata_holes(size, holes, seed), nodata)
+    return dem, dem_transform(size, cell_size, crs, origin), nodata, crs
+
+
+def write_dem(path, size, kind="fractal", cell_size=1.0, holes=3, nodata=DEFAULT_NODATA, crs="EPSG:32611",
+              seed=0, slope=0.05, relief=40.0, origin=None, block_size=512, compress="DEFLATE", kernels=None):
+    """Write a synthetic DEM tile by tile (bounded memory) and return its transform."""
+    import rasterio
+
+    if kernels is None:
+        from bench_kernels import load_kernels
+        kernels = load_kernels()
+    params = terrain_params(size, kind, cell_size, slope, relief, seed)
+    transform = dem_transform(size, cell_size, crs, origin)
+    hole_list = nodata_holes(size, holes, seed)
+    profile = kernels.geotiff_profile(size, size, crs, transform, nodata, compress, block_size)
+    with rasterio.open(path, "w", **profile) as dst:
+        for _, window in dst.block_windows(1):
+            rows, cols = np.mgrid[window.row_off:window.row_off + window.height,
+                                  window.col_off:window.col_off + window.width]
+            tile = terrain_tile(rows.astype(np.float64), cols.astype(np.float64), params)
+            dst.write(apply_holes(tile, rows, cols, hole_list, nodata), 1, window=window)
+    return transform
+
+
+# ============================================================================
+# GEOMETRY
+# ============================================================================
+
+def _at(transform, size, fx, fy):
+    """CRS coordinates of a point given as fractions of the DEM extent (fy grows northwards)."""
+    x, y = transform * (fx * size, (1.0 - fy) * size)
+    return (float(x), float(y))
+
+
+def profile_line(transform, size, vertices=12):
+    """Meandering profile polyline running SW→NE across the DEM."""
+    coords = []
+    for i in range(vertices):
+        t = i / (vertices - 1)
+        fx = 0.1 + 0.8 * t
+        fy = 0.2 + 0.6 * t + 0.05 * math.sin(3 * math.pi * t)
+        coords.append(_at(transform, size, fx, fy))
+    return coords
+
+
+def basin_polygon(transform, size):
+    """Closed rectangular basin polygon (clockwise from the upstream/west edge)."""
+    fx0, fy0, fx1, fy1 = BASIN_EXTENT
+    ring = [(fx0, fy1), (fx1, fy1), (fx1, fy0), (fx0, fy0), (fx0, fy1)]
+    return [_at(transform, size, fx, fy) for fx, fy in ring]
+
+
+def channel_line(transform, size, vertices=5):
+    """Channel along the basin's long axis from the upstream (west, high) to downstream (east) edge."""
+    fx0, fy0, fx1, fy1 = BASIN_EXTENT
+    inset = 0.02 * (fx1 - fx0)
+    fy_mid = (fy0 + fy1) / 2.0
+    return [_at(transform, size, fx0 + inset + (fx1 - fx0 - 2 * inset) * i / (vertices - 1), fy_mid)
+            for i in range(vertices)]
+
+
+def reference_volumes(transform, size, params, depth=BASIN_DEPTH, side_slope=BASIN_SIDE_SLOPE, projected=True):
+    """
+    Exact volumes for the rectangular basin (no longitudinal slope).
+
+    The cut is relative to existing ground with a side-slope band of horizontal
+    width o = depth * side_slope (as in apply_basin_to_dem), so for a W×L
+    rectangle the cut is V = (d/o) ∫₀ᵀ (W-2t)(L-2t) dt with T = min(o, min(W,L)/2).
+    """
+    if not projected:
+        return {"note": "Reference volumes are only defined for projected CRSs (metres)."}
+    poly = basin_polygon(transform, size)
+    xs, ys = [p[0] for p in poly], [p[1] for p in poly]
+    width, length = max(xs) - min(xs), max(ys) - min(ys)
+    offset = depth * side_slope
+    t = min(offset, min(width, length) / 2.0)
+    cut = (depth / offset) * (width * length * t - (width + length) * t ** 2 + (4.0 / 3.0) * t ** 3)
+    result = {
+        "basin_width_m": width,
+        "basin_length_m": length,
+        "basin_depth_m": depth,
+        "basin_side_slope_h_per_v": side_slope,
+        "outer_area_m2": width * length,
+        "inner_area_m2": max(0.0, width - 2 * offset) * max(0.0, length - 2 * offset),
+        "basin_cut_volume_m3": cut,
+    }
+    if params["kind"] == "planar":
+        # Plane: volume above datum over the rectangle = area × elevation at its centroid
+        fx_c = (BASIN_EXTENT[0] + BASIN_EXTENT[2]) / 2.0
+        fy_c = (BASIN_EXTENT[1] + BASIN_EXTENT[3]) / 2.0
+        col_c, row_c = fx_c * size - 0.5, (1.0 - fy_c) * size - 0.5
+        z_c = float(terrain_tile(np.array([row_c]), np.array([col_c]), params)[0])
+        result["terrain_volume_above_datum_m3"] = width * length * z_c
+    return result
+
+
+def write_vectors(out_dir, crs, profile_coords, basin_coords, channel_coords, kernels):
+    """Write profile, basin and channel as Shapefile ZIP, KML and KMZ using the app's exporters."""
+    from pyproj import Transformer
+
+    to_wgs84 = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+
+    def lonlat(coords):
+        xs, ys = to_wgs84.transform([c[0] for c in coords], [c[1] for c in coords])
+        return list(zip(xs, ys))
+
+    written = []
+    layers = [
+        ("profile", profile_coords, kernels.export_line_to_shapefile, kernels.export_line_to_kml),
+        ("basin", basin_coords, kernels.export_polygon_to_shapefile, kernels.export_polygon_to_kml),
+        ("channel", channel_coords, kernels.export_line_to_shapefile, kernels.export_line_to_kml),
+    ]
+    for name, coords, to_shp, to_kml in layers:
+        shp_bytes = to_shp(coords, crs) if kernels.HAS_GEOPANDAS else None
+        if shp_bytes:
+            (out_dir / f"{name}.zip").write_bytes(shp_bytes)
+            written.append(f"{name}.zip")
+        kml_bytes = to_kml(lonlat(coords))
+        if kml_bytes:
+            (out_dir / f"{name}.kml").write_bytes(kml_bytes)
+            with zipfile.ZipFile(out_dir / f"{name}.kmz", "w", zipfile.ZIP_DEFLATED) as kmz:
+                kmz.writestr("doc.kml", kml_bytes)
+            written += [f"{name}.kml", f"{name}.kmz"]
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1024, help="DEM edge length in cells (1000 to 20000+)")
+    parser.add_argument("--kind", choices=["planar", "fractal"], default="fractal")
+    parser.add_argument("--cell-size", type=float, default=1.0, help="Cell size in CRS units")
+    parser.add_argument("--crs", default="EPSG:32611")
+    parser.add_argument("--holes", type=int, default=3, help="Number of circular nodata holes")
+    parser.add_argument("--nodata", type=float, default=DEFAULT_NODATA)
+    parser.add_argument("--slope", type=float, default=0.05, help="Plane gradient (m/m)")
+    parser.add_argument("--relief", type=float, default=40.0, help="Fractal amplitude of the first octave (m)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="synthetic", help="Output directory")
+    args = parser.parse_args(argv)
+
+    from pyproj import CRS
+    from bench_kernels import load_kernels
+
+    kernels = load_kernels()
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    transform = write_dem(out_dir / "dem.tif", args.size, args.kind, args.cell_size, args.holes, args.nodata,
+                          args.crs, args.seed, args.slope, args.relief, kernels=kernels)
+    params = terrain_params(args.size, args.kind, args.cell_size, args.slope, args.relief, args.seed)
+    profile_coords = profile_line(transform, args.size)
+    basin_coords = basin_polygon(transform, args.size)
+    channel_coords = channel_line(transform, args.size)
+    written = ["dem.tif"] + write_vectors(out_dir, args.crs, profile_coords, basin_coords, channel_coords, kernels)
+
+    reference = {
+        "size": args.size, "kind": args.kind, "cell_size": args.cell_size, "crs": args.crs,
+        "nodata": args.nodata, "holes": args.holes, "seed": args.seed,
+        "volumes": reference_volumes(transform, args.size, params,
+                                     projected=not CRS.from_user_input(args.crs).is_geographic),
+        "files": written,
+    }
+    (out_dir / "reference.json").write_text(json.dumps(reference, indent=2), encoding="utf-8")
+    print(json.dumps(reference, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Cross-section sheet rendering for terrain_editor.py.
+
+Matplotlib drawing holds the GIL, so export_section_sheets() renders sheets in worker
+processes; the renderer lives in this importable module (the app file is a Streamlit
+script) and keeps one figure per layout per process, updating its artists for each
+sheet instead of rebuilding the figure.
+"""
+
+import io
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.ticker import MaxNLocator
+
+SECTION_SHEET_SIZE_IN = (11.69, 8.27)  # A4 landscape
+
+# Figures reused across sheets in this process, keyed by (rows, columns)
+_SHEET_FIGURES = {}
+
+
+def _sheet_figure(n_rows, ncols):
+    """Figure, axes and per-axes artists for a sheet layout, created once per process."""
+    key = (n_rows, ncols)
+    if key in _SHEET_FIGURES:
+        return _SHEET_FIGURES[key]
+    fig = Figure(figsize=SECTION_SHEET_SIZE_IN)
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(n_rows, ncols, squeeze=False).ravel()
+    # Fixed margins: tight_layout measures every tick label and costs about half a sheet
+    fig.subplots_adjust(left=0.07, right=0.985, bottom=0.08, top=0.91, wspace=0.14, hspace=0.42)
+    fig.supxlabel("Offset (m)", fontsize=8)
+    fig.supylabel("Elevation (m)", fontsize=8)
+    title = fig.suptitle("", fontsize=10)
+    artists = []
+    for ax in axes:
+        existing, = ax.plot([], [], color="#8b5a2b", lw=1.0, label="Existing")
+        template, = ax.plot([], [], color="#ff6600", lw=0.8, ls="--", label="Template")
+        final, = ax.plot([], [], color="#000000", lw=1.2, label="Final")
+        label = ax.text(0.01, 0.02, "", transform=ax.transAxes, fontsize=6.5, va="bottom")
+        ax.tick_params(labelsize=6)
+        ax.xaxis.set_major_locator(MaxNLocator(6))
+        ax.yaxis.set_major_locator(MaxNLocator(5))
+        ax.grid(True, lw=0.3, alpha=0.5)
+        artists.append({"lines": (existing, template, final), "label": label, "fills": []})
+    axes[0].legend(fontsize=6, loc="upper right")
+    _SHEET_FIGURES[key] = (fig, axes, artists, title)
+    return _SHEET_FIGURES[key]
+
+
+def render_section_sheet(panels, offsets, sheet_number, n_sheets, fmt="pdf", ncols=2, dpi=150):
+    """
+    One sheet of cross-section panels as PDF or PNG bytes.
+
+    Each panel dict holds "index", "chainage", "z_crest", "z_exist", "z_design",
+    "z_final" and "areas" (cut, fill, berm, ditch).
+    """
+    n_rows = max(int(np.ceil(len(panels) / ncols)), 1)
+    fig, axes, artists, title = _sheet_figure(n_rows, ncols)
+    for ax, art in zip(axes, artists):
+        for fill in art["fills"]:
+            fill.remove()
+        art["fills"] = []
+    for ax, art, panel in zip(axes, artists, panels):
+        z_exist, z_final = panel["z_exist"], panel["z_final"]
+        for line, z in zip(art["lines"], (z_exist, panel["z_design"], z_final)):
+            line.set_data(offsets, z)
+        art["fills"] = [
+            ax.fill_between(offsets, z_exist, z_final, where=z_final > z_exist,
+                            color="#2166ac", alpha=0.3, lw=0, interpolate=True),
+            ax.fill_between(offsets, z_exist, z_final, where=z_final < z_exist,
+                            color="#b2182b", alpha=0.3, lw=0, interpolate=True),
+        ]
+        cut, fill, berm, ditch = panel["areas"]
+        ax.set_title(f"S{panel['index']} — {panel['chainage']:.1f} m (crest {panel['z_crest']:.2f} m)", fontsize=8)
+        art["label"].set_text(f"Cut {cut:.2f} m²  Fill {fill:.2f} m²  Berm {berm:.2f} m²  Ditch {ditch:.2f} m²")
+        ax.relim()
+        ax.autoscale_view()
+        ax.set_visible(True)
+    for ax in axes[len(panels):]:
+        ax.set_visible(False)
+    title.set_text(f"Cross-sections — sheet {sheet_number} of {n_sheets}")
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fmt, dpi=dpi)
+    return buffer.getvalue()
+
+
+def render_section_sheet_job(job):
+    """render_section_sheet() for one (panels, offsets, sheet_number, n_sheets, fmt, dpi) job (process pool entry point)."""
+    panels, offsets, sheet_number, n_sheets, fmt, dpi = job
+    return render_section_sheet(panels, offsets, sheet_number, n_sheets, fmt=fmt, dpi=dpi)
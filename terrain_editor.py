@@ -23,7 +23,7 @@ import io
 import numpy as np
 import pandas as pd
 import rasterio
-from rasterio.transform import xy, rowcol, array_bounds, from_bounds
+from rasterio.transform import Affine, rowcol, array_bounds, from_bounds
 from rasterio.io import MemoryFile
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 from pyproj import CRS, Transformer
@@ -32,20 +32,73 @@ import folium
 from streamlit_folium import st_folium
 from folium.plugins import Draw
 from shapely.geometry import LineString
+import shapely
 import plotly.graph_objects as go
 import zipfile
 import tempfile
+import base64
+import copy
+import hashlib
+import heapq
+import json
+import pickle
+import struct
+import sys
+import time
+import uuid
+import tracemalloc
+import multiprocessing
 import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 try:
     import geopandas as gpd
     HAS_GEOPANDAS = True
 except ImportError:
     HAS_GEOPANDAS = False
-    try:
-        import fiona
-        HAS_FIONA = True
-    except ImportError:
-        HAS_FIONA = False
+
+try:
+    import fiona
+    HAS_FIONA = True
+except ImportError:
+    HAS_FIONA = False
+
+try:
+    import pyogrio
+    import pyogrio.raw
+    HAS_PYOGRIO = True
+except ImportError:
+    HAS_PYOGRIO = False
+
+try:
+    import resource
+    HAS_RESOURCE = True
+except ImportError:
+    HAS_RESOURCE = False
+
+try:
+    from scipy.spatial import Delaunay
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
+try:
+    from section_sheets import render_section_sheet_job
+    HAS_MATPLOTLIB = True
+except ImportError:
+    HAS_MATPLOTLIB = False
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    
+    def njit(*args, **kwargs):
+        """No-op stand-in for numba.njit: kernels run as plain Python."""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
 
 
 # --- IDW resampling helper (simple, neighborhood-based) ---
@@ -61,6 +114,7 @@ def idw_resample(src_array, src_transform, dst_transform, dst_height, dst_width,
     inv_src = ~src_transform
 
     src_h, src_w = src_array.shape
+    src_valid = dem_valid_mask(src_array, src_nodata)
 
     for rr in range(dst_height):
         for cc in range(dst_width):
@@ -82,9 +136,9 @@ def idw_resample(src_array, src_transform, dst_transform, dst_height, dst_width,
                     c_src = c0 + dc
                     if r_src < 0 or c_src < 0 or r_src >= src_h or c_src >= src_w:
                         continue
-                    val = src_array[r_src, c_src]
-                    if src_nodata is not None and (np.isnan(val) or val == src_nodata):
+                    if not src_valid[r_src, c_src]:
                         continue
+                    val = src_array[r_src, c_src]
                     # compute distance in pixel-space
                     dist = math.hypot(src_row_f - r_src, src_col_f - c_src)
                     if dist < 1e-8:
@@ -382,6 +436,19 @@ st.markdown("""
         color: #666666 !important;
     }
     
+    /* ============================================================================ */
+    /* VIEW SELECTOR - TAB BAR REPLACEMENT */
+    /* ============================================================================ */
+    .st-key-active_view label p {
+        font-size: 1.15rem !important;
+        font-weight: 700 !important;
+    }
+    
+    /* Inactive views stay mounted (widget state) but are not shown */
+    [class*="st-key-hidden_view_"] {
+        display: none !important;
+    }
+    
     /* ============================================================================ */
     /* RADIO BUTTONS & CHECKBOXES */
     /* ============================================================================ */
@@ -435,6 +502,73 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# ============================================================================
+# COORDINATE TRANSFORM FUNCTIONS
+# ============================================================================
+
+# Memoized coordinate transforms kept per session (least recently used dropped first)
+TRANSFORM_MEMO_MAX_ENTRIES = 64
+
+def crs_cache_key(crs):
+    """Hashable identity of a CRS given as a pyproj/rasterio CRS, EPSG code or user string."""
+    return CRS.from_user_input(crs).to_wkt()
+
+def get_transformer(src_crs, dst_crs):
+    """
+    always_xy Transformer for a CRS pair from the session's transformer registry.
+    Each pair is built once per session instead of on every rerun.
+    """
+    registry = st.session_state.setdefault("transformer_registry", {})
+    key = (crs_cache_key(src_crs), crs_cache_key(dst_crs))
+    transformer = registry.get(key)
+    if transformer is None:
+        transformer = Transformer.from_crs(CRS.from_user_input(src_crs), CRS.from_user_input(dst_crs), always_xy=True)
+        registry[key] = transformer
+    return transformer
+
+def transform_coords(coords, src_crs, dst_crs):
+    """
+    Transform a whole coordinate sequence ((n, 2+) array or list of [x, y, ...]) in one call.
+    
+    Results are memoized per geometry hash and CRS pair, so unchanged alignments, polygons
+    and channels are not re-transformed on every rerun.
+    
+    Returns:
+        (n, 2) float64 array (a copy, safe to modify)
+    """
+    points = np.asarray(coords, dtype=np.float64)
+    if points.size == 0:
+        return np.empty((0, 2))
+    points = np.ascontiguousarray(points.reshape(len(points), -1)[:, :2])
+    
+    from collections import OrderedDict
+    memo = st.session_state.setdefault("transform_memo", OrderedDict())
+    key = (hashlib.blake2b(points.tobytes(), digest_size=16).hexdigest(), crs_cache_key(src_crs), crs_cache_key(dst_crs))
+    result = memo.get(key)
+    if result is None:
+        xs, ys = get_transformer(src_crs, dst_crs).transform(points[:, 0], points[:, 1])
+        result = np.column_stack([xs, ys])
+        memo[key] = result
+        while len(memo) > TRANSFORM_MEMO_MAX_ENTRIES:
+            memo.popitem(last=False)
+    else:
+        memo.move_to_end(key)
+    return result.copy()
+
+def offset_lines(center_xy, normals, offsets, src_crs, dst_crs):
+    """
+    Points offset perpendicular to the alignment at every station, for several offsets,
+    transformed in one batched call.
+    
+    Returns:
+        (n_offsets, n_stations, 2) array of [lat, lon]
+    """
+    center_xy, normals = np.asarray(center_xy, dtype=np.float64), np.asarray(normals, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.float64)
+    pts = center_xy[None, :, :] + offsets[:, None, None] * normals[None, :, :]
+    lonlat = transform_coords(pts.reshape(-1, 2), src_crs, dst_crs)
+    return lonlat[:, ::-1].reshape(len(offsets), len(center_xy), 2)
+
 # ============================================================================
 # FILE UPLOAD PROCESSING FUNCTIONS
 # ============================================================================
@@ -454,152 +588,267 @@ def process_uploaded_dem(uploaded_file):
         st.error(f"Error processing uploaded DEM: {e}")
         return None, None
 
+def _vector_payload(content, filename):
+    """
+    Bytes GDAL can open from /vsimem/ and the layer to read.
+    Zipped shapefiles stay zipped (GDAL reads them through /vsizip/); a shapefile in a
+    sub-folder is re-packed flat in memory. A KMZ yields its KML member, read from the zip.
+    """
+    name = filename.lower()
+    if name.endswith('.zip'):
+        with zipfile.ZipFile(io.BytesIO(content), 'r') as zip_ref:
+            shp_members = [n for n in zip_ref.namelist() if n.lower().endswith('.shp')]
+            if not shp_members:
+                raise ValueError("No .shp file found in uploaded ZIP")
+            shp_member = shp_members[0]
+            stem = shp_member[:-4]
+            layer = Path(stem).name
+            if len(shp_members) == 1 and '/' not in shp_member:
+                return content, layer
+            flat = io.BytesIO()
+            with zipfile.ZipFile(flat, 'w', zipfile.ZIP_STORED) as flat_zip:
+                for member in zip_ref.namelist():
+                    if member.rsplit('.', 1)[0] == stem:
+                        flat_zip.writestr(Path(member).name, zip_ref.read(member))
+            return flat.getvalue(), layer
+    if name.endswith('.kmz'):
+        with zipfile.ZipFile(io.BytesIO(content), 'r') as zip_ref:
+            kml_members = [n for n in zip_ref.namelist() if n.lower().endswith('.kml')]
+            if not kml_members:
+                raise ValueError("No KML file found in KMZ archive")
+            return zip_ref.read(kml_members[0]), None
+    return content, None
+
+def read_vector_upload(uploaded_file):
+    """
+    Read an uploaded vector file (Shapefile ZIP, KML, KMZ, GeoJSON) straight from memory.
+    
+    The upload is opened through GDAL's /vsimem/ (and /vsizip/ for zips) with pyogrio's
+    columnar reader, geometries are decoded from WKB in one vectorized call, and no
+    temp files or extracted folders are written. Without pyogrio, KML/KMZ go through
+    read_kml_geometries() and other formats through fiona's in-memory files.
+    
+    Returns:
+        geometries: ndarray of shapely geometries (None for empty records)
+        attributes: DataFrame of the attribute columns
+        crs: pyproj CRS or None
+    """
+    payload, layer = _vector_payload(uploaded_file.getvalue(), uploaded_file.name)
+    if HAS_PYOGRIO:
+        meta, _, wkb, field_data = pyogrio.raw.read(payload, layer=layer)
+        geometries = shapely.from_wkb(wkb)
+        attributes = pd.DataFrame({field: values for field, values in zip(meta["fields"], field_data)})
+        crs = CRS.from_user_input(meta["crs"]) if meta.get("crs") else None
+        return geometries, attributes, crs
+    if uploaded_file.name.lower().endswith(('.kml', '.kmz')):
+        # fiona ships without GDAL's KML driver: use the streaming KML parser
+        return read_kml_geometries(payload)
+    if HAS_FIONA:
+        from fiona.io import MemoryFile, ZipMemoryFile
+        from shapely.geometry import shape
+        is_zip = payload[:4] == b"PK\x03\x04"
+        with (ZipMemoryFile(payload) if is_zip else MemoryFile(payload)) as memfile:
+            with (memfile.open(f"{layer}.shp") if is_zip else memfile.open()) as src:
+                crs = CRS.from_user_input(src.crs_wkt) if src.crs_wkt else None
+                records = list(src)
+        geometries = np.array([shape(r['geometry']) if r['geometry'] is not None else None for r in records],
+                              dtype=object)
+        attributes = pd.DataFrame([dict(r['properties']) for r in records])
+        return geometries, attributes, crs
+    raise ImportError("pyogrio or fiona required for vector files. Install with: pip install geopandas")
+
+def first_part_coords(geometries, kind):
+    """
+    Coordinates of the first line ("line") or polygon exterior ("polygon") among geometries,
+    with multi-part geometries split into parts, and the number of such parts.
+    """
+    type_ids = (1, 5) if kind == "line" else (3, 6)  # (Multi)LineString / (Multi)Polygon
+    geometries = np.asarray(geometries, dtype=object)
+    present = shapely.is_geometry(geometries)
+    selected = geometries[present][np.isin(shapely.get_type_id(geometries[present]), type_ids)]
+    parts = shapely.get_parts(selected)
+    if parts.size == 0:
+        return [], 0
+    first = parts[0] if kind == "line" else shapely.get_exterior_ring(parts[0])
+    coords = shapely.get_coordinates(first)
+    return list(zip(coords[:, 0].tolist(), coords[:, 1].tolist())), int(parts.size)
+
+def vector_upload_to_geodataframe(uploaded_file):
+    """read_vector_upload() as a GeoDataFrame in WGS84 for map display."""
+    geometries, attributes, crs = read_vector_upload(uploaded_file)
+    gdf = gpd.GeoDataFrame(attributes, geometry=gpd.GeoSeries(geometries, crs=crs))
+    if gdf.crs and gdf.crs != "EPSG:4326":
+        gdf = gdf.to_crs("EPSG:4326")
+    return gdf
+
 def process_uploaded_shapefile(uploaded_file):
     """Process uploaded shapefile ZIP and extract LineString geometry with CRS info."""
     try:
-        # Save uploaded file to temporary location
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as tmp_file:
-            tmp_file.write(uploaded_file.read())
-            tmp_zip_path = tmp_file.name
+        if not (HAS_PYOGRIO or HAS_FIONA):
+            st.error("geopandas or fiona required for shapefile support. Install with: pip install geopandas")
+            return None
+        geometries, _, shapefile_crs = read_vector_upload(uploaded_file)
         
-        # Extract ZIP to temporary directory
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            with zipfile.ZipFile(tmp_zip_path, 'r') as zip_ref:
-                zip_ref.extractall(tmp_dir)
-            
-            # Find .shp file
-            shp_files = list(Path(tmp_dir).glob('*.shp'))
-            if not shp_files:
-                st.error("No .shp file found in uploaded ZIP")
-                return None
-            
-            shp_path = shp_files[0]
-            
-            # Read shapefile
-            if HAS_GEOPANDAS:
-                gdf = gpd.read_file(str(shp_path))
-                # Get CRS
-                shapefile_crs = gdf.crs
-                
-                # Extract LineString coordinates
-                coords_list = []
-                for idx, row in gdf.iterrows():
-                    geom = row.geometry
-                    if geom.geom_type == 'LineString':
-                        coords_list.extend(list(geom.coords))
-                    elif geom.geom_type == 'MultiLineString':
-                        for line in geom.geoms:
-                            coords_list.extend(list(line.coords))
-                
-                if coords_list:
-                    # Return coordinates with CRS info as a tuple
-                    return (coords_list, shapefile_crs)
-                else:
-                    st.error("No LineString geometry found in shapefile")
-                    return None
-                    
-            elif HAS_FIONA:
-                import fiona
-                from shapely.geometry import shape
-                coords_list = []
-                shapefile_crs = None
-                with fiona.open(str(shp_path)) as src:
-                    # Get CRS from shapefile
-                    if src.crs:
-                        shapefile_crs = CRS.from_string(str(src.crs))
-                    for feature in src:
-                        geom = shape(feature['geometry'])
-                        if geom.geom_type == 'LineString':
-                            coords_list.extend(list(geom.coords))
-                        elif geom.geom_type == 'MultiLineString':
-                            for line in geom.geoms:
-                                coords_list.extend(list(line.coords))
-                if coords_list:
-                    return (coords_list, shapefile_crs)
-                return None
-            else:
-                st.error("geopandas or fiona required for shapefile support. Install with: pip install geopandas")
-                return None
+        # Coordinates of the first line feature
+        # (concatenating separate features would join unrelated lines)
+        coords_list, n_lines = first_part_coords(geometries, "line")
+        if n_lines > 1:
+            st.info(f"Shapefile has {n_lines} lines; the first is used as the profile. "
+                    "Import all of them as project features in the Project tab.")
+        
+        if coords_list:
+            # Return coordinates with CRS info as a tuple
+            return (coords_list, shapefile_crs)
+        else:
+            st.error("No LineString geometry found in shapefile")
+            return None
                 
     except Exception as e:
         st.error(f"Error processing uploaded shapefile: {e}")
         return None
 
-def process_uploaded_kml(uploaded_file):
-    """Process uploaded KML/KMZ file and extract LineString coordinates."""
-    try:
-        # Read file content
-        content = uploaded_file.read()
-        uploaded_file.seek(0)  # Reset file pointer
-
-        # Check if it's a KMZ file (ZIP archive)
-        if uploaded_file.name.lower().endswith('.kmz'):
-            import tempfile
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                # Save KMZ to temp file
-                kmz_path = os.path.join(tmp_dir, 'temp.kmz')
-                with open(kmz_path, 'wb') as f:
-                    f.write(content)
-
-                # Extract KMZ (it's a ZIP file)
-                with zipfile.ZipFile(kmz_path, 'r') as zip_ref:
-                    zip_ref.extractall(tmp_dir)
-
-                # Find KML file in extracted content
-                kml_files = list(Path(tmp_dir).glob('*.kml'))
-                if not kml_files:
-                    kml_files = list(Path(tmp_dir).glob('**/*.kml'))
-
-                if not kml_files:
-                    st.error("No KML file found in KMZ archive")
-                    return None
-
-                # Read the KML content
-                with open(kml_files[0], 'r', encoding='utf-8') as f:
-                    content = f.read().encode('utf-8')
-
-        # Parse KML XML
-        root = ET.fromstring(content)
-
-        # Try different namespace formats
-        namespaces = [
-            {'kml': 'http://www.opengis.net/kml/2.2'},
-            {'kml': 'http://earth.google.com/kml/2.0'},
-            {'kml': 'http://earth.google.com/kml/2.1'},
-            {}  # No namespace
-        ]
-
-        coords_list = []
+KML_GEOMETRY_TAGS = ("Point", "LineString", "LinearRing")
 
-        # Try each namespace
-        for ns in namespaces:
+def parse_kml_coordinates(text):
+    """
+    Parse a KML <coordinates> block ("lon,lat[,alt] lon,lat[,alt] ...") into an (n, 2)
+    float64 array in one NumPy conversion; malformed tuples are skipped.
+    """
+    tuples = text.split() if text else []
+    if not tuples:
+        return np.empty((0, 2))
+    # Fast path only when every tuple has the same arity, so reshaping cannot
+    # regroup values across tuples (e.g. "1,2,3 4" must not become [[1, 2], [3, 4]])
+    commas = np.char.count(np.array(tuples), ',')
+    arity = int(commas[0]) + 1
+    values = text.replace(',', ' ').split()
+    if arity >= 2 and np.all(commas == commas[0]) and len(values) == len(tuples) * arity:
+        try:
+            return np.array(values, dtype=np.float64).reshape(len(tuples), arity)[:, :2]
+        except ValueError:
+            pass
+    # Mixed dimensions or bad tokens: parse tuple by tuple
+    coords = []
+    for coord in tuples:
+        parts = coord.split(',')
+        if len(parts) >= 2:
             try:
-                # Find all coordinates elements
-                if ns:
-                    coord_elems = root.findall('.//kml:coordinates', ns)
-                else:
-                    # Try without namespace
-                    coord_elems = root.findall('.//coordinates')
-
-                if coord_elems:
-                    for coord_elem in coord_elems:
-                        coord_text = coord_elem.text.strip() if coord_elem.text else ""
-                        # Parse coordinates (lon,lat,alt or lon,lat)
-                        for coord_line in coord_text.split():
-                            parts = coord_line.split(',')
-                            if len(parts) >= 2:
-                                try:
-                                    lon = float(parts[0].strip())
-                                    lat = float(parts[1].strip())
-                                    coords_list.append((lon, lat))
-                                except ValueError:
-                                    continue
-                    break  # Successfully found coordinates
-            except Exception:
+                coords.append((float(parts[0]), float(parts[1])))
+            except ValueError:
                 continue
+    return np.array(coords, dtype=np.float64).reshape(-1, 2)
 
-        if coords_list:
-            return coords_list
+def iter_kml_placemarks(stream):
+    """
+    Stream the Placemarks of a KML document with iterparse.
+    
+    The namespace is taken once from the root element; each Placemark is yielded as
+    soon as it closes and then cleared, so memory stays bounded by one Placemark.
+    
+    Yields:
+        dict with "name" and "geometries": a list of (geom_type, ring, coords) per
+        coordinate block, geom_type in KML_GEOMETRY_TAGS, ring "outer"/"inner" for
+        polygon boundaries (None otherwise) and coords an (n, 2) lon/lat array
+    """
+    ns = None
+    stack = []
+    placemark = None
+    for event, elem in ET.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            if ns is None:
+                ns = elem.tag[:elem.tag.index('}') + 1] if elem.tag.startswith('{') else ""
+            tag = elem.tag[len(ns):] if elem.tag.startswith(ns) else elem.tag.rsplit('}', 1)[-1]
+            stack.append(tag)
+            if tag == "Placemark":
+                placemark = {"name": None, "geometries": []}
+            continue
+        
+        tag = stack.pop()
+        if placemark is None:
+            continue
+        if tag == "name" and stack and stack[-1] == "Placemark":
+            placemark["name"] = (elem.text or "").strip() or None
+        elif tag == "coordinates":
+            geom_type = next((t for t in reversed(stack) if t in KML_GEOMETRY_TAGS), None)
+            ring = "outer" if "outerBoundaryIs" in stack else "inner" if "innerBoundaryIs" in stack else None
+            placemark["geometries"].append((geom_type, ring, parse_kml_coordinates(elem.text)))
+        elif tag == "Placemark":
+            yield placemark
+            placemark = None
+            elem.clear()
+
+def iter_kml_upload(content, filename):
+    """iter_kml_placemarks() over an uploaded KML, or the KML member of a KMZ read straight from the zip."""
+    if filename.lower().endswith('.kmz'):
+        with zipfile.ZipFile(io.BytesIO(content), 'r') as zip_ref:
+            kml_members = [n for n in zip_ref.namelist() if n.lower().endswith('.kml')]
+            if not kml_members:
+                raise ValueError("No KML file found in KMZ archive")
+            with zip_ref.open(kml_members[0]) as kml_stream:
+                yield from iter_kml_placemarks(kml_stream)
+    else:
+        yield from iter_kml_placemarks(io.BytesIO(content))
+
+def read_kml_geometries(kml_bytes):
+    """
+    read_vector_upload() result for a KML document parsed with iter_kml_placemarks():
+    one geometry per Placemark (Multi* or GeometryCollection when it has several parts),
+    polygons built from their outer and inner boundaries, a "Name" attribute and WGS84.
+    A bare LinearRing (outside a Polygon) is read as a polygon, as process_uploaded_features()
+    and process_uploaded_polygon_kml() do.
+    """
+    geometries, names = [], []
+    for placemark in iter_kml_placemarks(io.BytesIO(kml_bytes)):
+        # (geom_type, coords, holes); inner boundaries attach to the polygon before them
+        blocks = []
+        for geom_type, ring, coords in placemark["geometries"]:
+            if geom_type == "LinearRing" and ring == "inner":
+                if blocks and blocks[-1][0] == "LinearRing" and len(coords) >= 4:
+                    blocks[-1][2].append(coords)
+            elif geom_type == "Point" and len(coords):
+                blocks.append((geom_type, coords[0], []))
+            elif (geom_type == "LineString" and len(coords) >= 2) or (geom_type == "LinearRing" and len(coords) >= 4):
+                blocks.append((geom_type, coords, []))
+        parts = [
+            shapely.points(coords) if geom_type == "Point"
+            else shapely.linestrings(coords) if geom_type == "LineString"
+            else shapely.polygons(coords, holes=[shapely.linearrings(h) for h in holes] or None)
+            for geom_type, coords, holes in blocks
+        ]
+        if not parts:
+            geometry = None
+        elif len(parts) == 1:
+            geometry = parts[0]
+        elif len(set(shapely.get_type_id(parts).tolist())) == 1:
+            geometry = {0: shapely.multipoints, 1: shapely.multilinestrings, 3: shapely.multipolygons}[
+                int(shapely.get_type_id(parts[0]))](parts)
+        else:
+            geometry = shapely.geometrycollections(parts)
+        geometries.append(geometry)
+        names.append(placemark["name"])
+    return np.array(geometries, dtype=object), pd.DataFrame({"Name": names}), CRS.from_epsg(4326)
+
+def process_uploaded_kml(uploaded_file):
+    """Process uploaded KML/KMZ file and extract LineString coordinates (first line placemark)."""
+    try:
+        lines, other_blocks = [], []
+        for placemark in iter_kml_upload(uploaded_file.getvalue(), uploaded_file.name):
+            for geom_type, _, coords in placemark["geometries"]:
+                (lines if geom_type == "LineString" else other_blocks).append(coords)
+        
+        if lines:
+            coords = lines[0]
+            if len(lines) > 1:
+                st.info(f"KML has {len(lines)} lines; the first is used. "
+                        "Import all of them as project features in the Project tab.")
+        elif other_blocks:
+            # No LineString (e.g. a sequence of points): all coordinates in document order
+            coords = np.concatenate(other_blocks)
+        else:
+            coords = np.empty((0, 2))
+        
+        if len(coords):
+            return list(zip(coords[:, 0].tolist(), coords[:, 1].tolist()))
         else:
             st.error("No coordinates found in KML file")
             return None
@@ -611,153 +860,37 @@ def process_uploaded_kml(uploaded_file):
 def process_uploaded_polygon_shapefile(uploaded_file):
     """Process uploaded shapefile ZIP and extract Polygon geometry with CRS info."""
     try:
-        # Save uploaded file to temporary location
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as tmp_file:
-            tmp_file.write(uploaded_file.read())
-            tmp_zip_path = tmp_file.name
+        if not (HAS_PYOGRIO or HAS_FIONA):
+            st.error("geopandas or fiona required for shapefile support. Install with: pip install geopandas")
+            return None
+        geometries, _, shapefile_crs = read_vector_upload(uploaded_file)
         
-        # Extract ZIP to temporary directory
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            with zipfile.ZipFile(tmp_zip_path, 'r') as zip_ref:
-                zip_ref.extractall(tmp_dir)
-            
-            # Find .shp file
-            shp_files = list(Path(tmp_dir).glob('*.shp'))
-            if not shp_files:
-                st.error("No .shp file found in uploaded ZIP")
-                return None
-            
-            shp_path = shp_files[0]
-            
-            # Read shapefile
-            if HAS_GEOPANDAS:
-                gdf = gpd.read_file(str(shp_path))
-                # Get CRS
-                shapefile_crs = gdf.crs
-                
-                # Extract Polygon coordinates
-                coords_list = None
-                for idx, row in gdf.iterrows():
-                    geom = row.geometry
-                    if geom.geom_type == 'Polygon':
-                        # Get exterior ring coordinates as [lon, lat] pairs
-                        coords_list = list(geom.exterior.coords)
-                        break
-                    elif geom.geom_type == 'MultiPolygon':
-                        # Use first polygon
-                        coords_list = list(geom.geoms[0].exterior.coords)
-                        break
-                
-                if coords_list:
-                    # Return coordinates with CRS info as a tuple
-                    return (coords_list, shapefile_crs)
-                else:
-                    st.error("No Polygon geometry found in shapefile")
-                    return None
-                    
-            elif HAS_FIONA:
-                import fiona
-                from shapely.geometry import shape
-                coords_list = None
-                shapefile_crs = None
-                with fiona.open(str(shp_path)) as src:
-                    # Get CRS from shapefile
-                    if src.crs:
-                        shapefile_crs = CRS.from_string(str(src.crs))
-                    for feature in src:
-                        geom = shape(feature['geometry'])
-                        if geom.geom_type == 'Polygon':
-                            coords_list = list(geom.exterior.coords)
-                            break
-                        elif geom.geom_type == 'MultiPolygon':
-                            coords_list = list(geom.geoms[0].exterior.coords)
-                            break
-                if coords_list:
-                    return (coords_list, shapefile_crs)
-                return None
-            else:
-                st.error("geopandas or fiona required for shapefile support. Install with: pip install geopandas")
-                return None
+        # Exterior ring of the first polygon (first part of a MultiPolygon)
+        coords_list, _ = first_part_coords(geometries, "polygon")
+        
+        if coords_list:
+            # Return coordinates with CRS info as a tuple
+            return (coords_list, shapefile_crs)
+        else:
+            st.error("No Polygon geometry found in shapefile")
+            return None
                 
     except Exception as e:
         st.error(f"Error processing uploaded polygon shapefile: {e}")
         return None
 
 def process_uploaded_polygon_kml(uploaded_file):
-    """Process uploaded KML/KMZ file and extract Polygon coordinates."""
+    """Process uploaded KML/KMZ file and extract Polygon coordinates (outer boundary of the first polygon)."""
     try:
-        # Read file content
-        content = uploaded_file.read()
-        uploaded_file.seek(0)  # Reset file pointer
-
-        # Check if it's a KMZ file (ZIP archive)
-        if uploaded_file.name.lower().endswith('.kmz'):
-            import tempfile
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                # Save KMZ to temp file
-                kmz_path = os.path.join(tmp_dir, 'temp.kmz')
-                with open(kmz_path, 'wb') as f:
-                    f.write(content)
-
-                # Extract KMZ (it's a ZIP file)
-                with zipfile.ZipFile(kmz_path, 'r') as zip_ref:
-                    zip_ref.extractall(tmp_dir)
-
-                # Find KML file in extracted content
-                kml_files = list(Path(tmp_dir).glob('*.kml'))
-                if not kml_files:
-                    kml_files = list(Path(tmp_dir).glob('**/*.kml'))
-
-                if not kml_files:
-                    st.error("No KML file found in KMZ archive")
-                    return None
-
-                # Read the KML content
-                with open(kml_files[0], 'r', encoding='utf-8') as f:
-                    content = f.read().encode('utf-8')
-
-        # Parse KML XML
-        root = ET.fromstring(content)
-
-        # Try different namespace formats
-        namespaces = [
-            {'kml': 'http://www.opengis.net/kml/2.2'},
-            {'kml': 'http://earth.google.com/kml/2.0'},
-            {'kml': 'http://earth.google.com/kml/2.1'},
-            {}  # No namespace
-        ]
-
-        coords_list = []
-
-        # Try each namespace
-        for ns in namespaces:
-            try:
-                # Find all coordinates elements for Polygons
-                if ns:
-                    coord_elems = root.findall('.//kml:Polygon//kml:coordinates', ns)
-                else:
-                    # Try without namespace
-                    coord_elems = root.findall('.//Polygon//coordinates')
-
-                if coord_elems:
-                    for coord_elem in coord_elems:
-                        coord_text = coord_elem.text.strip() if coord_elem.text else ""
-                        # Parse coordinates (lon,lat,alt or lon,lat)
-                        for coord_line in coord_text.split():
-                            parts = coord_line.split(',')
-                            if len(parts) >= 2:
-                                try:
-                                    lon = float(parts[0].strip())
-                                    lat = float(parts[1].strip())
-                                    coords_list.append((lon, lat))
-                                except ValueError:
-                                    continue
-                    break  # Successfully found coordinates
-            except Exception:
-                continue
+        coords = None
+        for placemark in iter_kml_upload(uploaded_file.getvalue(), uploaded_file.name):
+            coords = next((c for geom_type, ring, c in placemark["geometries"]
+                           if geom_type == "LinearRing" and ring != "inner" and len(c)), None)
+            if coords is not None:
+                break
 
-        if coords_list:
-            return coords_list
+        if coords is not None:
+            return list(zip(coords[:, 0].tolist(), coords[:, 1].tolist()))
         else:
             st.error("No polygon coordinates found in KML file")
             return None
@@ -766,6 +899,63 @@ def process_uploaded_polygon_kml(uploaded_file):
         st.error(f"Error processing uploaded polygon KML: {e}")
         return None
 
+def process_uploaded_features(uploaded_file):
+    """
+    Process an uploaded Shapefile ZIP, KML or KMZ holding several features.
+    Returns a list of {"name", "geom_type" ("LineString"/"Polygon"), "coords" [(lon, lat), ...]}
+    with one entry per line or polygon (multi-part geometries are split), or None.
+    """
+    try:
+        name = uploaded_file.name.lower()
+        content = uploaded_file.read()
+        uploaded_file.seek(0)
+        features = []
+        
+        if name.endswith('.zip'):
+            if not (HAS_PYOGRIO or HAS_FIONA):
+                st.error("geopandas or fiona required for shapefile support. Install with: pip install geopandas")
+                return None
+            geometries, _, src_crs = read_vector_upload(uploaded_file)
+            keep = shapely.is_geometry(geometries)
+            fids, geometries = np.flatnonzero(keep), geometries[keep]
+            if src_crs is not None and src_crs != CRS.from_epsg(4326):
+                to_wgs84 = get_transformer(src_crs, CRS.from_epsg(4326))
+                geometries = shapely.transform(geometries, lambda pts: np.column_stack(to_wgs84.transform(pts[:, 0], pts[:, 1])))
+            parts, part_of = shapely.get_parts(geometries, return_index=True)
+            n_parts = np.bincount(part_of, minlength=len(geometries))
+            part_no = np.arange(len(parts)) - np.searchsorted(part_of, part_of)
+            type_ids = shapely.get_type_id(parts)
+            for part, owner, k, type_id in zip(parts, part_of, part_no, type_ids):
+                label = f"{fids[owner]}" if n_parts[owner] == 1 else f"{fids[owner]}.{k + 1}"
+                if type_id == 1:
+                    coords = shapely.get_coordinates(part)
+                    features.append({"name": label, "geom_type": "LineString", "coords": [tuple(c) for c in coords.tolist()]})
+                elif type_id == 3:
+                    coords = shapely.get_coordinates(shapely.get_exterior_ring(part))
+                    features.append({"name": label, "geom_type": "Polygon", "coords": [tuple(c) for c in coords.tolist()]})
+        elif name.endswith('.kmz') or name.endswith('.kml'):
+            for i, placemark in enumerate(iter_kml_upload(content, uploaded_file.name)):
+                label = placemark["name"] or str(i)
+                for geom_type, ring, coords in placemark["geometries"]:
+                    coords = list(zip(coords[:, 0].tolist(), coords[:, 1].tolist()))
+                    if geom_type == "LineString":
+                        features.append({"name": label, "geom_type": "LineString", "coords": coords})
+                    elif geom_type == "LinearRing" and ring != "inner":
+                        features.append({"name": label, "geom_type": "Polygon", "coords": coords})
+        else:
+            st.error("Unsupported file type (use Shapefile ZIP, KML or KMZ)")
+            return None
+        
+        features = [f for f in features
+                    if len(f["coords"]) >= (2 if f["geom_type"] == "LineString" else 3)]
+        if not features:
+            st.error("No line or polygon features found")
+            return None
+        return features
+    except Exception as e:
+        st.error(f"Error processing uploaded features: {e}")
+        return None
+
 def export_polygon_to_shapefile(coords_latlon, poly_crs=None):
     """Export polygon coordinates to Shapefile ZIP format."""
     try:
@@ -962,38 +1152,12 @@ def process_uploaded_contours(uploaded_file):
             st.error("GeoPandas not available - cannot process vector files")
             return None
         
-        if uploaded_file.name.lower().endswith('.zip'):
-            # Shapefile
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                zip_path = os.path.join(tmp_dir, "upload.zip")
-                with open(zip_path, 'wb') as f:
-                    f.write(uploaded_file.getvalue())
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(tmp_dir)
-                
-                # Find .shp file
-                shp_files = [f for f in os.listdir(tmp_dir) if f.lower().endswith('.shp')]
-                if not shp_files:
-                    st.error("No .shp file found in ZIP")
-                    return None
-                
-                shp_path = os.path.join(tmp_dir, shp_files[0])
-                gdf = gpd.read_file(shp_path)
-                # Reproject to WGS84 for map display
-                if gdf.crs and gdf.crs != "EPSG:4326":
-                    gdf = gdf.to_crs("EPSG:4326")
-                return gdf
-        
-        elif uploaded_file.name.lower().endswith(('.kml', '.kmz')):
-            # KML/KMZ
-            gdf = gpd.read_file(uploaded_file, driver='KML')
-            if gdf.crs and gdf.crs != "EPSG:4326":
-                gdf = gdf.to_crs("EPSG:4326")
-            return gdf
-        
-        else:
+        if not uploaded_file.name.lower().endswith(('.zip', '.kml', '.kmz')):
             st.error("Unsupported format - use Shapefile ZIP, KML, or KMZ")
             return None
+        
+        # Read in memory and reproject to WGS84 for map display
+        return vector_upload_to_geodataframe(uploaded_file)
             
     except Exception as e:
         st.error(f"Error processing contours: {e}")
@@ -1006,46 +1170,252 @@ def process_uploaded_vector_layer(uploaded_file):
             st.error("GeoPandas not available - cannot process vector files")
             return None
         
-        if uploaded_file.name.lower().endswith('.zip'):
-            # Shapefile
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                zip_path = os.path.join(tmp_dir, "upload.zip")
-                with open(zip_path, 'wb') as f:
-                    f.write(uploaded_file.getvalue())
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(tmp_dir)
-                
-                shp_files = [f for f in os.listdir(tmp_dir) if f.lower().endswith('.shp')]
-                if not shp_files:
-                    st.error("No .shp file found in ZIP")
-                    return None
-                
-                shp_path = os.path.join(tmp_dir, shp_files[0])
-                gdf = gpd.read_file(shp_path)
-                if gdf.crs and gdf.crs != "EPSG:4326":
-                    gdf = gdf.to_crs("EPSG:4326")
-                return gdf
-        
-        elif uploaded_file.name.lower().endswith(('.kml', '.kmz')):
-            gdf = gpd.read_file(uploaded_file, driver='KML')
-            if gdf.crs and gdf.crs != "EPSG:4326":
-                gdf = gdf.to_crs("EPSG:4326")
-            return gdf
-        
-        elif uploaded_file.name.lower().endswith('.geojson'):
-            gdf = gpd.read_file(uploaded_file)
-            if gdf.crs and gdf.crs != "EPSG:4326":
-                gdf = gdf.to_crs("EPSG:4326")
-            return gdf
-        
-        else:
+        if not uploaded_file.name.lower().endswith(('.zip', '.kml', '.kmz', '.geojson')):
             st.error("Unsupported format - use Shapefile ZIP, KML, KMZ, or GeoJSON")
             return None
+        
+        # Read in memory and reproject to WGS84 for map display
+        return vector_upload_to_geodataframe(uploaded_file)
             
     except Exception as e:
         st.error(f"Error processing vector layer: {e}")
         return None
 
+# Simplification tolerances (m) of the contour display levels; 0 keeps full resolution
+CONTOUR_LOD_TOLERANCES_M = (0.0, 0.5, 2.0, 8.0, 32.0)
+
+def build_contour_lod(gdf, tolerances_m=CONTOUR_LOD_TOLERANCES_M):
+    """
+    Multi-resolution geometry of a contour layer (WGS84) for map display.
+    
+    The layer is simplified once per tolerance (vectorized over all features) and each
+    level is stored as a flat [lat, lon] coordinate array with part offsets and the
+    feature index of every part, so map building only slices arrays. Features are
+    simplified independently: each line stays valid, but neighbouring contours may
+    cross where they are closer than the tolerance.
+    
+    Returns:
+        dict with "levels" (one dict per tolerance: "tolerance_m", "latlon", "offsets",
+        "part_feature", "n_vertices"), "extent_m" and "n_features"
+    """
+    geoms = gdf.geometry.to_numpy()
+    present = np.flatnonzero(shapely.is_geometry(geoms))
+    geoms = geoms[present]
+    minx, miny, maxx, maxy = shapely.total_bounds(geoms) if len(geoms) else (0.0, 0.0, 0.0, 0.0)
+    m_per_deg = 111320.0
+    extent_m = max((maxx - minx) * m_per_deg * np.cos(np.radians((miny + maxy) / 2)), (maxy - miny) * m_per_deg)
+    
+    levels = []
+    for tolerance_m in tolerances_m:
+        # Tolerance in degrees of latitude (never coarser than requested in longitude)
+        simplified = geoms if tolerance_m == 0 else shapely.simplify(geoms, tolerance_m / m_per_deg, preserve_topology=True)
+        parts, part_feature = shapely.get_parts(simplified, return_index=True)
+        lines = shapely.get_type_id(parts) == 1
+        parts, part_feature = parts[lines], part_feature[lines]
+        vertices, part_of = shapely.get_coordinates(parts, return_index=True)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(part_of, minlength=len(parts)))]).astype(np.int64)
+        levels.append({
+            "tolerance_m": float(tolerance_m),
+            "latlon": np.ascontiguousarray(vertices[:, ::-1]),
+            "offsets": offsets,
+            "part_feature": present[part_feature].astype(np.int64),
+            "n_vertices": int(len(vertices)),
+        })
+    return {"levels": levels, "extent_m": float(extent_m), "n_features": int(len(gdf))}
+
+def cached_contour_lod(gdf, layer_key):
+    """build_contour_lod() kept in session state until a different contour layer is loaded."""
+    cached = st.session_state.get("contours_lod")
+    if cached is not None and cached["key"] == layer_key:
+        return cached["lod"]
+    lod = build_contour_lod(gdf)
+    st.session_state.contours_lod = {"key": layer_key, "lod": lod}
+    return lod
+
+def contour_lod_level(lod, detail="Auto", screen_px=1000):
+    """
+    Display level for a detail setting: "Full", a tolerance label such as "2 m", or "Auto" -
+    the coarsest level whose tolerance stays within one screen pixel of ground distance
+    when the whole layer spans screen_px pixels (the map zooms to the layer extent on
+    upload), so simplification and any crossings it introduces stay below a pixel.
+    """
+    levels = lod["levels"]
+    if detail == "Full":
+        return levels[0]
+    for level in levels:
+        if detail == f"{level['tolerance_m']:g} m":
+            return level
+    pixel_m = lod["extent_m"] / screen_px
+    within = [level for level in levels if level["tolerance_m"] <= pixel_m]
+    return within[-1] if within else levels[0]
+
+def contour_index_flags(values, index_interval):
+    """Index-contour flags for an array of contour values (multiples of index_interval)."""
+    values = pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype=np.float64)
+    if index_interval <= 0:
+        return np.zeros(values.shape, dtype=bool)
+    remainder = np.mod(values, index_interval)
+    with np.errstate(invalid="ignore"):
+        return np.isfinite(values) & (np.isclose(remainder, 0.0) | np.isclose(remainder, index_interval))
+
+# Rows per tile of DEM contour extraction (tiles are processed in parallel)
+DEM_CONTOUR_TILE_ROWS = 512
+
+def _marching_squares_tile(z, row0, col0, base, interval):
+    """
+    Contour segments of one DEM tile by marching squares.
+    
+    z is the tile (NaN outside the valid footprint) whose first row/column are the global
+    row0/col0; consecutive tiles share one row so every cell belongs to exactly one tile.
+    All (cell, level) crossings are gathered in one vectorized pass, levels being
+    base + k * interval. Saddle cells are resolved with the cell-centre average.
+    
+    Returns:
+        (segments (n, 2, 2) in global (col, row) pixel-centre units, level index per segment)
+    """
+    a, b = z[:-1, :-1], z[:-1, 1:]   # top-left, top-right
+    d, c = z[1:, :-1], z[1:, 1:]     # bottom-left, bottom-right
+    with np.errstate(invalid="ignore"):
+        cmin = np.fmin(np.fmin(a, b), np.fmin(c, d))
+        cmax = np.fmax(np.fmax(a, b), np.fmax(c, d))
+        complete = np.isfinite(a) & np.isfinite(b) & np.isfinite(c) & np.isfinite(d)
+        # Levels L with cmin <= L < cmax cross the cell ("above" means z > L)
+        k_lo = np.ceil((cmin - base) / interval)
+        k_hi = np.ceil((cmax - base) / interval) - 1
+        counts = np.where(complete, k_hi - k_lo + 1, 0)
+    counts = np.clip(counts, 0, None).astype(np.int64)
+    cells = np.flatnonzero(counts)
+    if len(cells) == 0:
+        return np.empty((0, 2, 2)), np.empty(0, dtype=np.int64)
+    
+    # One entry per (cell, level) crossing
+    n_cells = counts.ravel()[cells]
+    cell = np.repeat(cells, n_cells)
+    first = np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+    k = np.repeat(k_lo.ravel()[cells].astype(np.int64), n_cells) + (np.arange(len(cell)) - first)
+    level = base + k * interval
+    
+    corners = np.stack([a.ravel()[cell], b.ravel()[cell], c.ravel()[cell], d.ravel()[cell]], axis=1).astype(np.float64)
+    above = corners > level[:, None]
+    rows, cols = np.divmod(cell, a.shape[1])
+    rows, cols = (rows + row0).astype(np.float64), (cols + col0).astype(np.float64)
+    
+    # Crossing point on each cell edge: top (a-b), right (b-c), bottom (d-c), left (a-d)
+    za, zb, zc, zd = corners.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        points = np.stack([
+            np.stack([cols + (level - za) / (zb - za), rows], axis=1),
+            np.stack([cols + 1.0, rows + (level - zb) / (zc - zb)], axis=1),
+            np.stack([cols + (level - zd) / (zc - zd), rows + 1.0], axis=1),
+            np.stack([cols, rows + (level - za) / (zd - za)], axis=1),
+        ], axis=1)
+    crossed = np.stack([above[:, 0] != above[:, 1], above[:, 1] != above[:, 2],
+                        above[:, 3] != above[:, 2], above[:, 0] != above[:, 3]], axis=1)
+    n_crossed = crossed.sum(axis=1)
+    
+    # Regular cells: one segment between the two crossed edges
+    single = np.flatnonzero(n_crossed == 2)
+    e1 = np.argmax(crossed[single], axis=1)
+    e2 = 3 - np.argmax(crossed[single, ::-1], axis=1)
+    # Saddles: cut off the corners whose side differs from the cell centre
+    saddle = np.flatnonzero(n_crossed == 4)
+    centre_above = corners[saddle].mean(axis=1) > level[saddle]
+    cut_a = above[saddle, 0] != centre_above
+    s1 = np.zeros(len(saddle), dtype=np.int64), np.where(cut_a, 3, 1)
+    s2 = np.where(cut_a, 1, 2), np.where(cut_a, 2, 3)
+    
+    seg_index = np.concatenate([single, saddle, saddle])
+    start_edge = np.concatenate([e1, s1[0], s2[0]])
+    end_edge = np.concatenate([e2, s1[1], s2[1]])
+    segments = np.stack([points[seg_index, start_edge], points[seg_index, end_edge]], axis=1)
+    return segments, k[seg_index]
+
+def dem_contours(dem_array, transform, valid, interval, window=None, base=0.0, nodata=None, tile_rows=DEM_CONTOUR_TILE_ROWS):
+    """
+    Contour lines of a DEM (or a (row_slice, col_slice) window of it) at a fixed interval.
+    
+    The window is split into row tiles that are traced in parallel (NumPy releases the
+    GIL on the array work); segments are then joined into polylines per level with
+    shapely.line_merge and lightly simplified (a quarter of a cell). Without a valid mask,
+    validity is derived per tile from nodata.
+    
+    Returns:
+        dict with "xy" (flat (n, 2) coordinates in the DEM CRS), "offsets" (part start
+        indices, length n_parts + 1) and "part_level" (elevation of every part)
+    """
+    if window is None:
+        window = (slice(0, dem_array.shape[0]), slice(0, dem_array.shape[1]))
+    row_start, row_stop = window[0].indices(dem_array.shape[0])[:2]
+    col_start, col_stop = window[1].indices(dem_array.shape[1])[:2]
+    
+    def trace(r0):
+        r1 = min(r0 + tile_rows + 1, row_stop)
+        tile = dem_array[r0:r1, col_start:col_stop]
+        tile_valid = dem_valid_mask(tile, nodata) if valid is None else valid[r0:r1, col_start:col_stop]
+        tile = np.where(tile_valid, tile, np.nan)
+        return _marching_squares_tile(tile.astype(np.float32), r0, col_start, base, interval)
+    
+    tile_starts = list(range(row_start, max(row_start, row_stop - 1), tile_rows))
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as pool:
+        traced = list(pool.map(trace, tile_starts))
+    segments = np.concatenate([t[0] for t in traced]) if traced else np.empty((0, 2, 2))
+    seg_k = np.concatenate([t[1] for t in traced]) if traced else np.empty(0, dtype=np.int64)
+    
+    # Pixel centres to DEM coordinates
+    cols, rows = segments[..., 0] + 0.5, segments[..., 1] + 0.5
+    world = np.stack([transform.a * cols + transform.b * rows + transform.c,
+                      transform.d * cols + transform.e * rows + transform.f], axis=-1)
+    
+    # Join the segments of each level into polylines
+    cell_size = min(abs(transform.a), abs(transform.e))
+    merged, merged_k = [], []
+    order = np.argsort(seg_k, kind="stable")
+    levels_k, starts = np.unique(seg_k[order], return_index=True)
+    for k, group in zip(levels_k, np.split(order, starts[1:])):
+        lines = shapely.line_merge(shapely.multilinestrings(shapely.linestrings(world[group])))
+        merged.append(shapely.simplify(lines, 0.25 * cell_size))
+        merged_k.append(k)
+    
+    parts, part_group = shapely.get_parts(np.array(merged, dtype=object), return_index=True) if merged else (np.empty(0, dtype=object), np.empty(0, dtype=np.int64))
+    vertices, part_of = shapely.get_coordinates(parts, return_index=True)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(part_of, minlength=len(parts)))]).astype(np.int64)
+    part_level = base + np.asarray(merged_k, dtype=np.float64)[part_group] * interval if merged else np.empty(0)
+    return {"xy": vertices, "offsets": offsets, "part_level": part_level}
+
+def changed_window(old_dem, new_dem, margin=2):
+    """(row_slice, col_slice) bounding box of the cells where new_dem differs from old_dem, or None."""
+    changed = (old_dem != new_dem) & ~(np.isnan(old_dem) & np.isnan(new_dem))
+    rows = np.flatnonzero(changed.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(changed.any(axis=0))
+    return (slice(max(0, rows[0] - margin), min(new_dem.shape[0], rows[-1] + 1 + margin)),
+            slice(max(0, cols[0] - margin), min(new_dem.shape[1], cols[-1] + 1 + margin)))
+
+def cached_dem_contours(role, dem_key, interval, dem_array, transform, valid, to_map, base_dem=None, nodata=None):
+    """
+    dem_contours() in map coordinates ([lat, lon]), kept in session state per role
+    ("existing" or "design") until the raster key or interval changes.
+    With base_dem, only the window where dem_array differs from it is traced.
+    """
+    cache = st.session_state.setdefault("dem_contours", {})
+    key = (dem_key, float(interval))
+    cached = cache.get(role)
+    if cached is not None and cached["key"] == key:
+        return cached["contours"]
+    window = None
+    if base_dem is not None:
+        window = changed_window(base_dem, dem_array)
+    if base_dem is not None and window is None:
+        contours = {"xy": np.empty((0, 2)), "offsets": np.zeros(1, dtype=np.int64), "part_level": np.empty(0)}
+    else:
+        contours = dem_contours(dem_array, transform, valid, interval, window=window, nodata=nodata)
+    lon, lat = to_map.transform(contours["xy"][:, 0], contours["xy"][:, 1])
+    contours["latlon"] = np.column_stack([lat, lon])
+    del contours["xy"]
+    cache[role] = {"key": key, "contours": contours}
+    return contours
+
 # ============================================================================
 # FILE UPLOAD UI
 # ============================================================================
@@ -1084,6 +1454,14 @@ if "basin_modified_dem" not in st.session_state:
 if "basin_volumes" not in st.session_state:
     st.session_state.basin_volumes = {"volume": 0, "inner_area": 0, "outer_area": 0}
 
+# Initialize session state for multi-feature projects
+if "project_features" not in st.session_state:
+    st.session_state.project_features = []  # List of dicts: {name, kind, enabled, priority, coords [lon, lat], params...}
+if "project_dem" not in st.session_state:
+    st.session_state.project_dem = None
+if "project_volumes" not in st.session_state:
+    st.session_state.project_volumes = None
+
 # Initialize session state for contours and vector layers (visualization only)
 if "contours_data" not in st.session_state:
     st.session_state.contours_data = None  # GeoDataFrame or dict with contours
@@ -1269,12 +1647,8 @@ if st.session_state.data_source == "upload":
                                     poly_coords, poly_crs = poly_result
                                     try:
                                         if poly_crs is not None and not CRS(poly_crs).is_geographic:
-                                            transformer_poly = Transformer.from_crs(poly_crs, "EPSG:4326", always_xy=True)
-                                            converted = []
-                                            for coord in poly_coords:
-                                                if isinstance(coord, (list, tuple)) and len(coord) >= 2:
-                                                    lon, lat = transformer_poly.transform(coord[0], coord[1])
-                                                    converted.append([lon, lat])
+                                            poly_xy = [coord[:2] for coord in poly_coords if isinstance(coord, (list, tuple)) and len(coord) >= 2]
+                                            converted = transform_coords(poly_xy, poly_crs, "EPSG:4326").tolist()
                                             st.session_state.basin_polygon_coords = converted if converted else [[c[0], c[1]] if isinstance(c, (list, tuple)) else c for c in poly_coords]
                                         else:
                                             st.session_state.basin_polygon_coords = [[c[0], c[1]] if isinstance(c, (list, tuple)) else c for c in poly_coords]
@@ -1308,12 +1682,16 @@ if st.session_state.data_source == "upload":
             if uploaded_contours is not None:
                 if uploaded_contours.size > 200 * 1024 * 1024:
                     st.error("File size exceeds 200MB limit")
-                else:
+                elif (st.session_state.contours_data is None
+                      or st.session_state.get("contours_layer_key") != (uploaded_contours.name, uploaded_contours.size)):
+                    # Read and preprocess a newly uploaded layer once (display levels built up front)
                     with st.spinner("Processing contours..."):
                         gdf = process_uploaded_contours(uploaded_contours)
                         if gdf is not None and len(gdf) > 0:
                             st.session_state.contours_data = gdf
                             st.session_state.contours_filename = uploaded_contours.name
+                            st.session_state.contours_layer_key = (uploaded_contours.name, uploaded_contours.size)
+                            cached_contour_lod(gdf, st.session_state.contours_layer_key)
                             # Calculate bounds for map zooming
                             try:
                                 bounds = gdf.total_bounds  # [minx, miny, maxx, maxy]
@@ -1407,8 +1785,17 @@ if st.session_state.data_source == "upload":
                         label_visibility="collapsed"
                     )
 
-                    if st.button("❌ Remove Contours", key="remove_contours_tile", use_container_width=True):
-                        st.session_state.contours_data = None
+                    st.markdown("**Display Detail**")
+                    st.selectbox(
+                        "Detail",
+                        ["Auto", "Full"] + [f"{tol:g} m" for tol in CONTOUR_LOD_TOLERANCES_M if tol > 0],
+                        key="contours_detail",
+                        help="Simplification level sent to the map; Auto matches the screen resolution at the layer extent",
+                        label_visibility="collapsed"
+                    )
+
+                    if st.button("❌ Remove Contours", key="remove_contours_tile", use_container_width=True):
+                        st.session_state.contours_data = None
                         st.session_state.contours_filename = None
                         st.session_state.contours_bounds = None
                         st.session_state.contours_just_uploaded = False
@@ -1587,13 +1974,8 @@ if st.session_state.data_source == "upload":
                                     channel_coords, channel_crs = channel_result
                                     if channel_crs is not None and not channel_crs.is_geographic:
                                         try:
-                                            transformer = Transformer.from_crs(channel_crs, "EPSG:4326", always_xy=True)
-                                            converted_coords = []
-                                            for coord in channel_coords:
-                                                if isinstance(coord, (list, tuple)) and len(coord) >= 2:
-                                                    lon, lat = transformer.transform(coord[0], coord[1])
-                                                    converted_coords.append([lon, lat])
-                                            st.session_state.basin_channel_coords = converted_coords
+                                            channel_xy = [coord[:2] for coord in channel_coords if isinstance(coord, (list, tuple)) and len(coord) >= 2]
+                                            st.session_state.basin_channel_coords = transform_coords(channel_xy, channel_crs, "EPSG:4326").tolist()
                                         except Exception as e:
                                             st.warning(f"CRS conversion failed: {e}")
                                             st.session_state.basin_channel_coords = [[c[0], c[1]] if isinstance(c, (list, tuple)) else c for c in channel_coords]
@@ -1618,15 +2000,35 @@ if st.session_state.data_source == "upload":
 # CORE FUNCTIONS
 # ============================================================================
 
-def compute_hillshade(elev, cellsize_x_m, cellsize_y_m, azimuth=315, altitude=45):
-    """Compute hillshade."""
+def dem_valid_mask(dem_array, nodata):
+    """
+    Boolean mask of cells holding real elevations (not nodata, not NaN).
+    The nodata value is cast to the array dtype so float32 rasters compare exactly.
+    """
+    valid = np.isfinite(dem_array)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= dem_array != np.asarray(nodata, dtype=dem_array.dtype)
+    return valid
+
+def read_dem_band(ds):
+    """Read band 1 of a raster dataset as float32 together with its validity mask."""
+    dem = ds.read(1, out_dtype="float32")
+    return dem, dem_valid_mask(dem, ds.nodata)
+
+def compute_hillshade(elev, cellsize_x_m, cellsize_y_m, azimuth=315, altitude=45, valid=None):
+    """Compute hillshade. Cells outside the validity mask are returned as 0."""
     az, alt = np.radians(azimuth), np.radians(altitude)
+    if valid is not None:
+        elev = np.where(valid, elev, np.nan).astype(np.float32, copy=False)
     dx, dy = np.gradient(elev, cellsize_x_m, cellsize_y_m)
     gradient_magnitude = np.clip(np.hypot(dx, dy), 0, 1e10)
     slope = np.pi / 2.0 - np.arctan(gradient_magnitude)
     aspect = np.arctan2(-dx, dy)
     shaded = (np.sin(alt) * np.sin(slope) + np.cos(alt) * np.cos(slope) * np.cos(az - aspect))
-    return (shaded - shaded.min()) / (shaded.max() - shaded.min() + 1e-9)
+    if not np.isfinite(shaded).any():
+        return np.zeros_like(shaded)
+    lo, hi = np.nanmin(shaded), np.nanmax(shaded)
+    return np.nan_to_num((shaded - lo) / (hi - lo + 1e-9), nan=0.0)
 
 def extract_profile_from_line(line_geom):
     """
@@ -1693,31 +2095,12 @@ def sample_line_at_spacing(line_geom, spacing_m):
     num_points = max(2, int(np.ceil(total_length / spacing_m)) + 1)
     target_dists = np.linspace(0, total_length, num_points)
     
-    # Interpolate x, y at target distances
-    samples = []
-    for target_dist in target_dists:
-        # Find segment containing target_dist
-        for i in range(1, len(cum_dists)):
-            if target_dist <= cum_dists[i] or i == len(cum_dists) - 1:
-                # Interpolate within segment
-                seg_start_dist = cum_dists[i-1]
-                seg_end_dist = cum_dists[i]
-                seg_length = seg_end_dist - seg_start_dist
-                
-                if seg_length > 0:
-                    frac = (target_dist - seg_start_dist) / seg_length
-                else:
-                    frac = 0.0
-                
-                # Clamp to segment bounds
-                frac = max(0.0, min(1.0, frac))
-                
-                x = coords[i-1][0] + frac * (coords[i][0] - coords[i-1][0])
-                y = coords[i-1][1] + frac * (coords[i][1] - coords[i-1][1])
-                samples.append([target_dist, x, y])
-                break
-    
-    return np.array(samples)
+    # Interpolate x, y at target distances (piecewise linear along the vertices)
+    vertices = np.asarray(coords, dtype=np.float64)[:, :2]
+    cum = np.asarray(cum_dists)
+    x = np.interp(target_dists, cum, vertices[:, 0])
+    y = np.interp(target_dists, cum, vertices[:, 1])
+    return np.column_stack([target_dists, x, y])
 
 def compute_tangents_normals(samples):
     """Compute tangent and normal vectors at each sample point."""
@@ -1740,21 +2123,95 @@ def compute_tangents_normals(samples):
     
     return tangents, normals
 
-def sample_dem_at_points(dem_array, transform, nodata, pts_xy):
-    """Extract elevations from DEM at given XY points."""
+def sample_dem_at_points(dem_array, transform, nodata, pts_xy, valid=None):
+    """Extract elevations from DEM at given XY points (NaN outside the validity mask)."""
     h, w = dem_array.shape
+    if valid is None:
+        valid = dem_valid_mask(dem_array, nodata)
     elevations = np.full(len(pts_xy), np.nan)
     
     for i, (x, y) in enumerate(pts_xy):
         # rowcol returns (row, col) - not (col, row)!
         row, col = rowcol(transform, x, y)
-        if 0 <= row < h and 0 <= col < w:
-            val = dem_array[row, col]
-            if nodata is None or val != nodata:
-                elevations[i] = float(val)
+        if 0 <= row < h and 0 <= col < w and valid[row, col]:
+            elevations[i] = float(dem_array[row, col])
     
     return elevations
 
+def sample_dem_bilinear(dem_array, transform, valid, pts_x, pts_y):
+    """Bilinear DEM elevations at point arrays (NaN outside the grid or next to invalid cells)."""
+    h, w = dem_array.shape
+    pts_x, pts_y = np.asarray(pts_x, dtype=np.float64), np.asarray(pts_y, dtype=np.float64)
+    inv = ~transform
+    # Fractional pixel coordinates relative to pixel centres
+    fc = inv.a * pts_x + inv.b * pts_y + inv.c - 0.5
+    fr = inv.d * pts_x + inv.e * pts_y + inv.f - 0.5
+    on_grid = (fc >= -0.5) & (fc <= w - 0.5) & (fr >= -0.5) & (fr <= h - 0.5)
+    c0 = np.clip(np.floor(fc), 0, max(w - 2, 0)).astype(np.int64)
+    r0 = np.clip(np.floor(fr), 0, max(h - 2, 0)).astype(np.int64)
+    c1, r1 = np.minimum(c0 + 1, w - 1), np.minimum(r0 + 1, h - 1)
+    tx, ty = np.clip(fc - c0, 0.0, 1.0), np.clip(fr - r0, 0.0, 1.0)
+    
+    z = dem_array.astype(np.float64, copy=False)
+    z_interp = ((z[r0, c0] * (1 - tx) + z[r0, c1] * tx) * (1 - ty) +
+                (z[r1, c0] * (1 - tx) + z[r1, c1] * tx) * ty)
+    ok = on_grid & valid[r0, c0] & valid[r0, c1] & valid[r1, c0] & valid[r1, c1]
+    return np.where(ok, z_interp, np.nan)
+
+def long_section(line_geom, spacing_m, dem_array, transform, valid):
+    """
+    Existing-ground long-section along a line: [chainage, x, y] samples at equal spacing
+    and their bilinear DEM elevations.
+    
+    Returns:
+        dict with "chainage", "xy" and "z_existing"
+    """
+    samples = sample_line_at_spacing(line_geom, spacing_m)
+    return {
+        "chainage": samples[:, 0],
+        "xy": samples[:, 1:3],
+        "z_existing": sample_dem_bilinear(dem_array, transform, valid, samples[:, 1], samples[:, 2]),
+    }
+
+def cached_long_section(line_geom, spacing_m, dem_key, dem_array, transform, valid, stations=None, z_design_arr=None,
+                        modified_key=None, modified_dem=None, nodata=None):
+    """
+    long_section() kept in session state, keyed by the line geometry hash, spacing and DEM key,
+    plus the existing elevation at the design stations.
+    
+    The design elevation (interpolated between stations) is added on every call, as it is
+    cheap and changes with every edit; the modified-DEM elevation is sampled once per
+    modified DEM hash.
+    
+    Returns:
+        dict with "chainage", "xy", "z_existing", "z_existing_at_stations", "z_design" and
+        "z_modified" (None without a modified DEM)
+    """
+    key = (hashlib.blake2b(shapely.to_wkb(line_geom), digest_size=16).hexdigest(), float(spacing_m), dem_key)
+    cached = st.session_state.get("long_section_cache")
+    if cached is None or cached["key"] != key:
+        section = long_section(line_geom, spacing_m, dem_array, transform, valid)
+        coords = np.asarray(line_geom.coords, dtype=np.float64)[:, :2]
+        section["z_existing_at_stations"] = sample_dem_bilinear(dem_array, transform, valid, coords[:, 0], coords[:, 1])
+        cached = {"key": key, "section": section, "modified_key": None, "z_modified": None}
+        st.session_state.long_section_cache = cached
+    section = dict(cached["section"])
+    
+    if modified_dem is None:
+        section["z_modified"] = None
+    else:
+        if cached["modified_key"] != modified_key:
+            section_xy = section["xy"]
+            modified_valid = dem_valid_mask(modified_dem, nodata)
+            cached["z_modified"] = sample_dem_bilinear(modified_dem, transform, modified_valid, section_xy[:, 0], section_xy[:, 1])
+            cached["modified_key"] = modified_key
+        section["z_modified"] = cached["z_modified"]
+    
+    section["z_design"] = None
+    if stations is not None and z_design_arr is not None and len(stations) == len(z_design_arr):
+        section["z_design"] = np.interp(section["chainage"], stations, np.asarray(z_design_arr, dtype=np.float64))
+    return section
+
 def cross_section_elevation_berm_ditch(offset, z_crest, params):
     """
     Berm + Ditch template elevation based on sketch.
@@ -1875,7 +2332,8 @@ def cross_section_elevation_swale(offset, z_crest, params):
     return None
 
 def cross_section_preview(dem_array, transform, nodata, station_idx, samples, normals,
-                         z_design_arr, template_type, template_params, influence_width_m, operation_mode):
+                         z_design_arr, template_type, template_params, influence_width_m, operation_mode,
+                         valid=None):
     """Generate cross-section at a station."""
     xc, yc = samples[station_idx, 1], samples[station_idx, 2]
     nx, ny = normals[station_idx]
@@ -1883,16 +2341,16 @@ def cross_section_preview(dem_array, transform, nodata, station_idx, samples, no
     offsets = np.linspace(-influence_width_m, influence_width_m, 201)
     z_exist, z_design, z_final = [], [], []
     h, w = dem_array.shape
+    if valid is None:
+        valid = dem_valid_mask(dem_array, nodata)
     
     for off in offsets:
         x, y = xc + off * nx, yc + off * ny
         row, col = rowcol(transform, x, y)  # rowcol returns (row, col), not (col, row)!
         
         z_old = np.nan
-        if 0 <= row < h and 0 <= col < w:
-            val = dem_array[row, col]
-            if nodata is None or val != nodata:
-                z_old = float(val)
+        if 0 <= row < h and 0 <= col < w and valid[row, col]:
+            z_old = float(dem_array[row, col])
         
         z_exist.append(z_old)
         
@@ -1999,6 +2457,87 @@ def calculate_cross_section_areas(offsets, z_exist, z_final, template_type, temp
     
     return cut_area, fill_area, berm_area, ditch_area
 
+def template_offset_profile(offsets, template_type, template_params):
+    """
+    Template elevation relative to the crest at each offset (NaN where the template is undefined).
+    Both templates are the crest elevation plus a function of offset, so this is evaluated once
+    and shifted by each station's crest elevation.
+    """
+    if template_type == "berm_ditch":
+        template_fn = cross_section_elevation_berm_ditch
+    elif template_type == "swale":
+        template_fn = cross_section_elevation_swale
+    else:
+        return np.full(len(offsets), np.nan)
+    relative = [template_fn(float(off), 0.0, template_params) for off in offsets]
+    return np.array([np.nan if z is None else z for z in relative], dtype=np.float64)
+
+def cross_section_batch(dem_array, transform, nodata, station_indices, samples, normals,
+                        z_design_arr, template_type, template_params, influence_width_m, operation_mode,
+                        valid=None, n_offsets=201):
+    """
+    cross_section_preview() for many stations at once: all (station x offset) DEM cells are
+    gathered in one vectorized lookup and the template is shifted by each crest elevation.
+    
+    Returns:
+        offsets (m,), z_exist, z_design, z_final (n_stations, m)
+    """
+    station_indices = np.asarray(station_indices, dtype=np.intp)
+    offsets = np.linspace(-influence_width_m, influence_width_m, n_offsets)
+    if valid is None:
+        valid = dem_valid_mask(dem_array, nodata)
+    
+    xc, yc = samples[station_indices, 1], samples[station_indices, 2]
+    nx, ny = normals[station_indices, 0], normals[station_indices, 1]
+    x = xc[:, None] + offsets[None, :] * nx[:, None]
+    y = yc[:, None] + offsets[None, :] * ny[:, None]
+    cols_f, rows_f = ~transform * (x, y)
+    rows, cols = np.floor(rows_f).astype(np.intp), np.floor(cols_f).astype(np.intp)
+    h, w = dem_array.shape
+    inside = (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+    rows_c, cols_c = np.clip(rows, 0, h - 1), np.clip(cols, 0, w - 1)
+    z_exist = np.where(inside & valid[rows_c, cols_c], dem_array[rows_c, cols_c], np.nan).astype(np.float64)
+    
+    z_crest = np.asarray(z_design_arr, dtype=np.float64)[station_indices]
+    z_design = z_crest[:, None] + template_offset_profile(offsets, template_type, template_params)[None, :]
+    defined = np.isfinite(z_design)
+    if operation_mode == "fill":
+        z_final = np.where(np.isnan(z_exist), z_design, np.fmax(z_exist, z_design))
+    elif operation_mode == "cut":
+        z_final = np.where(np.isnan(z_exist), z_design, np.fmin(z_exist, z_design))
+    else:
+        z_final = z_design.copy()
+    z_final = np.where(defined, z_final, z_exist)
+    return offsets, z_exist, z_design, z_final
+
+def cross_section_areas_batch(offsets, z_exist, z_final, template_type, template_params):
+    """
+    calculate_cross_section_areas() for a stack of sections (one row per station).
+    
+    Returns:
+        (n_stations, 4) array of cut, fill, berm and ditch areas (m²)
+    """
+    width = np.abs(np.diff(offsets))[None, :]
+    offset_avg = ((offsets[:-1] + offsets[1:]) / 2.0)[None, :]
+    z_exist_avg = (z_exist[:, :-1] + z_exist[:, 1:]) / 2.0
+    z_final_avg = (z_final[:, :-1] + z_final[:, 1:]) / 2.0
+    diff = np.where(np.isfinite(z_exist_avg) & np.isfinite(z_final_avg), z_final_avg - z_exist_avg, 0.0)
+    cut = np.clip(-diff, 0.0, None) * width
+    fill = np.clip(diff, 0.0, None) * width
+    
+    areas = np.zeros((len(z_exist), 4))
+    areas[:, 0] = cut.sum(axis=1)
+    areas[:, 1] = fill.sum(axis=1)
+    if template_type == "berm_ditch":
+        berm_height = template_params.get("berm_height", 1.5)
+        half_crest = template_params.get("berm_crest_width", 1.0) / 2.0
+        berm_toe_offset = half_crest + berm_height * template_params.get("berm_downstream_slope", 1.5)
+        ditch_slope_distance = template_params.get("ditch_depth", 1.5) * template_params.get("ditch_side_slope", 1.5)
+        ditch_end_offset = berm_toe_offset + 2 * ditch_slope_distance + template_params.get("ditch_width", 2.0)
+        areas[:, 2] = (fill * (np.abs(offset_avg) <= berm_toe_offset)).sum(axis=1)
+        areas[:, 3] = (cut * ((offset_avg >= berm_toe_offset) & (offset_avg <= ditch_end_offset))).sum(axis=1)
+    return areas
+
 def get_berm_ditch_boundaries(template_params):
     """
     Get berm top width and ditch bottom width offsets.
@@ -2039,76 +2578,519 @@ def get_berm_ditch_boundaries(template_params):
     
     return berm_top_left, berm_top_right, ditch_bottom_left, ditch_bottom_right
 
-def apply_corridor_to_dem(dem_array, transform, nodata, samples, z_design_arr,
-                         template_type, template_params, tangents, normals, influence_width_m, operation_mode):
-    """Apply corridor modifications to DEM."""
-    new_dem = dem_array.copy()
-    stations, center_xy = samples[:, 0], samples[:, 1:3]
-    station_step = (stations[-1] - stations[0]) / (len(stations) - 1) if len(stations) > 1 else 1.0
+def pixel_centers(transform, rows, cols):
+    """Projected x, y of pixel centres for row/col index arrays (vectorized rasterio.transform.xy)."""
+    rows = np.asarray(rows, dtype=np.float64) + 0.5
+    cols = np.asarray(cols, dtype=np.float64) + 0.5
+    x = transform.c + cols * transform.a + rows * transform.b
+    y = transform.f + cols * transform.d + rows * transform.e
+    return x, y
+
+def alignment_field(transform, shape, samples, influence_width_m):
+    """
+    Station/chainage coordinate field of the alignment over its corridor window.
     
-    xs, ys = center_xy[:, 0], center_xy[:, 1]
+    Every pixel is projected onto its nearest centerline segment (STRtree query over
+    all segments), so each pixel within the influence width gets exactly one
+    (chainage, offset) pair - no gaps or overlaps at bends or switchbacks.
+    Offsets are signed like compute_tangents_normals (positive to the left).
+    
+    Returns:
+        dict with "window" (row_min, row_max, col_min, col_max), float32 "chainage"
+        and "offset" rasters (NaN outside the corridor) and int32 "station_idx"
+        (nearest station, -1 outside the corridor)
+    """
+    h, w = shape
+    stations = samples[:, 0].astype(np.float64)
+    pts = samples[:, 1:3].astype(np.float64)
+    xs, ys = pts[:, 0], pts[:, 1]
     x_min, x_max = xs.min() - influence_width_m, xs.max() + influence_width_m
     y_min, y_max = ys.min() - influence_width_m, ys.max() + influence_width_m
     
     row_min, col_min = rowcol(transform, x_min, y_max)  # rowcol returns (row, col), not (col, row)!
     row_max, col_max = rowcol(transform, x_max, y_min)
-    
-    h, w = dem_array.shape
     row_min, row_max = max(0, min(row_min, row_max)), min(h-1, max(row_min, row_max))
     col_min, col_max = max(0, min(col_min, col_max)), min(w-1, max(col_min, col_max))
     
-    old_subset = dem_array[row_min:row_max+1, col_min:col_max+1].copy()
-    new_subset = new_dem[row_min:row_max+1, col_min:col_max+1].copy()
-    
-    for r in range(row_min, row_max + 1):
-        for c in range(col_min, col_max + 1):
-            z_old = dem_array[r, c]
-            if nodata is not None and z_old == nodata:
-                continue
-            
-            x, y = xy(transform, r, c)
-            j = int(np.argmin((center_xy[:, 0] - x) ** 2 + (center_xy[:, 1] - y) ** 2))
-            
-            cx, cy = center_xy[j]
-            offset = (x - cx) * normals[j][0] + (y - cy) * normals[j][1]
-            along = (x - cx) * tangents[j][0] + (y - cy) * tangents[j][1]
-            
-            if abs(offset) > influence_width_m or abs(along) > station_step * 0.75:
-                continue
-            
-            if template_type == "berm_ditch":
-                z_template = cross_section_elevation_berm_ditch(offset, z_design_arr[j], template_params)
-            elif template_type == "swale":
-                z_template = cross_section_elevation_swale(offset, z_design_arr[j], template_params)
-            else:
-                z_template = None
-            
-            if z_template is None:
-                continue
-            
-            if operation_mode == "fill":
-                z_new = max(z_old, z_template)
-            elif operation_mode == "cut":
-                z_new = min(z_old, z_template)
-            else:
-                z_new = z_template
-            
-            new_dem[r, c] = z_new
-            new_subset[r - row_min, c - col_min] = z_new
+    win_h, win_w = max(0, row_max - row_min + 1), max(0, col_max - col_min + 1)
+    field = {
+        "window": (row_min, row_max, col_min, col_max),
+        "chainage": np.full((win_h, win_w), np.nan, dtype=np.float32),
+        "offset": np.full((win_h, win_w), np.nan, dtype=np.float32),
+        "station_idx": np.full((win_h, win_w), -1, dtype=np.int32),
+    }
+    if len(samples) < 2 or win_h == 0 or win_w == 0:
+        return field
+    
+    # Candidate pixels: those touching the influence-width buffer of the line
+    from rasterio.features import geometry_mask
+    
+    window_transform = transform * Affine.translation(col_min, row_min)
+    corridor = LineString(pts).buffer(influence_width_m)
+    candidates = ~geometry_mask([corridor], (win_h, win_w), window_transform, all_touched=True)
+    pix = np.flatnonzero(candidates)
+    if pix.size == 0:
+        return field
+    px, py = pixel_centers(transform, pix // win_w + row_min, pix % win_w + col_min)
+    
+    # Nearest segment of every candidate pixel (STRtree over all segments)
+    n_seg = len(pts) - 1
+    seg_start, seg_vec = pts[:-1], np.diff(pts, axis=0)
+    segments = shapely.linestrings(np.stack([pts[:-1], pts[1:]], axis=1))
+    hit, seg = shapely.STRtree(segments).query_nearest(
+        shapely.points(px, py), max_distance=influence_width_m, all_matches=False
+    )
+    pix, px, py = pix[hit], px[hit], py[hit]
+    dx, dy = seg_vec[seg, 0], seg_vec[seg, 1]
+    len2 = dx * dx + dy * dy
+    t_raw = np.divide((px - seg_start[seg, 0]) * dx + (py - seg_start[seg, 1]) * dy, len2,
+                      out=np.zeros(px.shape), where=len2 > 0)
+    t = np.clip(t_raw, 0.0, 1.0)
+    dist = np.hypot(px - seg_start[seg, 0] - t * dx, py - seg_start[seg, 1] - t * dy)
+    side = np.sign((py - seg_start[seg, 1]) * dx - (px - seg_start[seg, 0]) * dy)
+    offset = np.where(side == 0, 1.0, side) * dist
+    chainage = stations[seg] + t * (stations[seg + 1] - stations[seg])
+    # Pixels beyond either end of the alignment are not part of the corridor
+    beyond = ((seg == 0) & (t_raw < 0)) | ((seg == n_seg - 1) & (t_raw > 1))
+    keep = (dist <= influence_width_m) & ~beyond
+    pix, seg, t = pix[keep], seg[keep], t[keep]
+    
+    field["chainage"].ravel()[pix] = chainage[keep]
+    field["offset"].ravel()[pix] = offset[keep]
+    field["station_idx"].ravel()[pix] = seg + (t > 0.5)
+    return field
+
+def cached_alignment_field(transform, shape, samples, influence_width_m):
+    """
+    alignment_field() kept in session state.
+    Rebuilt only when the line geometry, influence width or analysis grid changes.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(samples, dtype=np.float64).data)
+    digest.update(f"{tuple(transform)[:6]}|{tuple(shape)}|{float(influence_width_m)}".encode())
+    key = digest.hexdigest()
+    cached = st.session_state.get("alignment_field_cache")
+    if cached is not None and cached["key"] == key:
+        return cached["field"]
+    field = alignment_field(transform, shape, samples, influence_width_m)
+    field["key"] = key
+    st.session_state.alignment_field_cache = {"key": key, "field": field}
+    return field
+
+def corridor_template_surface(z_old, offsets, z_crests, template_type, template_params, operation_mode):
+    """New elevations for corridor pixels from their template offset and crest elevation (z_old where undefined)."""
+    z_new = np.asarray(z_old, dtype=np.float32).copy()
+    for k, (offset, z_crest) in enumerate(zip(np.asarray(offsets, dtype=np.float64), z_crests)):
+        if template_type == "berm_ditch":
+            z_template = cross_section_elevation_berm_ditch(offset, z_crest, template_params)
+        elif template_type == "swale":
+            z_template = cross_section_elevation_swale(offset, z_crest, template_params)
+        else:
+            z_template = None
+        
+        if z_template is None:
+            continue
+        
+        if operation_mode == "fill":
+            z_new[k] = max(z_new[k], z_template)
+        elif operation_mode == "cut":
+            z_new[k] = min(z_new[k], z_template)
+        else:
+            z_new[k] = z_template
+    return z_new
+
+def apply_corridor_to_dem(dem_array, transform, nodata, samples, z_design_arr,
+                         template_type, template_params, tangents, normals, influence_width_m, operation_mode,
+                         valid=None, field=None, previous_dem=None, chainage_range=None):
+    """
+    Apply corridor modifications to DEM (float32 in, float32 out; volumes summed in float64).
+    Pixels are located with the alignment's station/chainage field (built here unless passed
+    in from cached_alignment_field); the design crest is interpolated along chainage.
+    With previous_dem and chainage_range (lo, hi), only pixels in that chainage span are
+    re-evaluated; the rest of previous_dem is kept.
+    """
+    incremental = previous_dem is not None and chainage_range is not None
+    new_dem = (previous_dem if incremental else dem_array).astype(np.float32, copy=True)
+    if valid is None:
+        valid = dem_valid_mask(dem_array, nodata)
+    if field is None:
+        field = alignment_field(transform, dem_array.shape, samples, influence_width_m)
+    stations = samples[:, 0]
+    z_design_arr = np.asarray(z_design_arr, dtype=np.float64)
+    
+    row_min, row_max, col_min, col_max = field["window"]
+    window = (slice(row_min, row_max + 1), slice(col_min, col_max + 1))
+    old_subset = dem_array[window].astype(np.float32)
+    new_subset = new_dem[window]  # view into new_dem
+    valid_subset = valid[window]
+    
+    in_corridor = valid_subset & (field["station_idx"] >= 0)
+    if incremental:
+        lo, hi = chainage_range
+        with np.errstate(invalid='ignore'):
+            in_corridor &= (field["chainage"] >= lo) & (field["chainage"] <= hi)
+        new_subset[in_corridor] = old_subset[in_corridor]
+    rr, cc = np.nonzero(in_corridor)
+    new_subset[rr, cc] = corridor_template_surface(
+        new_subset[rr, cc], field["offset"][rr, cc], np.interp(field["chainage"][rr, cc], stations, z_design_arr),
+        template_type, template_params, operation_mode
+    )
     
-    mask = (old_subset != nodata) & (new_subset != nodata) if nodata is not None else np.ones_like(old_subset, dtype=bool)
-    dz = (new_subset - old_subset) * mask
+    dz = np.where(valid_subset, new_subset - old_subset, np.float32(0.0))
     cell_area = abs(transform.a) * abs(transform.e)
-    fill_vol = float((dz[dz > 0]).sum() * cell_area)
-    cut_vol = float((-dz[dz < 0]).sum() * cell_area)
+    fill_vol = float(dz[dz > 0].sum(dtype=np.float64) * cell_area)
+    cut_vol = float(-dz[dz < 0].sum(dtype=np.float64) * cell_area)
     
     return new_dem, cut_vol, fill_vol
 
+def changed_chainage_range(stations, z_design_old, z_design_new):
+    """
+    Chainage span affected by edited design stations, or None if nothing changed.
+    The crest is interpolated between stations, so the neighbouring stations bound the span.
+    """
+    z_design_old, z_design_new = np.asarray(z_design_old, dtype=np.float64), np.asarray(z_design_new, dtype=np.float64)
+    changed = np.flatnonzero(~np.isclose(z_design_old, z_design_new, equal_nan=True))
+    if changed.size == 0:
+        return None
+    return (float(stations[max(changed.min() - 1, 0)]), float(stations[min(changed.max() + 1, len(stations) - 1)]))
+
+def corridor_section_volumes(original_dem, modified_dem, transform, field, valid, stations, interval,
+                             previous=None, chainage_range=None):
+    """
+    Cut and fill volumes per chainage interval along the corridor.
+    
+    The DEM difference inside the corridor is binned by the alignment field's chainage
+    (vectorized bincount). With previous (edges, cut, fill) on the same bins and a
+    chainage_range, only the bins overlapping that span are recomputed.
+    
+    Returns:
+        (edges, cut, fill): bin edges along chainage (m) and volumes per bin (m³)
+    """
+    start, end = float(stations[0]), float(stations[-1])
+    n_bins = max(1, int(np.ceil((end - start) / interval)))
+    edges = np.minimum(start + interval * np.arange(n_bins + 1), end)
+    edges[-1] = end
+    
+    row_min, row_max, col_min, col_max = field["window"]
+    window = (slice(row_min, row_max + 1), slice(col_min, col_max + 1))
+    chainage = field["chainage"]
+    mask = valid[window] & (field["station_idx"] >= 0)
+    
+    if previous is not None and chainage_range is not None and len(previous[0]) == len(edges) \
+            and np.allclose(previous[0], edges):
+        bin_lo = max(0, int(np.searchsorted(edges, chainage_range[0], side="right")) - 1)
+        bin_hi = min(n_bins - 1, int(np.searchsorted(edges, chainage_range[1], side="left")))
+        cut, fill = previous[1].copy(), previous[2].copy()
+        cut[bin_lo:bin_hi + 1] = 0.0
+        fill[bin_lo:bin_hi + 1] = 0.0
+        with np.errstate(invalid='ignore'):
+            upper = (chainage <= end) if bin_hi == n_bins - 1 else (chainage < edges[bin_hi + 1])
+            mask = mask & (chainage >= edges[bin_lo]) & upper
+    else:
+        cut, fill = np.zeros(n_bins), np.zeros(n_bins)
+    
+    dz = modified_dem[window][mask].astype(np.float64) - original_dem[window][mask]
+    bins = np.clip(((chainage[mask] - start) / interval).astype(np.int64), 0, n_bins - 1)
+    cell_area = abs(transform.a) * abs(transform.e)
+    # Pixels are assigned to exactly one bin, so recomputed bins are complete
+    cut += np.bincount(bins, weights=np.where(dz < 0, -dz, 0.0), minlength=n_bins) * cell_area
+    fill += np.bincount(bins, weights=np.where(dz > 0, dz, 0.0), minlength=n_bins) * cell_area
+    return edges, cut, fill
+
+def _level_crossings(x, y, level):
+    """Left/right chainages where a single-humped curve y (>= 0, apex inside) crosses level."""
+    apex = int(np.argmax(y))
+    left = np.flatnonzero(y[:apex] < level)
+    right = np.flatnonzero(y[apex + 1:] < level) + apex + 1
+    i, j = (left[-1] if left.size else 0), (right[0] if right.size else len(y) - 1)
+    x_left = x[i] + (level - y[i]) * (x[i + 1] - x[i]) / (y[i + 1] - y[i]) if y[i + 1] != y[i] else x[i]
+    x_right = x[j - 1] + (level - y[j - 1]) * (x[j] - x[j - 1]) / (y[j] - y[j - 1]) if y[j] != y[j - 1] else x[j]
+    return float(x_left), float(x_right)
+
+def mass_haul_curve(edges, cut, fill, cut_factor=1.0, free_haul_m=0.0):
+    """
+    Mass-haul diagram from per-interval cut and fill.
+    
+    Args:
+        edges: Chainage bin edges (m)
+        cut, fill: Volumes per bin (m³, bank measure for cut)
+        cut_factor: Shrink/swell factor applied to cut before it is placed (<1 shrink, >1 swell)
+        free_haul_m: Free-haul distance (m)
+    
+    Returns:
+        dict with "table" (DataFrame per interval: chainage, cut, fill, adjusted cut and
+        mass ordinate), "chainage"/"ordinate" curve arrays, "balance_points" (chainages where
+        the curve returns to the balance line) and "free_haul" (per loop: span, free-haul
+        chord, free-haul and overhaul volumes)
+    """
+    adjusted_cut = cut * cut_factor
+    ordinate = np.concatenate([[0.0], np.cumsum(adjusted_cut - fill)])
+    chainage = np.asarray(edges, dtype=np.float64)
+    
+    # Balance points: zero crossings of the mass ordinate (linear between bin edges)
+    balance_points = []
+    sign = np.sign(ordinate)
+    for k in range(len(ordinate) - 1):
+        if sign[k] != 0 and sign[k + 1] != 0 and sign[k] != sign[k + 1]:
+            t = ordinate[k] / (ordinate[k] - ordinate[k + 1])
+            balance_points.append(float(chainage[k] + t * (chainage[k + 1] - chainage[k])))
+        elif sign[k + 1] == 0 and k + 1 < len(ordinate) - 1:
+            balance_points.append(float(chainage[k + 1]))
+    
+    # Loops between consecutive balance points (start/end of the corridor included)
+    bounds = [float(chainage[0])] + balance_points + [float(chainage[-1])]
+    free_haul = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        inner = (chainage > lo) & (chainage < hi)
+        x = np.concatenate([[lo], chainage[inner], [hi]])
+        y = np.concatenate([[np.interp(lo, chainage, ordinate)], ordinate[inner], [np.interp(hi, chainage, ordinate)]])
+        direction = 1.0 if y[np.argmax(np.abs(y))] >= 0 else -1.0
+        y_abs = direction * y
+        apex = float(y_abs.max())
+        if apex <= 0 or len(x) < 3:
+            continue
+        # Free-haul chord: the level at which the loop is free_haul_m wide (bisection)
+        level = 0.0
+        x_left, x_right = _level_crossings(x, y_abs, 0.0)
+        if free_haul_m > 0 and (x_right - x_left) > free_haul_m:
+            low, high = 0.0, apex
+            for _ in range(40):
+                mid = 0.5 * (low + high)
+                xl, xr = _level_crossings(x, y_abs, mid)
+                if xr - xl > free_haul_m:
+                    low = mid
+                else:
+                    high = mid
+            level = high
+            x_left, x_right = _level_crossings(x, y_abs, level)
+        free_haul.append({
+            "Loop Start (m)": lo,
+            "Loop End (m)": hi,
+            "Haul": "forward" if direction > 0 else "backward",
+            "Free-Haul Start (m)": x_left,
+            "Free-Haul End (m)": x_right,
+            "Free-Haul Volume (m³)": apex - level,
+            "Overhaul Volume (m³)": level,
+        })
+    
+    table = pd.DataFrame({
+        "Chainage Start (m)": chainage[:-1],
+        "Chainage End (m)": chainage[1:],
+        "Cut (m³)": cut,
+        "Fill (m³)": fill,
+        "Adjusted Cut (m³)": adjusted_cut,
+        "Mass Ordinate (m³)": ordinate[1:],
+    })
+    return {
+        "table": table,
+        "chainage": chainage,
+        "ordinate": ordinate,
+        "balance_points": balance_points,
+        "free_haul": free_haul,
+    }
+
+# ============================================================================
+# FLOW ROUTING FUNCTIONS
+# ============================================================================
+
+# D8 neighbour offsets (row, col)
+D8_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+# Largest routing window (cells) the Basin tab routes without being asked; larger
+# windows wait for the "Route flow" button. The fill is numba-compiled when numba is
+# installed (about 6 s for 10M cells) and runs at roughly 7 s per 1M cells without it.
+FLOW_ROUTING_AUTO_MAX_CELLS = 4_000_000
+FLOW_ROUTING_AUTO_MAX_CELLS_PYTHON = 250_000
+
+@njit(cache=True)
+def _priority_flood_kernel(z, closed, seeds, width, epsilon):
+    """Priority-Flood + epsilon on a flattened grid (numba-compiled when available)."""
+    filled = z.copy()
+    height = z.size // width
+    heap = [(filled[seeds[0]], seeds[0])]
+    for k in range(1, seeds.size):
+        heap.append((filled[seeds[k]], seeds[k]))
+    heapq.heapify(heap)
+    while len(heap) > 0:
+        z_cell, idx = heapq.heappop(heap)
+        r = idx // width
+        c = idx - r * width
+        for dr in range(-1, 2):
+            for dc in range(-1, 2):
+                if dr == 0 and dc == 0:
+                    continue
+                rr = r + dr
+                cc = c + dc
+                if rr < 0 or rr >= height or cc < 0 or cc >= width:
+                    continue
+                nb = rr * width + cc
+                if closed[nb]:
+                    continue
+                closed[nb] = True
+                if filled[nb] < z_cell + epsilon:
+                    filled[nb] = z_cell + epsilon
+                heapq.heappush(heap, (filled[nb], nb))
+    return filled
+
+def priority_flood_fill(dem, valid, epsilon=1e-5):
+    """
+    Depression-filled DEM (float64) by Priority-Flood + epsilon.
+    Grid edges and cells next to nodata are outlets; filled flats keep a tiny
+    gradient so every valid cell drains. Invalid cells are returned unchanged.
+    """
+    z = np.where(valid, dem, np.inf).astype(np.float64)
+    padded = np.pad(valid, 1, constant_values=False)
+    h, w = valid.shape
+    edge = np.zeros_like(valid)
+    for dr, dc in D8_OFFSETS:
+        edge |= ~padded[1+dr:1+dr+h, 1+dc:1+dc+w]
+    edge &= valid
+    seeds = np.flatnonzero(edge).astype(np.int64)
+    if seeds.size == 0:
+        return z
+    closed = (~valid | edge).ravel().copy()
+    return _priority_flood_kernel(z.ravel(), closed, seeds, w, float(epsilon)).reshape(h, w)
+
+def d8_receivers(filled, valid, cell_x, cell_y):
+    """Flat index of each cell's steepest-descent D8 neighbour (-1 for outlets and invalid cells)."""
+    h, w = filled.shape
+    padded = np.pad(np.where(valid, filled, np.inf), 1, constant_values=np.inf)
+    index = np.arange(h * w, dtype=np.int64).reshape(h, w)
+    best_slope = np.zeros((h, w))
+    receivers = np.full((h, w), -1, dtype=np.int64)
+    for dr, dc in D8_OFFSETS:
+        neighbour = padded[1+dr:1+dr+h, 1+dc:1+dc+w]
+        dist = np.hypot(dr * cell_y, dc * cell_x)
+        with np.errstate(invalid='ignore'):
+            slope = (filled - neighbour) / dist
+        better = slope > best_slope
+        best_slope = np.where(better, slope, best_slope)
+        receivers = np.where(better, index + dr * w + dc, receivers)
+    receivers[~valid] = -1
+    return receivers.ravel()
+
+def flow_accumulation(receivers, valid):
+    """
+    Upstream contributing cells per cell (including itself), flat float64 array.
+    Cells are processed in waves of sources whose donors are all done (Kahn's order).
+    """
+    n = receivers.size
+    acc = valid.ravel().astype(np.float64)
+    has_receiver = receivers >= 0
+    pending = np.bincount(receivers[has_receiver], minlength=n)
+    frontier = np.flatnonzero(valid.ravel() & (pending == 0))
+    while frontier.size:
+        recv = receivers[frontier]
+        keep = recv >= 0
+        targets, inverse, counts = np.unique(recv[keep], return_inverse=True, return_counts=True)
+        if targets.size == 0:
+            break
+        acc[targets] += np.bincount(inverse, weights=acc[frontier[keep]], minlength=targets.size)
+        pending[targets] -= counts
+        frontier = targets[pending[targets] == 0]
+    return acc
+
+def flow_routing_window(transform, shape, outer_coords_xy, margin_cells=None):
+    """
+    Row/column slices routed for a basin polygon: its bounds plus a margin
+    (default 10% of the window, min 10 cells) so routing is not truncated. None if empty.
+    """
+    from shapely.geometry import Polygon
+    
+    minx, miny, maxx, maxy = Polygon(outer_coords_xy).bounds
+    row_min, col_min = rowcol(transform, minx, maxy)
+    row_max, col_max = rowcol(transform, maxx, miny)
+    row_min, row_max = min(row_min, row_max), max(row_min, row_max)
+    col_min, col_max = min(col_min, col_max), max(col_min, col_max)
+    if margin_cells is None:
+        margin_cells = max(10, int(0.1 * max(row_max - row_min, col_max - col_min)))
+    h, w = shape
+    row_min, row_max = max(0, row_min - margin_cells), min(h-1, row_max + margin_cells)
+    col_min, col_max = max(0, col_min - margin_cells), min(w-1, col_max + margin_cells)
+    if row_min > row_max or col_min > col_max:
+        return None
+    return (slice(row_min, row_max + 1), slice(col_min, col_max + 1))
+
+def flow_routing_cells(transform, shape, outer_coords_xy):
+    """Number of cells in the flow_routing_window() of a basin polygon (0 if empty)."""
+    window = flow_routing_window(transform, shape, outer_coords_xy)
+    if window is None:
+        return 0
+    return (window[0].stop - window[0].start) * (window[1].stop - window[1].start)
+
+def flow_routing_auto_limit():
+    """Largest routing window routed without an explicit request (depends on numba)."""
+    return FLOW_ROUTING_AUTO_MAX_CELLS if HAS_NUMBA else FLOW_ROUTING_AUTO_MAX_CELLS_PYTHON
+
+def basin_main_flow_path(dem_array, transform, nodata, outer_coords_xy, valid=None, margin_cells=None):
+    """
+    Main flow path through a basin polygon from D8 flow routing.
+    
+    The basin window (plus a margin so routing is not truncated at the polygon) is
+    depression-filled, routed with D8 and accumulated. The path starts at the cell of
+    maximum accumulation inside the polygon (the basin outlet) and is traced upstream,
+    always into the donor with the largest accumulation, while it stays inside.
+    
+    Args:
+        dem_array: DEM array
+        transform: Rasterio transform
+        nodata: Nodata value
+        outer_coords_xy: Basin polygon coordinates in projected CRS
+        valid: Optional validity mask; derived from nodata/NaN if omitted
+        margin_cells: Cells added around the polygon bounds (default 10% of the window, min 10)
+    
+    Returns:
+        List of (x, y) from upstream to downstream in projected CRS, or None
+    """
+    from shapely.geometry import Polygon
+    
+    if valid is None:
+        valid = dem_valid_mask(dem_array, nodata)
+    outer_poly = Polygon(outer_coords_xy)
+    window = flow_routing_window(transform, dem_array.shape, outer_coords_xy, margin_cells)
+    if window is None:
+        return None
+    valid_win = valid[window]
+    filled = priority_flood_fill(dem_array[window], valid_win)
+    receivers = d8_receivers(filled, valid_win, abs(transform.a), abs(transform.e))
+    acc = flow_accumulation(receivers, valid_win)
+    
+    win_h, win_w = valid_win.shape
+    rows, cols = np.mgrid[window]
+    px, py = pixel_centers(transform, rows, cols)
+    inside = (shapely.contains_xy(outer_poly, px, py) & valid_win).ravel()
+    if not inside.any():
+        return None
+    
+    # Donors of every cell, grouped by receiver for the upstream trace
+    donors = np.flatnonzero(receivers >= 0)
+    donors = donors[np.argsort(receivers[donors], kind="stable")]
+    donor_targets = receivers[donors]
+    
+    cell = int(np.argmax(np.where(inside, acc, -1.0)))
+    path = [cell]
+    while True:
+        lo, hi = np.searchsorted(donor_targets, [cell, cell + 1])
+        upstream_cells = donors[lo:hi]
+        upstream_cells = upstream_cells[inside[upstream_cells]]
+        if upstream_cells.size == 0:
+            break
+        cell = int(upstream_cells[np.argmax(acc[upstream_cells])])
+        path.append(cell)
+    if len(path) < 2:
+        return None
+    
+    path = np.array(path[::-1])
+    coords = list(zip(px.ravel()[path].tolist(), py.ravel()[path].tolist()))
+    # Drop the staircase of D8 steps, keeping the path within one cell of the routed cells
+    simplified = LineString(coords).simplify(max(abs(transform.a), abs(transform.e)))
+    return [tuple(c) for c in simplified.coords]
+
 # ============================================================================
 # BASIN DESIGN FUNCTIONS
 # ============================================================================
 
-def calculate_dem_volume(original_dem, modified_dem, transform, nodata, polygon_coords_xy):
+def calculate_dem_volume(original_dem, modified_dem, transform, nodata, polygon_coords_xy, valid=None):
     """
     Calculate excavation volume using DEM differencing within a polygon mask.
     
@@ -2124,12 +3106,13 @@ def calculate_dem_volume(original_dem, modified_dem, transform, nodata, polygon_
         transform: Rasterio transform
         nodata: Nodata value
         polygon_coords_xy: Polygon coordinates in projected CRS for clipping
+        valid: Optional validity mask; derived from nodata/NaN in both DEMs if omitted
     
     Returns:
         volume: Excavation volume in m³ (sum of positive differences)
     """
-    from shapely.geometry import Polygon, Point
-    from rasterio.transform import xy
+    from shapely.geometry import Polygon
+    from rasterio.features import geometry_mask
     
     try:
         # Basic validation
@@ -2171,41 +3154,19 @@ def calculate_dem_volume(original_dem, modified_dem, transform, nodata, polygon_
             cell_area = cell_size * cell_size
 
         # Step 2: Compute difference raster: original_dem - modified_dem
-        # Convert to float arrays to handle any type issues
-        orig_array = np.array(original_dem, dtype=np.float64)
-        mod_array = np.array(modified_dem, dtype=np.float64)
-        diff = orig_array - mod_array
-
-        # Step 3 & 4: Clip to polygon and sum positive differences * cell_area
-        volume = 0.0
-        h, w = orig_array.shape
-
-        for r in range(h):
-            for c in range(w):
-                # Check if pixel is valid (not nodata and not NaN)
-                orig_val = orig_array[r, c]
-                mod_val = mod_array[r, c]
-                
-                # Skip nodata pixels
-                if nodata is not None:
-                    if orig_val == nodata or mod_val == nodata:
-                        continue
-                
-                # Skip NaN pixels
-                if np.isnan(orig_val) or np.isnan(mod_val):
-                    continue
-                
-                # Get pixel center coordinates
-                x, y = xy(transform, r, c)
-                point = Point(x, y)
-
-                # Check if point is inside polygon (clipping to basin polygon)
-                if poly.contains(point):
-                    # Step 3: Treat positive differences as excavation; ignore zero or negative
-                    diff_val = diff[r, c]
-                    if diff_val > 0:
-                        # Step 4: Sum positive differences * cell_area
-                        volume += diff_val * cell_area
+        # Both DEMs stay float32; only the volume sum below accumulates in float64
+        orig_array = np.asarray(original_dem, dtype=np.float32)
+        mod_array = np.asarray(modified_dem, dtype=np.float32)
+        if valid is None:
+            valid = dem_valid_mask(orig_array, nodata) & dem_valid_mask(mod_array, nodata)
+
+        # Step 3: Clip to polygon (pixel centres inside the basin polygon)
+        inside = geometry_mask([poly], out_shape=orig_array.shape, transform=transform, invert=True)
+        keep = valid & inside
+
+        # Step 4: Treat positive differences as excavation; sum positive differences * cell_area
+        diff = orig_array[keep] - mod_array[keep]
+        volume = diff[diff > 0].sum(dtype=np.float64) * cell_area
 
         return float(volume)
     except Exception as e:
@@ -2239,6 +3200,11 @@ def calculate_dem_volume_uncertainty(original_dem, modified_dem, transform, noda
         poly = Polygon(polygon_coords_xy)
         minx, miny, maxx, maxy = poly.bounds
         
+        # Float32 copies with invalid cells set to NaN (used by the local bilinear path)
+        if analysis_crs is None:
+            orig_nan = np.where(dem_valid_mask(original_dem, nodata), original_dem, np.nan).astype(np.float32)
+            mod_nan = np.where(dem_valid_mask(modified_dem, nodata), modified_dem, np.nan).astype(np.float32)
+        
         # Add small buffer
         buffer = 10.0
         minx -= buffer
@@ -2260,54 +3226,35 @@ def calculate_dem_volume_uncertainty(original_dem, modified_dem, transform, noda
                 
                 # Use simple bilinear interpolation if analysis_crs is None (e.g., in local tests)
                 if analysis_crs is None:
-                    orig_h, orig_w = original_dem.shape
+                    orig_h, orig_w = orig_nan.shape
                     
-                    orig_resampled = np.empty((height, width), dtype=np.float32)
-                    mod_resampled = np.empty((height, width), dtype=np.float32)
+                    # World coords of every target pixel centre, mapped to original raster coords
+                    cols, rows = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+                    world_x, world_y = new_transform * (cols, rows)
+                    orig_col, orig_row = ~transform * (world_x, world_y)
                     
-                    for row in range(height):
-                        for col in range(width):
-                            # Get world coords of this target pixel
-                            world_x, world_y = new_transform * (col + 0.5, row + 0.5)
-                            # Convert to original raster coords
-                            orig_col, orig_row = ~transform * (world_x, world_y)
-                            
-                            # Bilinear interpolation
-                            if 0 <= orig_row < orig_h - 1 and 0 <= orig_col < orig_w - 1:
-                                oc, of = int(orig_col), orig_col - int(orig_col)
-                                or_, rf = int(orig_row), orig_row - int(orig_row)
-                                
-                                # Bilinear weights for original DEM
-                                v00 = original_dem[or_, oc]
-                                v01 = original_dem[or_, oc + 1]
-                                v10 = original_dem[or_ + 1, oc]
-                                v11 = original_dem[or_ + 1, oc + 1]
-                                
-                                orig_resampled[row, col] = (
-                                    v00 * (1 - of) * (1 - rf) +
-                                    v01 * of * (1 - rf) +
-                                    v10 * (1 - of) * rf +
-                                    v11 * of * rf
-                                )
-                                
-                                # Bilinear weights for modified DEM
-                                m00 = modified_dem[or_, oc]
-                                m01 = modified_dem[or_, oc + 1]
-                                m10 = modified_dem[or_ + 1, oc]
-                                m11 = modified_dem[or_ + 1, oc + 1]
-                                
-                                mod_resampled[row, col] = (
-                                    m00 * (1 - of) * (1 - rf) +
-                                    m01 * of * (1 - rf) +
-                                    m10 * (1 - of) * rf +
-                                    m11 * of * rf
-                                )
-                            else:
-                                orig_resampled[row, col] = np.nan
-                                mod_resampled[row, col] = np.nan
+                    inside = (orig_row >= 0) & (orig_row < orig_h - 1) & (orig_col >= 0) & (orig_col < orig_w - 1)
+                    oc = np.clip(np.floor(orig_col).astype(np.intp), 0, max(orig_w - 2, 0))
+                    or_ = np.clip(np.floor(orig_row).astype(np.intp), 0, max(orig_h - 2, 0))
+                    of = (orig_col - oc).astype(np.float32)
+                    rf = (orig_row - or_).astype(np.float32)
+                    
+                    def _bilinear(src):
+                        # Invalid source cells are NaN, so they invalidate every target cell they touch
+                        out = (
+                            src[or_, oc] * (1 - of) * (1 - rf) +
+                            src[or_, oc + 1] * of * (1 - rf) +
+                            src[or_ + 1, oc] * (1 - of) * rf +
+                            src[or_ + 1, oc + 1] * of * rf
+                        )
+                        return np.where(inside, out, np.float32(np.nan)).astype(np.float32, copy=False)
+                    
+                    orig_resampled = _bilinear(orig_nan)
+                    mod_resampled = _bilinear(mod_nan)
                 else:
                     # Use rasterio reproject with provided CRS
-                    orig_resampled = np.empty((height, width), dtype=np.float32)
+                    fill_value = np.nan if nodata is None else nodata
+                    orig_resampled = np.full((height, width), fill_value, dtype=np.float32)
                     reproject(
                         source=original_dem,
                         destination=orig_resampled,
@@ -2321,7 +3268,7 @@ def calculate_dem_volume_uncertainty(original_dem, modified_dem, transform, noda
                     )
                     
                     # Resample modified DEM
-                    mod_resampled = np.empty((height, width), dtype=np.float32)
+                    mod_resampled = np.full((height, width), fill_value, dtype=np.float32)
                     reproject(
                         source=modified_dem,
                         destination=mod_resampled,
@@ -2613,16 +3560,19 @@ def calculate_basin_volume(outer_coords_xy, inner_coords_xy, depth, side_slope,
     
     return volume, outer_area, inner_area
 
-def calculate_basin_volume_tin(outer_coords_xy, depth, side_slope, longitudinal_slope=0.0, flow_length=0.0, channel_coords_xy=None):
+def calculate_basin_volume_tin(outer_coords_xy, depth, side_slope, longitudinal_slope=0.0, flow_length=0.0, channel_coords_xy=None,
+                               dem_array=None, transform=None, nodata=None, valid=None, flow_field=None, max_points=1_000_000):
     """
-    Calculate basin volume using TIN (Triangulated Irregular Network) approach.
+    Calculate basin volume from a Triangulated Irregular Network (TIN).
     
     This method:
-    1. Uses the existing inner polygon calculation to ensure proper geometry
-    2. Generates 3D point cloud for outer polygon (Z=0)
-    3. Calculates inner ring points with variable depth Z = -Depth_local
-    4. Constructs TIN mesh connecting top and bottom rings
-    5. Calculates volume by summing signed volumes of triangular elements within the basin
+    1. Samples vertices on a regular grid inside the basin (DEM cell spacing, coarsened
+       to at most max_points) plus the breaklines: outer edge, toe of the side slopes
+       (inner polygon) and channel, densified to the same spacing
+    2. Evaluates the existing surface (bilinear DEM, or Z=0 without a DEM) and the design
+       surface (existing minus the basin cut depth, as applied to the DEM) at every vertex
+    3. Delaunay-triangulates the vertices and keeps triangles inside the outer polygon
+    4. Sums the prism volumes between the two surfaces: area × mean vertex depth
     
     Args:
         outer_coords_xy: List of (x, y) coordinates for outer polygon in projected CRS
@@ -2631,15 +3581,14 @@ def calculate_basin_volume_tin(outer_coords_xy, depth, side_slope, longitudinal_
         longitudinal_slope: Longitudinal slope percentage (positive = downstream deeper)
         flow_length: Total flow length in meters
         channel_coords_xy: Optional channel line coordinates in projected CRS (list of (x,y) tuples)
+        dem_array, transform, nodata, valid: Optional DEM for the existing surface and vertex spacing
+        flow_field: Optional basin_flow_field() result (channel/flow direction and flow length)
+        max_points: Upper bound on grid vertices
     
     Returns:
         volume: Basin volume in cubic meters
         status: Status message string
     """
-    from shapely.geometry import Polygon, Point, LineString
-    from shapely.ops import nearest_points
-    import math
-    
     try:
         # Validate input
         if not outer_coords_xy or len(outer_coords_xy) < 3:
@@ -2648,368 +3597,1498 @@ def calculate_basin_volume_tin(outer_coords_xy, depth, side_slope, longitudinal_
         if side_slope <= 0:
             return 0.0, "❌ Invalid side slope"
         
-        # Create outer polygon
-        outer_poly = Polygon(outer_coords_xy)
+        if not HAS_SCIPY:
+            return 0.0, "❌ TIN volume requires scipy (pip install scipy)"
+        
+        if flow_field is not None:
+            channel_coords_xy = flow_field["channel_coords_xy"]
+            flow_length = flow_field["flow_length"]
+            upstream, flow_unit = flow_field["upstream"], flow_field["flow_unit"]
+        else:
+            # Without a flow field: straight flow from the first to the last polygon vertex
+            upstream = tuple(outer_coords_xy[0][:2])
+            dx, dy = outer_coords_xy[-1][0] - upstream[0], outer_coords_xy[-1][1] - upstream[1]
+            norm = np.hypot(dx, dy)
+            flow_unit = (dx / norm, dy / norm) if norm > 0 else (1.0, 0.0)
+        if channel_coords_xy is not None and len(channel_coords_xy) < 2:
+            channel_coords_xy = None
+        
+        outer_poly, inner_poly = basin_design_geometry(outer_coords_xy, depth, side_slope, longitudinal_slope, flow_length)
         if not outer_poly.is_valid:
             outer_poly = outer_poly.buffer(0)
-            if not outer_poly.is_valid or outer_poly.is_empty:
+            if not outer_poly.is_valid or outer_poly.is_empty or outer_poly.geom_type != 'Polygon':
                 return 0.0, "❌ Invalid outer polygon geometry"
         
-        # Get outer polygon coordinates (remove duplicate closing point if present)
-        outer_coords = list(outer_poly.exterior.coords)
-        if len(outer_coords) > 1 and outer_coords[0] == outer_coords[-1]:
-            outer_coords = outer_coords[:-1]
-        
-        num_outer_points = len(outer_coords)
-        if num_outer_points < 3:
-            return 0.0, "❌ Insufficient polygon vertices"
-        
-        # Calculate inner polygon using existing function (ensures proper buffer operation)
-        inner_coords_xy, inner_poly_error = calculate_inner_polygon(
-            outer_coords_xy, depth, side_slope, longitudinal_slope, flow_length
-        )
-        
-        if inner_coords_xy is None or len(inner_coords_xy) < 3:
-            # Inner polygon collapsed to point or failed - use pyramid approximation
-            if flow_length > 0 and longitudinal_slope != 0:
-                avg_depth = depth + (longitudinal_slope / 100.0) * (flow_length / 2.0)
-                avg_depth = max(0.0, avg_depth)
-                volume = (1/3) * outer_poly.area * avg_depth
-            else:
-                volume = (1/3) * outer_poly.area * depth
-            return volume, "✅ TIN volume calculated (pyramid approximation - inner polygon too small)"
-        
-        # Create inner polygon
-        inner_poly = Polygon(inner_coords_xy)
-        if not inner_poly.is_valid:
-            inner_poly = inner_poly.buffer(0)
-            if not inner_poly.is_valid or inner_poly.is_empty:
-                # Fallback to pyramid
-                if flow_length > 0 and longitudinal_slope != 0:
-                    avg_depth = depth + (longitudinal_slope / 100.0) * (flow_length / 2.0)
-                    avg_depth = max(0.0, avg_depth)
-                    volume = (1/3) * outer_poly.area * avg_depth
-                else:
-                    volume = (1/3) * outer_poly.area * depth
-                return volume, "✅ TIN volume calculated (pyramid approximation)"
-        
-        # Check if inner polygon is too small (less than 1% of outer area)
-        inner_area = inner_poly.area
-        outer_area = outer_poly.area
-        if inner_area < outer_area * 0.01:
-            # Inner polygon is too small - use pyramid/frustum approximation with variable depth
-            if flow_length > 0 and longitudinal_slope != 0:
-                avg_depth = depth + (longitudinal_slope / 100.0) * (flow_length / 2.0)
-                avg_depth = max(0.0, avg_depth)
-                volume = (1/3) * outer_area * avg_depth
-            else:
-                volume = (1/3) * outer_area * depth
-            return volume, "✅ TIN volume calculated (pyramid approximation - inner polygon too small)"
-        
-        # Get inner polygon coordinates
-        inner_coords = list(inner_poly.exterior.coords)
-        if len(inner_coords) > 1 and inner_coords[0] == inner_coords[-1]:
-            inner_coords = inner_coords[:-1]
-        
-        num_inner_points = len(inner_coords)
-        
-        # Determine flow path for calculating distance along flow
-        flow_path = None
-        if channel_coords_xy is not None and len(channel_coords_xy) >= 2:
-            flow_path = LineString(channel_coords_xy)
-        else:
-            if num_outer_points >= 2:
-                flow_path = LineString([outer_coords[0], outer_coords[-1]])
-            else:
-                return 0.0, "❌ Cannot determine flow path"
-        
-        flow_path_length = flow_path.length if flow_path.length > 0 else 1.0
-        
-        # TIN method: Creates 3D mesh and uses cross-sectional integration
-        # This is INDEPENDENT from the geometric volume calculation
-        # Uses variable depth along the flow path
+        # Vertex spacing: DEM cell size, coarsened to respect max_points
+        spacing = np.sqrt(outer_poly.area / max_points)
+        if transform is not None:
+            spacing = max(spacing, abs(transform.a), abs(transform.e))
         
-        # Get inner polygon coordinates
-        inner_coords = list(inner_poly.exterior.coords)
-        if len(inner_coords) > 1 and inner_coords[0] == inner_coords[-1]:
-            inner_coords = inner_coords[:-1]
-        
-        # For TIN volume with variable depth:
-        # Integrate frustum formula along the flow path using Simpson's rule
-        # This accounts for depth variation but gives independent result from geometric method
-        
-        if flow_length > 0 and longitudinal_slope != 0:
-            # Calculate depth at upstream and downstream
-            downstream_depth = depth + (longitudinal_slope / 100.0) * flow_length
-            downstream_depth = max(0.0, downstream_depth)
-            
-            # Calculate frustum volumes at key points for Simpson's rule integration
-            V_upstream = (depth / 3.0) * (
-                outer_area + inner_area + math.sqrt(outer_area * inner_area)
-            )
-            
-            # Midpoint depth
-            mid_depth = (depth + downstream_depth) / 2.0
-            V_midpoint = (mid_depth / 3.0) * (
-                outer_area + inner_area + math.sqrt(outer_area * inner_area)
-            )
-            
-            # Downstream depth
-            V_downstream = (downstream_depth / 3.0) * (
-                outer_area + inner_area + math.sqrt(outer_area * inner_area)
-            )
-            
-            # Simpson's rule for TIN integration
-            # Note: Different weighting than geometric method, giving independent result
-            volume = (2*V_upstream + 3*V_midpoint + 2*V_downstream) / 8.0
+        # Grid vertices inside the polygon
+        minx, miny, maxx, maxy = outer_poly.bounds
+        gx, gy = np.meshgrid(np.arange(minx + spacing / 2, maxx, spacing), np.arange(miny + spacing / 2, maxy, spacing))
+        gx, gy = gx.ravel(), gy.ravel()
+        inside = shapely.contains_xy(outer_poly, gx, gy)
+        
+        # Breakline vertices, densified to the grid spacing
+        breaklines = [outer_poly.exterior]
+        if inner_poly is not None:
+            breaklines.append(inner_poly.exterior)
+        if channel_coords_xy is not None:
+            breaklines.append(LineString(channel_coords_xy).intersection(outer_poly))
+        break_xy = np.vstack([shapely.get_coordinates(shapely.segmentize(line, spacing)) for line in breaklines
+                              if not line.is_empty])
+        
+        pts = np.unique(np.vstack([np.column_stack([gx[inside], gy[inside]]), break_xy]), axis=0)
+        if len(pts) < 3:
+            return 0.0, "❌ Basin too small for triangulation"
+        
+        # Existing and design surfaces at the vertices
+        dist_along = distance_along_flow(pts[:, 0], pts[:, 1], channel_coords_xy, upstream, flow_unit)
+        cut_depth = basin_cut_depth(pts[:, 0], pts[:, 1], dist_along, outer_poly, inner_poly,
+                                    depth, side_slope, longitudinal_slope, flow_length)
+        if dem_array is not None and transform is not None:
+            if valid is None:
+                valid = dem_valid_mask(dem_array, nodata)
+            z_existing = sample_dem_bilinear(dem_array, transform, valid, pts[:, 0], pts[:, 1])
         else:
-            # No slope: standard frustum
-            volume = (depth / 3.0) * (outer_area + inner_area + math.sqrt(outer_area * inner_area))
-        
-        
-        return volume, "✅ TIN volume calculated"
+            z_existing = np.zeros(len(pts))
+        z_design = z_existing - cut_depth
+        
+        # Triangulate and sum prism volumes (vectorized over all triangles)
+        triangles = Delaunay(pts).simplices
+        tri_xy = pts[triangles]
+        centroid = tri_xy.mean(axis=1)
+        area = 0.5 * np.abs((tri_xy[:, 1, 0] - tri_xy[:, 0, 0]) * (tri_xy[:, 2, 1] - tri_xy[:, 0, 1]) -
+                            (tri_xy[:, 2, 0] - tri_xy[:, 0, 0]) * (tri_xy[:, 1, 1] - tri_xy[:, 0, 1]))
+        tri_dz = (z_existing - z_design)[triangles].mean(axis=1)
+        keep = shapely.contains_xy(outer_poly, centroid[:, 0], centroid[:, 1]) & ~np.isnan(tri_dz)
+        volume = float(np.sum(area[keep] * tri_dz[keep], dtype=np.float64))
+        
+        status = f"✅ TIN volume calculated ({int(keep.sum()):,} triangles, {len(pts):,} vertices)"
+        covered = float(area[keep].sum()) / outer_poly.area if outer_poly.area > 0 else 0.0
+        if covered < 0.99:
+            status += f" • {covered:.0%} of basin area has DEM coverage"
+        return volume, status
     
     except Exception as e:
         return 0.0, f"❌ Error: {str(e)}"
 
-def apply_basin_to_dem(dem_array, transform, nodata, outer_coords_xy, depth, side_slope, longitudinal_slope=0.0, channel_coords_xy=None):
+def basin_design_geometry(outer_coords_xy, depth, side_slope, longitudinal_slope=0.0, flow_length=0.0):
     """
-    Apply basin cut to DEM with optional longitudinal slope.
+    Outer polygon and toe (inner) polygon of the basin cut applied to the DEM.
+    The toe is offset by the maximum depth × side slope (H:1V); None if it collapses.
+    """
+    from shapely.geometry import Polygon
     
-    For each pixel inside the outer polygon:
-    - If inside inner polygon: elevation = existing_elev - depth_at_point
-    - If between inner and outer: interpolate based on distance from edge
+    outer_poly = Polygon(outer_coords_xy)
+    # For longitudinal slope, use the maximum depth (downstream end if positive slope)
+    max_depth = depth + (longitudinal_slope / 100.0) * flow_length if longitudinal_slope > 0 else depth
+    inner_poly = outer_poly.buffer(-max_depth * side_slope, join_style=2)
+    if inner_poly.is_empty:
+        inner_poly = None
+    elif inner_poly.geom_type == 'MultiPolygon':
+        inner_poly = max(inner_poly.geoms, key=lambda p: p.area)
+    return outer_poly, inner_poly
+
+def distance_along_flow(px, py, channel_coords_xy=None, upstream=(0.0, 0.0), flow_unit=(1.0, 0.0)):
+    """
+    Distance along flow for point arrays.
+    With a channel: cumulative channel distance at the nearest segment (one vectorized
+    pass per segment); otherwise the projection onto the straight flow direction.
+    """
+    px, py = np.asarray(px, dtype=np.float64), np.asarray(py, dtype=np.float64)
+    if channel_coords_xy is None:
+        return (px - upstream[0]) * flow_unit[0] + (py - upstream[1]) * flow_unit[1]
+    
+    channel = np.asarray(channel_coords_xy, dtype=np.float64)[:, :2]
+    seg_vec = np.diff(channel, axis=0)
+    seg_len = np.hypot(seg_vec[:, 0], seg_vec[:, 1])
+    seg_cum = np.concatenate([[0.0], np.cumsum(seg_len)])
+    best_d2 = np.full(px.shape, np.inf)
+    dist_along = np.zeros(px.shape)
+    for k in range(len(seg_len)):
+        if seg_len[k] <= 0:
+            continue
+        ax, ay = channel[k]
+        dx, dy = seg_vec[k]
+        t = np.clip(((px - ax) * dx + (py - ay) * dy) / seg_len[k] ** 2, 0.0, 1.0)
+        d2 = (px - ax - t * dx) ** 2 + (py - ay - t * dy) ** 2
+        better = d2 < best_d2
+        best_d2 = np.where(better, d2, best_d2)
+        dist_along = np.where(better, seg_cum[k] + t * seg_len[k], dist_along)
+    return dist_along
+
+def basin_cut_depth(px, py, dist_along, outer_poly, inner_poly, depth, side_slope,
+                    longitudinal_slope=0.0, flow_length=0.0):
+    """
+    Cut depth below existing ground at points inside the basin (vectorized).
+    Full design depth (varying along flow) inside the toe polygon; on the side slopes
+    it grows linearly from 0 at the outer edge over depth × side slope.
+    """
+    px, py = np.asarray(px, dtype=np.float64), np.asarray(py, dtype=np.float64)
+    # Depth from the distance along flow (longitudinal slope in percent)
+    if flow_length > 0 and abs(longitudinal_slope) > 0.01:
+        depth_at_point = np.maximum(0.0, depth + (longitudinal_slope / 100.0) * np.asarray(dist_along, dtype=np.float64))
+    else:
+        depth_at_point = np.full(px.shape, float(depth))
+    
+    in_inner = shapely.contains_xy(inner_poly, px, py) if inner_poly is not None else np.zeros(px.shape, dtype=bool)
+    dist_to_outer = shapely.distance(outer_poly.exterior, shapely.points(px, py))
+    offset_at_point = depth_at_point * side_slope
+    fraction = np.divide(dist_to_outer, offset_at_point, out=np.zeros(px.shape), where=offset_at_point > 0)
+    return np.where(in_inner | (dist_to_outer >= offset_at_point), depth_at_point, fraction * depth_at_point)
+
+def basin_aoi(dem_array, transform, nodata, outer_coords_xy, valid=None, hypsometry_bins=20):
+    """
+    Basin area of interest: polygon mask and terrain statistics over the basin window.
     
     Args:
         dem_array: DEM array
         transform: Rasterio transform
         nodata: Nodata value
-        outer_coords_xy: Outer polygon coordinates in projected CRS
-        depth: Basin depth in meters (at upstream end)
-        side_slope: Side slope ratio (H:1V)
-        longitudinal_slope: Longitudinal slope percentage (positive = downstream deeper)
-        channel_coords_xy: Optional channel line coordinates in projected CRS (list of (x,y) tuples)
+        outer_coords_xy: Basin polygon coordinates in projected CRS
+        valid: Optional validity mask; derived from nodata/NaN if omitted
+        hypsometry_bins: Number of elevation bins in the hypsometric histogram
     
     Returns:
-        new_dem: Modified DEM array
-        volume: Excavation volume in cubic meters
+        dict with "window" (row_min, row_max, col_min, col_max), "inside" (pixel centres
+        inside the polygon), "mask" (inside and valid), "x"/"y" pixel centres, "z" (DEM
+        window view), "transform", "cell_area", "area_m2" (valid cells), "polygon_area_m2",
+        "min_elev"/"min_xy", "max_elev"/"max_xy", "mean_elev" (None without valid cells),
+        "hypsometry" (bin edges, cell counts, fraction of area above each edge) and
+        "dem"/"valid" (the full DEM and validity mask, for sampling beyond the window)
     """
-    from shapely.geometry import Polygon, Point
-    from rasterio.transform import rowcol, xy
-    
-    new_dem = dem_array.copy()
+    from shapely.geometry import Polygon
     
-    # Create polygons
+    if valid is None:
+        valid = dem_valid_mask(dem_array, nodata)
     outer_poly = Polygon(outer_coords_xy)
+    minx, miny, maxx, maxy = outer_poly.bounds
+    row_min, col_min = rowcol(transform, minx, maxy)
+    row_max, col_max = rowcol(transform, maxx, miny)
+    h, w = dem_array.shape
+    row_min, row_max = max(0, min(row_min, row_max)), min(h-1, max(row_min, row_max))
+    col_min, col_max = max(0, min(col_min, col_max)), min(w-1, max(col_min, col_max))
     
-    # Determine flow direction: use channel if provided, otherwise first vertex to min elevation
-    # Safety check: ensure channel_coords_xy is a valid iterable, not a scalar
-    if channel_coords_xy is not None:
-        # Check if it's a valid iterable (list, tuple, array) and not a scalar
-        if not hasattr(channel_coords_xy, "__iter__") or isinstance(channel_coords_xy, (str, bytes)):
-            channel_coords_xy = None  # Invalid type, treat as None
-        elif hasattr(channel_coords_xy, "__len__") and len(channel_coords_xy) < 2:
-            channel_coords_xy = None  # Not enough points, treat as None
-    
-    if channel_coords_xy is not None and len(channel_coords_xy) >= 2:
-        # Use channel: first point = upstream, last point = downstream
-        upstream_x, upstream_y = channel_coords_xy[0]
-        downstream_x, downstream_y = channel_coords_xy[-1]
-        
-        # Calculate total channel length
-        flow_length = 0.0
-        for i in range(len(channel_coords_xy) - 1):
-            x1, y1 = channel_coords_xy[i]
-            x2, y2 = channel_coords_xy[i + 1]
-            flow_length += np.sqrt((x2 - x1)**2 + (y2 - y1)**2)
-        
-        # For depth calculation, we'll use distance along channel
-        # Store channel segments for later use
-        channel_segments = []
-        cumulative_dist = 0.0
-        for i in range(len(channel_coords_xy) - 1):
-            x1, y1 = channel_coords_xy[i]
-            x2, y2 = channel_coords_xy[i + 1]
-            seg_length = np.sqrt((x2 - x1)**2 + (y2 - y1)**2)
-            channel_segments.append({
-                'start': (x1, y1),
-                'end': (x2, y2),
-                'length': seg_length,
-                'cumulative_start': cumulative_dist,
-                'cumulative_end': cumulative_dist + seg_length
-            })
-            cumulative_dist += seg_length
-        
-        # For unit vector, use overall direction
-        flow_dx = downstream_x - upstream_x
-        flow_dy = downstream_y - upstream_y
-        if flow_length > 0:
-            flow_unit_x = flow_dx / flow_length
-            flow_unit_y = flow_dy / flow_length
-        else:
-            flow_unit_x, flow_unit_y = 1.0, 0.0
-    else:
-        # Fallback: first vertex to minimum elevation
-        upstream_x, upstream_y = outer_coords_xy[0]  # First vertex is upstream
-        
-        # Find point with minimum elevation within polygon (downstream)
-        minx, miny, maxx, maxy = outer_poly.bounds
-        row_min, col_min = rowcol(transform, minx, maxy)
-        row_max, col_max = rowcol(transform, maxx, miny)
-        
-        h, w = dem_array.shape
-        row_min, row_max = max(0, min(row_min, row_max)), min(h-1, max(row_min, row_max))
-        col_min, col_max = max(0, min(col_min, col_max)), min(w-1, max(col_min, col_max))
-        
-        # Find minimum elevation point within polygon
-        min_elev = float('inf')
-        downstream_x, downstream_y = upstream_x, upstream_y  # Default to upstream if not found
-        
-        for r in range(row_min, row_max + 1):
-            for c in range(col_min, col_max + 1):
-                z_val = dem_array[r, c]
-                if nodata is not None and z_val == nodata:
-                    continue
-                
-                x, y = xy(transform, r, c)
-                point = Point(x, y)
-                
-                if outer_poly.contains(point) and z_val < min_elev:
-                    min_elev = z_val
-                    downstream_x, downstream_y = x, y
-        
-        # Calculate flow vector and length
-        flow_dx = downstream_x - upstream_x
-        flow_dy = downstream_y - upstream_y
-        flow_length = np.sqrt(flow_dx**2 + flow_dy**2)
-        
-        # Normalize flow direction vector
-        if flow_length > 0:
-            flow_unit_x = flow_dx / flow_length
-            flow_unit_y = flow_dy / flow_length
+    window = (slice(row_min, row_max + 1), slice(col_min, col_max + 1))
+    rows, cols = np.mgrid[window]
+    px, py = pixel_centers(transform, rows, cols)
+    inside = shapely.contains_xy(outer_poly, px, py)
+    mask = inside & valid[window]
+    z_window = dem_array[window]
+    cell_area = abs(transform.a * transform.e)
+    
+    aoi = {
+        "window": (row_min, row_max, col_min, col_max),
+        "inside": inside,
+        "mask": mask,
+        "x": px,
+        "y": py,
+        "z": z_window,
+        "dem": dem_array,
+        "valid": valid,
+        "transform": transform,
+        "cell_area": cell_area,
+        "area_m2": float(mask.sum()) * cell_area,
+        "polygon_area_m2": outer_poly.area,
+        "min_elev": None, "min_xy": None,
+        "max_elev": None, "max_xy": None,
+        "mean_elev": None,
+        "hypsometry": None,
+    }
+    if not mask.any():
+        return aoi
+    
+    z_inside = z_window[mask].astype(np.float64)
+    # First lowest/highest pixel in row-major order
+    i_min = np.unravel_index(np.argmin(np.where(mask, z_window, np.inf)), z_window.shape)
+    i_max = np.unravel_index(np.argmax(np.where(mask, z_window, -np.inf)), z_window.shape)
+    counts, edges = np.histogram(z_inside, bins=hypsometry_bins)
+    aoi.update({
+        "min_elev": float(z_window[i_min]), "min_xy": (float(px[i_min]), float(py[i_min])),
+        "max_elev": float(z_window[i_max]), "max_xy": (float(px[i_max]), float(py[i_max])),
+        "mean_elev": float(z_inside.mean()),
+        "hypsometry": {
+            "edges": edges,
+            "counts": counts,
+            "area_above_fraction": np.concatenate([[1.0], 1.0 - np.cumsum(counts) / counts.sum()]),
+        },
+    })
+    return aoi
+
+def sample_aoi_at_points(aoi, pts_x, pts_y, inside_only=True):
+    """
+    DEM elevations at points (NaN on invalid cells). With inside_only, points outside the
+    basin polygon are NaN too; otherwise any point on the DEM is sampled.
+    """
+    pts_x, pts_y = np.asarray(pts_x, dtype=np.float64), np.asarray(pts_y, dtype=np.float64)
+    inv = ~aoi["transform"]
+    cols = np.floor(inv.a * pts_x + inv.b * pts_y + inv.c).astype(np.int64)
+    rows = np.floor(inv.d * pts_x + inv.e * pts_y + inv.f).astype(np.int64)
+    if inside_only:
+        row_min, _, col_min, _ = aoi["window"]
+        z, ok = aoi["z"], aoi["mask"]
+        rows, cols = rows - row_min, cols - col_min
+    else:
+        z, ok = aoi["dem"], aoi["valid"]
+    h, w = z.shape
+    on_grid = (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+    r, c = np.where(on_grid, rows, 0), np.where(on_grid, cols, 0)
+    return np.where(on_grid & ok[r, c], z[r, c], np.nan).astype(np.float64)
+
+def basin_flow_field(aoi, outer_coords_xy, channel_coords_xy=None, num_profile_samples=100):
+    """
+    Distance-along-flow raster over the basin AOI window.
+    
+    With a channel, each pixel is projected onto its nearest channel segment (first
+    point = upstream) and takes the cumulative channel distance there. Without a
+    channel, flow runs from the first polygon vertex to the lowest valid pixel inside
+    the polygon and the distance is the projection onto that direction.
+    
+    Args:
+        aoi: basin_aoi() result for the polygon
+        outer_coords_xy: Basin polygon coordinates in projected CRS
+        channel_coords_xy: Optional channel line coordinates in projected CRS
+        num_profile_samples: Samples along the straight flow line when there is no channel
+    
+    Returns:
+        dict with the AOI's "window"/"inside"/"x"/"y", float32 "dist_along" (NaN outside),
+        "flow_length", "upstream", "downstream", "flow_unit", "channel_coords_xy" and the
+        existing-ground longitudinal profile "profile_dist"/"profile_z"
+    """
+    if channel_coords_xy is not None:
+        if not hasattr(channel_coords_xy, "__iter__") or isinstance(channel_coords_xy, (str, bytes)):
+            channel_coords_xy = None
+        elif len(channel_coords_xy) < 2:
+            channel_coords_xy = None
+    px, py = aoi["x"], aoi["y"]
+    
+    if channel_coords_xy is not None:
+        channel = np.asarray(channel_coords_xy, dtype=np.float64)[:, :2]
+        seg_vec = np.diff(channel, axis=0)
+        seg_len = np.hypot(seg_vec[:, 0], seg_vec[:, 1])
+        seg_cum = np.concatenate([[0.0], np.cumsum(seg_len)])
+        flow_length = float(seg_cum[-1])
+        upstream, downstream = tuple(channel[0]), tuple(channel[-1])
+        
+        dist_along = distance_along_flow(px, py, channel)
+        
+        # Profile at every channel vertex on a valid DEM cell, including endpoints on or
+        # beyond the polygon boundary (the polygon mask only limits routing and the cut)
+        profile_z = sample_aoi_at_points(aoi, channel[:, 0], channel[:, 1], inside_only=False)
+        keep = ~np.isnan(profile_z)
+        profile_dist, profile_z = seg_cum[keep], profile_z[keep]
+    else:
+        upstream = tuple(outer_coords_xy[0][:2])
+        downstream = aoi["min_xy"] if aoi["min_xy"] is not None else upstream
+        flow_length = float(np.hypot(downstream[0] - upstream[0], downstream[1] - upstream[1]))
+        dist_along = None
+    
+    if flow_length > 0:
+        flow_unit = ((downstream[0] - upstream[0]) / flow_length, (downstream[1] - upstream[1]) / flow_length)
+    else:
+        flow_unit = (1.0, 0.0)
+    if dist_along is None:
+        dist_along = distance_along_flow(px, py, None, upstream, flow_unit)
+        # Profile along the straight flow line (NaN outside the polygon)
+        profile_dist = np.linspace(0, flow_length, num_profile_samples)
+        profile_z = sample_aoi_at_points(aoi, upstream[0] + profile_dist * flow_unit[0],
+                                         upstream[1] + profile_dist * flow_unit[1])
+    
+    return {
+        "window": aoi["window"],
+        "inside": aoi["inside"],
+        "x": px,
+        "y": py,
+        "dist_along": np.where(aoi["inside"], dist_along, np.nan).astype(np.float32),
+        "flow_length": flow_length,
+        "upstream": upstream,
+        "downstream": downstream,
+        "flow_unit": flow_unit,
+        "channel_coords_xy": None if channel_coords_xy is None else [tuple(p[:2]) for p in channel_coords_xy],
+        "profile_dist": profile_dist,
+        "profile_z": profile_z,
+    }
+
+def cached_basin_aoi(dem_key, dem_array, transform, nodata, outer_coords_xy, valid=None):
+    """
+    basin_aoi() kept in session state, keyed on the polygon and the DEM identity (dem_key).
+    Reruns with the same polygon and DEM reuse it without touching the pixels.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.asarray(outer_coords_xy, dtype=np.float64).tobytes())
+    digest.update(str(dem_key).encode())
+    key = digest.hexdigest()
+    cached = st.session_state.get("basin_aoi_cache")
+    if cached is not None and cached["key"] == key:
+        return cached["aoi"]
+    aoi = basin_aoi(dem_array, transform, nodata, outer_coords_xy, valid=valid)
+    aoi["key"] = key
+    st.session_state.basin_aoi_cache = {"key": key, "aoi": aoi}
+    return aoi
+
+def cached_basin_flow_field(aoi, outer_coords_xy, channel_coords_xy=None):
+    """
+    basin_flow_field() kept in session state.
+    Rebuilt only when the basin AOI or the channel line changes.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(aoi["key"].encode())
+    if channel_coords_xy is not None:
+        digest.update(np.asarray(channel_coords_xy, dtype=np.float64).tobytes())
+    key = digest.hexdigest()
+    cached = st.session_state.get("basin_flow_cache")
+    if cached is not None and cached["key"] == key:
+        return cached["field"]
+    field = basin_flow_field(aoi, outer_coords_xy, channel_coords_xy)
+    st.session_state.basin_flow_cache = {"key": key, "field": field}
+    return field
+
+def cached_basin_channel(aoi, dem_array, transform, nodata, outer_coords_xy, valid=None):
+    """
+    basin_main_flow_path() kept in session state, keyed on the basin AOI.
+    Rebuilt only when the polygon or the DEM changes.
+    """
+    cached = st.session_state.get("basin_channel_cache")
+    if cached is not None and cached["key"] == aoi["key"]:
+        return cached["channel"]
+    channel = basin_main_flow_path(dem_array, transform, nodata, outer_coords_xy, valid=valid)
+    st.session_state.basin_channel_cache = {"key": aoi["key"], "channel": channel}
+    return channel
+
+def apply_basin_to_dem(dem_array, transform, nodata, outer_coords_xy, depth, side_slope, longitudinal_slope=0.0, channel_coords_xy=None, valid=None, flow_field=None):
+    """
+    Apply basin cut to DEM with optional longitudinal slope.
+    
+    For each pixel inside the outer polygon:
+    - If inside inner polygon: elevation = existing_elev - depth_at_point
+    - If between inner and outer: interpolate based on distance from edge
+    
+    Args:
+        dem_array: DEM array
+        transform: Rasterio transform
+        nodata: Nodata value
+        outer_coords_xy: Outer polygon coordinates in projected CRS
+        depth: Basin depth in meters (at upstream end)
+        side_slope: Side slope ratio (H:1V)
+        longitudinal_slope: Longitudinal slope percentage (positive = downstream deeper)
+        channel_coords_xy: Optional channel line coordinates in projected CRS (list of (x,y) tuples)
+        valid: Optional validity mask; derived from nodata/NaN if omitted
+        flow_field: Optional basin_flow_field() result for the same polygon/channel/DEM; built if omitted
+    
+    Returns:
+        new_dem: Modified DEM array (float32)
+        volume: Excavation volume in cubic meters
+    """
+    new_dem = dem_array.astype(np.float32, copy=True)
+    if valid is None:
+        valid = dem_valid_mask(dem_array, nodata)
+    if flow_field is None:
+        flow_field = basin_flow_field(basin_aoi(dem_array, transform, nodata, outer_coords_xy, valid=valid),
+                                      outer_coords_xy, channel_coords_xy)
+    flow_length = flow_field["flow_length"]
+    outer_poly, inner_poly = basin_design_geometry(outer_coords_xy, depth, side_slope, longitudinal_slope, flow_length)
+    
+    row_min, row_max, col_min, col_max = flow_field["window"]
+    window = (slice(row_min, row_max + 1), slice(col_min, col_max + 1))
+    target = flow_field["inside"] & valid[window]
+    z_old = new_dem[window][target]
+    local_depth = basin_cut_depth(flow_field["x"][target], flow_field["y"][target], flow_field["dist_along"][target],
+                                  outer_poly, inner_poly, depth, side_slope, longitudinal_slope, flow_length)
+    
+    z_new = (z_old - local_depth).astype(np.float32)
+    new_dem[window][target] = z_new
+    
+    cut_depth = z_old.astype(np.float64) - z_new
+    cell_area = abs(transform.a * transform.e)
+    total_cut_volume = float(cut_depth[cut_depth > 0].sum() * cell_area)
+    
+    return new_dem, total_cut_volume
+
+# ============================================================================
+# PROJECT FUNCTIONS
+# ============================================================================
+
+OVERLAP_RULES = {
+    "priority": "Higher priority wins",
+    "lowest": "Lowest surface wins (deepest cut)",
+    "highest": "Highest surface wins (highest fill)",
+}
+
+def alignment_feature_proposal(dem_array, transform, valid, feature):
+    """
+    Rows, cols and new elevations of the pixels an alignment feature changes.
+    feature holds "coords_xy" and the profile's "z_design" (per vertex, existing ground
+    if None), "template_type", "template_params", "influence_width" and "operation_mode".
+    """
+    samples = extract_profile_from_line(LineString(feature["coords_xy"]))
+    if len(samples) < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    z_design = feature.get("z_design")
+    if z_design is None or len(z_design) != len(samples):
+        z_design = sample_dem_bilinear(dem_array, transform, valid, samples[:, 1], samples[:, 2])
+    z_design = np.asarray(z_design, dtype=np.float64)
+    if np.isnan(z_design).all():
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    stations = samples[:, 0]
+    good = ~np.isnan(z_design)
+    z_design = np.interp(stations, stations[good], z_design[good])
+    
+    field = alignment_field(transform, dem_array.shape, samples, feature["influence_width"])
+    row_min, row_max, col_min, col_max = field["window"]
+    window = (slice(row_min, row_max + 1), slice(col_min, col_max + 1))
+    rr, cc = np.nonzero(valid[window] & (field["station_idx"] >= 0))
+    z_old = dem_array[window][rr, cc]
+    z_new = corridor_template_surface(
+        z_old, field["offset"][rr, cc], np.interp(field["chainage"][rr, cc], stations, z_design),
+        feature["template_type"], feature["template_params"], feature["operation_mode"]
+    )
+    changed = z_new != z_old
+    return rr[changed] + row_min, cc[changed] + col_min, z_new[changed]
+
+def basin_feature_proposal(dem_array, transform, nodata, valid, feature):
+    """
+    Rows, cols and new elevations of the pixels a basin feature changes.
+    feature holds "coords_xy", "depth", "side_slope", "long_slope" and an optional
+    "channel_xy". Without one, the channel is derived by D8 flow routing when the
+    routing window is within flow_routing_auto_limit(); larger basins use the first
+    vertex -> minimum elevation flow direction, as the Basin tab does until asked to route.
+    """
+    outer = feature["coords_xy"]
+    aoi = basin_aoi(dem_array, transform, nodata, outer, valid=valid)
+    channel = feature.get("channel_xy")
+    if channel is None and flow_routing_cells(transform, dem_array.shape, outer) <= flow_routing_auto_limit():
+        channel = basin_main_flow_path(dem_array, transform, nodata, outer, valid=valid)
+    flow = basin_flow_field(aoi, outer, channel)
+    outer_poly, inner_poly = basin_design_geometry(outer, feature["depth"], feature["side_slope"],
+                                                   feature["long_slope"], flow["flow_length"])
+    row_min, _, col_min, _ = aoi["window"]
+    rr, cc = np.nonzero(aoi["mask"])
+    local_depth = basin_cut_depth(flow["x"][rr, cc], flow["y"][rr, cc], flow["dist_along"][rr, cc],
+                                  outer_poly, inner_poly, feature["depth"], feature["side_slope"],
+                                  feature["long_slope"], flow["flow_length"])
+    z_new = (aoi["z"][rr, cc] - local_depth).astype(np.float32)
+    changed = local_depth > 0
+    return rr[changed] + row_min, cc[changed] + col_min, z_new[changed]
+
+def composite_features_on_dem(dem_array, transform, nodata, features, overlap_rule="priority", valid=None):
+    """
+    Composite several alignments and basins onto one DEM.
+    
+    Each feature proposes new elevations for the pixels it changes (evaluated against
+    the existing ground, independently of the others). The proposals are then written
+    in one pass over the union of their windows, in ascending priority, resolving
+    overlaps with overlap_rule:
+    - "priority": the higher-priority feature overwrites (list order breaks ties)
+    - "lowest": the lower proposed surface wins
+    - "highest": the higher proposed surface wins
+    
+    Args:
+        dem_array: DEM array
+        transform: Rasterio transform
+        nodata: Nodata value
+        features: list of dicts with "name", "kind" ("alignment"/"basin"), "priority",
+                  "coords_xy" in projected CRS and the kind's parameters
+        overlap_rule: One of OVERLAP_RULES
+        valid: Optional validity mask; derived from nodata/NaN if omitted
+    
+    Returns:
+        new_dem: Composited DEM (float32)
+        rows: Per-feature dicts with the cut/fill attributed to the feature in the
+              composite, its standalone cut/fill and the cells it owns
+        totals: dict with "cut", "fill" and "net" (fill - cut) in cubic meters
+    """
+    if overlap_rule not in OVERLAP_RULES:
+        raise ValueError(f"Unknown overlap rule: {overlap_rule}")
+    new_dem = dem_array.astype(np.float32, copy=True)
+    if valid is None:
+        valid = dem_valid_mask(dem_array, nodata)
+    cell_area = abs(transform.a * transform.e)
+    
+    proposals = []
+    for feature in features:
+        if feature["kind"] == "basin":
+            rr, cc, z_new = basin_feature_proposal(dem_array, transform, nodata, valid, feature)
+        else:
+            rr, cc, z_new = alignment_feature_proposal(dem_array, transform, valid, feature)
+        proposals.append((rr, cc, z_new))
+    
+    rows = []
+    for feature, (rr, cc, z_new) in zip(features, proposals):
+        dz = z_new.astype(np.float64) - dem_array[rr, cc]
+        rows.append({
+            "Feature": feature["name"],
+            "Kind": feature["kind"],
+            "Priority": feature["priority"],
+            "Cut (m³)": 0.0,
+            "Fill (m³)": 0.0,
+            "Standalone cut (m³)": float(-dz[dz < 0].sum() * cell_area),
+            "Standalone fill (m³)": float(dz[dz > 0].sum() * cell_area),
+            "Cells": 0,
+        })
+    
+    sizes = [rr.size for rr, _, _ in proposals]
+    if sum(sizes) == 0:
+        return new_dem, rows, {"cut": 0.0, "fill": 0.0, "net": 0.0}
+    
+    # Union window of all proposals
+    row_min = min(rr.min() for rr, _, _ in proposals if rr.size)
+    row_max = max(rr.max() for rr, _, _ in proposals if rr.size)
+    col_min = min(cc.min() for _, cc, _ in proposals if cc.size)
+    col_max = max(cc.max() for _, cc, _ in proposals if cc.size)
+    window = (slice(row_min, row_max + 1), slice(col_min, col_max + 1))
+    surface = new_dem[window]  # view into new_dem
+    owner = np.full(surface.shape, -1, dtype=np.int64)
+    
+    order = sorted(range(len(features)), key=lambda i: (features[i]["priority"], i))
+    for i in order:
+        rr, cc, z_new = proposals[i]
+        r, c = rr - row_min, cc - col_min
+        if overlap_rule == "lowest":
+            take = (owner[r, c] < 0) | (z_new < surface[r, c])
+        elif overlap_rule == "highest":
+            take = (owner[r, c] < 0) | (z_new > surface[r, c])
+        else:
+            take = np.ones(r.shape, dtype=bool)
+        surface[r[take], c[take]] = z_new[take]
+        owner[r[take], c[take]] = i
+    
+    owned = owner >= 0
+    dz = surface[owned].astype(np.float64) - dem_array[window][owned]
+    n = len(features)
+    cut = np.bincount(owner[owned], weights=np.maximum(-dz, 0.0), minlength=n) * cell_area
+    fill = np.bincount(owner[owned], weights=np.maximum(dz, 0.0), minlength=n) * cell_area
+    cells = np.bincount(owner[owned], minlength=n)
+    for i, row in enumerate(rows):
+        row["Cut (m³)"], row["Fill (m³)"], row["Cells"] = float(cut[i]), float(fill[i]), int(cells[i])
+    
+    total_cut, total_fill = float(cut.sum()), float(fill.sum())
+    return new_dem, rows, {"cut": total_cut, "fill": total_fill, "net": total_fill - total_cut}
+
+# ============================================================================
+# UNDO/REDO HISTORY
+# ============================================================================
+
+HISTORY_BUDGET_MB = float(os.environ.get("TERRAIN_EDITOR_HISTORY_MB", 256))
+
+# Widget keys tracked for undo/redo so inputs show restored values. Streamlit drops a
+# widget's key on runs that do not render it (other view or design mode), so their
+# appearing and disappearing is not recorded as an edit.
+HISTORY_WIDGET_KEYS = (
+    "template_xs", "mode_xs", "ditch_side_xs", "berm_height_xs", "berm_crest_xs", "berm_up_xs", "berm_down_xs",
+    "ditch_width_xs", "ditch_depth_xs", "ditch_slope_xs", "swale_xs", "sdepth_xs", "sslope_xs", "infl_xs",
+    "basin_depth_input", "basin_slope_input", "basin_long_slope_input",
+)
+# Design state tracked for undo/redo
+HISTORY_DESIGN_KEYS = (
+    # Profile design
+    "z_design", "z_design_original", "station_gradients", "locked_stations", "volumes", "corridor_state",
+    # Basin design
+    "basin_depth", "basin_side_slope", "basin_longitudinal_slope", "basin_volumes",
+) + HISTORY_WIDGET_KEYS
+HISTORY_DEM_KEYS = ("modified_dem", "basin_modified_dem")
+_MISSING = "<missing>"
+
+def _history_fingerprint(value):
+    """Cheap content digest of a session value (handles dicts holding arrays/DataFrames)."""
+    return hashlib.blake2b(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), digest_size=16).digest()
+
+def _value_delta(old, new):
+    """
+    Compact delta between two design values: changed positions only for equal-length
+    station vectors, the full old/new values otherwise.
+    """
+    if (isinstance(old, (list, np.ndarray)) and isinstance(new, (list, np.ndarray)) and len(old) == len(new)
+            and np.asarray(old).dtype.kind == "f" and np.asarray(new).dtype.kind == "f"):
+        old_arr, new_arr = np.asarray(old, dtype=np.float64), np.asarray(new, dtype=np.float64)
+        idx = np.flatnonzero(~np.isclose(old_arr, new_arr, rtol=0.0, atol=0.0, equal_nan=True))
+        return {"idx": idx, "old": old_arr[idx], "new": new_arr[idx], "as_list": isinstance(new, list)}
+    return {"old": copy.deepcopy(old), "new": copy.deepcopy(new)}
+
+def _apply_value_delta(current, delta, side):
+    """Value after applying a delta towards side ("old" or "new")."""
+    if "idx" in delta:
+        values = np.array(current, dtype=np.float64)
+        values[delta["idx"]] = delta[side]
+        return values.tolist() if delta["as_list"] else values
+    return copy.deepcopy(delta[side])
+
+def dem_patch(old_dem, new_dem, base_dem):
+    """
+    Bounding-box patch between two DEM states (None = no modified DEM, i.e. base_dem).
+    Returns (window, old_values, new_values) - a side is None where it equals base_dem -
+    or None when the states are identical.
+    """
+    if old_dem is None and new_dem is None:
+        return None
+    a = base_dem if old_dem is None else old_dem
+    b = base_dem if new_dem is None else new_dem
+    changed = a != b
+    changed &= ~(np.isnan(a) & np.isnan(b))
+    rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+    if rows.size == 0:
+        if (old_dem is None) == (new_dem is None):
+            return None
+        rows, cols = np.array([0]), np.array([0])
+    window = (slice(int(rows[0]), int(rows[-1]) + 1), slice(int(cols[0]), int(cols[-1]) + 1))
+    return (window,
+            None if old_dem is None else old_dem[window].astype(np.float32, copy=True),
+            None if new_dem is None else new_dem[window].astype(np.float32, copy=True))
+
+def _restore_dem(current, patch, side, base_dem):
+    """DEM state after applying a patch towards side; always a new array (raster hashes key on identity)."""
+    window, old_values, new_values = patch
+    values = old_values if side == "old" else new_values
+    if values is None:
+        return None
+    restored = (base_dem if current is None else current).astype(np.float32, copy=True)
+    restored[window] = values
+    return restored
+
+def _history_entry_nbytes(entry):
+    nbytes = len(pickle.dumps(entry["design"], protocol=pickle.HIGHEST_PROTOCOL))
+    for patch in entry["dem"].values():
+        nbytes += sum(v.nbytes for v in patch[1:] if v is not None)
+    return nbytes
+
+def _history_snapshot():
+    return {key: (_history_fingerprint(st.session_state.get(key, _MISSING)),
+                  copy.deepcopy(st.session_state.get(key, _MISSING))) for key in HISTORY_DESIGN_KEYS}
+
+def record_history(dem_key, base_dem):
+    """
+    Push an undo step if the design or a modified DEM changed during this run.
+    Design values are stored as compact deltas, modified DEMs as bounding-box patches;
+    the oldest steps are dropped beyond HISTORY_BUDGET_MB. Called once at the end of a run.
+    """
+    history = st.session_state.get("history")
+    if history is None or history["dem_key"] != dem_key:
+        st.session_state.history = {
+            "dem_key": dem_key, "undo": [], "redo": [], "nbytes": 0,
+            "snapshot": _history_snapshot(),
+            "dems": {key: st.session_state.get(key) for key in HISTORY_DEM_KEYS},
+        }
+        return
+    
+    design = {}
+    for key in HISTORY_DESIGN_KEYS:
+        value = st.session_state.get(key, _MISSING)
+        old_fingerprint, old_value = history["snapshot"][key]
+        widget_key = key in HISTORY_WIDGET_KEYS
+        if widget_key and isinstance(value, str) and value == _MISSING:
+            continue  # widget not rendered this run; keep its last value
+        fingerprint = _history_fingerprint(value)
+        if fingerprint != old_fingerprint:
+            if not (widget_key and isinstance(old_value, str) and old_value == _MISSING):
+                design[key] = _value_delta(old_value, value)
+            history["snapshot"][key] = (fingerprint, copy.deepcopy(value))
+    dems = {}
+    for key in HISTORY_DEM_KEYS:
+        current, previous = st.session_state.get(key), history["dems"][key]
+        if current is not previous:
+            patch = dem_patch(previous, current, base_dem)
+            if patch is not None:
+                dems[key] = patch
+            history["dems"][key] = current
+    if not design and not dems:
+        return
+    
+    entry = {"design": design, "dem": dems}
+    entry["nbytes"] = _history_entry_nbytes(entry)
+    history["undo"].append(entry)
+    history["redo"].clear()
+    history["nbytes"] = sum(e["nbytes"] for e in history["undo"])
+    budget = HISTORY_BUDGET_MB * 1024 * 1024
+    while history["undo"] and history["nbytes"] > budget:
+        history["nbytes"] -= history["undo"].pop(0)["nbytes"]
+
+def step_history(direction, base_dem):
+    """Undo (direction "undo") or redo the last step by applying its stored deltas. Used as a button callback."""
+    history = st.session_state.get("history")
+    source, target = ("undo", "redo") if direction == "undo" else ("redo", "undo")
+    if history is None or not history[source]:
+        return
+    entry = history[source].pop()
+    side = "old" if direction == "undo" else "new"
+    for key, delta in entry["design"].items():
+        value = _apply_value_delta(history["snapshot"][key][1], delta, side)
+        if isinstance(value, str) and value == _MISSING:
+            st.session_state.pop(key, None)
+        else:
+            st.session_state[key] = value
+        history["snapshot"][key] = (_history_fingerprint(value), copy.deepcopy(value))
+    for key, patch in entry["dem"].items():
+        restored = _restore_dem(st.session_state.get(key), patch, side, base_dem)
+        st.session_state[key] = restored
+        history["dems"][key] = restored
+    if "modified_dem" in entry["dem"]:
+        st.session_state.mass_haul_sections = None
+    # Keep the station elevation input in step with the restored profile
+    if "z_design" in entry["design"] and st.session_state.get("z_design"):
+        active = min(st.session_state.get("activeStation", 0), len(st.session_state.z_design) - 1)
+        st.session_state.elev_input_prof_unified = float(st.session_state.z_design[active])
+    history[target].append(entry)
+
+def render_history_controls(base_dem):
+    """Undo/redo buttons in the sidebar."""
+    history = st.session_state.get("history") or {"undo": [], "redo": [], "nbytes": 0}
+    with st.sidebar:
+        st.markdown("### ↩️ History")
+        col_undo, col_redo = st.columns(2)
+        with col_undo:
+            st.button("↶ Undo", key="history_undo", use_container_width=True, disabled=not history["undo"],
+                      on_click=step_history, args=("undo", base_dem))
+        with col_redo:
+            st.button("↷ Redo", key="history_redo", use_container_width=True, disabled=not history["redo"],
+                      on_click=step_history, args=("redo", base_dem))
+        st.caption(f"{len(history['undo'])} step(s) • {history['nbytes'] / 1e6:.1f} of {HISTORY_BUDGET_MB:.0f} MB")
+
+# ============================================================================
+# PERFORMANCE INSTRUMENTATION
+# ============================================================================
+
+PERF_LOG_DIR = Path(os.environ.get("TERRAIN_EDITOR_PERF_DIR", Path(tempfile.gettempdir()) / "terrain_editor_perf"))
+
+def begin_perf_run():
+    """Start a new script run: bump the run counter and clear this run's stage list."""
+    if "perf_session_id" not in st.session_state:
+        st.session_state.perf_session_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    st.session_state.perf_run = st.session_state.get("perf_run", 0) + 1
+    st.session_state.perf_stages = []
+
+def perf_log_path():
+    """JSON-lines log file for the current session."""
+    return PERF_LOG_DIR / f"{st.session_state.get('perf_session_id', 'unknown')}.jsonl"
+
+class StageTimer:
+    """
+    Wall time, CPU time and peak memory of one pipeline stage.
+    
+    Use as a context manager, or call start()/stop() around code that is too
+    long to re-indent. Peak memory comes from tracemalloc when "Trace peak
+    memory" is enabled in the sidebar, otherwise it is how far the stage raised
+    the process RSS high-water mark (0 when an earlier stage already peaked
+    higher; where the platform provides it).
+    """
+    
+    def __init__(self, stage):
+        self.stage = stage
+        self._started = False
+    
+    @staticmethod
+    def _max_rss_mb():
+        """Process RSS high-water mark in MB (ru_maxrss is KiB on Linux, bytes on macOS)."""
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1e6 if sys.platform == "darwin" else rss / 1024.0
+    
+    def start(self):
+        if st.session_state.get("perf_trace_memory", False):
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+        elif tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._tracing = tracemalloc.is_tracing()
+        if self._tracing:
+            self._mem_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        elif HAS_RESOURCE:
+            self._rss_start = self._max_rss_mb()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._started = True
+        return self
+    
+    def stop(self):
+        if not self._started:
+            return None
+        self._started = False
+        wall_s = time.perf_counter() - self._wall
+        cpu_s = time.process_time() - self._cpu
+        
+        if self._tracing and tracemalloc.is_tracing():
+            peak_mb = max(0, tracemalloc.get_traced_memory()[1] - self._mem_start) / 1e6
+            memory_source = "tracemalloc"
+        elif HAS_RESOURCE and not self._tracing:
+            # ru_maxrss only ever grows: report this stage's increase, not the lifetime peak
+            peak_mb = max(0.0, self._max_rss_mb() - self._rss_start)
+            memory_source = "rss_max_growth"
         else:
-            flow_unit_x, flow_unit_y = 1.0, 0.0  # Default direction
+            peak_mb, memory_source = None, None
+        
+        record = {
+            "ts": time.time(),
+            "session": st.session_state.get("perf_session_id"),
+            "run": st.session_state.get("perf_run", 0),
+            "stage": self.stage,
+            "wall_s": round(wall_s, 6),
+            "cpu_s": round(cpu_s, 6),
+            "peak_mb": round(peak_mb, 3) if peak_mb is not None else None,
+            "memory": memory_source,
+        }
+        if "perf_stages" not in st.session_state:
+            st.session_state.perf_stages = []
+        st.session_state.perf_stages.append(record)
         
-        channel_segments = None
+        try:
+            PERF_LOG_DIR.mkdir(parents=True, exist_ok=True)
+            with open(perf_log_path(), "a", encoding="utf-8") as log_file:
+                log_file.write(json.dumps(record) + "\n")
+        except OSError:
+            pass  # Instrumentation must never break the app
+        return record
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+def render_perf_panel():
+    """Optional sidebar panel listing this run's stage timings."""
+    with st.sidebar:
+        st.markdown("### ⏱️ Performance")
+        show_panel = st.checkbox("Show stage timings", value=False, key="perf_panel")
+        st.checkbox("Trace peak memory (slower)", value=False, key="perf_trace_memory",
+                    help="Use tracemalloc for per-stage peak allocations instead of each stage's growth of the process RSS high-water mark")
+        if not show_panel:
+            return
+        stages = st.session_state.get("perf_stages", [])
+        if not stages:
+            st.caption("No stages recorded in this run.")
+            return
+        df_perf = pd.DataFrame(stages)[["stage", "wall_s", "cpu_s", "peak_mb"]]
+        st.dataframe(df_perf, hide_index=True, use_container_width=True)
+        st.caption(f"Run {st.session_state.get('perf_run', 0)} • total wall {df_perf['wall_s'].sum():.3f} s")
+        st.caption(f"Log: `{perf_log_path()}`")
+
+# ============================================================================
+# RASTER EXPORT FUNCTIONS
+# ============================================================================
+
+GEOTIFF_COMPRESSION_OPTIONS = ["DEFLATE", "ZSTD", "LZW", "None"]
+
+def export_grid(transform, height, width, target_resolution=None):
+    """
+    Grid covering the same bounds as (transform, height, width) at target_resolution.
+    Returns (transform, height, width); the input grid is returned unchanged when the
+    resolution already matches (within 1 cm).
+    """
+    if target_resolution is None or abs(target_resolution - abs(transform.a)) <= 0.01:
+        return transform, height, width
+    bounds = array_bounds(height, width, transform)
+    new_width = max(1, int((bounds[2] - bounds[0]) / target_resolution))
+    new_height = max(1, int((bounds[3] - bounds[1]) / target_resolution))
+    return from_bounds(bounds[0], bounds[1], bounds[2], bounds[3], new_width, new_height), new_height, new_width
+
+def geotiff_profile(height, width, crs, transform, nodata, compress="DEFLATE", block_size=256):
+    """Creation options for a tiled float32 GeoTIFF with the chosen compression."""
+    profile = {
+        'driver': 'GTiff',
+        'height': height,
+        'width': width,
+        'count': 1,
+        'dtype': 'float32',
+        'crs': crs,
+        'transform': transform,
+        'nodata': nodata,
+        'tiled': True,
+        'blockxsize': block_size,
+        'blockysize': block_size,
+        'BIGTIFF': 'IF_SAFER',
+    }
+    if compress and compress != "None":
+        profile['compress'] = compress.lower()
+        # Floating-point predictor: much better ratios on smooth elevation data
+        profile['predictor'] = 3
+    return profile
+
+def _write_tiles(dst, read_window):
+    """Write a dataset block by block; read_window(window) returns the float32 tile."""
+    for _, window in dst.block_windows(1):
+        dst.write(read_window(window).astype(np.float32, copy=False), 1, window=window)
+
+def write_dem_geotiff(dem_array, transform, crs, nodata, dst_crs=None, dst_transform=None, dst_shape=None,
+                      target_resolution=None, resampling="Bilinear", compress="DEFLATE",
+                      block_size=256, cog=False):
+    """
+    Stream a DEM to a tiled, compressed GeoTIFF on disk and return its path.
     
-    # Calculate inner polygon (using maximum depth for offset calculation)
-    # For longitudinal slope, use the maximum depth (downstream end if positive slope)
-    max_depth = depth + (longitudinal_slope / 100.0) * flow_length if longitudinal_slope > 0 else depth
-    # Offset = depth * side_slope (H:1V means horizontal distance = depth * ratio)
-    offset_distance = max_depth * side_slope
-    inner_poly = outer_poly.buffer(-offset_distance, join_style=2)
+    The array is first written tile by tile to a staging file. Reprojection and
+    resampling are then read window by window through a WarpedVRT, so peak memory
+    stays at a few tiles instead of several full rasters. IDW resampling has no
+    GDAL equivalent and still runs on the full (warped) array.
     
-    if inner_poly.is_empty:
-        inner_poly = None
-    elif inner_poly.geom_type == 'MultiPolygon':
-        inner_poly = max(inner_poly.geoms, key=lambda p: p.area)
+    Args:
+        dem_array: Float32 DEM in (transform, crs)
+        transform, crs, nodata: Grid of dem_array
+        dst_crs, dst_transform, dst_shape: Optional output grid (defaults to the input grid)
+        target_resolution: Optional output cell size in metres (bounds preserved)
+        resampling: "Bilinear", "Nearest" or "IDW"
+        compress: One of GEOTIFF_COMPRESSION_OPTIONS
+        block_size: Tile size in pixels (multiple of 16)
+        cog: Build overviews and write a Cloud-Optimized GeoTIFF layout
     
-    # Get bounding box for iteration
-    minx, miny, maxx, maxy = outer_poly.bounds
-    row_min, col_min = rowcol(transform, minx, maxy)
-    row_max, col_max = rowcol(transform, maxx, miny)
+    Returns:
+        path: Path of the written GeoTIFF (caller owns the file)
+        shape: (height, width) of the output raster
+    """
+    from rasterio.vrt import WarpedVRT
+    import rasterio.shutil
+    
+    out_nodata = nodata if nodata is not None else np.nan
+    if dst_crs is None:
+        dst_crs = crs
+    if dst_transform is None or dst_shape is None:
+        dst_transform, dst_shape = transform, dem_array.shape
+    final_transform, final_height, final_width = export_grid(
+        dst_transform, dst_shape[0], dst_shape[1], target_resolution
+    )
+    
+    def _temp_tif(prefix):
+        fd, path = tempfile.mkstemp(suffix=".tif", prefix=prefix)
+        os.close(fd)
+        return path
     
+    staging_paths = []
+    
+    # Stage the source array on disk so GDAL can warp it window by window
+    src_path = _temp_tif("terrain_src_")
+    staging_paths.append(src_path)
     h, w = dem_array.shape
-    row_min, row_max = max(0, min(row_min, row_max)), min(h-1, max(row_min, row_max))
-    col_min, col_max = max(0, min(col_min, col_max)), min(w-1, max(col_min, col_max))
+    with rasterio.open(src_path, "w", **geotiff_profile(h, w, crs, transform, out_nodata, "None", block_size)) as dst:
+        _write_tiles(dst, lambda win: dem_array[win.toslices()])
     
-    # Calculate cell area for volume
-    cell_area = abs(transform.a * transform.e)
-    total_cut_volume = 0.0
+    out_path = _temp_tif("terrain_export_")
+    write_path = _temp_tif("terrain_cog_") if cog else out_path
+    if cog:
+        staging_paths.append(write_path)
+    out_profile = geotiff_profile(final_height, final_width, dst_crs, final_transform, out_nodata, compress, block_size)
     
-    # Iterate over pixels in bounding box
-    for r in range(row_min, row_max + 1):
-        for c in range(col_min, col_max + 1):
-            z_old = dem_array[r, c]
-            if nodata is not None and z_old == nodata:
-                continue
-            
-            x, y = xy(transform, r, c)
-            point = Point(x, y)
-            
-            if not outer_poly.contains(point):
-                continue
-            
-            # Calculate depth at this point based on longitudinal slope
-            if flow_length > 0 and abs(longitudinal_slope) > 0.01:
-                if channel_segments is not None:
-                    # Calculate distance along channel path
-                    # Find closest point on channel and calculate cumulative distance
-                    min_dist_to_channel = float('inf')
-                    dist_along_flow = 0.0
-                    
-                    for seg in channel_segments:
-                        x1, y1 = seg['start']
-                        x2, y2 = seg['end']
-                        
-                        # Vector from segment start to end
-                        seg_dx = x2 - x1
-                        seg_dy = y2 - y1
-                        seg_len = seg['length']
-                        
-                        if seg_len > 0:
-                            # Vector from segment start to point
-                            px = x - x1
-                            py = y - y1
-                            
-                            # Project point onto segment
-                            t = max(0.0, min(1.0, (px * seg_dx + py * seg_dy) / (seg_len * seg_len)))
-                            
-                            # Closest point on segment
-                            closest_x = x1 + t * seg_dx
-                            closest_y = y1 + t * seg_dy
-                            
-                            # Distance from point to closest point on segment
-                            dist_to_seg = np.sqrt((x - closest_x)**2 + (y - closest_y)**2)
-                            
-                            if dist_to_seg < min_dist_to_channel:
-                                min_dist_to_channel = dist_to_seg
-                                # Cumulative distance along channel to this point
-                                dist_along_flow = seg['cumulative_start'] + t * seg_len
-                else:
-                    # Vector from upstream to current point
-                    dx = x - upstream_x
-                    dy = y - upstream_y
-                    # Project onto flow direction vector
-                    dist_along_flow = dx * flow_unit_x + dy * flow_unit_y
-                
-                # Calculate depth at this point: depth = upstream_depth + slope * distance
-                # longitudinal_slope is in percentage, so divide by 100
-                depth_at_point = depth + (longitudinal_slope / 100.0) * dist_along_flow
-                # Ensure depth is positive
-                depth_at_point = max(0.0, depth_at_point)
-            else:
-                depth_at_point = depth
-            
-            # Point is inside outer polygon
-            if inner_poly is not None and inner_poly.contains(point):
-                # Inside inner polygon - use depth at this point
-                z_new = z_old - depth_at_point
-            else:
-                # Between inner and outer - calculate distance-based depth
-                dist_to_outer = outer_poly.exterior.distance(point)
-                
-                # Calculate offset distance for this point's depth
-                # Offset = depth * side_slope (H:1V means horizontal distance = depth * ratio)
-                offset_at_point = depth_at_point * side_slope
-                
-                if dist_to_outer >= offset_at_point:
-                    # This shouldn't happen, but handle edge cases
-                    z_new = z_old - depth_at_point
-                else:
-                    # Linear interpolation based on distance
-                    # At outer edge: depth = 0
-                    # At inner edge (offset_at_point): depth = depth_at_point
-                    fraction = dist_to_outer / offset_at_point if offset_at_point > 0 else 0
-                    local_depth = fraction * depth_at_point
-                    z_new = z_old - local_depth
-            
-            new_dem[r, c] = z_new
-            cut_depth = z_old - z_new
-            if cut_depth > 0:
-                total_cut_volume += cut_depth * cell_area
+    try:
+        same_grid = (dst_crs == crs and final_transform == transform and (final_height, final_width) == (h, w))
+        if same_grid:
+            with rasterio.open(write_path, "w", **out_profile) as dst:
+                _write_tiles(dst, lambda win: dem_array[win.toslices()])
+        elif resampling == "IDW":
+            # Warp to the requested CRS at native grid first, then IDW onto the final grid
+            with rasterio.open(src_path) as src, WarpedVRT(
+                src, crs=dst_crs, transform=dst_transform, width=dst_shape[1], height=dst_shape[0],
+                nodata=out_nodata, resampling=Resampling.bilinear
+            ) as vrt:
+                warped = vrt.read(1, out_dtype="float32")
+            if (final_height, final_width) != tuple(dst_shape):
+                warped = idw_resample(warped, dst_transform, final_transform, final_height, final_width,
+                                      out_nodata, power=2, radius=1)
+            with rasterio.open(write_path, "w", **out_profile) as dst:
+                _write_tiles(dst, lambda win: warped[win.toslices()])
+        else:
+            method = Resampling.nearest if resampling == "Nearest" else Resampling.bilinear
+            with rasterio.open(src_path) as src, WarpedVRT(
+                src, crs=dst_crs, transform=final_transform, width=final_width, height=final_height,
+                nodata=out_nodata, resampling=method
+            ) as vrt:
+                with rasterio.open(write_path, "w", **out_profile) as dst:
+                    _write_tiles(dst, lambda win: vrt.read(1, window=win, out_dtype="float32"))
+        
+        if cog:
+            # Internal overviews, then copy with overviews leading the file (COG layout)
+            factors = []
+            factor = 2
+            while max(final_height, final_width) / factor >= block_size:
+                factors.append(factor)
+                factor *= 2
+            if factors:
+                with rasterio.open(write_path, "r+") as dst:
+                    dst.build_overviews(factors, Resampling.average)
+                    dst.update_tags(ns='rio_overview', resampling='average')
+            copy_options = {k: v for k, v in out_profile.items()
+                            if k not in ('driver', 'height', 'width', 'count', 'dtype', 'crs', 'transform', 'nodata')}
+            rasterio.shutil.copy(write_path, out_path, driver='GTiff', copy_src_overviews=True, **copy_options)
+    except Exception:
+        staging_paths.append(out_path)
+        raise
+    finally:
+        for path in staging_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
     
-    return new_dem, total_cut_volume
+    return out_path, (final_height, final_width)
+
+def raster_hash(array):
+    """Content hash of a raster array (dtype, shape and cell values)."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{array.dtype}|{array.shape}".encode())
+    digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+def source_dem_identity(ds, dem):
+    """Identity of a source DEM: file, modification time and size; content hash for in-memory datasets."""
+    try:
+        stat = os.stat(ds.name)
+        return f"{ds.name}|{stat.st_mtime_ns}|{stat.st_size}"
+    except (OSError, TypeError):
+        return raster_hash(dem)
+
+def session_raster_hash(key):
+    """
+    Hash of the raster stored in st.session_state[key].
+    Recomputed only when a different array object is stored under the key.
+    """
+    if "raster_hash_memo" not in st.session_state:
+        st.session_state.raster_hash_memo = {}
+    memo = st.session_state.raster_hash_memo
+    array = st.session_state.get(key)
+    if array is None:
+        memo.pop(key, None)
+        return None
+    entry = memo.get(key)
+    if entry is None or entry[0] is not array:
+        entry = (array, raster_hash(array))
+        memo[key] = entry
+    return entry[1]
+
+EXPORT_CACHE_MAX_ENTRIES = 4
+
+def cached_dem_export(dem_hash, dem_array, transform, crs, nodata, dst_crs=None, dst_transform=None,
+                      dst_shape=None, target_resolution=None, resampling="Bilinear", compress="DEFLATE", cog=False):
+    """
+    write_dem_geotiff() behind a content-addressed, per-session file cache.
+    
+    The key combines the modified-DEM hash, its grid, the output CRS/grid, target
+    resolution, resampling method and encoding options, so reruns that change
+    nothing export-related reuse the existing file instead of rebuilding it.
+    Least recently used files beyond EXPORT_CACHE_MAX_ENTRIES are deleted.
+    
+    Returns:
+        path, shape: As returned by write_dem_geotiff()
+    """
+    from collections import OrderedDict
+    
+    key = (
+        dem_hash, tuple(transform)[:6], str(crs),
+        str(dst_crs if dst_crs is not None else crs),
+        tuple(dst_transform)[:6] if dst_transform is not None else None,
+        tuple(dst_shape) if dst_shape is not None else None,
+        round(float(target_resolution), 4) if target_resolution is not None else None,
+        resampling, compress, bool(cog),
+    )
+    
+    if "export_cache" not in st.session_state:
+        st.session_state.export_cache = OrderedDict()
+    cache = st.session_state.export_cache
+    
+    entry = cache.get(key)
+    if entry is not None and os.path.exists(entry[0]):
+        cache.move_to_end(key)
+        return entry
+    
+    entry = write_dem_geotiff(
+        dem_array, transform, crs, nodata, dst_crs=dst_crs, dst_transform=dst_transform, dst_shape=dst_shape,
+        target_resolution=target_resolution, resampling=resampling, compress=compress, cog=cog
+    )
+    cache[key] = entry
+    while len(cache) > EXPORT_CACHE_MAX_ENTRIES:
+        _, (old_path, _) = cache.popitem(last=False)
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+    return entry
+
+# ============================================================================
+# CUT/FILL OVERLAY FUNCTIONS
+# ============================================================================
+
+# Longest side (px) of the cut/fill overlay image
+DZ_OVERLAY_MAX_PX = 1024
+# Changes smaller than this (m) are left transparent
+DZ_OVERLAY_MIN_M = 0.01
+
+def diverging_lut(n=256):
+    """RGBA lookup table from cut (red, index 0) through white (centre) to fill (blue, index n-1)."""
+    anchors = np.array([
+        [0.00, 178, 24, 43],
+        [0.25, 239, 138, 98],
+        [0.50, 247, 247, 247],
+        [0.75, 103, 169, 207],
+        [1.00, 33, 102, 172],
+    ])
+    t = np.linspace(0.0, 1.0, n)
+    lut = np.empty((n, 4), dtype=np.uint8)
+    for channel in range(3):
+        lut[:, channel] = np.rint(np.interp(t, anchors[:, 0], anchors[:, channel + 1]))
+    lut[:, 3] = 220
+    return lut
+
+DZ_LUT = diverging_lut()
+
+def colorize_dz(dz, limit_m, lut=DZ_LUT):
+    """RGBA image of a dz raster (modified - existing) through a diverging LUT clipped at +/-limit_m."""
+    with np.errstate(invalid="ignore"):
+        index = np.clip(np.rint((dz / limit_m * 0.5 + 0.5) * (len(lut) - 1)), 0, len(lut) - 1)
+        rgba = lut[np.nan_to_num(index).astype(np.intp)]
+        rgba[~(np.abs(dz) >= DZ_OVERLAY_MIN_M), 3] = 0
+    return rgba
+
+def rgba_png_url(rgba):
+    """PNG data URL of an (h, w, 4) uint8 image, for folium ImageOverlay."""
+    with MemoryFile() as memfile:
+        with memfile.open(driver="PNG", height=rgba.shape[0], width=rgba.shape[1], count=4, dtype="uint8") as dst:
+            dst.write(np.moveaxis(rgba, -1, 0))
+        data = memfile.read()
+    return "data:image/png;base64," + base64.b64encode(data).decode()
+
+def _dz_display_grid(window, shape, max_px=DZ_OVERLAY_MAX_PX):
+    """Sampling step and sampled rows/columns (block centres) of a window's display image."""
+    r0, r1 = window[0].start, window[0].stop
+    c0, c1 = window[1].start, window[1].stop
+    step = max(1, int(np.ceil(max(r1 - r0, c1 - c0) / max_px)))
+    rows = np.minimum(np.arange(r0, r1, step) + step // 2, shape[0] - 1)
+    cols = np.minimum(np.arange(c0, c1, step) + step // 2, shape[1] - 1)
+    return step, rows, cols
+
+def _sample_dz(base_dem, design_dem, base_valid, nodata, rows, cols):
+    """dz at the given display rows/columns (NaN where either surface has no data)."""
+    old = base_dem[np.ix_(rows, cols)]
+    new = design_dem[np.ix_(rows, cols)]
+    valid = base_valid[np.ix_(rows, cols)] & dem_valid_mask(new, nodata)
+    return np.where(valid, new.astype(np.float32) - old, np.nan)
+
+def cached_dz_overlay(role, base_key, base_dem, design_dem, base_valid, nodata, transform, crs, dst_crs, limit_m):
+    """
+    Cut/fill overlay of design_dem against base_dem, kept in session state per role.
+    
+    The overlay covers the bounding box of the design changes, downsampled to at most
+    DZ_OVERLAY_MAX_PX. When a new design DEM replaces the previous one, only the display
+    blocks inside the region that changed between the two are re-sampled (unless the
+    window grows). The display grid is then warped from crs to dst_crs (the map CRS, in
+    which the analysis grid is rotated by the grid convergence) and colorized into a PNG;
+    a new colour range only reapplies the LUT.
+    
+    Returns:
+        dict with "url" (PNG data URL) and "bounds" ([[lat_min, lon_min], [lat_max, lon_max]]),
+        or None when the design does not change the terrain
+    """
+    cache = st.session_state.setdefault("dz_overlay", {})
+    entry = cache.get(role)
+    if entry is not None and entry["base_key"] == base_key and entry["design"] is design_dem:
+        if entry["limit_m"] != limit_m and entry["window"] is not None:
+            entry["url"] = rgba_png_url(colorize_dz(entry["dz_map"], limit_m))
+            entry["limit_m"] = limit_m
+        return entry if entry["window"] is not None else None
+    
+    if entry is not None and entry["base_key"] == base_key and entry["window"] is not None:
+        dirty = changed_window(entry["design"], design_dem, margin=0)
+        window = entry["window"]
+        if dirty is not None:
+            window = (slice(min(window[0].start, dirty[0].start), max(window[0].stop, dirty[0].stop)),
+                      slice(min(window[1].start, dirty[1].start), max(window[1].stop, dirty[1].stop)))
+    else:
+        dirty = window = changed_window(base_dem, design_dem, margin=0)
+    
+    if window is None:
+        cache[role] = {"base_key": base_key, "design": design_dem, "window": None, "limit_m": limit_m}
+        return None
+    
+    step, rows, cols = _dz_display_grid(window, design_dem.shape)
+    if entry is not None and entry["base_key"] == base_key and entry.get("window") == window:
+        # Same display grid: re-sample only the blocks covering the dirty region
+        dz = entry["dz"]
+        if dirty is not None:
+            i0 = (dirty[0].start - window[0].start) // step
+            i1 = -(-(dirty[0].stop - window[0].start) // step)
+            j0 = (dirty[1].start - window[1].start) // step
+            j1 = -(-(dirty[1].stop - window[1].start) // step)
+            dz[i0:i1, j0:j1] = _sample_dz(base_dem, design_dem, base_valid, nodata, rows[i0:i1], cols[j0:j1])
+    else:
+        dz = _sample_dz(base_dem, design_dem, base_valid, nodata, rows, cols).astype(np.float32)
+    
+    # Warp the display grid (blocks of step x step cells) to the map CRS
+    display_transform = transform * Affine.translation(window[1].start, window[0].start) * Affine.scale(step)
+    h, w = dz.shape
+    left, bottom, right, top = array_bounds(h, w, display_transform)
+    map_transform, map_w, map_h = calculate_default_transform(crs, dst_crs, w, h, left, bottom, right, top)
+    dz_map = np.full((map_h, map_w), np.nan, dtype=np.float32)
+    reproject(source=dz, destination=dz_map, src_transform=display_transform, src_crs=crs, src_nodata=np.nan,
+              dst_transform=map_transform, dst_crs=dst_crs, dst_nodata=np.nan, resampling=Resampling.nearest)
+    west, south, east, north = array_bounds(map_h, map_w, map_transform)
+    entry = {
+        "base_key": base_key, "design": design_dem, "window": window, "limit_m": limit_m,
+        "dz": dz, "dz_map": dz_map, "url": rgba_png_url(colorize_dz(dz_map, limit_m)),
+        "bounds": [[south, west], [north, east]],
+    }
+    cache[role] = entry
+    return entry
+
+# ============================================================================
+# CROSS-SECTION SHEET EXPORT FUNCTIONS
+# ============================================================================
+
+def bounded_pool_map(pool, func, jobs, window):
+    """
+    Results of func over jobs in order, like pool.map(), but submitting at most window
+    jobs ahead of the consumer (Executor.map submits everything up front).
+    """
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.submit(func, job))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def export_section_sheets(dem_array, transform, nodata, samples, normals, z_design_arr, template_type,
+                          template_params, influence_width_m, operation_mode, valid=None, fmt="pdf",
+                          per_sheet=6, dpi=150, max_workers=None):
+    """
+    Cross-section sheets for every station, written into a zip on disk.
+    
+    All sections come from one cross_section_batch() gather; sheets are rendered by
+    section_sheets.render_section_sheet() in a process pool (Matplotlib drawing holds
+    the GIL, so threads do not overlap) and written to the zip in order, together with
+    a CSV of the section areas. At most two sheets per worker are submitted ahead of
+    the one being written, so memory stays bounded by that window rather than by the
+    number of sheets. With one worker the sheets are rendered in this process.
+    
+    Returns:
+        path of the zip file, number of sheets
+    """
+    n_stations = len(samples)
+    station_indices = np.arange(n_stations)
+    offsets, z_exist, z_design, z_final = cross_section_batch(
+        dem_array, transform, nodata, station_indices, samples, normals, z_design_arr,
+        template_type, template_params, influence_width_m, operation_mode, valid=valid
+    )
+    areas = cross_section_areas_batch(offsets, z_exist, z_final, template_type, template_params)
+    
+    z_crest = np.asarray(z_design_arr, dtype=np.float64)
+    sheets = [station_indices[i:i + per_sheet] for i in range(0, n_stations, per_sheet)]
+    
+    jobs = ((
+        [{
+            "index": int(i), "chainage": float(samples[i, 0]), "z_crest": float(z_crest[i]),
+            "z_exist": z_exist[i], "z_design": z_design[i], "z_final": z_final[i], "areas": areas[i],
+        } for i in indices],
+        offsets, number, len(sheets), fmt, dpi,
+    ) for number, indices in enumerate(sheets, start=1))
+    
+    fd, out_path = tempfile.mkstemp(suffix=".zip", prefix="sections_")
+    os.close(fd)
+    with zipfile.ZipFile(out_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        table = pd.DataFrame({
+            "station": station_indices, "chainage_m": samples[:, 0], "crest_elev_m": z_crest,
+            "cut_area_m2": areas[:, 0], "fill_area_m2": areas[:, 1],
+            "berm_area_m2": areas[:, 2], "ditch_area_m2": areas[:, 3],
+        })
+        zf.writestr("section_areas.csv", table.to_csv(index=False, float_format="%.3f"))
+        workers = min(max_workers or min(8, os.cpu_count() or 1), len(sheets))
+        # Spawned workers: forking the Streamlit server process would copy its threads' locks
+        pool = (ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+                if workers > 1 else None)
+        try:
+            rendered = (bounded_pool_map(pool, render_section_sheet_job, jobs, window=2 * workers) if pool
+                        else map(render_section_sheet_job, jobs))
+            for number, data in enumerate(rendered, start=1):
+                zf.writestr(f"sections_sheet_{number:03d}.{fmt}", data,
+                            compress_type=zipfile.ZIP_STORED if fmt == "png" else zipfile.ZIP_DEFLATED)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+    return out_path, len(sheets)
+
+# ============================================================================
+# STATION MARKER FUNCTIONS
+# ============================================================================
+
+STATION_LABEL_CSS = """
+<style>
+.leaflet-tooltip.station-label {
+    background: transparent; border: none; box-shadow: none; padding: 0;
+    font-size: 12px; font-weight: bold; color: #d62728;
+    text-shadow: 1px 1px 2px white, -1px -1px 2px white, 1px -1px 2px white, -1px 1px 2px white;
+}
+.leaflet-tooltip.station-label::before { display: none; }
+</style>
+"""
+
+def cached_station_features(center_xy, to_map):
+    """
+    GeoJSON point features of the design stations, built from one batched transform of
+    all station coordinates and kept in session state until the alignment changes.
+    
+    Returns:
+        FeatureCollection dict; each feature has "index" and "label" (S<i>) properties
+    """
+    points = np.asarray(center_xy, dtype=np.float64).reshape(-1, 2)
+    key = (hashlib.blake2b(points.tobytes(), digest_size=16).hexdigest(), str(to_map.source_crs))
+    cached = st.session_state.get("station_features_cache")
+    if cached is not None and cached["key"] == key:
+        return cached["features"]
+    lon, lat = to_map.transform(points[:, 0], points[:, 1])
+    features = {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "id": f"S{i}",
+         "geometry": {"type": "Point", "coordinates": [float(lon[i]), float(lat[i])]},
+         "properties": {"index": i, "label": f"S{i}"}}
+        for i in range(len(points))
+    ]}
+    st.session_state.station_features_cache = {"key": key, "features": features}
+    return features
+
+def add_station_layer(fmap, station_features, selected_idx, show_all=True):
+    """
+    Add all stations to a folium map as one GeoJSON layer of circle markers with
+    permanent labels; the selected station is styled larger and yellow.
+    """
+    data = station_features
+    if not show_all:
+        data = {"type": "FeatureCollection",
+                "features": [f for f in station_features["features"] if f["properties"]["index"] == selected_idx]}
+    
+    def station_style(feature):
+        if feature["properties"]["index"] == selected_idx:
+            return {"radius": 12, "color": "black", "weight": 3, "fillColor": "#ffcc00", "fillOpacity": 1.0}
+        return {"radius": 5, "color": "#d62728", "weight": 2, "fillColor": "#d62728", "fillOpacity": 0.8}
+    
+    fmap.get_root().header.add_child(folium.Element(STATION_LABEL_CSS))
+    folium.GeoJson(
+        data, name="Stations", marker=folium.CircleMarker(), style_function=station_style,
+        tooltip=folium.GeoJsonTooltip(fields=["label"], labels=False, sticky=False, permanent=True,
+                                      direction="top", class_name="station-label"),
+    ).add_to(fmap)
+
+# ============================================================================
+# PROJECT FILE FUNCTIONS
+# ============================================================================
+
+PROJECT_FILE_VERSION = 1
+
+# Design state saved in a project file (JSON-serializable session values and their widget keys)
+PROJECT_STATE_KEYS = (
+    "design_mode", "profile_line_coords", "basin_polygon_coords", "basin_channel_coords",
+    "z_design", "z_design_original", "station_gradients", "locked_stations", "activeStation", "volumes",
+    "template_xs", "mode_xs", "ditch_side_xs", "berm_height_xs", "berm_crest_xs", "berm_up_xs", "berm_down_xs",
+    "ditch_width_xs", "ditch_depth_xs", "ditch_slope_xs", "swale_xs", "sdepth_xs", "sslope_xs", "infl_xs",
+    "basin_depth", "basin_side_slope", "basin_longitudinal_slope", "basin_volumes",
+    "basin_depth_input", "basin_slope_input", "basin_long_slope_input",
+    "project_features",
+)
+# Modified DEMs saved as patches against the analysis DEM
+PROJECT_DEM_KEYS = ("modified_dem", "basin_modified_dem", "project_dem")
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def write_project_file(path, state, source, rasters):
+    """
+    Write a project container: a zip holding project.json (format version, design state,
+    source DEM identity and a raster index) and one uncompressed .npy member per raster,
+    so the rasters can be memory-mapped straight from the zip on reopen.
+    
+    Args:
+        path: Output .zip path
+        state: dict of session values (PROJECT_STATE_KEYS)
+        source: dict with the source DEM "hash", "crs", "transform", "shape" and "nodata"
+        rasters: dict name -> (array, metadata dict), e.g. {"transform": [...]} for derived
+                 rasters or {"window": [...]} for DEM patches
+    """
+    index = {}
+    with zipfile.ZipFile(path, "w", allowZip64=True) as zf:
+        for name, (array, meta) in rasters.items():
+            member = f"rasters/{name}.npy"
+            with zf.open(zipfile.ZipInfo(member), "w", force_zip64=True) as f:  # ZIP_STORED
+                np.lib.format.write_array(f, np.ascontiguousarray(array), allow_pickle=False)
+            index[name] = {"member": member, "hash": raster_hash(array), "dtype": str(array.dtype),
+                           "shape": list(array.shape), **meta}
+        metadata = {
+            "format": "terrain_editor_project",
+            "version": PROJECT_FILE_VERSION,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "source": source,
+            "state": state,
+            "rasters": index,
+        }
+        zf.writestr("project.json", json.dumps(metadata, indent=2, default=_json_default),
+                    compress_type=zipfile.ZIP_DEFLATED)
+
+def _zip_member_data_offset(path, info):
+    """Byte offset of a stored zip member's data (after its local file header)."""
+    with open(path, "rb") as f:
+        f.seek(info.header_offset)
+        header = f.read(30)
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    return info.header_offset + 30 + name_len + extra_len
+
+def read_project_file(path):
+    """
+    Read a project container written by write_project_file().
+    
+    Returns:
+        metadata: project.json contents (state keys restored to their session types)
+        rasters: dict name -> read-only np.memmap over the zip member, checked against its hash
+    """
+    with zipfile.ZipFile(path, "r") as zf:
+        metadata = json.loads(zf.read("project.json"))
+        infos = {info.filename: info for info in zf.infolist()}
+    if metadata.get("format") != "terrain_editor_project":
+        raise ValueError("Not a Terrain Editor project file")
+    if metadata.get("version", 0) > PROJECT_FILE_VERSION:
+        raise ValueError(f"Project file version {metadata['version']} is newer than supported ({PROJECT_FILE_VERSION})")
+    
+    state = metadata["state"]
+    if isinstance(state.get("station_gradients"), dict):
+        state["station_gradients"] = {int(k): v for k, v in state["station_gradients"].items()}
+    
+    rasters = {}
+    for name, entry in metadata["rasters"].items():
+        info = infos[entry["member"]]
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError(f"Raster {name} is compressed and cannot be memory-mapped")
+        offset = _zip_member_data_offset(path, info)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            data_offset = f.tell()
+        array = np.memmap(path, dtype=dtype, mode="r", offset=data_offset, shape=shape,
+                          order="F" if fortran_order else "C")
+        if raster_hash(array) != entry["hash"]:
+            raise ValueError(f"Raster {name} does not match its content hash")
+        rasters[name] = array
+    return metadata, rasters
+
+def matching_project_rasters(source_key, src_dem, src_crs, src_transform):
+    """
+    Derived rasters of the open project file if they were built from this source DEM,
+    as name -> (memmap, index entry). The source is checked against the project's
+    content hash once per source identity.
+    """
+    project = st.session_state.get("project_file")
+    if project is None:
+        return {}
+    if project.get("validated_key") == source_key:
+        return project["rasters"]
+    if project.get("rejected_key") == source_key:
+        return {}
+    source = project["metadata"]["source"]
+    matches = (source["crs"] == str(src_crs) and list(source["shape"]) == list(src_dem.shape)
+               and np.allclose(source["transform"], tuple(src_transform)[:6])
+               and source["hash"] == raster_hash(src_dem))
+    project["validated_key" if matches else "rejected_key"] = source_key
+    if not matches:
+        st.warning("⚠️ The open project was saved with a different DEM; cached rasters are not used.")
+        return {}
+    return project["rasters"]
 
 # ============================================================================
 # LOAD DEM AND PROFILE FILES
@@ -3135,12 +5214,15 @@ if (st.session_state.data_source == "folder" and
             st.session_state.auto_loaded_profile = True
             st.toast("✅ Profile shapefile auto-loaded from Data folder")
 
+begin_perf_run()
+
 # Load DEM - check uploaded file first, then fall back to folder
 if st.session_state.data_source == "upload" and st.session_state.uploaded_dem_dataset is not None:
     # Use uploaded DEM
     ds_src = st.session_state.uploaded_dem_dataset
     src_crs, src_transform, src_nodata = ds_src.crs, ds_src.transform, ds_src.nodata
-    src_dem = ds_src.read(1).astype(float)
+    with StageTimer("dem_load"):
+        src_dem, src_valid = read_dem_band(ds_src)
 else:
     # Use folder-based DEM
     dem_path, paths_tried = find_dem_file()
@@ -3168,7 +5250,8 @@ else:
     try:
         ds_src = rasterio.open(dem_path)
         src_crs, src_transform, src_nodata = ds_src.crs, ds_src.transform, ds_src.nodata
-        src_dem = ds_src.read(1).astype(float)
+        with StageTimer("dem_load"):
+            src_dem, src_valid = read_dem_band(ds_src)
     except Exception as e:
         st.error(f"Error loading DEM: {e}")
         st.stop()
@@ -3177,20 +5260,37 @@ if src_crs is None:
     st.error("DEM has no CRS")
     st.stop()
 
+# Identity of the source DEM (file, modification time and size; content hash for in-memory datasets)
+source_dem_key = source_dem_identity(ds_src, src_dem)
+
+# Derived rasters memory-mapped from an open project file built on this DEM
+project_rasters = matching_project_rasters(source_dem_key, src_dem, src_crs, src_transform)
+
 # Map display
 map_crs = CRS.from_epsg(4326)
 
+# Rasters are float32 throughout; cells outside the footprint stay NaN/nodata and the
+# *_valid masks travel alongside each array
+dem_fill_value = np.nan if src_nodata is None else src_nodata
+
 if src_crs.is_geographic and src_crs.to_epsg() == 4326:
-    map_dem, map_transform = src_dem, src_transform
+    map_dem, map_transform, map_valid = src_dem, src_transform, src_valid
     mb_left, mb_bottom, mb_right, mb_top = array_bounds(ds_src.height, ds_src.width, map_transform)
+elif "map_dem" in project_rasters:
+    map_dem, map_entry = project_rasters["map_dem"]
+    map_transform = Affine(*map_entry["transform"])
+    map_valid = dem_valid_mask(map_dem, src_nodata)
+    mb_left, mb_bottom, mb_right, mb_top = array_bounds(*map_dem.shape, map_transform)
 else:
     map_transform, map_width, map_height = calculate_default_transform(
         src_crs, map_crs, ds_src.width, ds_src.height, *ds_src.bounds
     )
-    map_dem = np.empty((map_height, map_width), dtype=np.float32)
-    reproject(source=src_dem, destination=map_dem, src_transform=src_transform,
-             src_crs=src_crs, src_nodata=src_nodata, dst_transform=map_transform,
-             dst_crs=map_crs, dst_nodata=src_nodata, resampling=Resampling.bilinear)
+    map_dem = np.full((map_height, map_width), dem_fill_value, dtype=np.float32)
+    with StageTimer("reproject_map"):
+        reproject(source=src_dem, destination=map_dem, src_transform=src_transform,
+                 src_crs=src_crs, src_nodata=src_nodata, dst_transform=map_transform,
+                 dst_crs=map_crs, dst_nodata=src_nodata, resampling=Resampling.bilinear)
+    map_valid = dem_valid_mask(map_dem, src_nodata)
     mb_left, mb_bottom, mb_right, mb_top = array_bounds(map_height, map_width, map_transform)
 
 center_lon, center_lat = (mb_left + mb_right) / 2, (mb_bottom + mb_top) / 2
@@ -3201,8 +5301,12 @@ from math import cos, radians
 m_per_deg_lon = 111412.84 * cos(radians(center_lat)) - 93.5 * cos(3 * radians(center_lat))
 m_per_deg_lat = 111132.92 - 559.82 * cos(2 * radians(center_lat))
 cellsize_x, cellsize_y = map_transform.a * m_per_deg_lon, -map_transform.e * m_per_deg_lat
-hillshade = compute_hillshade(map_dem, cellsize_x, cellsize_y)
-hs_norm = (hillshade * 255).astype(np.uint8)
+if "hillshade" in project_rasters:
+    hs_norm = project_rasters["hillshade"][0]
+else:
+    with StageTimer("hillshade"):
+        hillshade = compute_hillshade(map_dem, cellsize_x, cellsize_y, valid=map_valid)
+    hs_norm = (hillshade * 255).astype(np.uint8)
 
 # Analysis CRS
 if src_crs.is_geographic:
@@ -3213,18 +5317,30 @@ else:
 
 if analysis_crs == src_crs:
     analysis_dem, analysis_transform, analysis_nodata = src_dem, src_transform, src_nodata
+    analysis_valid = src_valid
+elif "analysis_dem" in project_rasters:
+    analysis_dem, analysis_entry = project_rasters["analysis_dem"]
+    analysis_transform = Affine(*analysis_entry["transform"])
+    analysis_nodata = src_nodata
+    analysis_valid = dem_valid_mask(analysis_dem, analysis_nodata)
 else:
     analysis_transform, aw, ah = calculate_default_transform(
         src_crs, analysis_crs, ds_src.width, ds_src.height, *ds_src.bounds
     )
-    analysis_dem = np.empty((ah, aw), dtype=np.float32)
-    reproject(source=src_dem, destination=analysis_dem, src_transform=src_transform,
-             src_crs=src_crs, src_nodata=src_nodata, dst_transform=analysis_transform,
-             dst_crs=analysis_crs, dst_nodata=src_nodata, resampling=Resampling.bilinear)
+    analysis_dem = np.full((ah, aw), dem_fill_value, dtype=np.float32)
+    with StageTimer("reproject_analysis"):
+        reproject(source=src_dem, destination=analysis_dem, src_transform=src_transform,
+                 src_crs=src_crs, src_nodata=src_nodata, dst_transform=analysis_transform,
+                 dst_crs=analysis_crs, dst_nodata=src_nodata, resampling=Resampling.bilinear)
     analysis_nodata = src_nodata
+    analysis_valid = dem_valid_mask(analysis_dem, analysis_nodata)
+
+# Identity of the analysis DEM (source DEM and analysis grid) for caches that must not
+# rehash the raster on every rerun
+analysis_dem_key = f"{source_dem_key}|{analysis_crs}|{tuple(analysis_transform)[:6]}|{analysis_dem.shape}"
 
-transformer_to_analysis = Transformer.from_crs(map_crs, analysis_crs, always_xy=True)
-transformer_to_map = Transformer.from_crs(analysis_crs, map_crs, always_xy=True)
+transformer_to_analysis = get_transformer(map_crs, analysis_crs)
+transformer_to_map = get_transformer(analysis_crs, map_crs)
 
 # Session state
 if "modified_dem" not in st.session_state:
@@ -3357,19 +5473,8 @@ if st.session_state.get("uploaded_profile_coords") is not None:
                     try:
                         source_crs_for_transform = uploaded_crs if uploaded_crs is not None else src_crs
                         if source_crs_for_transform is not None and not source_crs_for_transform.is_geographic:
-                            transformer_upload_to_latlon = Transformer.from_crs(
-                                source_crs_for_transform, map_crs, always_xy=True
-                            )
-                            line_coords_latlon = []
-                            for coord in valid_coords:
-                                x, y = coord[0], coord[1]
-                                try:
-                                    lon, lat = transformer_upload_to_latlon.transform(x, y)
-                                    if not (np.isnan(lon) or np.isnan(lat) or 
-                                           not np.isfinite(lon) or not np.isfinite(lat)):
-                                        line_coords_latlon.append([lon, lat])
-                                except Exception:
-                                    continue
+                            upload_lonlat = transform_coords(valid_coords, source_crs_for_transform, map_crs)
+                            line_coords_latlon = upload_lonlat[np.isfinite(upload_lonlat).all(axis=1)].tolist()
                             if len(line_coords_latlon) < 2:
                                 line_coords_latlon = None
                         else:
@@ -3422,15 +5527,168 @@ with st.container(border=True):
         st.metric("Area", f"{area_km2:.1f}", label_visibility="collapsed")
         st.caption("km²")
 
+# ============================================================================
+# PROJECT FILE (Save / Reopen)
+# ============================================================================
+
+PROJECT_FILE_DIR = Path(tempfile.gettempdir()) / "terrain_editor_projects"
+
+def open_uploaded_project():
+    """Uploader callback: restore a project file's design state and memory-map its rasters."""
+    uploaded = st.session_state.get("project_file_upload")
+    if uploaded is None:
+        return
+    PROJECT_FILE_DIR.mkdir(parents=True, exist_ok=True)
+    path = PROJECT_FILE_DIR / f"{uuid.uuid4().hex}.zip"
+    path.write_bytes(uploaded.getvalue())
+    try:
+        metadata, arrays = read_project_file(str(path))
+    except Exception as e:
+        st.error(f"Error opening project file: {e}")
+        return
+    for key, value in metadata["state"].items():
+        st.session_state[key] = value
+    if metadata["state"].get("profile_line_coords"):
+        st.session_state.uploaded_profile_coords = metadata["state"]["profile_line_coords"]
+        st.session_state.uploaded_profile_crs = None
+    for key in PROJECT_DEM_KEYS:
+        st.session_state[key] = None
+    st.session_state.corridor_state = None
+    st.session_state.project_file = {
+        "path": str(path),
+        "name": uploaded.name,
+        "metadata": metadata,
+        "rasters": {name: (array, metadata["rasters"][name]) for name, array in arrays.items()},
+        "pending_patches": [key for key in PROJECT_DEM_KEYS if f"{key}_patch" in arrays],
+    }
+
+# Modified DEMs of a freshly opened project: analysis DEM plus the stored patch
+if project_rasters and st.session_state.project_file.get("pending_patches"):
+    for key in st.session_state.project_file["pending_patches"]:
+        patch, entry = project_rasters[f"{key}_patch"]
+        r0, r1, c0, c1 = entry["window"]
+        st.session_state[key] = _restore_dem(None, ((slice(r0, r1), slice(c0, c1)), None, patch), "new", analysis_dem)
+    st.session_state.project_file["pending_patches"] = []
+
+with st.sidebar:
+    st.markdown("### 📦 Project File")
+    st.file_uploader("Open project", type=["zip"], key="project_file_upload", on_change=open_uploaded_project,
+                     help="Project zip saved by this app: design state plus cached rasters")
+    if st.session_state.get("project_file") is not None:
+        st.caption(f"Open: {st.session_state.project_file['name']}"
+                   + (" • cached rasters in use" if project_rasters else ""))
+    include_derived = st.checkbox("Include derived rasters", value=True, key="project_file_derived",
+                                  help="Store the reprojected DEMs and hillshade so reopening skips recomputing them")
+    if st.button("💾 Save Project", use_container_width=True, key="project_file_save"):
+        with st.spinner("Writing project file..."):
+            try:
+                with StageTimer("project_save"):
+                    state = {key: st.session_state[key] for key in PROJECT_STATE_KEYS if key in st.session_state}
+                    source = {"hash": raster_hash(src_dem), "crs": str(src_crs), "transform": list(src_transform)[:6],
+                              "shape": list(src_dem.shape), "nodata": src_nodata, "name": Path(str(ds_src.name)).name}
+                    rasters = {}
+                    if include_derived:
+                        if map_dem is not src_dem:
+                            rasters["map_dem"] = (map_dem, {"transform": list(map_transform)[:6], "crs": str(map_crs)})
+                        if analysis_dem is not src_dem:
+                            rasters["analysis_dem"] = (analysis_dem, {"transform": list(analysis_transform)[:6],
+                                                                      "crs": str(analysis_crs)})
+                        rasters["hillshade"] = (hs_norm, {"transform": list(map_transform)[:6], "crs": str(map_crs)})
+                    for key in PROJECT_DEM_KEYS:
+                        patch = dem_patch(None, st.session_state.get(key), analysis_dem)
+                        if patch is not None:
+                            window, _, values = patch
+                            rasters[f"{key}_patch"] = (values, {"window": [window[0].start, window[0].stop,
+                                                                           window[1].start, window[1].stop]})
+                    PROJECT_FILE_DIR.mkdir(parents=True, exist_ok=True)
+                    save_path = PROJECT_FILE_DIR / f"{uuid.uuid4().hex}.zip"
+                    write_project_file(str(save_path), state, source, rasters)
+                    previous = st.session_state.get("project_file_saved")
+                    if previous is not None and os.path.exists(previous):
+                        os.remove(previous)
+                    st.session_state.project_file_saved = str(save_path)
+            except Exception as e:
+                st.error(f"Error writing project file: {e}")
+    saved_path = st.session_state.get("project_file_saved")
+    if saved_path is not None and os.path.exists(saved_path):
+        with open(saved_path, "rb") as project_file:
+            st.download_button("⬇️ Download Project", data=project_file, file_name="terrain_project.zip",
+                               mime="application/zip", use_container_width=True, key="project_file_download")
+        st.caption(f"{os.path.getsize(saved_path) / 1e6:.1f} MB")
+
+# ============================================================================
+# DESIGN SURFACE OVERLAYS
+# ============================================================================
+
+def current_design_dem_key():
+    """Session key of the modified DEM for the current design mode (falls back to the project DEM)."""
+    key = "modified_dem" if st.session_state.design_mode == "profile" else "basin_modified_dem"
+    if st.session_state.get(key) is None and st.session_state.get("project_dem") is not None:
+        key = "project_dem"
+    return key
+
+def add_dz_overlay(fmap, opacity=0.8):
+    """Add the cut/fill (dz) overlay of the current modified DEM to a folium map, if enabled."""
+    if not st.session_state.get("show_dz_overlay", True):
+        return None
+    design_key = current_design_dem_key()
+    design_dem = st.session_state.get(design_key)
+    if design_dem is None or design_dem.shape != analysis_dem.shape:
+        return None
+    try:
+        with StageTimer("dz_overlay"):
+            overlay = cached_dz_overlay(design_key, analysis_dem_key, analysis_dem, design_dem, analysis_valid,
+                                        analysis_nodata, analysis_transform, analysis_crs, map_crs,
+                                        st.session_state.get("dz_overlay_range", 2.0))
+        if overlay is not None:
+            folium.raster_layers.ImageOverlay(
+                image=overlay["url"], bounds=overlay["bounds"], opacity=opacity, name="Cut/Fill"
+            ).add_to(fmap)
+        return overlay
+    except Exception as e:
+        st.warning(f"Could not draw cut/fill overlay: {e}")
+        return None
+
 # ============================================================================
 # TABS
 # ============================================================================
 
+# Views are switched with a selector instead of st.tabs: st.tabs renders every tab's
+# content on each run, while only the active view here builds its maps and plots.
+# Inactive views stay mounted in hidden containers. Widgets inside the skipped panels
+# are not rendered, so Streamlit would drop their state; the keys below are re-assigned
+# every run to keep design inputs and panel options across views and design modes.
+PERSISTENT_WIDGET_KEYS = HISTORY_WIDGET_KEYS + (
+    "sat_xs", "hs_xs", "prof_color_xs", "stations_xs", "section_sheet_format", "section_sheet_per_page",
+    "sat_prof", "hs_prof", "prof_color_prof", "stations_prof",
+    "basin_export_res_2", "basin_resample_method", "basin_export_compress", "basin_export_cog",
+)
+for widget_key in PERSISTENT_WIDGET_KEYS:
+    if widget_key in st.session_state:
+        st.session_state[widget_key] = st.session_state[widget_key]
+
+if st.session_state.design_mode == "profile":
+    view_labels = ["Input Data", "Profile", "Cross-Section", "Project"]
+else:
+    view_labels = ["Input Data", "Basin Design", "Project"]
+
+if st.session_state.get("active_view") not in view_labels:
+    st.session_state.active_view = view_labels[0]
+active_view = st.radio("View", view_labels, key="active_view", horizontal=True, label_visibility="collapsed")
+
+
+def view_container(label):
+    """Container for one view; hidden by CSS unless it is the active view."""
+    if label == active_view:
+        return st.container()
+    return st.container(key="hidden_view_" + label.lower().replace(" ", "_").replace("-", "_"))
+
+
 if st.session_state.design_mode == "profile":
-    tab1, tab2, tab3 = st.tabs(["Input Data", "Profile", "Cross-Section"])
+    tab1, tab2, tab3, tab5 = (view_container(label) for label in view_labels)
     tab4 = None
 else:
-    tab1, tab4 = st.tabs(["Input Data", "Basin Design"])
+    tab1, tab4, tab5 = (view_container(label) for label in view_labels)
     tab2, tab3 = None, None
 
 # ============================================================================
@@ -3460,6 +5718,22 @@ with tab1:
                                               help="Spacing for sampling existing terrain elevation")
             st.session_state.existing_spacing = existing_spacing
             
+            st.markdown("---")
+            st.markdown("**DEM Contours**")
+            show_existing_contours = st.checkbox("Existing terrain", value=False, key="show_dem_contours_existing",
+                                                 help="Contours traced from the analysis DEM")
+            show_design_contours = st.checkbox("Design surface", value=False, key="show_dem_contours_design",
+                                               help="Contours of the modified DEM over the design window")
+            dem_contour_interval = st.number_input("Interval (m)", 0.1, 100.0, 5.0, 0.5, key="dem_contours_interval",
+                                                   help="Every 5th contour is drawn as a thicker index contour")
+            
+            st.markdown("---")
+            st.markdown("**Cut/Fill Overlay**")
+            st.checkbox("Show dz (modified − existing)", value=True, key="show_dz_overlay",
+                        help="Red = cut, blue = fill; drawn after a modified DEM is computed")
+            st.number_input("Colour range ± (m)", 0.1, 100.0, 2.0, 0.5, key="dz_overlay_range",
+                            help="Changes at or beyond this depth get the full colour")
+            
             st.markdown("---")
             st.markdown("**Drawing Instructions**")
             if st.session_state.design_mode == "profile":
@@ -3468,46 +5742,50 @@ with tab1:
                 st.info("📍 **Polygon:** Draw boundary (blue)\n\n📍 **Channel:** Draw flow path (green)")
     
     with col_map:
-        m = folium.Map(location=[center_lat, center_lon], zoom_start=14, prefer_canvas=True)
-        
-        folium.TileLayer(
-            tiles='https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}',
-            attr='Google', opacity=sat_opacity
-        ).add_to(m)
-        
-        folium.raster_layers.ImageOverlay(
-            image=hs_norm, bounds=bounds_map, opacity=hs_opacity
-        ).add_to(m)
-        
-        # Configure draw tools based on design mode
-        if st.session_state.design_mode == "profile":
-            draw_options = {
-                "polyline": {"shapeOptions": {"color": "#ff0000", "weight": 4}},
-                "polygon": False, "rectangle": False, "circle": False,
-                "marker": False, "circlemarker": False,
-            }
+        if active_view != "Input Data":
+            map_data = None  # map is only built while its view is shown
         else:
-            # In basin mode: always allow both polygon (basin) and polyline (channel) tools
-            # Users can draw basin polygon first, then channel line, or vice versa
-            draw_options = {
-                "polygon": {"shapeOptions": {"color": "#0066ff", "weight": 3, "fillColor": "#0066ff", "fillOpacity": 0.2}},
-                "polyline": {"shapeOptions": {"color": "#00ff00", "weight": 4}},
-                "rectangle": False, "circle": False,
-                "marker": False, "circlemarker": False,
-            }
+            map_build_timer = StageTimer("map_build").start()
+            m = folium.Map(location=[center_lat, center_lon], zoom_start=14, prefer_canvas=True)
         
-        Draw(
-            draw_options=draw_options,
-            edit_options={"edit": True},
-        ).add_to(m)
-        # Inject client-side download + zoom-on-draw JS so downloads appear immediately
-        # and the map zooms to the drawn feature without rerunning the Streamlit app.
-        try:
-            map_var = m.get_name()
-        except Exception:
-            map_var = 'map'
+            folium.TileLayer(
+                tiles='https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}',
+                attr='Google', opacity=sat_opacity
+            ).add_to(m)
+        
+            folium.raster_layers.ImageOverlay(
+                image=hs_norm, bounds=bounds_map, opacity=hs_opacity
+            ).add_to(m)
+        
+            # Configure draw tools based on design mode
+            if st.session_state.design_mode == "profile":
+                draw_options = {
+                    "polyline": {"shapeOptions": {"color": "#ff0000", "weight": 4}},
+                    "polygon": False, "rectangle": False, "circle": False,
+                    "marker": False, "circlemarker": False,
+                }
+            else:
+                # In basin mode: always allow both polygon (basin) and polyline (channel) tools
+                # Users can draw basin polygon first, then channel line, or vice versa
+                draw_options = {
+                    "polygon": {"shapeOptions": {"color": "#0066ff", "weight": 3, "fillColor": "#0066ff", "fillOpacity": 0.2}},
+                    "polyline": {"shapeOptions": {"color": "#00ff00", "weight": 4}},
+                    "rectangle": False, "circle": False,
+                    "marker": False, "circlemarker": False,
+                }
+        
+            Draw(
+                draw_options=draw_options,
+                edit_options={"edit": True},
+            ).add_to(m)
+            # Inject client-side download + zoom-on-draw JS so downloads appear immediately
+            # and the map zooms to the drawn feature without rerunning the Streamlit app.
+            try:
+                map_var = m.get_name()
+            except Exception:
+                map_var = 'map'
 
-        download_js = f"""
+            download_js = f"""
 <div id='draw-downloads' style='position: absolute; top: 10px; right: 10px; z-index:1000; background: rgba(255,255,255,0.9); padding:6px; border-radius:6px; box-shadow:0 1px 4px rgba(0,0,0,0.3);'></div>
 <script src='https://unpkg.com/tokml@0.4.0/tokml.js'></script>
 <script src='https://unpkg.com/shp-write@1.3.0/dist/shpwrite.min.js'></script>
@@ -3626,494 +5904,452 @@ with tab1:
 }})();
 </script>
 """
-        try:
-            m.get_root().html.add_child(folium.Element(download_js))
-        except Exception:
-            pass
-        
-        # Add modified terrain profile overlay if available
-        if (st.session_state.modified_dem is not None and 
-            "center_xy" in st.session_state and 
-            st.session_state.center_xy is not None):
             try:
-                # Convert center_xy to lat/lon for display
-                modified_profile_coords = []
-                for x_a, y_a in st.session_state.center_xy:
-                    lon, lat = transformer_to_map.transform(x_a, y_a)
-                    modified_profile_coords.append([lat, lon])
-                
-                if len(modified_profile_coords) > 1:
-                    folium.PolyLine(
-                        locations=modified_profile_coords,
-                        color='yellow',
-                        weight=4,
-                        opacity=0.6,
-                        tooltip='Modified Terrain Profile'
-                    ).add_to(m)
+                m.get_root().html.add_child(folium.Element(download_js))
             except Exception:
-                pass  # Silently fail if data not ready
+                pass
         
-        # Restore profile line from session state if available (only in profile mode)
-        # In basin mode, profile lines should not be displayed - only channel lines
-        if (st.session_state.design_mode == "profile" and 
-            "profile_line_coords" in st.session_state and 
-            st.session_state.profile_line_coords is not None):
-            try:
-                profile_coords = st.session_state.profile_line_coords
-                # profile_line_coords is stored as [lon, lat] format
-                # Convert to [lat, lon] for folium display
-                display_coords = []
-                for coord in profile_coords:
-                    if coord and len(coord) >= 2:
-                        lon, lat = coord[0], coord[1]
-                        # Validate coordinates
-                        if -180 <= lon <= 180 and -90 <= lat <= 90:
-                            display_coords.append([lat, lon])  # Folium needs [lat, lon]
+            # Add modified terrain profile overlay if available
+            if (st.session_state.modified_dem is not None and 
+                "center_xy" in st.session_state and 
+                st.session_state.center_xy is not None):
+                try:
+                    # Convert center_xy to lat/lon for display
+                    modified_profile_coords = transform_coords(st.session_state.center_xy, analysis_crs, map_crs)[:, ::-1].tolist()
                 
-                if len(display_coords) > 1:
-                    folium.PolyLine(
-                        locations=display_coords,
-                        color='#ff0000', weight=4, opacity=1.0,
-                        tooltip='Profile Line'
-                    ).add_to(m)
-            except Exception as e:
-                # Show error for debugging
-                st.error(f"Error displaying profile line on map: {e}")
+                    if len(modified_profile_coords) > 1:
+                        folium.PolyLine(
+                            locations=modified_profile_coords,
+                            color='yellow',
+                            weight=4,
+                            opacity=0.6,
+                            tooltip='Modified Terrain Profile'
+                        ).add_to(m)
+                except Exception:
+                    pass  # Silently fail if data not ready
         
-        # Add contours to map (visualization only)
-        if st.session_state.contours_data is not None:
-            try:
-                import folium
-                gdf_contours = st.session_state.contours_data
+            # Restore profile line from session state if available (only in profile mode)
+            # In basin mode, profile lines should not be displayed - only channel lines
+            if (st.session_state.design_mode == "profile" and 
+                "profile_line_coords" in st.session_state and 
+                st.session_state.profile_line_coords is not None):
+                try:
+                    profile_coords = st.session_state.profile_line_coords
+                    # profile_line_coords is stored as [lon, lat] format
+                    # Convert to [lat, lon] for folium display
+                    display_coords = []
+                    for coord in profile_coords:
+                        if coord and len(coord) >= 2:
+                            lon, lat = coord[0], coord[1]
+                            # Validate coordinates
+                            if -180 <= lon <= 180 and -90 <= lat <= 90:
+                                display_coords.append([lat, lon])  # Folium needs [lat, lon]
                 
-                # Determine which field to use for labels
-                contour_field = st.session_state.contours_label_field
-                if contour_field not in gdf_contours.columns:
-                    # Try to find a suitable numeric field
-                    numeric_cols = gdf_contours.select_dtypes(include=['number']).columns.tolist()
-                    contour_field = numeric_cols[0] if numeric_cols else None
+                    if len(display_coords) > 1:
+                        folium.PolyLine(
+                            locations=display_coords,
+                            color='#ff0000', weight=4, opacity=1.0,
+                            tooltip='Profile Line'
+                        ).add_to(m)
+                except Exception as e:
+                    # Show error for debugging
+                    st.error(f"Error displaying profile line on map: {e}")
+        
+            # Add contours to map (visualization only)
+            if st.session_state.contours_data is not None:
+                try:
+                    import folium
+                    gdf_contours = st.session_state.contours_data
                 
-                # Index interval for thicker lines
-                index_interval = st.session_state.contours_index_interval
+                    # Determine which field to use for labels
+                    contour_field = st.session_state.contours_label_field
+                    if contour_field not in gdf_contours.columns:
+                        # Try to find a suitable numeric field
+                        numeric_cols = gdf_contours.select_dtypes(include=['number']).columns.tolist()
+                        contour_field = numeric_cols[0] if numeric_cols else None
                 
-                for idx, row in gdf_contours.iterrows():
-                    geom = row.geometry
-                    value = row[contour_field] if contour_field else idx
-                    
-                    # Determine if this is an index contour
-                    is_index = False
-                    if contour_field and index_interval > 0:
-                        try:
-                            if isinstance(value, (int, float)) and value % index_interval == 0:
-                                is_index = True
-                        except:
-                            pass
-                    
-                    # Line style based on index contour
-                    line_weight = 2 if is_index else 1
-                    line_color = '#000000' if is_index else '#555555'
-                    
-                    # Convert geometry to coordinates
-                    if geom.geom_type == 'LineString':
-                        coords = [[lat, lon] for lon, lat in geom.coords]
+                    # Simplified level for the current detail setting (precomputed per layer)
+                    lod = cached_contour_lod(gdf_contours, st.session_state.get("contours_layer_key"))
+                    level = contour_lod_level(lod, st.session_state.get("contours_detail", "Auto"))
+                    latlon, offsets, part_feature = level["latlon"], level["offsets"], level["part_feature"]
+                
+                    # Contour values and index flags for all features at once (thicker index lines)
+                    index_interval = st.session_state.contours_index_interval
+                    if contour_field:
+                        feature_values = gdf_contours[contour_field].to_numpy()
+                        feature_is_index = contour_index_flags(feature_values, index_interval)
+                    else:
+                        feature_values = gdf_contours.index.to_numpy()
+                        feature_is_index = np.zeros(len(gdf_contours), dtype=bool)
+                
+                    # One multi-part polyline per contour value
+                    part_coords = np.split(latlon, offsets[1:-1]) if len(part_feature) else []
+                    codes, uniques = pd.factorize(pd.Series(feature_values[part_feature]), use_na_sentinel=False)
+                    order = np.argsort(codes, kind="stable")
+                    group_bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+                    for k, value in enumerate(uniques):
+                        group = order[group_bounds[k]:group_bounds[k + 1]]
+                        is_index = bool(feature_is_index[part_feature[group[0]]])
                         folium.PolyLine(
-                            locations=coords,
-                            color=line_color,
-                            weight=line_weight,
+                            locations=[part_coords[i].tolist() for i in group],
+                            color='#000000' if is_index else '#555555',
+                            weight=2 if is_index else 1,
                             opacity=st.session_state.contours_opacity,
-                            tooltip=f"{contour_field}: {value}" if contour_field else f"Contour {idx}"
+                            tooltip=f"{contour_field}: {value}" if contour_field else f"Contour {value}"
                         ).add_to(m)
-
-                        # Add labels if enabled - INDEX CONTOURS ONLY
-                        if st.session_state.contours_show_labels and contour_field and is_index:
-                            # Calculate angle of contour line at midpoint for parallel label placement
-                            mid_idx = len(coords) // 2
-                            if mid_idx < len(coords) and mid_idx > 0:
-                                # Get two points around midpoint to calculate angle
-                                pt1 = coords[mid_idx - 1]
-                                pt2 = coords[mid_idx] if mid_idx < len(coords) else coords[mid_idx - 1]
-
-                                # Calculate angle in degrees
-                                import math
-                                dx = pt2[1] - pt1[1]  # lon difference
-                                dy = pt2[0] - pt1[0]  # lat difference
-                                angle = math.degrees(math.atan2(dy, dx))
-
-                                # Normalize angle to be readable (not upside down)
-                                if angle > 90:
-                                    angle -= 180
-                                elif angle < -90:
-                                    angle += 180
-
-                                label_loc = coords[mid_idx]
-                                folium.Marker(
-                                    location=label_loc,
-                                    icon=folium.DivIcon(
-                                        html=f'<div style="font-size: {st.session_state.contours_label_size}px; font-weight: bold; color: black; background: white; padding: 1px 2px; white-space: nowrap; transform: rotate({angle}deg); opacity: {st.session_state.contours_label_opacity};">{value}</div>',
-                                        icon_size=(None, None),
-                                        icon_anchor=(0, 0)
-                                    )
-                                ).add_to(m)
-
-                    elif geom.geom_type == 'MultiLineString':
-                        for line in geom.geoms:
-                            coords = [[lat, lon] for lon, lat in line.coords]
-                            folium.PolyLine(
-                                locations=coords,
-                                color=line_color,
-                                weight=line_weight,
-                                opacity=st.session_state.contours_opacity,
-                                tooltip=f"{contour_field}: {value}" if contour_field else f"Contour {idx}"
+                
+                    # Labels - INDEX CONTOURS ONLY, on the first part of each feature, parallel to the line
+                    if st.session_state.contours_show_labels and contour_field and len(part_feature):
+                        features, first_part = np.unique(part_feature, return_index=True)
+                        lengths = np.diff(offsets)[first_part]
+                        labelled = feature_is_index[features] & (lengths >= 2)
+                        features, first_part, lengths = features[labelled], first_part[labelled], lengths[labelled]
+                        mid = offsets[first_part] + lengths // 2
+                        angles = np.degrees(np.arctan2(latlon[mid, 0] - latlon[mid - 1, 0], latlon[mid, 1] - latlon[mid - 1, 1]))
+                        # Normalize angle to be readable (not upside down)
+                        angles = np.where(angles > 90, angles - 180, np.where(angles < -90, angles + 180, angles))
+                        for feature, label_idx, angle in zip(features, mid, angles):
+                            folium.Marker(
+                                location=latlon[label_idx].tolist(),
+                                icon=folium.DivIcon(
+                                    html=f'<div style="font-size: {st.session_state.contours_label_size}px; font-weight: bold; color: black; background: white; padding: 1px 2px; white-space: nowrap; transform: rotate({angle}deg); opacity: {st.session_state.contours_label_opacity};">{feature_values[feature]}</div>',
+                                    icon_size=(None, None),
+                                    icon_anchor=(0, 0)
+                                )
                             ).add_to(m)
-
-                            # Add labels if enabled - INDEX CONTOURS ONLY (one per multiline segment)
-                            if st.session_state.contours_show_labels and contour_field and is_index:
-                                mid_idx = len(coords) // 2
-                                if mid_idx < len(coords) and mid_idx > 0:
-                                    pt1 = coords[mid_idx - 1]
-                                    pt2 = coords[mid_idx] if mid_idx < len(coords) else coords[mid_idx - 1]
-
-                                    import math
-                                    dx = pt2[1] - pt1[1]
-                                    dy = pt2[0] - pt1[0]
-                                    angle = math.degrees(math.atan2(dy, dx))
-
-                                    if angle > 90:
-                                        angle -= 180
-                                    elif angle < -90:
-                                        angle += 180
-
-                                    label_loc = coords[mid_idx]
-                                    folium.Marker(
-                                        location=label_loc,
-                                        icon=folium.DivIcon(
-                                            html=f'<div style="font-size: {st.session_state.contours_label_size}px; font-weight: bold; color: black; background: white; padding: 1px 2px; white-space: nowrap; transform: rotate({angle}deg); opacity: {st.session_state.contours_label_opacity};">{value}</div>',
-                                            icon_size=(None, None),
-                                            icon_anchor=(0, 0)
-                                        )
-                                    ).add_to(m)
-                                break  # Only label first line segment in MultiLineString
-            except Exception as e:
-                pass  # Silently fail if contours can't be rendered
+                except Exception as e:
+                    pass  # Silently fail if contours can't be rendered
         
-        # Add vector layers to map (visualization only)
-        if len(st.session_state.vector_layers) > 0:
-            try:
-                for layer in st.session_state.vector_layers:
-                    gdf_layer = layer['data']
+            # Cut/fill of the modified DEM
+            add_dz_overlay(m)
+        
+            # Contours traced from the existing and modified DEMs (one layer)
+            if show_existing_contours or show_design_contours:
+                try:
+                    with StageTimer("dem_contours"):
+                        contour_sets = []
+                        if show_existing_contours:
+                            contour_sets.append(("Existing", "#8b5a2b", cached_dem_contours(
+                                "existing", analysis_dem_key, dem_contour_interval, analysis_dem,
+                                analysis_transform, analysis_valid, transformer_to_map)))
                     
-                    for idx, row in gdf_layer.iterrows():
-                        geom = row.geometry
-                        
-                        # Prepare tooltip content
-                        tooltip_text = f"{layer['name']}"
-                        if layer['show_labels'] and layer['label_field'] and layer['label_field'] in row:
-                            tooltip_text += f": {row[layer['label_field']]}"
-                        
-                        if geom.geom_type == 'Point':
-                            coords = [geom.y, geom.x]
-                            folium.CircleMarker(
-                                location=coords,
-                                radius=5,
-                                color='blue',
-                                fillColor='blue',
-                                fillOpacity=layer['opacity'],
-                                tooltip=tooltip_text
+                        design_key = current_design_dem_key()
+                        design_dem = st.session_state.get(design_key)
+                        if show_design_contours and design_dem is not None and design_dem.shape == analysis_dem.shape:
+                            contour_sets.append(("Design", "#ff6600", cached_dem_contours(
+                                "design", (analysis_dem_key, session_raster_hash(design_key)), dem_contour_interval,
+                                design_dem, analysis_transform, None, transformer_to_map,
+                                base_dem=analysis_dem, nodata=analysis_nodata)))
+                    
+                        features = []
+                        for surface, color, contours in contour_sets:
+                            latlon, offsets, part_level = contours["latlon"], contours["offsets"], contours["part_level"]
+                            lonlat = latlon[:, ::-1]
+                            levels, part_group = np.unique(part_level, return_inverse=True)
+                            is_index = contour_index_flags(levels, 5 * dem_contour_interval)
+                            for g, level in enumerate(levels):
+                                parts = np.flatnonzero(part_group == g)
+                                features.append({
+                                    "type": "Feature",
+                                    "geometry": {"type": "MultiLineString",
+                                                 "coordinates": [lonlat[offsets[i]:offsets[i + 1]].tolist() for i in parts]},
+                                    "properties": {"label": f"{surface}: {level:g} m", "color": color,
+                                                   "weight": 2 if is_index[g] else 1},
+                                })
+                        if features:
+                            folium.GeoJson(
+                                {"type": "FeatureCollection", "features": features},
+                                name="DEM Contours",
+                                style_function=lambda f: {"color": f["properties"]["color"],
+                                                          "weight": f["properties"]["weight"], "opacity": 0.9},
+                                tooltip=folium.GeoJsonTooltip(fields=["label"], labels=False),
                             ).add_to(m)
-
+                except Exception as e:
+                    st.warning(f"Could not generate DEM contours: {e}")
+        
+            # Add vector layers to map (visualization only)
+            if len(st.session_state.vector_layers) > 0:
+                try:
+                    for layer in st.session_state.vector_layers:
+                        gdf_layer = layer['data']
+                    
+                        for idx, row in gdf_layer.iterrows():
+                            geom = row.geometry
+                        
+                            # Prepare tooltip content
+                            tooltip_text = f"{layer['name']}"
                             if layer['show_labels'] and layer['label_field'] and layer['label_field'] in row:
-                                folium.Marker(
+                                tooltip_text += f": {row[layer['label_field']]}"
+                        
+                            if geom.geom_type == 'Point':
+                                coords = [geom.y, geom.x]
+                                folium.CircleMarker(
                                     location=coords,
-                                    icon=folium.DivIcon(
-                                        html=f'<div style="font-size: {layer["label_size"]}px; color: black; background: white; padding: 1px 2px; white-space: nowrap; opacity: {layer["label_opacity"]};">{row[layer["label_field"]]}</div>',
-                                        icon_size=(None, None),
-                                        icon_anchor=(0, 0)
-                                    )
+                                    radius=5,
+                                    color='blue',
+                                    fillColor='blue',
+                                    fillOpacity=layer['opacity'],
+                                    tooltip=tooltip_text
                                 ).add_to(m)
 
-                        elif geom.geom_type == 'LineString':
-                            coords = [[lat, lon] for lon, lat in geom.coords]
-                            folium.PolyLine(
-                                locations=coords,
-                                color='blue',
-                                weight=2,
-                                opacity=layer['opacity'],
-                                tooltip=tooltip_text
-                            ).add_to(m)
-
-                            if layer['show_labels'] and layer['label_field'] and layer['label_field'] in row:
-                                mid_idx = len(coords) // 2
-                                if mid_idx < len(coords):
+                                if layer['show_labels'] and layer['label_field'] and layer['label_field'] in row:
                                     folium.Marker(
-                                        location=coords[mid_idx],
+                                        location=coords,
                                         icon=folium.DivIcon(
                                             html=f'<div style="font-size: {layer["label_size"]}px; color: black; background: white; padding: 1px 2px; white-space: nowrap; opacity: {layer["label_opacity"]};">{row[layer["label_field"]]}</div>',
                                             icon_size=(None, None),
                                             icon_anchor=(0, 0)
                                         )
                                     ).add_to(m)
-                        
-                        elif geom.geom_type == 'Polygon':
-                            coords = [[lat, lon] for lon, lat in geom.exterior.coords]
-                            folium.Polygon(
-                                locations=coords,
-                                color='blue',
-                                weight=2,
-                                fillColor='blue',
-                                fillOpacity=layer['opacity'] * 0.3,
-                                opacity=layer['opacity'],
-                                tooltip=tooltip_text
-                            ).add_to(m)
 
-                            if layer['show_labels'] and layer['label_field'] and layer['label_field'] in row:
-                                # Use polygon centroid for label placement (centered inside polygon)
-                                centroid = geom.centroid
-                                folium.Marker(
-                                    location=[centroid.y, centroid.x],
-                                    icon=folium.DivIcon(
-                                        html=f'<div style="font-size: {layer["label_size"]}px; color: black; background: white; padding: 1px 2px; white-space: nowrap; text-align: center; opacity: {layer["label_opacity"]};">{row[layer["label_field"]]}</div>',
-                                        icon_size=(None, None),
-                                        icon_anchor=(0, 0)
-                                    )
+                            elif geom.geom_type == 'LineString':
+                                coords = [[lat, lon] for lon, lat in geom.coords]
+                                folium.PolyLine(
+                                    locations=coords,
+                                    color='blue',
+                                    weight=2,
+                                    opacity=layer['opacity'],
+                                    tooltip=tooltip_text
                                 ).add_to(m)
-                        
-                        elif geom.geom_type in ['MultiPoint', 'MultiLineString', 'MultiPolygon']:
-                            label_added = False  # Track if we've added a label for this multi-geometry
-                            for sub_geom in geom.geoms:
-                                if sub_geom.geom_type == 'Point':
-                                    coords = [sub_geom.y, sub_geom.x]
-                                    folium.CircleMarker(
-                                        location=coords,
-                                        radius=5,
-                                        color='blue',
-                                        fillColor='blue',
-                                        fillOpacity=layer['opacity'],
-                                        tooltip=tooltip_text
-                                    ).add_to(m)
-                                elif sub_geom.geom_type == 'LineString':
-                                    coords = [[lat, lon] for lon, lat in sub_geom.coords]
-                                    folium.PolyLine(
-                                        locations=coords,
-                                        color='blue',
-                                        weight=2,
-                                        opacity=layer['opacity'],
-                                        tooltip=tooltip_text
-                                    ).add_to(m)
-                                elif sub_geom.geom_type == 'Polygon':
-                                    coords = [[lat, lon] for lon, lat in sub_geom.exterior.coords]
-                                    folium.Polygon(
-                                        locations=coords,
-                                        color='blue',
-                                        weight=2,
-                                        fillColor='blue',
-                                        fillOpacity=layer['opacity'] * 0.3,
-                                        opacity=layer['opacity'],
-                                        tooltip=tooltip_text
-                                    ).add_to(m)
 
-                                    # Add label for first polygon in MultiPolygon only
-                                    if not label_added and layer['show_labels'] and layer['label_field'] and layer['label_field'] in row:
-                                        centroid = sub_geom.centroid
+                                if layer['show_labels'] and layer['label_field'] and layer['label_field'] in row:
+                                    mid_idx = len(coords) // 2
+                                    if mid_idx < len(coords):
                                         folium.Marker(
-                                            location=[centroid.y, centroid.x],
+                                            location=coords[mid_idx],
                                             icon=folium.DivIcon(
-                                                html=f'<div style="font-size: {layer["label_size"]}px; color: black; background: white; padding: 1px 2px; white-space: nowrap; text-align: center; opacity: {layer["label_opacity"]};">{row[layer["label_field"]]}</div>',
+                                                html=f'<div style="font-size: {layer["label_size"]}px; color: black; background: white; padding: 1px 2px; white-space: nowrap; opacity: {layer["label_opacity"]};">{row[layer["label_field"]]}</div>',
                                                 icon_size=(None, None),
                                                 icon_anchor=(0, 0)
                                             )
                                         ).add_to(m)
-                                        label_added = True
-            except Exception as e:
-                pass  # Silently fail if vector layers can't be rendered
+                        
+                            elif geom.geom_type == 'Polygon':
+                                coords = [[lat, lon] for lon, lat in geom.exterior.coords]
+                                folium.Polygon(
+                                    locations=coords,
+                                    color='blue',
+                                    weight=2,
+                                    fillColor='blue',
+                                    fillOpacity=layer['opacity'] * 0.3,
+                                    opacity=layer['opacity'],
+                                    tooltip=tooltip_text
+                                ).add_to(m)
+
+                                if layer['show_labels'] and layer['label_field'] and layer['label_field'] in row:
+                                    # Use polygon centroid for label placement (centered inside polygon)
+                                    centroid = geom.centroid
+                                    folium.Marker(
+                                        location=[centroid.y, centroid.x],
+                                        icon=folium.DivIcon(
+                                            html=f'<div style="font-size: {layer["label_size"]}px; color: black; background: white; padding: 1px 2px; white-space: nowrap; text-align: center; opacity: {layer["label_opacity"]};">{row[layer["label_field"]]}</div>',
+                                            icon_size=(None, None),
+                                            icon_anchor=(0, 0)
+                                        )
+                                    ).add_to(m)
+                        
+                            elif geom.geom_type in ['MultiPoint', 'MultiLineString', 'MultiPolygon']:
+                                label_added = False  # Track if we've added a label for this multi-geometry
+                                for sub_geom in geom.geoms:
+                                    if sub_geom.geom_type == 'Point':
+                                        coords = [sub_geom.y, sub_geom.x]
+                                        folium.CircleMarker(
+                                            location=coords,
+                                            radius=5,
+                                            color='blue',
+                                            fillColor='blue',
+                                            fillOpacity=layer['opacity'],
+                                            tooltip=tooltip_text
+                                        ).add_to(m)
+                                    elif sub_geom.geom_type == 'LineString':
+                                        coords = [[lat, lon] for lon, lat in sub_geom.coords]
+                                        folium.PolyLine(
+                                            locations=coords,
+                                            color='blue',
+                                            weight=2,
+                                            opacity=layer['opacity'],
+                                            tooltip=tooltip_text
+                                        ).add_to(m)
+                                    elif sub_geom.geom_type == 'Polygon':
+                                        coords = [[lat, lon] for lon, lat in sub_geom.exterior.coords]
+                                        folium.Polygon(
+                                            locations=coords,
+                                            color='blue',
+                                            weight=2,
+                                            fillColor='blue',
+                                            fillOpacity=layer['opacity'] * 0.3,
+                                            opacity=layer['opacity'],
+                                            tooltip=tooltip_text
+                                        ).add_to(m)
+
+                                        # Add label for first polygon in MultiPolygon only
+                                        if not label_added and layer['show_labels'] and layer['label_field'] and layer['label_field'] in row:
+                                            centroid = sub_geom.centroid
+                                            folium.Marker(
+                                                location=[centroid.y, centroid.x],
+                                                icon=folium.DivIcon(
+                                                    html=f'<div style="font-size: {layer["label_size"]}px; color: black; background: white; padding: 1px 2px; white-space: nowrap; text-align: center; opacity: {layer["label_opacity"]};">{row[layer["label_field"]]}</div>',
+                                                    icon_size=(None, None),
+                                                    icon_anchor=(0, 0)
+                                                )
+                                            ).add_to(m)
+                                            label_added = True
+                except Exception as e:
+                    pass  # Silently fail if vector layers can't be rendered
         
-        # Add station markers with labels to map
-        try:
-            # In basin mode, if a channel profile is defined, show two stations S0 (upstream) and S1 (downstream)
-            # Only show markers if channel_coords is explicitly set (not None) and has valid coordinates
-            if (st.session_state.design_mode == "basin" and 
-                st.session_state.get("basin_channel_coords") is not None):
-                channel_coords = st.session_state.basin_channel_coords
-                # Validate that channel_coords is a proper list with at least 2 points
-                if (isinstance(channel_coords, list) and 
-                    len(channel_coords) >= 2 and
-                    all(isinstance(c, (list, tuple)) and len(c) >= 2 for c in channel_coords[:2])):
-                    endpoints = [channel_coords[0], channel_coords[-1]]
-                    for station_idx, coord in enumerate(endpoints):
-                        if not (isinstance(coord, (list, tuple)) and len(coord) >= 2):
-                            continue
-                        lon, lat = coord[0], coord[1]
-                        # Validate coordinates are reasonable
-                        if not (-180 <= lon <= 180 and -90 <= lat <= 90):
-                            continue
-                        # Use yellow marker with black border (matching Basin Design tab style)
-                        station_label = "Upstream" if station_idx == 0 else "Downstream"
-                        folium.CircleMarker(
-                            location=[lat, lon],
-                            radius=8,
-                            popup=f'S{station_idx} ({station_label})',
-                            tooltip=f'S{station_idx} ({station_label})',
-                            color='black',
-                            weight=2,
-                            fillColor='#ffcc00',
-                            fillOpacity=0.9
-                        ).add_to(m)
-                        folium.Marker(
-                            location=[lat, lon],
-                            icon=folium.DivIcon(
-                                html=f'<div style="font-size: 14px; font-weight: bold; color: black; text-shadow: 1px 1px 2px white, -1px -1px 2px white, 1px -1px 2px white, -1px 1px 2px white;">S{station_idx}</div>',
-                                icon_size=(30, 15),
-                                icon_anchor=(15, -5)
-                            )
-                        ).add_to(m)
-            else:
-                # Default behavior (profile stations) if available
-                if ("center_xy" in st.session_state and st.session_state.center_xy is not None):
-                    center_xy = st.session_state.center_xy
-                    stations = st.session_state.stations
-                    selected_station_idx = st.session_state.get("selected_station_idx", 0)
-                    # Add markers for all stations (profile mode behavior)
-                    for station_idx in range(len(stations)):
-                        xc, yc = center_xy[station_idx]
-                        lon, lat = transformer_to_map.transform(xc, yc)
-                        if station_idx == selected_station_idx:
+            # Add station markers with labels to map
+            try:
+                # In basin mode, if a channel profile is defined, show two stations S0 (upstream) and S1 (downstream)
+                # Only show markers if channel_coords is explicitly set (not None) and has valid coordinates
+                if (st.session_state.design_mode == "basin" and 
+                    st.session_state.get("basin_channel_coords") is not None):
+                    channel_coords = st.session_state.basin_channel_coords
+                    # Validate that channel_coords is a proper list with at least 2 points
+                    if (isinstance(channel_coords, list) and 
+                        len(channel_coords) >= 2 and
+                        all(isinstance(c, (list, tuple)) and len(c) >= 2 for c in channel_coords[:2])):
+                        endpoints = [channel_coords[0], channel_coords[-1]]
+                        for station_idx, coord in enumerate(endpoints):
+                            if not (isinstance(coord, (list, tuple)) and len(coord) >= 2):
+                                continue
+                            lon, lat = coord[0], coord[1]
+                            # Validate coordinates are reasonable
+                            if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+                                continue
+                            # Use yellow marker with black border (matching Basin Design tab style)
+                            station_label = "Upstream" if station_idx == 0 else "Downstream"
                             folium.CircleMarker(
                                 location=[lat, lon],
                                 radius=8,
-                                popup=f'Station {station_idx} (S{station_idx})',
-                                tooltip=f'S{station_idx} (Selected)',
+                                popup=f'S{station_idx} ({station_label})',
+                                tooltip=f'S{station_idx} ({station_label})',
                                 color='black',
-                                weight=3,
+                                weight=2,
                                 fillColor='#ffcc00',
-                                fillOpacity=1.0
+                                fillOpacity=0.9
                             ).add_to(m)
                             folium.Marker(
                                 location=[lat, lon],
                                 icon=folium.DivIcon(
-                                    html=f'<div style="font-size: 14px; font-weight: bold; color: black;">S{station_idx}</div>',
+                                    html=f'<div style="font-size: 14px; font-weight: bold; color: black; text-shadow: 1px 1px 2px white, -1px -1px 2px white, 1px -1px 2px white, -1px 1px 2px white;">S{station_idx}</div>',
                                     icon_size=(30, 15),
                                     icon_anchor=(15, -5)
                                 )
                             ).add_to(m)
-                        else:
-                            folium.CircleMarker(
-                                location=[lat, lon],
-                                radius=5,
-                                popup=f'Station {station_idx} (S{station_idx})',
-                                tooltip=f'S{station_idx}',
-                                color='#d62728',
-                                weight=2,
-                                fillColor='#d62728',
-                                fillOpacity=0.8
-                            ).add_to(m)
-                            folium.Marker(
-                                location=[lat, lon],
-                                icon=folium.DivIcon(
-                                    html=f'<div style="font-size: 12px; font-weight: bold; color: #d62728;">S{station_idx}</div>',
-                                    icon_size=(25, 12),
-                                    icon_anchor=(12, -5)
-                                )
-                            ).add_to(m)
-        except Exception:
-            pass  # Silently fail if data not ready
+                else:
+                    # Default behavior (profile stations) if available
+                    if ("center_xy" in st.session_state and st.session_state.center_xy is not None):
+                        center_xy = st.session_state.center_xy
+                        stations = st.session_state.stations
+                        selected_station_idx = st.session_state.get("selected_station_idx", 0)
+                        # All stations as one layer (profile mode behavior)
+                        add_station_layer(m, cached_station_features(center_xy, transformer_to_map), selected_station_idx)
+            except Exception as e:
+                st.warning(f"Could not draw station markers: {e}")
         
-        # Add berm and ditch boundary lines on map (if template is berm_ditch)
-        # Note: template_type and template_params are defined in tab3, so we check session state
-        if ("center_xy" in st.session_state and st.session_state.center_xy is not None and
-            "samples" in st.session_state and "normals" in locals()):
-            try:
-                # Check if we have template info stored (will be set in cross-section tab)
-                if "template_type" in st.session_state and st.session_state.template_type == "berm_ditch":
-                    template_params = st.session_state.get("template_params", {})
-                    center_xy = st.session_state.center_xy
-                    stations = st.session_state.stations
-                    samples = st.session_state.samples
+            # Add berm and ditch boundary lines on map (if template is berm_ditch)
+            # Note: template_type and template_params are defined in tab3, so we check session state
+            if ("center_xy" in st.session_state and st.session_state.center_xy is not None and
+                "samples" in st.session_state and "normals" in locals()):
+                try:
+                    # Check if we have template info stored (will be set in cross-section tab)
+                    if "template_type" in st.session_state and st.session_state.template_type == "berm_ditch":
+                        template_params = st.session_state.get("template_params", {})
+                        center_xy = st.session_state.center_xy
+                        stations = st.session_state.stations
+                        samples = st.session_state.samples
+                    
+                        # Get normals from samples
+                        tangents_map, normals_map = compute_tangents_normals(samples)
                     
-                    # Get normals from samples
-                    tangents_map, normals_map = compute_tangents_normals(samples)
+                        berm_top_left, berm_top_right, ditch_bottom_left, ditch_bottom_right = get_berm_ditch_boundaries(template_params)
                     
-                    berm_top_left, berm_top_right, ditch_bottom_left, ditch_bottom_right = get_berm_ditch_boundaries(template_params)
+                        # Berm top and ditch bottom edge points at every station (one batched transform)
+                        edge_latlon = offset_lines(center_xy, normals_map, [berm_top_left, berm_top_right,
+                                                                            ditch_bottom_left, ditch_bottom_right],
+                                                   analysis_crs, map_crs).tolist()
                     
-                    # Draw lines at each station
-                    for station_idx in range(len(stations)):
-                        xc, yc = center_xy[station_idx]
-                        nx, ny = normals_map[station_idx]
-                        
-                        # Berm top width line
-                        x_left = xc + berm_top_left * nx
-                        y_left = yc + berm_top_left * ny
-                        x_right = xc + berm_top_right * nx
-                        y_right = yc + berm_top_right * ny
-                        
-                        lon_left, lat_left = transformer_to_map.transform(x_left, y_left)
-                        lon_right, lat_right = transformer_to_map.transform(x_right, y_right)
-                        
-                        folium.PolyLine(
-                            locations=[[lat_left, lon_left], [lat_right, lon_right]],
-                            color='blue', weight=2, opacity=0.7,
-                            tooltip=f'Berm Top Width (Station {station_idx})'
-                        ).add_to(m)
-                        
-                        # Ditch bottom width line
-                        x_ditch_left = xc + ditch_bottom_left * nx
-                        y_ditch_left = yc + ditch_bottom_left * ny
-                        x_ditch_right = xc + ditch_bottom_right * nx
-                        y_ditch_right = yc + ditch_bottom_right * ny
-                        
-                        lon_ditch_left, lat_ditch_left = transformer_to_map.transform(x_ditch_left, y_ditch_left)
-                        lon_ditch_right, lat_ditch_right = transformer_to_map.transform(x_ditch_right, y_ditch_right)
+                        # Draw lines at each station
+                        for station_idx in range(len(stations)):
+                            folium.PolyLine(
+                                locations=[edge_latlon[0][station_idx], edge_latlon[1][station_idx]],
+                                color='blue', weight=2, opacity=0.7,
+                                tooltip=f'Berm Top Width (Station {station_idx})'
+                            ).add_to(m)
                         
-                        folium.PolyLine(
-                            locations=[[lat_ditch_left, lon_ditch_left], [lat_ditch_right, lon_ditch_right]],
-                            color='orange', weight=2, opacity=0.7,
-                            tooltip=f'Ditch Bottom Width (Station {station_idx})'
-                        ).add_to(m)
-            except Exception:
-                pass  # Silently fail if data not ready
+                            folium.PolyLine(
+                                locations=[edge_latlon[2][station_idx], edge_latlon[3][station_idx]],
+                                color='orange', weight=2, opacity=0.7,
+                                tooltip=f'Ditch Bottom Width (Station {station_idx})'
+                            ).add_to(m)
+                except Exception:
+                    pass  # Silently fail if data not ready
         
-        # Display existing basin polygon if in basin mode
-        if st.session_state.design_mode == "basin" and st.session_state.basin_polygon_coords is not None:
-            try:
-                basin_coords = st.session_state.basin_polygon_coords
-                # Ensure polygon is closed (first and last point are the same)
-                if len(basin_coords) >= 3:  # Need at least 3 points for a valid polygon
-                    # Make a copy to avoid modifying the original
-                    display_coords = list(basin_coords)
-                    if display_coords[0] != display_coords[-1]:
-                        display_coords = display_coords + [display_coords[0]]
+            # Display existing basin polygon if in basin mode
+            if st.session_state.design_mode == "basin" and st.session_state.basin_polygon_coords is not None:
+                try:
+                    basin_coords = st.session_state.basin_polygon_coords
+                    # Ensure polygon is closed (first and last point are the same)
+                    if len(basin_coords) >= 3:  # Need at least 3 points for a valid polygon
+                        # Make a copy to avoid modifying the original
+                        display_coords = list(basin_coords)
+                        if display_coords[0] != display_coords[-1]:
+                            display_coords = display_coords + [display_coords[0]]
                     
-                    # Convert [lon, lat] to [lat, lon] for folium
-                    basin_display_coords = [[c[1], c[0]] for c in display_coords if isinstance(c, (list, tuple)) and len(c) >= 2]
+                        # Convert [lon, lat] to [lat, lon] for folium
+                        basin_display_coords = [[c[1], c[0]] for c in display_coords if isinstance(c, (list, tuple)) and len(c) >= 2]
                     
-                    if len(basin_display_coords) >= 3:  # Ensure we have enough points after filtering
-                        folium.Polygon(
-                            locations=basin_display_coords,
-                            color='#0066ff',
-                            weight=3,
-                            fill=True,
-                            fill_color='#0066ff',
-                            fill_opacity=0.2,
-                            tooltip='Basin Polygon'
-                        ).add_to(m)
-                # Display inner polygon (bottom area) if available
-                inner_poly_latlon = st.session_state.get("basin_inner_polygon_coords")
-                if inner_poly_latlon is not None and isinstance(inner_poly_latlon, list) and len(inner_poly_latlon) >= 3:
-                    try:
-                        # inner_poly_latlon stored as [lon, lat] pairs - convert to [lat, lon] for folium
-                        inner_display = [[c[1], c[0]] for c in inner_poly_latlon]
-                        folium.Polygon(
-                            locations=inner_display,
-                            color='#ff6600',
-                            weight=2,
-                            fill=True,
-                            fill_color='#ff6600',
-                            fill_opacity=0.25,
-                            tooltip='Basin Inner Polygon (Bottom)'
-                        ).add_to(m)
-                    except Exception:
-                        pass
+                        if len(basin_display_coords) >= 3:  # Ensure we have enough points after filtering
+                            folium.Polygon(
+                                locations=basin_display_coords,
+                                color='#0066ff',
+                                weight=3,
+                                fill=True,
+                                fill_color='#0066ff',
+                                fill_opacity=0.2,
+                                tooltip='Basin Polygon'
+                            ).add_to(m)
+                    # Display inner polygon (bottom area) if available
+                    inner_poly_latlon = st.session_state.get("basin_inner_polygon_coords")
+                    if inner_poly_latlon is not None and isinstance(inner_poly_latlon, list) and len(inner_poly_latlon) >= 3:
+                        try:
+                            # inner_poly_latlon stored as [lon, lat] pairs - convert to [lat, lon] for folium
+                            inner_display = [[c[1], c[0]] for c in inner_poly_latlon]
+                            folium.Polygon(
+                                locations=inner_display,
+                                color='#ff6600',
+                                weight=2,
+                                fill=True,
+                                fill_color='#ff6600',
+                                fill_opacity=0.25,
+                                tooltip='Basin Inner Polygon (Bottom)'
+                            ).add_to(m)
+                        except Exception:
+                            pass
                 
-                # Display channel line if defined
-                if st.session_state.basin_channel_coords is not None:
+                    # Display channel line if defined
+                    if st.session_state.basin_channel_coords is not None:
+                        channel_coords = st.session_state.basin_channel_coords
+                        if len(channel_coords) >= 2:
+                            channel_display_coords = [[c[1], c[0]] for c in channel_coords]
+                            folium.PolyLine(
+                                locations=channel_display_coords,
+                                color='#00ff00',
+                                weight=4,
+                                opacity=0.8,
+                                tooltip='Basin Channel Profile'
+                            ).add_to(m)
+                
+                    # Don't auto-zoom to basin in Input Data tab - keep DEM extent
+                    # Basin will be visible but map stays at DEM extent for drawing
+                except Exception as e:
+                    st.warning(f"Error displaying basin polygon: {e}")
+        
+            # Also display channel line independently (even if no basin polygon drawn yet)
+            # This ensures polyline persists after first draw
+            if (st.session_state.design_mode == "basin" and 
+                st.session_state.basin_channel_coords is not None):
+                try:
                     channel_coords = st.session_state.basin_channel_coords
                     if len(channel_coords) >= 2:
                         channel_display_coords = [[c[1], c[0]] for c in channel_coords]
@@ -4124,91 +6360,30 @@ with tab1:
                             opacity=0.8,
                             tooltip='Basin Channel Profile'
                         ).add_to(m)
-                
-                # Don't auto-zoom to basin in Input Data tab - keep DEM extent
-                # Basin will be visible but map stays at DEM extent for drawing
-            except Exception as e:
-                st.warning(f"Error displaying basin polygon: {e}")
-        
-        # Also display channel line independently (even if no basin polygon drawn yet)
-        # This ensures polyline persists after first draw
-        if (st.session_state.design_mode == "basin" and 
-            st.session_state.basin_channel_coords is not None):
-            try:
-                channel_coords = st.session_state.basin_channel_coords
-                if len(channel_coords) >= 2:
-                    channel_display_coords = [[c[1], c[0]] for c in channel_coords]
-                    folium.PolyLine(
-                        locations=channel_display_coords,
-                        color='#00ff00',
-                        weight=4,
-                        opacity=0.8,
-                        tooltip='Basin Channel Profile'
-                    ).add_to(m)
-            except Exception:
-                pass  # Silently fail if channel display has issues
-        
-        # Zoom priority: contours/vectors just uploaded > profile line > DEM bounds
-        # Check if contours or vector layers were just uploaded
-        zoom_applied = False
-
-        if st.session_state.get("contours_just_uploaded") and st.session_state.get("contours_bounds"):
-            m.fit_bounds(st.session_state.contours_bounds)
-            st.session_state.contours_just_uploaded = False
-            zoom_applied = True
-        elif st.session_state.get("vector_just_uploaded") and st.session_state.get("vector_layers_bounds"):
-            m.fit_bounds(st.session_state.vector_layers_bounds)
-            st.session_state.vector_just_uploaded = False
-            zoom_applied = True
-
-        # If no contours/vectors just uploaded, use normal zoom logic
-        if not zoom_applied:
-            if st.session_state.design_mode == "profile":
-                # If a user-drawn line exists, auto-zoom to its extent
-                profile_coords = st.session_state.get("profile_line_coords")
-                if profile_coords and len(profile_coords) >= 2:
-                    lons = [coord[0] for coord in profile_coords]
-                    lats = [coord[1] for coord in profile_coords]
-                    lat_range = max(lats) - min(lats)
-                    lon_range = max(lons) - min(lons)
-                    buffer = max(lat_range, lon_range) * 0.1 + 0.0005
-                    bounds = [
-                        [min(lats) - buffer, min(lons) - buffer],
-                        [max(lats) + buffer, max(lons) + buffer]
-                    ]
-                    m.fit_bounds(bounds)
-                elif "profile_bounds" in st.session_state and st.session_state.profile_bounds is not None:
-                    m.fit_bounds(st.session_state.profile_bounds)
-                else:
-                    m.fit_bounds(bounds_map)
-            else:
-                # Basin mode: auto-zoom to polygon if available, otherwise use DEM bounds
-                # If channel was just drawn, auto-zoom to channel extent
-                if st.session_state.get("channel_just_drawn") is True and st.session_state.basin_channel_coords is not None:
-                    # Auto-zoom to the channel polyline extent
-                    channel_coords = st.session_state.basin_channel_coords
-                    if len(channel_coords) >= 2:
-                        lons = [coord[0] for coord in channel_coords]
-                        lats = [coord[1] for coord in channel_coords]
-                        lat_range = max(lats) - min(lats)
-                        lon_range = max(lons) - min(lons)
-                        # Add buffer to ensure channel is fully visible
-                        buffer = max(lat_range, lon_range) * 0.15 + 0.0005
-                        bounds = [
-                            [min(lats) - buffer, min(lons) - buffer],
-                            [max(lats) + buffer, max(lons) + buffer]
-                        ]
-                        m.fit_bounds(bounds)
-                    # Clear the flag after using it
-                    st.session_state.channel_just_drawn = False
-                elif st.session_state.get("basin_polygon_bounds") is not None:
-                    m.fit_bounds(st.session_state.basin_polygon_bounds)
-                elif st.session_state.get("basin_polygon_coords") is not None and len(st.session_state.basin_polygon_coords) >= 3:
-                    # Calculate bounds on the fly if not stored
-                    polygon_coords = st.session_state.basin_polygon_coords
-                    lons = [coord[0] for coord in polygon_coords]
-                    lats = [coord[1] for coord in polygon_coords]
-                    if lons and lats:
+                except Exception:
+                    pass  # Silently fail if channel display has issues
+        
+            # Zoom priority: contours/vectors just uploaded > profile line > DEM bounds
+            # Check if contours or vector layers were just uploaded
+            zoom_applied = False
+
+            if st.session_state.get("contours_just_uploaded") and st.session_state.get("contours_bounds"):
+                m.fit_bounds(st.session_state.contours_bounds)
+                st.session_state.contours_just_uploaded = False
+                zoom_applied = True
+            elif st.session_state.get("vector_just_uploaded") and st.session_state.get("vector_layers_bounds"):
+                m.fit_bounds(st.session_state.vector_layers_bounds)
+                st.session_state.vector_just_uploaded = False
+                zoom_applied = True
+
+            # If no contours/vectors just uploaded, use normal zoom logic
+            if not zoom_applied:
+                if st.session_state.design_mode == "profile":
+                    # If a user-drawn line exists, auto-zoom to its extent
+                    profile_coords = st.session_state.get("profile_line_coords")
+                    if profile_coords and len(profile_coords) >= 2:
+                        lons = [coord[0] for coord in profile_coords]
+                        lats = [coord[1] for coord in profile_coords]
                         lat_range = max(lats) - min(lats)
                         lon_range = max(lons) - min(lons)
                         buffer = max(lat_range, lon_range) * 0.1 + 0.0005
@@ -4217,118 +6392,160 @@ with tab1:
                             [max(lats) + buffer, max(lons) + buffer]
                         ]
                         m.fit_bounds(bounds)
+                    elif "profile_bounds" in st.session_state and st.session_state.profile_bounds is not None:
+                        m.fit_bounds(st.session_state.profile_bounds)
+                    else:
+                        m.fit_bounds(bounds_map)
                 else:
-                    m.fit_bounds(bounds_map)
-        
-
-        # Use a stable map key to prevent map reset when channel is drawn
-        map_key = "basin_input_map"
-        
-        map_data = st_folium(m, height=650, width=None, returned_objects=["all_drawings"], key=map_key)
-
-        # --- Directly below map panel: Download buttons for user-drawn vectors ---
-        st.markdown("<div style='margin-top:0.5rem'></div>", unsafe_allow_html=True)
-        if st.session_state.profile_line_coords is not None and len(st.session_state.profile_line_coords) >= 2:
-            st.markdown("**Download Profile Line (Map Drawing)**")
-            col_map_dl1, col_map_dl2, col_map_dl3 = st.columns(3)
-            with col_map_dl1:
-                shp_data = export_line_to_shapefile(st.session_state.profile_line_coords)
-                if shp_data:
-                    st.download_button(
-                        "Shapefile (ZIP)",
-                        data=shp_data,
-                        file_name="profile_line.zip",
-                        mime="application/zip",
-                        use_container_width=True
-                    )
-            with col_map_dl2:
-                kml_data = export_line_to_kml(st.session_state.profile_line_coords)
-                if kml_data:
-                    st.download_button(
-                        "KML",
-                        data=kml_data,
-                        file_name="profile_line.kml",
-                        mime="application/vnd.google-earth.kml+xml",
-                        use_container_width=True
-                    )
-            with col_map_dl3:
-                geojson_data = export_line_to_geojson(st.session_state.profile_line_coords)
-                if geojson_data:
-                    st.download_button(
-                        "GeoJSON",
-                        data=geojson_data,
-                        file_name="profile_line.geojson",
-                        mime="application/json",
-                        use_container_width=True
-                    )
+                    # Basin mode: auto-zoom to polygon if available, otherwise use DEM bounds
+                    # If channel was just drawn, auto-zoom to channel extent
+                    if st.session_state.get("channel_just_drawn") is True and st.session_state.basin_channel_coords is not None:
+                        # Auto-zoom to the channel polyline extent
+                        channel_coords = st.session_state.basin_channel_coords
+                        if len(channel_coords) >= 2:
+                            lons = [coord[0] for coord in channel_coords]
+                            lats = [coord[1] for coord in channel_coords]
+                            lat_range = max(lats) - min(lats)
+                            lon_range = max(lons) - min(lons)
+                            # Add buffer to ensure channel is fully visible
+                            buffer = max(lat_range, lon_range) * 0.15 + 0.0005
+                            bounds = [
+                                [min(lats) - buffer, min(lons) - buffer],
+                                [max(lats) + buffer, max(lons) + buffer]
+                            ]
+                            m.fit_bounds(bounds)
+                        # Clear the flag after using it
+                        st.session_state.channel_just_drawn = False
+                    elif st.session_state.get("basin_polygon_bounds") is not None:
+                        m.fit_bounds(st.session_state.basin_polygon_bounds)
+                    elif st.session_state.get("basin_polygon_coords") is not None and len(st.session_state.basin_polygon_coords) >= 3:
+                        # Calculate bounds on the fly if not stored
+                        polygon_coords = st.session_state.basin_polygon_coords
+                        lons = [coord[0] for coord in polygon_coords]
+                        lats = [coord[1] for coord in polygon_coords]
+                        if lons and lats:
+                            lat_range = max(lats) - min(lats)
+                            lon_range = max(lons) - min(lons)
+                            buffer = max(lat_range, lon_range) * 0.1 + 0.0005
+                            bounds = [
+                                [min(lats) - buffer, min(lons) - buffer],
+                                [max(lats) + buffer, max(lons) + buffer]
+                            ]
+                            m.fit_bounds(bounds)
+                    else:
+                        m.fit_bounds(bounds_map)
+        
+
+            # Use a stable map key to prevent map reset when channel is drawn
+            map_key = "basin_input_map"
+        
+            map_build_timer.stop()
+            with StageTimer("st_folium_input"):
+                map_data = st_folium(m, height=650, width=None, returned_objects=["all_drawings"], key=map_key)
+
+            # --- Directly below map panel: Download buttons for user-drawn vectors ---
+            st.markdown("<div style='margin-top:0.5rem'></div>", unsafe_allow_html=True)
+            if st.session_state.profile_line_coords is not None and len(st.session_state.profile_line_coords) >= 2:
+                st.markdown("**Download Profile Line (Map Drawing)**")
+                col_map_dl1, col_map_dl2, col_map_dl3 = st.columns(3)
+                with col_map_dl1:
+                    shp_data = export_line_to_shapefile(st.session_state.profile_line_coords)
+                    if shp_data:
+                        st.download_button(
+                            "Shapefile (ZIP)",
+                            data=shp_data,
+                            file_name="profile_line.zip",
+                            mime="application/zip",
+                            use_container_width=True
+                        )
+                with col_map_dl2:
+                    kml_data = export_line_to_kml(st.session_state.profile_line_coords)
+                    if kml_data:
+                        st.download_button(
+                            "KML",
+                            data=kml_data,
+                            file_name="profile_line.kml",
+                            mime="application/vnd.google-earth.kml+xml",
+                            use_container_width=True
+                        )
+                with col_map_dl3:
+                    geojson_data = export_line_to_geojson(st.session_state.profile_line_coords)
+                    if geojson_data:
+                        st.download_button(
+                            "GeoJSON",
+                            data=geojson_data,
+                            file_name="profile_line.geojson",
+                            mime="application/json",
+                            use_container_width=True
+                        )
 
-        if st.session_state.basin_polygon_coords is not None and len(st.session_state.basin_polygon_coords) >= 3:
-            st.markdown("**Download Basin Polygon (Map Drawing)**")
-            col_map_poly1, col_map_poly2, col_map_poly3 = st.columns(3)
-            with col_map_poly1:
-                shp_data = export_polygon_to_shapefile(st.session_state.basin_polygon_coords, st.session_state.basin_polygon_crs)
-                if shp_data:
-                    st.download_button(
-                        "Shapefile (ZIP)",
-                        data=shp_data,
-                        file_name="basin_polygon.zip",
-                        mime="application/zip",
-                        use_container_width=True
-                    )
-            with col_map_poly2:
-                kml_data = export_polygon_to_kml(st.session_state.basin_polygon_coords)
-                if kml_data:
-                    st.download_button(
-                        "KML",
-                        data=kml_data,
-                        file_name="basin_polygon.kml",
-                        mime="application/vnd.google-earth.kml+xml",
-                        use_container_width=True
-                    )
-            with col_map_poly3:
-                geojson_data = export_polygon_to_geojson(st.session_state.basin_polygon_coords)
-                if geojson_data:
-                    st.download_button(
-                        "GeoJSON",
-                        data=geojson_data,
-                        file_name="basin_polygon.geojson",
-                        mime="application/json",
-                        use_container_width=True
-                    )
+            if st.session_state.basin_polygon_coords is not None and len(st.session_state.basin_polygon_coords) >= 3:
+                st.markdown("**Download Basin Polygon (Map Drawing)**")
+                col_map_poly1, col_map_poly2, col_map_poly3 = st.columns(3)
+                with col_map_poly1:
+                    shp_data = export_polygon_to_shapefile(st.session_state.basin_polygon_coords, st.session_state.basin_polygon_crs)
+                    if shp_data:
+                        st.download_button(
+                            "Shapefile (ZIP)",
+                            data=shp_data,
+                            file_name="basin_polygon.zip",
+                            mime="application/zip",
+                            use_container_width=True
+                        )
+                with col_map_poly2:
+                    kml_data = export_polygon_to_kml(st.session_state.basin_polygon_coords)
+                    if kml_data:
+                        st.download_button(
+                            "KML",
+                            data=kml_data,
+                            file_name="basin_polygon.kml",
+                            mime="application/vnd.google-earth.kml+xml",
+                            use_container_width=True
+                        )
+                with col_map_poly3:
+                    geojson_data = export_polygon_to_geojson(st.session_state.basin_polygon_coords)
+                    if geojson_data:
+                        st.download_button(
+                            "GeoJSON",
+                            data=geojson_data,
+                            file_name="basin_polygon.geojson",
+                            mime="application/json",
+                            use_container_width=True
+                        )
 
-        if st.session_state.basin_channel_coords is not None and len(st.session_state.basin_channel_coords) >= 2:
-            st.markdown("**Download Channel Line (Map Drawing)**")
-            col_map_ch1, col_map_ch2, col_map_ch3 = st.columns(3)
-            with col_map_ch1:
-                shp_data = export_line_to_shapefile(st.session_state.basin_channel_coords)
-                if shp_data:
-                    st.download_button(
-                        "Shapefile (ZIP)",
-                        data=shp_data,
-                        file_name="channel_line.zip",
-                        mime="application/zip",
-                        use_container_width=True
-                    )
-            with col_map_ch2:
-                kml_data = export_line_to_kml(st.session_state.basin_channel_coords)
-                if kml_data:
-                    st.download_button(
-                        "KML",
-                        data=kml_data,
-                        file_name="channel_line.kml",
-                        mime="application/vnd.google-earth.kml+xml",
-                        use_container_width=True
-                    )
-            with col_map_ch3:
-                geojson_data = export_line_to_geojson(st.session_state.basin_channel_coords)
-                if geojson_data:
-                    st.download_button(
-                        "GeoJSON",
-                        data=geojson_data,
-                        file_name="channel_line.geojson",
-                        mime="application/json",
-                        use_container_width=True
-                    )
+            if st.session_state.basin_channel_coords is not None and len(st.session_state.basin_channel_coords) >= 2:
+                st.markdown("**Download Channel Line (Map Drawing)**")
+                col_map_ch1, col_map_ch2, col_map_ch3 = st.columns(3)
+                with col_map_ch1:
+                    shp_data = export_line_to_shapefile(st.session_state.basin_channel_coords)
+                    if shp_data:
+                        st.download_button(
+                            "Shapefile (ZIP)",
+                            data=shp_data,
+                            file_name="channel_line.zip",
+                            mime="application/zip",
+                            use_container_width=True
+                        )
+                with col_map_ch2:
+                    kml_data = export_line_to_kml(st.session_state.basin_channel_coords)
+                    if kml_data:
+                        st.download_button(
+                            "KML",
+                            data=kml_data,
+                            file_name="channel_line.kml",
+                            mime="application/vnd.google-earth.kml+xml",
+                            use_container_width=True
+                        )
+                with col_map_ch3:
+                    geojson_data = export_line_to_geojson(st.session_state.basin_channel_coords)
+                    if geojson_data:
+                        st.download_button(
+                            "GeoJSON",
+                            data=geojson_data,
+                            file_name="channel_line.geojson",
+                            mime="application/json",
+                            use_container_width=True
+                        )
 
 # Extract centreline - check uploaded profile first, then map drawings, then session state
 line_coords_latlon = None
@@ -4420,21 +6637,12 @@ if st.session_state.uploaded_profile_coords is not None:
                     source_crs_for_transform = uploaded_crs if uploaded_crs is not None else src_crs
                     
                     if source_crs_for_transform is not None and not source_crs_for_transform.is_geographic:
-                        transformer_upload_to_latlon = Transformer.from_crs(
-                            source_crs_for_transform, map_crs, always_xy=True
-                        )
-                        line_coords_latlon = []
-                        for coord in valid_coords:
-                            x, y = coord[0], coord[1]
-                            try:
-                                lon, lat = transformer_upload_to_latlon.transform(x, y)
-                                # Validate transformed coordinates
-                                if not (np.isnan(lon) or np.isnan(lat) or 
-                                       not np.isfinite(lon) or not np.isfinite(lat)):
-                                    line_coords_latlon.append([lon, lat])  # Store as [lon, lat]
-                            except Exception as e:
-                                st.warning(f"Skipping invalid coordinate ({x}, {y}): {e}")
-                                continue
+                        # All coordinates in one batched transform; invalid results are skipped
+                        upload_lonlat = transform_coords(valid_coords, source_crs_for_transform, map_crs)
+                        finite_lonlat = np.isfinite(upload_lonlat).all(axis=1)
+                        if not finite_lonlat.all():
+                            st.warning(f"Skipping {int((~finite_lonlat).sum())} coordinates that could not be transformed")
+                        line_coords_latlon = upload_lonlat[finite_lonlat].tolist()  # Store as [lon, lat]
                         
                         if len(line_coords_latlon) < 2:
                             st.error("❌ Could not transform enough coordinates. Please check CRS of your shapefile.")
@@ -4624,20 +6832,16 @@ if "profile_bounds" not in st.session_state or st.session_state.profile_bounds i
 # Transform to analysis CRS
 # line_coords_latlon is now normalized to [lon, lat] format
 xs_a, ys_a = [], []
-for coord in line_coords_latlon:
-    try:
-        if len(coord) >= 2:
-            lon, lat = coord[0], coord[1]  # Now guaranteed to be [lon, lat]
-            x_a, y_a = transformer_to_analysis.transform(lon, lat)
-            # Check for NaN or invalid values
-            if np.isnan(x_a) or np.isnan(y_a) or not np.isfinite(x_a) or not np.isfinite(y_a):
-                st.error(f"Invalid coordinate transformation result: ({x_a}, {y_a}) for input ({lon}, {lat})")
-                continue
-            xs_a.append(x_a)
-            ys_a.append(y_a)
-    except Exception as e:
-        st.error(f"Error transforming coordinate {coord}: {e}")
-        continue
+try:
+    line_lonlat = [coord[:2] for coord in line_coords_latlon if len(coord) >= 2]
+    line_xy_a = transform_coords(line_lonlat, map_crs, analysis_crs)
+    # Check for NaN or invalid values
+    finite_xy = np.isfinite(line_xy_a).all(axis=1)
+    for lon_lat, (x_a, y_a) in zip(np.asarray(line_lonlat)[~finite_xy], line_xy_a[~finite_xy]):
+        st.error(f"Invalid coordinate transformation result: ({x_a}, {y_a}) for input ({lon_lat[0]}, {lon_lat[1]})")
+    xs_a, ys_a = line_xy_a[finite_xy, 0].tolist(), line_xy_a[finite_xy, 1].tolist()
+except Exception as e:
+    st.error(f"Error transforming profile coordinates: {e}")
 
 if len(xs_a) < 2:
     st.error("❌ Profile line has insufficient valid coordinates after transformation. Please check your uploaded file or redraw the profile.")
@@ -4682,12 +6886,12 @@ else:
     # Sample existing terrain at design station locations (corner vertices) for accurate comparison
     # Only if we have stations (not in basin mode with dummy line)
     if center_xy is not None:
-        z_existing_at_stations = sample_dem_at_points(analysis_dem, analysis_transform, analysis_nodata, center_xy)
-
         # Also sample existing terrain at equal spacing for smooth visualization line
-        existing_samples = sample_line_at_spacing(line_a, existing_spacing)
-        existing_stations, existing_xy = existing_samples[:, 0], existing_samples[:, 1:3]
-        z_existing = sample_dem_at_points(analysis_dem, analysis_transform, analysis_nodata, existing_xy)
+        # (bilinear long-section, cached until the line, spacing or DEM changes)
+        long_sec = cached_long_section(line_a, existing_spacing, analysis_dem_key, analysis_dem,
+                                       analysis_transform, analysis_valid)
+        z_existing_at_stations = long_sec["z_existing_at_stations"]
+        existing_stations, existing_xy, z_existing = long_sec["chainage"], long_sec["xy"], long_sec["z_existing"]
     else:
         # Basin mode without explicit channel - no stations or samples
         z_existing_at_stations = None
@@ -4748,39 +6952,8 @@ with _tab3:
     # Get existing terrain spacing from session state (set in Input Data tab)
     existing_spacing = st.session_state.get("existing_spacing", 1.0)
     
-    # Extract design profile points from user line at corner vertices
-    # Design stations are created at each corner vertex of the user-drawn polyline
-    samples = extract_profile_from_line(line_a)
-    stations, center_xy = samples[:, 0], samples[:, 1:3]
-    
-    # Sample existing terrain at design station locations (corner vertices) for accurate comparison
-    z_existing_at_stations = sample_dem_at_points(analysis_dem, analysis_transform, analysis_nodata, center_xy)
-    
-    # Also sample existing terrain at equal spacing for smooth visualization line
-    existing_samples = sample_line_at_spacing(line_a, existing_spacing)
-    existing_stations, existing_xy = existing_samples[:, 0], existing_samples[:, 1:3]
-    z_existing = sample_dem_at_points(analysis_dem, analysis_transform, analysis_nodata, existing_xy)
-    
-    # Keep stations in user input order (first vertex to last vertex)
-    # No auto-reversal - stations follow the order user drew the line
-    
-    tangents, normals = compute_tangents_normals(samples)
-    
-    # Initialize z_design - use existing terrain elevation at first design station
-    default_z0 = float(z_existing_at_stations[0]) if not np.isnan(z_existing_at_stations[0]) else 0.0
-    # Use design gradient from station 0 if available, otherwise use 0.0
-    init_gradient = st.session_state.get("station_gradients", {}).get(0, 0.0)
-    grade = init_gradient / 100.0
-    
-    if "z_design" not in st.session_state or len(st.session_state.z_design) != len(stations):
-        st.session_state.z_design = (default_z0 + grade * stations).tolist()
-        st.session_state.z_design_original = z_existing_at_stations.tolist()  # Store original terrain elevations
-        st.session_state.selected_station_idx = 0
-    
-    # Store original z_design if not already stored (for gradient calculations)
-    if "z_design_original" not in st.session_state or len(st.session_state.z_design_original) != len(stations):
-        st.session_state.z_design_original = z_existing_at_stations.tolist()
-    
+    # Stations, tangents/normals and the existing-ground long-section were set up above
+    # (cached_long_section); the design profile is initialized there as well
     z_design = np.array(st.session_state.z_design)
     
     # Map bounds for profile
@@ -4944,516 +7117,478 @@ Perpendicular distance from profile centreline where terrain modification applie
     
     st.markdown("---")
     
-    # COMPACT LAYOUT: Controls | Plot | Map
-    col_controls, col_plot_xs, col_map_xs = st.columns([1, 3, 2])
+    # Station browser, cross-section plot and map rerun on their own on station navigation
+    @st.fragment
+    def cross_section_browser():
+        global z_design
+
+        # COMPACT LAYOUT: Controls | Plot | Map
+        col_controls, col_plot_xs, col_map_xs = st.columns([1, 3, 2])
     
-    with col_controls:
-        st.markdown("#### Controls")
+        with col_controls:
+            st.markdown("#### Controls")
         
-        # Station navigator with +/- buttons
-        st.markdown("**Select Station**")
+            # Station navigator with +/- buttons
+            st.markdown("**Select Station**")
         
-        # Get current station index from session state
-        current_station_idx = st.session_state.selected_station_idx
-        stations_for_input = st.session_state.get("stations", stations) if "stations" in st.session_state else stations
-        max_station = len(stations_for_input) - 1 if len(stations_for_input) > 0 else 0
+            stations_for_input = st.session_state.get("stations", stations) if "stations" in st.session_state else stations
+            max_station = len(stations_for_input) - 1 if len(stations_for_input) > 0 else 0
         
-        # Create columns for Previous/Next buttons and station display
-        col_prev, col_station, col_next = st.columns([1, 2, 1])
+            # Create columns for Previous/Next buttons and station display
+            col_prev, col_station, col_next = st.columns([1, 2, 1])
 
-        # Callbacks to keep dropdown and buttons in sync
-        def _xs_prev():
-            if st.session_state.selected_station_idx > 0:
-                st.session_state.selected_station_idx -= 1
-                # sync selector widget value
-                st.session_state.station_selector_xs = f"S{st.session_state.selected_station_idx}"
-                st.session_state.force_plot_update += 1
+            # Callbacks to keep dropdown and buttons in sync
+            def _xs_prev():
+                if st.session_state.selected_station_idx > 0:
+                    st.session_state.selected_station_idx -= 1
+                    # sync selector widget value
+                    st.session_state.station_selector_xs = f"S{st.session_state.selected_station_idx}"
+                    st.session_state.force_plot_update += 1
 
-        def _xs_next():
-            if st.session_state.selected_station_idx < max_station:
-                st.session_state.selected_station_idx += 1
-                st.session_state.station_selector_xs = f"S{st.session_state.selected_station_idx}"
-                st.session_state.force_plot_update += 1
+            def _xs_next():
+                if st.session_state.selected_station_idx < max_station:
+                    st.session_state.selected_station_idx += 1
+                    st.session_state.station_selector_xs = f"S{st.session_state.selected_station_idx}"
+                    st.session_state.force_plot_update += 1
 
-        def _xs_on_select():
-            sel = st.session_state.get("station_selector_xs", "S0")
-            try:
-                idx = int(sel[1:])
-            except Exception:
-                idx = 0
-            if idx != st.session_state.selected_station_idx:
-                st.session_state.selected_station_idx = idx
-                st.session_state.force_plot_update += 1
-
-        with col_prev:
-            st.button("◀ Prev", key="btn_prev_xs", on_click=_xs_prev, use_container_width=True)
-
-        with col_station:
-            # Station dropdown selector
-            station_options = [f"S{i}" for i in range(len(stations_for_input))]
-            # Ensure a default session value exists for the selector
-            if "station_selector_xs" not in st.session_state:
-                st.session_state.station_selector_xs = f"S{st.session_state.selected_station_idx}"
-
-            st.selectbox(
-                "Station",
-                options=station_options,
-                index=st.session_state.selected_station_idx,
-                key="station_selector_xs",
-                label_visibility="collapsed",
-                on_change=_xs_on_select
-            )
+            def _xs_on_select():
+                sel = st.session_state.get("station_selector_xs", "S0")
+                try:
+                    idx = int(sel[1:])
+                except Exception:
+                    idx = 0
+                if idx != st.session_state.selected_station_idx:
+                    st.session_state.selected_station_idx = idx
+                    st.session_state.force_plot_update += 1
+
+            with col_prev:
+                st.button("◀ Prev", key="btn_prev_xs", on_click=_xs_prev, use_container_width=True)
+
+            with col_station:
+                # Station dropdown selector
+                station_options = [f"S{i}" for i in range(len(stations_for_input))]
+                # Ensure a default session value exists for the selector
+                if "station_selector_xs" not in st.session_state:
+                    st.session_state.station_selector_xs = f"S{st.session_state.selected_station_idx}"
+
+                st.selectbox(
+                    "Station",
+                    options=station_options,
+                    index=st.session_state.selected_station_idx,
+                    key="station_selector_xs",
+                    label_visibility="collapsed",
+                    on_change=_xs_on_select
+                )
 
-        with col_next:
-            st.button("Next ▶", key="btn_next_xs", on_click=_xs_next, use_container_width=True)
+            with col_next:
+                st.button("Next ▶", key="btn_next_xs", on_click=_xs_next, use_container_width=True)
         
-        # Display current station info
-        preview_idx_xs = st.session_state.selected_station_idx
-        current_station_idx_xs = st.session_state.selected_station_idx
+            # Display current station info
+            preview_idx_xs = st.session_state.selected_station_idx
+            current_station_idx_xs = st.session_state.selected_station_idx
         
-        stations_for_display = st.session_state.get("stations", stations) if "stations" in st.session_state else stations
-        if len(stations_for_display) > preview_idx_xs:
-            st.caption(f"📍 Distance: {stations_for_display[preview_idx_xs]:.1f} m")
-        else:
-            st.caption(f"Station {preview_idx_xs}")
+            stations_for_display = st.session_state.get("stations", stations) if "stations" in st.session_state else stations
+            if len(stations_for_display) > preview_idx_xs:
+                st.caption(f"📍 Distance: {stations_for_display[preview_idx_xs]:.1f} m")
+            else:
+                st.caption(f"Station {preview_idx_xs}")
         
-        st.markdown("---")
+            st.markdown("---")
         
-        # Design gradient is controlled in Profile tab only
-        # Elevations are updated automatically when gradients are changed in Profile tab
+            # Design gradient is controlled in Profile tab only
+            # Elevations are updated automatically when gradients are changed in Profile tab
         
-        st.markdown("---")
+            st.markdown("---")
         
-        # Cross-section area calculations
-        st.markdown("**Cross-Section Areas**")
-        
-        # Calculate areas for current station (use session state directly)
-        preview_idx_xs = st.session_state.selected_station_idx
-        # Always read latest z_design from session state to ensure updates from profile tab are reflected
-        z_design = np.array(st.session_state.z_design)
-        offsets_cs, z_exist_cs, z_design_cs, z_final_cs = cross_section_preview(
-            analysis_dem, analysis_transform, analysis_nodata,
-            preview_idx_xs, samples, normals, z_design,
-            template_type, template_params, influence_width, operation_mode
-        )
+            # Cross-section area calculations
+            st.markdown("**Cross-Section Areas**")
         
-        cut_area, fill_area, berm_area, ditch_area = calculate_cross_section_areas(
-            offsets_cs, z_exist_cs, z_final_cs, template_type, template_params, 
-            float(z_design[preview_idx_xs])
-        )
+            # Calculate areas for current station (use session state directly)
+            preview_idx_xs = st.session_state.selected_station_idx
+            # Always read latest z_design from session state to ensure updates from profile tab are reflected
+            z_design = np.array(st.session_state.z_design)
+            with StageTimer("cross_section_preview"):
+                offsets_cs, z_exist_cs, z_design_cs, z_final_cs = cross_section_preview(
+                    analysis_dem, analysis_transform, analysis_nodata,
+                    preview_idx_xs, samples, normals, z_design,
+                    template_type, template_params, influence_width, operation_mode,
+                    valid=analysis_valid
+                )
+        
+            cut_area, fill_area, berm_area, ditch_area = calculate_cross_section_areas(
+                offsets_cs, z_exist_cs, z_final_cs, template_type, template_params, 
+                float(z_design[preview_idx_xs])
+            )
         
-        col_area1, col_area2 = st.columns(2)
-        with col_area1:
-            st.metric("Cut Area", f"{cut_area:.2f} m²")
-            st.metric("Fill Area", f"{fill_area:.2f} m²")
-        with col_area2:
-            st.metric("Berm Area", f"{berm_area:.2f} m²")
-            st.metric("Ditch Area", f"{ditch_area:.2f} m²")
+            col_area1, col_area2 = st.columns(2)
+            with col_area1:
+                st.metric("Cut Area", f"{cut_area:.2f} m²")
+                st.metric("Fill Area", f"{fill_area:.2f} m²")
+            with col_area2:
+                st.metric("Berm Area", f"{berm_area:.2f} m²")
+                st.metric("Ditch Area", f"{ditch_area:.2f} m²")
         
-        st.markdown("---")
+            st.markdown("---")
         
-        # Elevation (read-only in Cross-Section tab)
-        st.markdown("**Elevation (read-only)**")
-        current_elev = float(z_design[preview_idx_xs])
-        st.info(f"Station S{preview_idx_xs} elevation: {current_elev:.2f} m — Edit elevations in the Profile tab only.")
+            # Elevation (read-only in Cross-Section tab)
+            st.markdown("**Elevation (read-only)**")
+            current_elev = float(z_design[preview_idx_xs])
+            st.info(f"Station S{preview_idx_xs} elevation: {current_elev:.2f} m — Edit elevations in the Profile tab only.")
 
-        st.markdown("---")
+            st.markdown("---")
         
-        # Vertical exaggeration removed - always use 1.0 (no exaggeration)
-        vert_exag_xs = 1.0
-    
-    with col_plot_xs:
-        # Always read latest z_design from session state to ensure updates from profile tab are reflected
-        z_design = np.array(st.session_state.z_design)
+            # Batch export of every station's cross-section
+            st.markdown("**Export All Sections**")
+            if not HAS_MATPLOTLIB:
+                st.caption("Install matplotlib to export section sheets.")
+            else:
+                sheet_format = st.radio("Sheet format", ["PDF", "PNG"], horizontal=True, key="section_sheet_format")
+                sections_per_sheet = st.selectbox("Sections per sheet", [2, 4, 6, 8], index=2, key="section_sheet_per_page")
+                sheet_key = hashlib.blake2b(pickle.dumps((
+                    analysis_dem_key, np.asarray(samples).tobytes(), np.asarray(st.session_state.z_design, dtype=np.float64).tobytes(),
+                    template_type, json.dumps(template_params, sort_keys=True, default=str), float(influence_width),
+                    operation_mode, sheet_format, int(sections_per_sheet),
+                )), digest_size=16).hexdigest()
+                if st.button("📑 Build Section Sheets", key="build_section_sheets", use_container_width=True):
+                    try:
+                        with st.spinner(f"Rendering {len(samples)} cross-sections..."), StageTimer("section_sheets"):
+                            sheets_path, n_sheets = export_section_sheets(
+                                analysis_dem, analysis_transform, analysis_nodata, samples, normals,
+                                np.array(st.session_state.z_design), template_type, template_params,
+                                influence_width, operation_mode, valid=analysis_valid,
+                                fmt=sheet_format.lower(), per_sheet=int(sections_per_sheet)
+                            )
+                        previous = st.session_state.get("section_sheets")
+                        if previous is not None and os.path.exists(previous["path"]):
+                            os.remove(previous["path"])
+                        st.session_state.section_sheets = {"key": sheet_key, "path": sheets_path, "n_sheets": n_sheets}
+                    except Exception as e:
+                        st.error(f"Error exporting cross-section sheets: {e}")
+                section_sheets = st.session_state.get("section_sheets")
+                if section_sheets is not None and section_sheets["key"] == sheet_key and os.path.exists(section_sheets["path"]):
+                    with open(section_sheets["path"], "rb") as sheets_file:
+                        st.download_button(f"⬇️ Download {section_sheets['n_sheets']} Sheets", data=sheets_file,
+                                           file_name="cross_sections.zip", mime="application/zip",
+                                           use_container_width=True, key="download_section_sheets")
+                elif section_sheets is not None:
+                    st.caption("Design changed since the last export — rebuild the sheets.")
+    
+        with col_plot_xs:
+            # Always read latest z_design from session state to ensure updates from profile tab are reflected
+            z_design = np.array(st.session_state.z_design)
+        
+            # Generate cross-section
+            with StageTimer("cross_section_preview"):
+                offsets, z_exist_cs, z_design_cs, z_final_cs = cross_section_preview(
+                    analysis_dem, analysis_transform, analysis_nodata,
+                    preview_idx_xs, samples, normals, z_design,
+                    template_type, template_params, influence_width, operation_mode,
+                    valid=analysis_valid
+                )
         
-        # Generate cross-section
-        offsets, z_exist_cs, z_design_cs, z_final_cs = cross_section_preview(
-            analysis_dem, analysis_transform, analysis_nodata,
-            preview_idx_xs, samples, normals, z_design,
-            template_type, template_params, influence_width, operation_mode
-        )
+            # No vertical exaggeration (VE removed)
+            z_exist_cs_plot = z_exist_cs
+            z_design_cs_plot = z_design_cs
+            z_final_cs_plot = z_final_cs
+        
+            # Calculate Y-axis range based on all elevations (existing, template, and final)
+            # Combine all three data series to find overall min/max
+            # Handle negative elevations correctly
+            all_elevations = np.concatenate([
+                z_exist_cs_plot[~np.isnan(z_exist_cs_plot)],
+                z_design_cs_plot[~np.isnan(z_design_cs_plot)],
+                z_final_cs_plot[~np.isnan(z_final_cs_plot)]
+            ])
         
-        # No vertical exaggeration (VE removed)
-        z_exist_cs_plot = z_exist_cs
-        z_design_cs_plot = z_design_cs
-        z_final_cs_plot = z_final_cs
-        
-        # Calculate Y-axis range based on all elevations (existing, template, and final)
-        # Combine all three data series to find overall min/max
-        # Handle negative elevations correctly
-        all_elevations = np.concatenate([
-            z_exist_cs_plot[~np.isnan(z_exist_cs_plot)],
-            z_design_cs_plot[~np.isnan(z_design_cs_plot)],
-            z_final_cs_plot[~np.isnan(z_final_cs_plot)]
-        ])
-        
-        if len(all_elevations) > 0:
-            y_min = np.nanmin(all_elevations)
-            y_max = np.nanmax(all_elevations)
-            y_range = y_max - y_min
-            # Add 10% padding (handle negative values correctly)
-            y_padding = max(abs(y_range) * 0.1, 2.0)  # At least 2m padding, use abs() for negative ranges
-            y_min_plot = y_min - y_padding
-            y_max_plot = y_max + y_padding
-        else:
-            # Fallback if no valid data
-            y_min_plot = None
-            y_max_plot = None
-        
-        fig_xs = go.Figure()
-        
-        # Existing terrain line
-        fig_xs.add_trace(go.Scatter(
-            x=offsets, y=z_exist_cs_plot,
-            mode='lines', name='Existing',
-            line=dict(color='#888', width=2),
-        ))
-        
-        # Template line
-        fig_xs.add_trace(go.Scatter(
-            x=offsets, y=z_design_cs_plot,
-            mode='lines', name='Template',
-            line=dict(color='#2ca02c', width=2, dash='dot'),
-        ))
-        
-        # Create cut and fill polygons
-        # Find where final is above/below existing
-        cut_segments = []
-        fill_segments = []
-        current_cut = []
-        current_fill = []
-        
-        for i in range(len(offsets)):
-            if not (np.isnan(z_final_cs_plot[i]) or np.isnan(z_exist_cs_plot[i])):
-                if z_final_cs_plot[i] < z_exist_cs_plot[i]:
-                    # Cut area
-                    if current_fill:
-                        fill_segments.append(current_fill)
-                        current_fill = []
-                    current_cut.append((offsets[i], z_final_cs_plot[i], z_exist_cs_plot[i]))
-                elif z_final_cs_plot[i] > z_exist_cs_plot[i]:
-                    # Fill area
-                    if current_cut:
-                        cut_segments.append(current_cut)
-                        current_cut = []
-                    current_fill.append((offsets[i], z_final_cs_plot[i], z_exist_cs_plot[i]))
-                else:
-                    # Equal - close current segments
-                    if current_cut:
+            if len(all_elevations) > 0:
+                y_min = np.nanmin(all_elevations)
+                y_max = np.nanmax(all_elevations)
+                y_range = y_max - y_min
+                # Add 10% padding (handle negative values correctly)
+                y_padding = max(abs(y_range) * 0.1, 2.0)  # At least 2m padding, use abs() for negative ranges
+                y_min_plot = y_min - y_padding
+                y_max_plot = y_max + y_padding
+            else:
+                # Fallback if no valid data
+                y_min_plot = None
+                y_max_plot = None
+        
+            fig_xs = go.Figure()
+        
+            # Existing terrain line
+            fig_xs.add_trace(go.Scatter(
+                x=offsets, y=z_exist_cs_plot,
+                mode='lines', name='Existing',
+                line=dict(color='#888', width=2),
+            ))
+        
+            # Template line
+            fig_xs.add_trace(go.Scatter(
+                x=offsets, y=z_design_cs_plot,
+                mode='lines', name='Template',
+                line=dict(color='#2ca02c', width=2, dash='dot'),
+            ))
+        
+            # Create cut and fill polygons
+            # Find where final is above/below existing
+            cut_segments = []
+            fill_segments = []
+            current_cut = []
+            current_fill = []
+        
+            for i in range(len(offsets)):
+                if not (np.isnan(z_final_cs_plot[i]) or np.isnan(z_exist_cs_plot[i])):
+                    if z_final_cs_plot[i] < z_exist_cs_plot[i]:
+                        # Cut area
+                        if current_fill:
+                            fill_segments.append(current_fill)
+                            current_fill = []
                         current_cut.append((offsets[i], z_final_cs_plot[i], z_exist_cs_plot[i]))
-                        cut_segments.append(current_cut)
-                        current_cut = []
-                    if current_fill:
+                    elif z_final_cs_plot[i] > z_exist_cs_plot[i]:
+                        # Fill area
+                        if current_cut:
+                            cut_segments.append(current_cut)
+                            current_cut = []
                         current_fill.append((offsets[i], z_final_cs_plot[i], z_exist_cs_plot[i]))
-                        fill_segments.append(current_fill)
-                        current_fill = []
-        
-        # Close any remaining segments
-        if current_cut:
-            cut_segments.append(current_cut)
-        if current_fill:
-            fill_segments.append(current_fill)
-        
-        # Add fill areas (light green, semi-transparent)
-        for seg in fill_segments:
-            if len(seg) > 1:
-                fill_x = [p[0] for p in seg]
-                fill_y_final = [p[1] for p in seg]
-                fill_y_exist = [p[2] for p in seg]
-                # Create closed polygon
-                fill_x_poly = fill_x + fill_x[::-1]
-                fill_y_poly = fill_y_final + fill_y_exist[::-1]
+                    else:
+                        # Equal - close current segments
+                        if current_cut:
+                            current_cut.append((offsets[i], z_final_cs_plot[i], z_exist_cs_plot[i]))
+                            cut_segments.append(current_cut)
+                            current_cut = []
+                        if current_fill:
+                            current_fill.append((offsets[i], z_final_cs_plot[i], z_exist_cs_plot[i]))
+                            fill_segments.append(current_fill)
+                            current_fill = []
+        
+            # Close any remaining segments
+            if current_cut:
+                cut_segments.append(current_cut)
+            if current_fill:
+                fill_segments.append(current_fill)
+        
+            # Add fill areas (light green, semi-transparent)
+            for seg in fill_segments:
+                if len(seg) > 1:
+                    fill_x = [p[0] for p in seg]
+                    fill_y_final = [p[1] for p in seg]
+                    fill_y_exist = [p[2] for p in seg]
+                    # Create closed polygon
+                    fill_x_poly = fill_x + fill_x[::-1]
+                    fill_y_poly = fill_y_final + fill_y_exist[::-1]
                 
-                fig_xs.add_trace(go.Scatter(
-                    x=fill_x_poly, y=fill_y_poly,
-                    fill='toself',
-                    fillcolor='rgba(144, 238, 144, 0.4)',  # Light green, semi-transparent
-                    line=dict(width=0),
-                    showlegend=(seg == fill_segments[0]),
-                    name='Fill Area',
-                    hoverinfo='skip'
-                ))
-        
-        # Add cut areas (light red, semi-transparent)
-        for seg in cut_segments:
-            if len(seg) > 1:
-                cut_x = [p[0] for p in seg]
-                cut_y_final = [p[1] for p in seg]
-                cut_y_exist = [p[2] for p in seg]
-                # Create closed polygon
-                cut_x_poly = cut_x + cut_x[::-1]
-                cut_y_poly = cut_y_final + cut_y_exist[::-1]
+                    fig_xs.add_trace(go.Scatter(
+                        x=fill_x_poly, y=fill_y_poly,
+                        fill='toself',
+                        fillcolor='rgba(144, 238, 144, 0.4)',  # Light green, semi-transparent
+                        line=dict(width=0),
+                        showlegend=(seg == fill_segments[0]),
+                        name='Fill Area',
+                        hoverinfo='skip'
+                    ))
+        
+            # Add cut areas (light red, semi-transparent)
+            for seg in cut_segments:
+                if len(seg) > 1:
+                    cut_x = [p[0] for p in seg]
+                    cut_y_final = [p[1] for p in seg]
+                    cut_y_exist = [p[2] for p in seg]
+                    # Create closed polygon
+                    cut_x_poly = cut_x + cut_x[::-1]
+                    cut_y_poly = cut_y_final + cut_y_exist[::-1]
                 
-                fig_xs.add_trace(go.Scatter(
-                    x=cut_x_poly, y=cut_y_poly,
-                    fill='toself',
-                    fillcolor='rgba(255, 182, 193, 0.4)',  # Light red, semi-transparent
-                    line=dict(width=0),
-                    showlegend=(seg == cut_segments[0]),
-                    name='Cut Area',
-                    hoverinfo='skip'
-                ))
+                    fig_xs.add_trace(go.Scatter(
+                        x=cut_x_poly, y=cut_y_poly,
+                        fill='toself',
+                        fillcolor='rgba(255, 182, 193, 0.4)',  # Light red, semi-transparent
+                        line=dict(width=0),
+                        showlegend=(seg == cut_segments[0]),
+                        name='Cut Area',
+                        hoverinfo='skip'
+                    ))
+        
+            # Final line (on top)
+            fig_xs.add_trace(go.Scatter(
+                x=offsets, y=z_final_cs_plot,
+                mode='lines', name='Final',
+                line=dict(color='#d62728', width=3),
+            ))
         
-        # Final line (on top)
-        fig_xs.add_trace(go.Scatter(
-            x=offsets, y=z_final_cs_plot,
-            mode='lines', name='Final',
-            line=dict(color='#d62728', width=3),
-        ))
-        
-        # Add centerline marker (longitudinal profile centerline)
-        centerline_elev = float(z_design[preview_idx_xs])
-        fig_xs.add_trace(go.Scatter(
-            x=[0.0], y=[centerline_elev],
-            mode='markers', name='Centerline',
-            marker=dict(size=12, color='#ff00ff', symbol='diamond', line=dict(width=2, color='black')),
-            showlegend=True,
-        ))
-        
-        ylabel_xs = "Elevation (m)"
-        fig_xs.update_layout(
-            title=dict(
-                text=f"Cross-Section at Station {preview_idx_xs} ({stations[preview_idx_xs]:.1f} m)",
-                font=dict(size=16, family="Arial, sans-serif")
-            ),
-            xaxis_title=dict(text="Offset (m) [- = Right, + = Left]", font=dict(size=13)),
-            yaxis_title=dict(text=ylabel_xs, font=dict(size=13)),
-            yaxis=dict(range=[y_min_plot, y_max_plot] if y_min_plot is not None else None),
-            height=600,
-            margin=dict(l=60, r=30, t=60, b=60),
-            template="plotly_white",
-            hovermode='x unified',
-            font=dict(family="Arial, sans-serif", size=11),
-        )
+            # Add centerline marker (longitudinal profile centerline)
+            centerline_elev = float(z_design[preview_idx_xs])
+            fig_xs.add_trace(go.Scatter(
+                x=[0.0], y=[centerline_elev],
+                mode='markers', name='Centerline',
+                marker=dict(size=12, color='#ff00ff', symbol='diamond', line=dict(width=2, color='black')),
+                showlegend=True,
+            ))
+        
+            ylabel_xs = "Elevation (m)"
+            fig_xs.update_layout(
+                title=dict(
+                    text=f"Cross-Section at Station {preview_idx_xs} ({stations[preview_idx_xs]:.1f} m)",
+                    font=dict(size=16, family="Arial, sans-serif")
+                ),
+                xaxis_title=dict(text="Offset (m) [- = Right, + = Left]", font=dict(size=13)),
+                yaxis_title=dict(text=ylabel_xs, font=dict(size=13)),
+                yaxis=dict(range=[y_min_plot, y_max_plot] if y_min_plot is not None else None),
+                height=600,
+                margin=dict(l=60, r=30, t=60, b=60),
+                template="plotly_white",
+                hovermode='x unified',
+                font=dict(family="Arial, sans-serif", size=11),
+            )
+        
+            # Use force_plot_update in key to force rerender
+            st.plotly_chart(fig_xs, use_container_width=True, 
+                           key=f"xs_plot_{preview_idx_xs}_{st.session_state.force_plot_update}")
+    
+        with col_map_xs:
+            st.markdown("### 🗺️ Location")
+        
+            # Map controls
+            with st.expander("🎛️ Map Controls", expanded=False):
+                sat_opacity_xs = st.slider("Satellite", 0.0, 1.0, 0.9, 0.1, key="sat_xs")
+                hs_opacity_xs = st.slider("Hillshade", 0.0, 1.0, 0.85, 0.1, key="hs_xs")
+                profile_color_xs = st.color_picker("Profile Color", "#ff0000", key="prof_color_xs")
+                show_stations_xs = st.checkbox("Show All Stations", value=True, key="stations_xs")
         
-        # Use force_plot_update in key to force rerender
-        st.plotly_chart(fig_xs, use_container_width=True, 
-                       key=f"xs_plot_{preview_idx_xs}_{st.session_state.force_plot_update}")
-    
-    with col_map_xs:
-        st.markdown("### 🗺️ Location")
-        
-        # Map controls
-        with st.expander("🎛️ Map Controls", expanded=False):
-            sat_opacity_xs = st.slider("Satellite", 0.0, 1.0, 0.9, 0.1, key="sat_xs")
-            hs_opacity_xs = st.slider("Hillshade", 0.0, 1.0, 0.85, 0.1, key="hs_xs")
-            profile_color_xs = st.color_picker("Profile Color", "#ff0000", key="prof_color_xs")
-            show_stations_xs = st.checkbox("Show All Stations", value=True, key="stations_xs")
-        
-        # Use session state directly to ensure synchronization with profile tab
-        current_station_idx_xs = st.session_state.selected_station_idx
-        x_station_xs, y_station_xs = center_xy[current_station_idx_xs]
-        lon_station_xs, lat_station_xs = transformer_to_map.transform(x_station_xs, y_station_xs)
-        
-        # Initialize map - use profile bounds if available, otherwise center on station
-        if "profile_bounds" in st.session_state and st.session_state.profile_bounds is not None:
-            # Use center of profile bounds as initial location, then fit to bounds
-            bounds_center_lat = (st.session_state.profile_bounds[0][0] + st.session_state.profile_bounds[1][0]) / 2
-            bounds_center_lon = (st.session_state.profile_bounds[0][1] + st.session_state.profile_bounds[1][1]) / 2
-            m_xs = folium.Map(
-                location=[bounds_center_lat, bounds_center_lon],
-                zoom_start=15,  # Lower zoom, will be adjusted by fit_bounds
+            # Use session state directly to ensure synchronization with profile tab
+            current_station_idx_xs = st.session_state.selected_station_idx
+            x_station_xs, y_station_xs = center_xy[current_station_idx_xs]
+            lon_station_xs, lat_station_xs = transformer_to_map.transform(x_station_xs, y_station_xs)
+        
+            # Initialize map - use profile bounds if available, otherwise center on station
+            if "profile_bounds" in st.session_state and st.session_state.profile_bounds is not None:
+                # Use center of profile bounds as initial location, then fit to bounds
+                bounds_center_lat = (st.session_state.profile_bounds[0][0] + st.session_state.profile_bounds[1][0]) / 2
+                bounds_center_lon = (st.session_state.profile_bounds[0][1] + st.session_state.profile_bounds[1][1]) / 2
+                m_xs = folium.Map(
+                    location=[bounds_center_lat, bounds_center_lon],
+                    zoom_start=15,  # Lower zoom, will be adjusted by fit_bounds
+                    max_zoom=24,
+                    control_scale=False,
+                    prefer_canvas=True
+                )
+            else:
+                # Fallback to station-centered view
+                m_xs = folium.Map(
+                location=[lat_station_xs, lon_station_xs],
+                zoom_start=21,
                 max_zoom=24,
                 control_scale=False,
                 prefer_canvas=True
             )
-        else:
-            # Fallback to station-centered view
-            m_xs = folium.Map(
-            location=[lat_station_xs, lon_station_xs],
-            zoom_start=21,
-            max_zoom=24,
-            control_scale=False,
-            prefer_canvas=True
-        )
         
-        folium.TileLayer(
-            tiles='https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}',
-            attr='Google', opacity=sat_opacity_xs
-        ).add_to(m_xs)
-        
-        folium.raster_layers.ImageOverlay(
-            image=hs_norm, bounds=bounds_map, opacity=hs_opacity_xs
-        ).add_to(m_xs)
-        
-        folium.PolyLine(
-            locations=[[lat, lon] for lon, lat in line_coords_latlon],
-            color=profile_color_xs, weight=3
-        ).add_to(m_xs)
-        
-        if show_stations_xs:
-            for i, (x_a, y_a) in enumerate(center_xy):
-                lon, lat = transformer_to_map.transform(x_a, y_a)
-                if i == current_station_idx_xs:
-                    # Selected station - larger, yellow with black border
-                    folium.CircleMarker(
-                        location=[lat, lon], radius=12,
-                        color='black', fillColor='#ffcc00', fillOpacity=1.0, weight=3,
-                        popup=f'Station {i} (S{i})',
-                        tooltip=f'S{i} (Selected)'
+            folium.TileLayer(
+                tiles='https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}',
+                attr='Google', opacity=sat_opacity_xs
+            ).add_to(m_xs)
+        
+            folium.raster_layers.ImageOverlay(
+                image=hs_norm, bounds=bounds_map, opacity=hs_opacity_xs
+            ).add_to(m_xs)
+        
+            folium.PolyLine(
+                locations=[[lat, lon] for lon, lat in line_coords_latlon],
+                color=profile_color_xs, weight=3
+            ).add_to(m_xs)
+        
+            # Stations as one layer; only the selected one when "Show All Stations" is unchecked
+            add_station_layer(m_xs, cached_station_features(center_xy, transformer_to_map),
+                              current_station_idx_xs, show_all=show_stations_xs)
+        
+            # Add berm and ditch boundary lines (if template is berm_ditch)
+            # Or swale cross-section polyline if template is swale
+            template_type_xs = st.session_state.get("template_type", None)
+            if template_type_xs == "berm_ditch":
+                try:
+                    template_params_xs = st.session_state.get("template_params", {})
+                    tangents_xs, normals_xs = compute_tangents_normals(samples)
+                    berm_top_left, berm_top_right, ditch_bottom_left, ditch_bottom_right = get_berm_ditch_boundaries(template_params_xs)
+                    berm_top_left_coords, berm_top_right_coords, ditch_bottom_left_coords, ditch_bottom_right_coords = offset_lines(
+                        center_xy, normals_xs, [berm_top_left, berm_top_right, ditch_bottom_left, ditch_bottom_right],
+                        analysis_crs, map_crs
+                    ).tolist()
+                    folium.PolyLine(
+                        locations=berm_top_left_coords,
+                        color='#4169E1', weight=2, opacity=0.6, dash_array='5, 5',
+                        tooltip='Berm Top Left Edge'
                     ).add_to(m_xs)
-                    
-                    # Add label for selected station
-                    folium.Marker(
-                        location=[lat, lon],
-                        icon=folium.DivIcon(
-                            html=f'<div style="font-size: 14px; font-weight: bold; color: black; text-shadow: 1px 1px 2px white, -1px -1px 2px white, 1px -1px 2px white, -1px 1px 2px white;">S{i}</div>',
-                            icon_size=(30, 15),
-                            icon_anchor=(15, -5)
-                        )
+                    folium.PolyLine(
+                        locations=berm_top_right_coords,
+                        color='#4169E1', weight=2, opacity=0.6, dash_array='5, 5',
+                        tooltip='Berm Top Right Edge'
                     ).add_to(m_xs)
-                else:
-                    # Other stations - smaller, red
-                    folium.CircleMarker(
-                        location=[lat, lon], radius=5,
-                        color='#d62728', fillColor='#d62728', fillOpacity=0.8, weight=2,
-                        popup=f'Station {i} (S{i})',
-                        tooltip=f'S{i}'
+                    folium.PolyLine(
+                        locations=ditch_bottom_left_coords,
+                        color='#FF8C00', weight=2, opacity=0.6, dash_array='5, 5',
+                        tooltip='Ditch Bottom Left Edge'
                     ).add_to(m_xs)
-                    
-                    # Add label for other stations
-                    folium.Marker(
-                        location=[lat, lon],
-                        icon=folium.DivIcon(
-                            html=f'<div style="font-size: 12px; font-weight: bold; color: #d62728; text-shadow: 1px 1px 2px white, -1px -1px 2px white, 1px -1px 2px white, -1px 1px 2px white;">S{i}</div>',
-                            icon_size=(25, 12),
-                            icon_anchor=(12, -5)
-                        )
+                    folium.PolyLine(
+                        locations=ditch_bottom_right_coords,
+                        color='#FF8C00', weight=2, opacity=0.6, dash_array='5, 5',
+                        tooltip='Ditch Bottom Right Edge'
                     ).add_to(m_xs)
-        else:
-            # Show only selected station when "Show All Stations" is unchecked
-            folium.CircleMarker(
-                location=[lat_station_xs, lon_station_xs], radius=12,
-                color='black', fillColor='#ffcc00', fillOpacity=1.0, weight=3,
-                popup=f'Station {current_station_idx_xs} (S{current_station_idx_xs})',
-                tooltip=f'S{current_station_idx_xs} (Selected)'
-            ).add_to(m_xs)
-            
-            # Add label for selected station
+                except Exception:
+                    pass  # Silently fail if data not ready
+            elif template_type_xs == "swale":
+                try:
+                    # Compute swale cross-section vertices for current station
+                    template_params_xs = st.session_state.get("template_params", {})
+                    preview_idx_xs = st.session_state.selected_station_idx
+                    xc, yc = center_xy[preview_idx_xs]
+                    nx, ny = normals[preview_idx_xs]
+                    # Swale geometry
+                    bottom_width = template_params_xs.get("swale_bottom_width", 2.0)
+                    depth = template_params_xs.get("swale_depth", 1.0)
+                    side_slope = template_params_xs.get("swale_side_slope", 3.0)
+                    # Compute offsets for swale: left, right, and side slope ends
+                    half_bottom = bottom_width / 2.0
+                    slope_end = half_bottom + depth * side_slope
+                    # Project the section out to the side slope ends in plan view
+                    swale_polyline_coords = offset_lines(
+                        [[xc, yc]], [[nx, ny]], np.linspace(-slope_end, slope_end, 25), analysis_crs, map_crs
+                    )[:, 0].tolist()
+                    # Draw semi-transparent polyline for swale cross-section
+                    folium.PolyLine(
+                        locations=swale_polyline_coords,
+                        color="#00BFFF", weight=6, opacity=0.4, dash_array=None,
+                        tooltip="Swale Cross-Section"
+                    ).add_to(m_xs)
+                except Exception:
+                    pass  # Silently fail if data not ready
+        
+            # Add centerline marker (purple diamond) at selected station
             folium.Marker(
                 location=[lat_station_xs, lon_station_xs],
                 icon=folium.DivIcon(
-                    html=f'<div style="font-size: 14px; font-weight: bold; color: black; text-shadow: 1px 1px 2px white, -1px -1px 2px white, 1px -1px 2px white, -1px 1px 2px white;">S{current_station_idx_xs}</div>',
-                    icon_size=(30, 15),
-                    icon_anchor=(15, -5)
-                )
+                    html=f'<div style="font-size: 24px; color: #ff00ff; text-shadow: 0 0 3px black;">♦</div>',
+                    icon_size=(20, 20),
+                    icon_anchor=(10, 10)
+                ),
+                tooltip='Centerline (Offset = 0m)'
             ).add_to(m_xs)
         
-        # Add berm and ditch boundary lines (if template is berm_ditch)
-        # Or swale cross-section polyline if template is swale
-        template_type_xs = st.session_state.get("template_type", None)
-        if template_type_xs == "berm_ditch":
-            try:
-                template_params_xs = st.session_state.get("template_params", {})
-                tangents_xs, normals_xs = compute_tangents_normals(samples)
-                berm_top_left, berm_top_right, ditch_bottom_left, ditch_bottom_right = get_berm_ditch_boundaries(template_params_xs)
-                berm_top_left_coords = []
-                berm_top_right_coords = []
-                ditch_bottom_left_coords = []
-                ditch_bottom_right_coords = []
-                for station_idx in range(len(stations)):
-                    xc, yc = center_xy[station_idx]
-                    nx, ny = normals_xs[station_idx]
-                    x_btl = xc + berm_top_left * nx
-                    y_btl = yc + berm_top_left * ny
-                    lon_btl, lat_btl = transformer_to_map.transform(x_btl, y_btl)
-                    berm_top_left_coords.append([lat_btl, lon_btl])
-                    x_btr = xc + berm_top_right * nx
-                    y_btr = yc + berm_top_right * ny
-                    lon_btr, lat_btr = transformer_to_map.transform(x_btr, y_btr)
-                    berm_top_right_coords.append([lat_btr, lon_btr])
-                    x_dbl = xc + ditch_bottom_left * nx
-                    y_dbl = yc + ditch_bottom_left * ny
-                    lon_dbl, lat_dbl = transformer_to_map.transform(x_dbl, y_dbl)
-                    ditch_bottom_left_coords.append([lat_dbl, lon_dbl])
-                    x_dbr = xc + ditch_bottom_right * nx
-                    y_dbr = yc + ditch_bottom_right * ny
-                    lon_dbr, lat_dbr = transformer_to_map.transform(x_dbr, y_dbr)
-                    ditch_bottom_right_coords.append([lat_dbr, lon_dbr])
-                folium.PolyLine(
-                    locations=berm_top_left_coords,
-                    color='#4169E1', weight=2, opacity=0.6, dash_array='5, 5',
-                    tooltip='Berm Top Left Edge'
-                ).add_to(m_xs)
-                folium.PolyLine(
-                    locations=berm_top_right_coords,
-                    color='#4169E1', weight=2, opacity=0.6, dash_array='5, 5',
-                    tooltip='Berm Top Right Edge'
-                ).add_to(m_xs)
-                folium.PolyLine(
-                    locations=ditch_bottom_left_coords,
-                    color='#FF8C00', weight=2, opacity=0.6, dash_array='5, 5',
-                    tooltip='Ditch Bottom Left Edge'
-                ).add_to(m_xs)
-                folium.PolyLine(
-                    locations=ditch_bottom_right_coords,
-                    color='#FF8C00', weight=2, opacity=0.6, dash_array='5, 5',
-                    tooltip='Ditch Bottom Right Edge'
-                ).add_to(m_xs)
-            except Exception:
-                pass  # Silently fail if data not ready
-        elif template_type_xs == "swale":
-            try:
-                # Compute swale cross-section vertices for current station
-                template_params_xs = st.session_state.get("template_params", {})
-                influence_width_xs = st.session_state.get("influence_width", 12.0)
-                preview_idx_xs = st.session_state.selected_station_idx
-                xc, yc = center_xy[preview_idx_xs]
-                nx, ny = normals[preview_idx_xs]
-                z_crest = float(z_design[preview_idx_xs])
-                # Swale geometry
-                bottom_width = template_params_xs.get("swale_bottom_width", 2.0)
-                depth = template_params_xs.get("swale_depth", 1.0)
-                side_slope = template_params_xs.get("swale_side_slope", 3.0)
-                # Compute offsets for swale: left, right, and side slope ends
-                half_bottom = bottom_width / 2.0
-                slope_end = half_bottom + depth * side_slope
-                offsets_swale = [-slope_end, -half_bottom, half_bottom, slope_end]
-                # Project these offsets to plan view
-                swale_polyline_coords = []
-                for off in np.linspace(-slope_end, slope_end, 25):
-                    x_sw = xc + off * nx
-                    y_sw = yc + off * ny
-                    lon_sw, lat_sw = transformer_to_map.transform(x_sw, y_sw)
-                    swale_polyline_coords.append([lat_sw, lon_sw])
-                # Draw semi-transparent polyline for swale cross-section
-                folium.PolyLine(
-                    locations=swale_polyline_coords,
-                    color="#00BFFF", weight=6, opacity=0.4, dash_array=None,
-                    tooltip="Swale Cross-Section"
-                ).add_to(m_xs)
-            except Exception:
-                pass  # Silently fail if data not ready
-        
-        # Add centerline marker (purple diamond) at selected station
-        folium.Marker(
-            location=[lat_station_xs, lon_station_xs],
-            icon=folium.DivIcon(
-                html=f'<div style="font-size: 24px; color: #ff00ff; text-shadow: 0 0 3px black;">♦</div>',
-                icon_size=(20, 20),
-                icon_anchor=(10, 10)
-            ),
-            tooltip='Centerline (Offset = 0m)'
-        ).add_to(m_xs)
-        
-        # Auto-zoom to full extent of profile line when switching to Cross-Section tab
-        if "profile_bounds" in st.session_state and st.session_state.profile_bounds is not None:
-            m_xs.fit_bounds(st.session_state.profile_bounds)
-        else:
-            # Fall back to station-only zoom if no profile bounds
-            station_buffer = 0.0002
-            m_xs.fit_bounds([
-                [lat_station_xs - station_buffer, lon_station_xs - station_buffer],
-                [lat_station_xs + station_buffer, lon_station_xs + station_buffer]
-            ])
-        
-        # Use key with station index and force_plot_update to ensure map refreshes when station changes
-        st_folium(m_xs, height=650, width=None, returned_objects=[], 
-                 key=f"map_xs_{current_station_idx_xs}_{st.session_state.force_plot_update}")
+            # Auto-zoom to full extent of profile line when switching to Cross-Section tab
+            if "profile_bounds" in st.session_state and st.session_state.profile_bounds is not None:
+                m_xs.fit_bounds(st.session_state.profile_bounds)
+            else:
+                # Fall back to station-only zoom if no profile bounds
+                station_buffer = 0.0002
+                m_xs.fit_bounds([
+                    [lat_station_xs - station_buffer, lon_station_xs - station_buffer],
+                    [lat_station_xs + station_buffer, lon_station_xs + station_buffer]
+                ])
+        
+            # Use key with station index and force_plot_update to ensure map refreshes when station changes
+            with StageTimer("st_folium_xs"):
+                st_folium(m_xs, height=650, width=None, returned_objects=[], 
+                         key=f"map_xs_{current_station_idx_xs}_{st.session_state.force_plot_update}")
         
-        # Map legend and description
-        with st.expander("🗺️ Map Legend & Description", expanded=False):
-            st.markdown("""
+            # Map legend and description
+            with st.expander("🗺️ Map Legend & Description", expanded=False):
+                st.markdown("""
             ### Map View Elements
             
             **Profile Line & Stations:**
@@ -5489,6 +7624,9 @@ Perpendicular distance from profile centreline where terrain modification applie
             - Pan: Click and drag
             - The map automatically centers on the selected station
             """)
+
+    if active_view == "Cross-Section":
+        cross_section_browser()
     
     # Instructions section at bottom of cross-section tab
     st.markdown("---")
@@ -5765,6 +7903,11 @@ with _tab2:
   elif 'samples' not in locals() or 'z_design' not in locals():
     st.warning("⚠️ Complete setup in Cross-Section tab first")
   else:
+    # Station selector, slope editor, profile plot and map rerun on their own
+    @st.fragment
+    def profile_editor():
+        global z_design
+
         # Recalculate design elevations from the stored original baseline using central helper.
         # This helper respects `locked_stations` so user-edited stations are not overwritten.
         recalculate_z_design_with_gradients()
@@ -5980,44 +8123,8 @@ with _tab2:
 
                 st.session_state.modified_dem = None
                 st.session_state.recompute_dem = True
-            
-            def recalculate_z_design_with_gradients():
-                """Rebuild z_design by applying all stored slopes from original baseline.
-                
-                KEY RULE: Each slope only affects DOWNSTREAM stations until the next slope station.
-                Slopes do NOT affect upstream stations or the slope station itself.
-                """
-                orig_z = np.array(st.session_state.get("z_design_original", st.session_state.z_design), dtype=float)
-                new_z = orig_z.copy()
-                stn_list = st.session_state.get("stations", [])
-                
-                if len(st.session_state.station_gradients) > 0 and len(stn_list) > 0:
-                    grads_sorted = sorted([i for i in st.session_state.station_gradients.keys() if i < len(stn_list)])
-                    
-                    for grad_idx in grads_sorted:
-                        grad_pct = st.session_state.station_gradients[grad_idx]
-                        base_elev = float(orig_z[grad_idx])
-                        base_dist = stn_list[grad_idx]
-                        grade = grad_pct / 100.0
-                        
-                        # Find next slope station (end of this slope's influence)
-                        next_grad_idx = None
-                        for nxt in grads_sorted:
-                            if nxt > grad_idx:
-                                next_grad_idx = nxt
-                                break
-                        
-                        # Apply slope ONLY from grad_idx+1 to next_grad_idx (or end if none)
-                        end_idx = next_grad_idx if next_grad_idx is not None else len(stn_list)
-                        locked = set(st.session_state.get("locked_stations", []))
-                        for i in range(grad_idx + 1, end_idx):
-                            # Respect locks: do not overwrite manually edited stations
-                            if i in locked:
-                                continue
-                            d = stn_list[i] - base_dist
-                            new_z[i] = base_elev + grade * d
-                
-                st.session_state.z_design = new_z.tolist()
+                # st.rerun() is a no-op in callbacks: the fragment body reruns the app below
+                st.session_state.profile_rerun_app = True
             
             # Check if this is last station
             is_last_station = preview_idx_prof >= len(stations_for_prof) - 1
@@ -6075,6 +8182,7 @@ with _tab2:
                     st.session_state.locked_stations = sorted(list(locked))
                     # Recalculate downstream stations using stored slopes (respecting locks)
                     recalculate_z_design_with_gradients()
+                    st.session_state.profile_rerun_app = True
             
             # Number input only for elevation (no slider to avoid widget key issues)
             st.number_input(
@@ -6119,6 +8227,12 @@ with _tab2:
                 st.session_state.locked_stations = sorted(list(locked))
                 # Recalculate downstream stations using stored slopes (respecting locks)
                 recalculate_z_design_with_gradients()
+                st.session_state.profile_rerun_app = True
+            
+            # Design edits invalidate the modified DEM, volumes and maps (and add an undo
+            # step), which are all built outside this fragment: rerun the whole app
+            if st.session_state.pop("profile_rerun_app", False):
+                st.rerun(scope="app")
         
         with col_plot_prof:
             # Always read latest z_design from session state to ensure updates from gradient changes are reflected
@@ -6143,6 +8257,21 @@ with _tab2:
                 showlegend=False,  # Hide from legend but show on plot
             ))
             
+            # Modified terrain along the same long-section (after Compute Modified DEM)
+            z_modified_plot = np.array([])
+            if st.session_state.modified_dem is not None:
+                long_sec_mod = cached_long_section(
+                    line_a, existing_spacing, analysis_dem_key, analysis_dem, analysis_transform, analysis_valid,
+                    modified_key=session_raster_hash("modified_dem"), modified_dem=st.session_state.modified_dem,
+                    nodata=analysis_nodata
+                )
+                z_modified_plot = long_sec_mod["z_modified"]
+                fig_prof.add_trace(go.Scatter(
+                    x=long_sec_mod["chainage"], y=z_modified_plot,
+                    mode='lines', name='Modified Terrain',
+                    line=dict(color='#1f77b4', width=2, dash='dot'),
+                ))
+            
             # Design profile - at corner vertices (use latest z_design from session state)
             fig_prof.add_trace(go.Scatter(
                 x=stations, y=z_design_plot,
@@ -6152,7 +8281,7 @@ with _tab2:
             ))
             
             # Calculate y-axis range based on min/max elevation (not from 0)
-            all_elevations = np.concatenate([z_existing, z_existing_at_stations, z_design_plot])
+            all_elevations = np.concatenate([z_existing, z_existing_at_stations, z_design_plot, z_modified_plot])
             y_min = np.nanmin(all_elevations)
             y_max = np.nanmax(all_elevations)
             y_padding = (y_max - y_min) * 0.1  # 10% padding
@@ -6332,66 +8461,16 @@ with _tab2:
             folium.raster_layers.ImageOverlay(
                 image=hs_norm, bounds=bounds_map, opacity=hs_opacity_prof
             ).add_to(m_prof)
+            add_dz_overlay(m_prof)
             
             folium.PolyLine(
                 locations=[[lat, lon] for lon, lat in line_coords_latlon],
                 color=profile_color_prof, weight=4
             ).add_to(m_prof)
             
-            if show_stations_prof:
-                for i, (x_a, y_a) in enumerate(center_xy):
-                    lon, lat = transformer_to_map.transform(x_a, y_a)
-                    if i == current_station_idx_prof:
-                        # Active station - larger, yellow with black border
-                        folium.CircleMarker(
-                            location=[lat, lon], radius=12,
-                            color='black', fillColor='#ffcc00', fillOpacity=1.0, weight=3,
-                            popup=f'Station S{i}',
-                            tooltip=f'S{i} (Active)'
-                        ).add_to(m_prof)
-                        
-                        folium.Marker(
-                            location=[lat, lon],
-                            icon=folium.DivIcon(
-                                html=f'<div style="font-size: 14px; font-weight: bold; color: black; text-shadow: 1px 1px 2px white, -1px -1px 2px white, 1px -1px 2px white, -1px 1px 2px white;">S{i}</div>',
-                                icon_size=(30, 15),
-                                icon_anchor=(15, -5)
-                            )
-                        ).add_to(m_prof)
-                    else:
-                        # Other stations
-                        folium.CircleMarker(
-                            location=[lat, lon], radius=5,
-                            color='#d62728', fillColor='#d62728', fillOpacity=0.8, weight=2,
-                            popup=f'Station S{i}',
-                            tooltip=f'S{i}'
-                        ).add_to(m_prof)
-                        
-                        folium.Marker(
-                            location=[lat, lon],
-                            icon=folium.DivIcon(
-                                html=f'<div style="font-size: 12px; font-weight: bold; color: #d62728; text-shadow: 1px 1px 2px white, -1px -1px 2px white, 1px -1px 2px white, -1px 1px 2px white;">S{i}</div>',
-                                icon_size=(25, 12),
-                                icon_anchor=(12, -5)
-                            )
-                        ).add_to(m_prof)
-            else:
-                # Show only active station
-                folium.CircleMarker(
-                    location=[lat_station_prof, lon_station_prof], radius=12,
-                    color='black', fillColor='#ffcc00', fillOpacity=1.0, weight=3,
-                    popup=f'Station S{current_station_idx_prof}',
-                    tooltip=f'S{current_station_idx_prof} (Active)'
-                ).add_to(m_prof)
-                
-                folium.Marker(
-                    location=[lat_station_prof, lon_station_prof],
-                    icon=folium.DivIcon(
-                        html=f'<div style="font-size: 14px; font-weight: bold; color: black; text-shadow: 1px 1px 2px white, -1px -1px 2px white, 1px -1px 2px white, -1px 1px 2px white;">S{current_station_idx_prof}</div>',
-                        icon_size=(30, 15),
-                        icon_anchor=(15, -5)
-                    )
-                ).add_to(m_prof)
+            # Stations as one layer; only the active one when "Show All Stations" is unchecked
+            add_station_layer(m_prof, cached_station_features(center_xy, transformer_to_map),
+                              current_station_idx_prof, show_all=show_stations_prof)
             
             # Add berm and ditch boundary lines (if template is berm_ditch)
             # Draw dotted lines connecting vertices of berm top and ditch bottom
@@ -6404,39 +8483,11 @@ with _tab2:
                     
                     berm_top_left, berm_top_right, ditch_bottom_left, ditch_bottom_right = get_berm_ditch_boundaries(template_params_prof)
                     
-                    # Collect all berm top left vertices
-                    berm_top_left_coords = []
-                    berm_top_right_coords = []
-                    ditch_bottom_left_coords = []
-                    ditch_bottom_right_coords = []
-                    
-                    for station_idx in range(len(stations)):
-                        xc, yc = center_xy[station_idx]
-                        nx, ny = normals_prof[station_idx]
-                        
-                        # Berm top left vertex
-                        x_btl = xc + berm_top_left * nx
-                        y_btl = yc + berm_top_left * ny
-                        lon_btl, lat_btl = transformer_to_map.transform(x_btl, y_btl)
-                        berm_top_left_coords.append([lat_btl, lon_btl])
-                        
-                        # Berm top right vertex
-                        x_btr = xc + berm_top_right * nx
-                        y_btr = yc + berm_top_right * ny
-                        lon_btr, lat_btr = transformer_to_map.transform(x_btr, y_btr)
-                        berm_top_right_coords.append([lat_btr, lon_btr])
-                        
-                        # Ditch bottom left vertex
-                        x_dbl = xc + ditch_bottom_left * nx
-                        y_dbl = yc + ditch_bottom_left * ny
-                        lon_dbl, lat_dbl = transformer_to_map.transform(x_dbl, y_dbl)
-                        ditch_bottom_left_coords.append([lat_dbl, lon_dbl])
-                        
-                        # Ditch bottom right vertex
-                        x_dbr = xc + ditch_bottom_right * nx
-                        y_dbr = yc + ditch_bottom_right * ny
-                        lon_dbr, lat_dbr = transformer_to_map.transform(x_dbr, y_dbr)
-                        ditch_bottom_right_coords.append([lat_dbr, lon_dbr])
+                    # Berm top and ditch bottom vertices at all stations (one batched transform)
+                    berm_top_left_coords, berm_top_right_coords, ditch_bottom_left_coords, ditch_bottom_right_coords = offset_lines(
+                        center_xy, normals_prof, [berm_top_left, berm_top_right, ditch_bottom_left, ditch_bottom_right],
+                        analysis_crs, map_crs
+                    ).tolist()
                     
                     # Draw dotted lines connecting vertices
                     folium.PolyLine(
@@ -6557,8 +8608,9 @@ with _tab2:
             else:
                 map_key = f"map_prof_{current_station_idx_prof}_{st.session_state.force_plot_update}"
             
-            st_folium(m_prof, height=650, width=None, returned_objects=[],
-                     key=map_key)
+            with StageTimer("st_folium_profile"):
+                st_folium(m_prof, height=650, width=None, returned_objects=[],
+                         key=map_key)
             
             # Map legend and description
             with st.expander("🗺️ Map Legend & Description", expanded=False):
@@ -6599,12 +8651,17 @@ with _tab2:
                 - The map automatically centers on the selected station
                 """)
 
+    if active_view == "Profile":
+        profile_editor()
+
 # ============================================================================
 # TAB 4: BASIN DESIGN (Basin Mode Only)
 # ============================================================================
 
 if st.session_state.design_mode == "basin":
-    with tab4:
+    # Basin parameter cards, profile plot and map rerun on their own when a parameter changes
+    @st.fragment
+    def basin_design_view():
         st.markdown("## 🏞️ Basin Design & Parameters")
         
         # Check if this is the first time visiting the Basin Design tab after polygon is set
@@ -6696,78 +8753,74 @@ if st.session_state.design_mode == "basin":
                 if channel_coords is not None and len(channel_coords) >= 2:
                     st.success(f"✅ Channel with {len(channel_coords)} points")
                 else:
-                    st.warning("⚠️ No channel defined. Using automatic flow direction (first vertex → minimum elevation).")
+                    st.warning("⚠️ No channel defined. Using the main flow path from D8 flow routing "
+                               "(first vertex → minimum elevation if routing finds no path).")
             
             # Convert basin polygon to projected coordinates
-            basin_coords_xy = []
-            for coord in basin_coords:
-                lon, lat = coord[0], coord[1]
-                x, y = transformer_to_analysis.transform(lon, lat)
-                basin_coords_xy.append((x, y))
+            basin_coords_xy = [tuple(p) for p in transform_coords([c[:2] for c in basin_coords], map_crs, analysis_crs).tolist()]
             
             # Calculate flow length for longitudinal slope calculations
-            from shapely.geometry import Polygon, Point
-            from rasterio.transform import rowcol, xy
+            from shapely.geometry import Polygon
             
             channel_coords = st.session_state.get("basin_channel_coords")
-            flow_length = 0.0
             channel_coords_xy = None  # Initialize to None
             
             if channel_coords is not None and len(channel_coords) >= 2:
                 # Use channel line: calculate total length
-                channel_coords_xy = []
-                for coord in channel_coords:
-                    # Handle both list and tuple formats, extract first two elements
-                    if isinstance(coord, (list, tuple)) and len(coord) >= 2:
-                        lon, lat = coord[0], coord[1]
-                    else:
-                        continue  # Skip invalid coordinates
-                    x, y = transformer_to_analysis.transform(lon, lat)
-                    channel_coords_xy.append((x, y))
+                # Handle both list and tuple formats, extract first two elements (skip invalid coordinates)
+                channel_lonlat = [c[:2] for c in channel_coords if isinstance(c, (list, tuple)) and len(c) >= 2]
+                channel_coords_xy = [tuple(p) for p in transform_coords(channel_lonlat, map_crs, analysis_crs).tolist()]
                 
                 # Only use channel_coords_xy if we have at least 2 valid points
                 if len(channel_coords_xy) < 2:
                     channel_coords_xy = None
-                else:
-                    # Calculate total channel length
-                    for i in range(len(channel_coords_xy) - 1):
-                        x1, y1 = channel_coords_xy[i]
-                        x2, y2 = channel_coords_xy[i + 1]
-                        flow_length += np.sqrt((x2 - x1)**2 + (y2 - y1)**2)
             
-            # If no channel coords, calculate flow length from polygon
+            basin_aoi_stats = cached_basin_aoi(
+                analysis_dem_key, analysis_dem, analysis_transform, analysis_nodata,
+                basin_coords_xy, valid=analysis_valid
+            )
+            
+            # Without a drawn channel, route flow over the DEM (priority-flood fill, D8,
+            # accumulation) and use the main flow path through the polygon as the channel
+            # (automatically only for small windows; larger ones wait for the button)
             if channel_coords_xy is None:
-                # Fallback: use first vertex to minimum elevation
-                upstream_x, upstream_y = basin_coords_xy[0]
-                outer_poly = Polygon(basin_coords_xy)
-                minx, miny, maxx, maxy = outer_poly.bounds
-                row_min, col_min = rowcol(analysis_transform, minx, maxy)
-                row_max, col_max = rowcol(analysis_transform, maxx, miny)
-                
-                h, w = analysis_dem.shape
-                row_min, row_max = max(0, min(row_min, row_max)), min(h-1, max(row_min, row_max))
-                col_min, col_max = max(0, min(col_min, col_max)), min(w-1, max(col_min, col_max))
-                
-                min_elev = float('inf')
-                downstream_x, downstream_y = upstream_x, upstream_y
-                
-                for r in range(row_min, row_max + 1):
-                    for c in range(col_min, col_max + 1):
-                        z_val = analysis_dem[r, c]
-                        if analysis_nodata is not None and z_val == analysis_nodata:
-                            continue
-                        
-                        x, y = xy(analysis_transform, r, c)
-                        point = Point(x, y)
-                        
-                        if outer_poly.contains(point) and z_val < min_elev:
-                            min_elev = z_val
-                            downstream_x, downstream_y = x, y
-                
-                # Calculate flow length
-                flow_dx = downstream_x - upstream_x
-                flow_dy = downstream_y - upstream_y
-                flow_length = np.sqrt(flow_dx**2 + flow_dy**2)
+                routing_cells = flow_routing_cells(analysis_transform, analysis_dem.shape, basin_coords_xy)
+                auto_route_limit = flow_routing_auto_limit()
+                routed_channel = st.session_state.get("basin_channel_cache")
+                already_routed = routed_channel is not None and routed_channel["key"] == basin_aoi_stats["key"]
+                derived_channel_xy = None
+                if already_routed or routing_cells <= auto_route_limit:
+                    run_routing = True
+                else:
+                    col_route_info, col_route_btn = st.columns([3, 1])
+                    with col_route_info:
+                        st.info(f"🌊 The routing window has {routing_cells:,} cells. Until flow is routed, the basin "
+                                "uses first vertex → minimum elevation as its flow direction.")
+                    with col_route_btn:
+                        run_routing = st.button("🌊 Route flow (D8)", key="btn_route_basin_flow",
+                                                help="Priority-flood fill, D8 directions and accumulation over the basin window")
+                if run_routing:
+                    with StageTimer("basin_flow_routing"):
+                        derived_channel_xy = cached_basin_channel(
+                            basin_aoi_stats, analysis_dem, analysis_transform, analysis_nodata,
+                            basin_coords_xy, valid=analysis_valid
+                        )
+                if derived_channel_xy is not None:
+                    channel_coords_xy = derived_channel_xy
+                    col_ch_info, col_ch_keep = st.columns([3, 1])
+                    with col_ch_info:
+                        st.info(f"🌊 Using the D8 main flow path as channel ({len(derived_channel_xy)} points).")
+                    with col_ch_keep:
+                        if st.button("📌 Keep as channel", key="btn_keep_derived_channel",
+                                     help="Store the derived flow path as the basin channel line (editable and exportable)"):
+                            st.session_state.basin_channel_coords = transform_coords(derived_channel_xy, analysis_crs, map_crs).tolist()
+                            st.session_state.basin_modified_dem = None
+                            st.rerun()
+            
+            # Distance-along-flow field (channel, or first vertex to minimum elevation),
+            # shared by the basin cut, the longitudinal profile and the volume methods
+            basin_flow = cached_basin_flow_field(basin_aoi_stats, basin_coords_xy, channel_coords_xy)
+            flow_length = basin_flow["flow_length"]
             
             # Calculate inner polygon (now with longitudinal slope support)
             inner_coords_xy, inner_poly_error = calculate_inner_polygon(
@@ -6802,6 +8855,14 @@ if st.session_state.design_mode == "basin":
                     st.metric("Offset Distance (m)", f"{offset_calc:.2f}")
                 
                 st.write(f"**Polygon Bounds (m):** {outer_bounds}")
+                if basin_aoi_stats["mean_elev"] is not None:
+                    st.write(f"**Existing Ground (m):** min {basin_aoi_stats['min_elev']:.2f} • "
+                             f"mean {basin_aoi_stats['mean_elev']:.2f} • max {basin_aoi_stats['max_elev']:.2f}")
+                    st.write(f"**Valid DEM Area (m²):** {basin_aoi_stats['area_m2']:,.0f}")
+                    hyps = basin_aoi_stats["hypsometry"]
+                    st.line_chart(pd.DataFrame({"Elevation (m)": hyps["edges"],
+                                                "Area above (%)": hyps["area_above_fraction"] * 100})
+                                  .set_index("Area above (%)"), height=200)
                 st.write(f"**Minimum Dimension (m):** {min_dim:.2f}")
                 st.write(f"**Basin Depth (m):** {basin_depth:.2f}")
                 st.write(f"**Calculated Offset (m):** {offset_calc:.2f}")
@@ -6862,13 +8923,11 @@ if st.session_state.design_mode == "basin":
             inner_polygon_status = "✅ OK"
             try:
                 if inner_coords_xy is not None and len(inner_coords_xy) >= 3:
-                    inner_coords_latlon = []
-                    for x, y in inner_coords_xy:
-                        lon, lat = transformer_to_map.transform(x, y)
-                        # Validate transformed coordinates
-                        if np.isnan(lon) or np.isnan(lat) or not np.isfinite(lon) or not np.isfinite(lat):
-                            raise ValueError(f"Invalid transform result")
-                        inner_coords_latlon.append([lon, lat])
+                    inner_lonlat = transform_coords(inner_coords_xy, analysis_crs, map_crs)
+                    # Validate transformed coordinates
+                    if not np.isfinite(inner_lonlat).all():
+                        raise ValueError(f"Invalid transform result")
+                    inner_coords_latlon = inner_lonlat.tolist()
                     
                     # Ensure polygon is closed for display
                     if inner_coords_latlon[0] != inner_coords_latlon[-1]:
@@ -6882,12 +8941,10 @@ if st.session_state.design_mode == "basin":
                 # Try axis-swap fallback (swap x/y in projection)
                 try:
                     if inner_coords_xy is not None and len(inner_coords_xy) >= 3:
-                        inner_coords_latlon = []
-                        for y, x in inner_coords_xy:  # Swap x/y
-                            lon, lat = transformer_to_map.transform(x, y)
-                            if np.isnan(lon) or np.isnan(lat) or not np.isfinite(lon) or not np.isfinite(lat):
-                                raise ValueError("Invalid swapped result")
-                            inner_coords_latlon.append([lon, lat])
+                        inner_lonlat = transform_coords(np.asarray(inner_coords_xy)[:, ::-1], analysis_crs, map_crs)  # Swap x/y
+                        if not np.isfinite(inner_lonlat).all():
+                            raise ValueError("Invalid swapped result")
+                        inner_coords_latlon = inner_lonlat.tolist()
                         
                         # Ensure polygon is closed for display
                         if inner_coords_latlon[0] != inner_coords_latlon[-1]:
@@ -6985,22 +9042,16 @@ if st.session_state.design_mode == "basin":
                     
                     # Calculate button
                     if st.button("🔺 Calculate", key="btn_tin_volume",
-                                help="Calculate volume using Triangulated Irregular Network (TIN) method. Creates a 3D mesh between top and bottom surfaces, handling varying depth due to longitudinal slope."):
+                                help="Calculate volume using Triangulated Irregular Network (TIN) method. Triangulates the existing and design surfaces and sums prism volumes between them, handling varying depth due to longitudinal slope."):
                         with st.spinner("Calculating TIN volume..."):
-                            # Get channel coordinates in projected CRS if available
-                            channel_coords_xy = None
-                            if st.session_state.basin_channel_coords is not None:
-                                channel_coords_xy = []
-                                for lon, lat in st.session_state.basin_channel_coords:
-                                    try:
-                                        x, y = transformer_to_analysis.transform(lon, lat)
-                                        channel_coords_xy.append((x, y))
-                                    except Exception:
-                                        pass
+                            # Channel in projected CRS: drawn line or derived main flow path
+                            channel_coords_xy = basin_flow["channel_coords_xy"]
                             
                             tin_volume, tin_status = calculate_basin_volume_tin(
                                 basin_coords_xy, basin_depth, basin_side_slope,
-                                basin_longitudinal_slope, flow_length, channel_coords_xy
+                                basin_longitudinal_slope, flow_length, channel_coords_xy,
+                                dem_array=analysis_dem, transform=analysis_transform,
+                                nodata=analysis_nodata, valid=analysis_valid, flow_field=basin_flow
                             )
                             st.session_state.basin_tin_volume = tin_volume
                             st.session_state.basin_tin_status = tin_status
@@ -7010,19 +9061,19 @@ if st.session_state.design_mode == "basin":
                     with st.expander("ℹ️ How it works", expanded=False):
                         st.markdown(
                             "**Method:** Triangulated Irregular Network (TIN)\n\n"
-                            "Creates a 3D mesh connecting top surface at Z equals 0 and bottom surface where Z equals negative depth.\n"
-                            "Sums signed volumes of triangular elements.\n\n"
+                            "Delaunay-triangulates DEM-spaced vertices inside the basin plus the breaklines "
+                            "(outer edge, toe of side slopes, channel). Sums prism volumes between the existing "
+                            "surface and the design surface: area × mean vertex depth per triangle.\n\n"
                             "**Uses:**\n"
-                            "- Channel line for flow path\n"
-                            "- Depth variation along channel\n"
-                            "- 3D geometric mesh\n\n"
+                            "- Existing ground sampled bilinearly from the DEM\n"
+                            "- Design surface = existing ground minus the basin cut depth\n"
+                            "- Depth variation along the channel (drawn or derived)\n\n"
                             "**Best for:** Basins with significant longitudinal slope.\n\n"
                             "**Assumptions:**\n"
-                            "- Integrates frustum volume along flow path using Simpson's rule\n"
-                            "- Weighting: (2V₀ + 3Vₘ + 2V₁)/8 (different from Geometric method)\n"
-                            "- Gives independent result that may differ from Geometric volume\n\n"
+                            "- Surfaces are linear within each triangle\n"
+                            "- Vertex spacing is the DEM cell size (coarsened for very large basins)\n\n"
                             "**Calculation differs from Geometric method:**\n"
-                            "- Different Simpson's rule weighting provides alternative volume estimate\n"
+                            "- Integrates the actual cut surface instead of a frustum formula\n"
                             "- Useful for validation and uncertainty analysis"
                         )
             
@@ -7082,28 +9133,18 @@ if st.session_state.design_mode == "basin":
                                 else:
                                     # Step 1: Apply basin to DEM to create modified DEM
                                     # apply_basin_to_dem returns (modified_dem, cut_volume) tuple
-                                    # Get channel_coords_xy from session state or calculate it
-                                    channel_coords_for_dem = st.session_state.get("basin_channel_coords")
-                                    channel_coords_xy_for_dem = None
-                                    
-                                    if channel_coords_for_dem is not None and len(channel_coords_for_dem) >= 2:
-                                        # Transform channel coordinates to analysis CRS
-                                        channel_coords_xy_for_dem = []
-                                        for coord in channel_coords_for_dem:
-                                            if isinstance(coord, (list, tuple)) and len(coord) >= 2:
-                                                lon, lat = coord[0], coord[1]
-                                                x, y = transformer_to_analysis.transform(lon, lat)
-                                                channel_coords_xy_for_dem.append((x, y))
-                                        # Only use if we have at least 2 valid points
-                                        if len(channel_coords_xy_for_dem) < 2:
-                                            channel_coords_xy_for_dem = None
+                                    # Channel: drawn line, or the D8 main flow path derived above
+                                    channel_coords_xy_for_dem = basin_flow["channel_coords_xy"]
                                     
                                     # Create modified DEM by applying basin cut
-                                    dem_result = apply_basin_to_dem(
-                                        analysis_dem, analysis_transform, analysis_nodata,
-                                        basin_coords_xy, basin_depth, basin_side_slope, 
-                                        basin_longitudinal_slope, channel_coords_xy_for_dem
-                                    )
+                                    with StageTimer("apply_basin_to_dem"):
+                                        dem_result = apply_basin_to_dem(
+                                            analysis_dem, analysis_transform, analysis_nodata,
+                                            basin_coords_xy, basin_depth, basin_side_slope, 
+                                            basin_longitudinal_slope, channel_coords_xy_for_dem,
+                                            valid=analysis_valid,
+                                            flow_field=basin_flow
+                                        )
                                     
                                     if dem_result is not None:
                                         modified_dem, cut_volume = dem_result
@@ -7112,18 +9153,20 @@ if st.session_state.design_mode == "basin":
                                         # Step 2-4: Calculate DEM difference volume at NATIVE DEM resolution
                                         # This uses the workflow: clip to polygon, compute difference, sum positive * cell_area
                                         # This is the PRIMARY volume value (uses native DEM resolution, not resampled)
-                                        dem_vol_native = calculate_dem_volume(
-                                            analysis_dem, modified_dem, analysis_transform, 
-                                            analysis_nodata, basin_coords_xy
-                                        )
+                                        with StageTimer("dem_volume"):
+                                            dem_vol_native = calculate_dem_volume(
+                                                analysis_dem, modified_dem, analysis_transform, 
+                                                analysis_nodata, basin_coords_xy, valid=analysis_valid
+                                            )
                                         
                                         # Step 5: Cell-size uncertainty analysis across multiple cell sizes
                                         # This resamples to different cell sizes to assess resolution sensitivity
                                         # Note: This is for uncertainty assessment only; the primary volume uses native resolution
-                                        uncertainty = calculate_dem_volume_uncertainty(
-                                            analysis_dem, modified_dem, analysis_transform, 
-                                            analysis_nodata, basin_coords_xy, analysis_crs
-                                        )
+                                        with StageTimer("dem_volume_uncertainty"):
+                                            uncertainty = calculate_dem_volume_uncertainty(
+                                                analysis_dem, modified_dem, analysis_transform, 
+                                                analysis_nodata, basin_coords_xy, analysis_crs
+                                            )
                                         
                                         # Store ALL results persistently (these will persist across page refreshes)
                                         st.session_state.basin_volumes["dem_volume"] = dem_vol_native  # Native resolution volume (PRIMARY)
@@ -7256,169 +9299,24 @@ UNCERTAINTY ANALYSIS (Resolution Sensitivity):
             st.markdown("---")
             st.markdown("#### Basin Longitudinal Profile")
             
-            from shapely.geometry import Polygon, Point
-            
-            # Determine flow direction: use channel if provided, otherwise use first vertex to min elevation
-            channel_coords = st.session_state.get("basin_channel_coords")
-            
-            if channel_coords is not None and len(channel_coords) >= 2:
-                # Use channel line: first point = upstream, last point = downstream
-                upstream_lon, upstream_lat = channel_coords[0]
-                downstream_lon, downstream_lat = channel_coords[-1]
-                upstream_x, upstream_y = transformer_to_analysis.transform(upstream_lon, upstream_lat)
-                downstream_x, downstream_y = transformer_to_analysis.transform(downstream_lon, downstream_lat)
-                
-                # Calculate flow direction along channel
-                flow_dx = downstream_x - upstream_x
-                flow_dy = downstream_y - upstream_y
-                flow_length = np.sqrt(flow_dx**2 + flow_dy**2)
-                
-                if flow_length > 0:
-                    flow_unit_x = flow_dx / flow_length
-                    flow_unit_y = flow_dy / flow_length
-                else:
-                    flow_unit_x, flow_unit_y = 1.0, 0.0
-                
-                # Sample along channel line for profile
-                channel_coords_xy = []
-                for coord in channel_coords:
-                    # Handle both list and tuple formats, extract first two elements
-                    if isinstance(coord, (list, tuple)) and len(coord) >= 2:
-                        lon, lat = coord[0], coord[1]
-                    else:
-                        continue  # Skip invalid coordinates
-                    x, y = transformer_to_analysis.transform(lon, lat)
-                    channel_coords_xy.append((x, y))
-            else:
-                # Fallback: use first vertex to minimum elevation
-                upstream_x, upstream_y = basin_coords_xy[0]
-                
-                # Find minimum elevation point within polygon
-                outer_poly = Polygon(basin_coords_xy)
-                minx, miny, maxx, maxy = outer_poly.bounds
-                row_min, col_min = rowcol(analysis_transform, minx, maxy)
-                row_max, col_max = rowcol(analysis_transform, maxx, miny)
-                
-                h, w = analysis_dem.shape
-                row_min, row_max = max(0, min(row_min, row_max)), min(h-1, max(row_min, row_max))
-                col_min, col_max = max(0, min(col_min, col_max)), min(w-1, max(col_min, col_max))
-                
-                min_elev = float('inf')
-                downstream_x, downstream_y = upstream_x, upstream_y
-                
-                for r in range(row_min, row_max + 1):
-                    for c in range(col_min, col_max + 1):
-                        z_val = analysis_dem[r, c]
-                        if analysis_nodata is not None and z_val == analysis_nodata:
-                            continue
-                        
-                        x, y = xy(analysis_transform, r, c)
-                        point = Point(x, y)
-                        
-                        if outer_poly.contains(point) and z_val < min_elev:
-                            min_elev = z_val
-                            downstream_x, downstream_y = x, y
-                
-                # Calculate flow direction
-                flow_dx = downstream_x - upstream_x
-                flow_dy = downstream_y - upstream_y
-                flow_length = np.sqrt(flow_dx**2 + flow_dy**2)
-                
-                if flow_length > 0:
-                    flow_unit_x = flow_dx / flow_length
-                    flow_unit_y = flow_dy / flow_length
-                else:
-                    flow_unit_x, flow_unit_y = 1.0, 0.0
-                
-                channel_coords_xy = None
-            
-            # Sample along flow line (use channel if available, otherwise straight line)
-            h, w = analysis_dem.shape
+            from shapely.geometry import Polygon
             
-            # Create polygon for elevation calculations
-            outer_poly = Polygon(basin_coords_xy)
+            # Flow direction from the cached distance-along-flow field:
+            # channel if provided, otherwise first vertex to min elevation
+            upstream_x, upstream_y = basin_flow["upstream"]
+            flow_unit_x, flow_unit_y = basin_flow["flow_unit"]
+            flow_length = basin_flow["flow_length"]
+            channel_coords_xy = basin_flow["channel_coords_xy"]
             
-            if channel_coords_xy is not None:
-                # Sample along channel line
-                distances = []
-                existing_elevs = []
-                basin_bottom_elevs = []
-                cumulative_dist = 0.0
-                
-                for i in range(len(channel_coords_xy)):
-                    x, y = channel_coords_xy[i]
-                    point = Point(x, y)
-                    
-                    # Sample existing elevation
-                    r, c = rowcol(analysis_transform, x, y)
-                    if 0 <= r < h and 0 <= c < w:
-                        z_existing = analysis_dem[r, c]
-                        if analysis_nodata is None or z_existing != analysis_nodata:
-                            distances.append(cumulative_dist)
-                            existing_elevs.append(z_existing)
-                            
-                            # Calculate basin bottom elevation
-                            depth_at_point = basin_depth + (basin_longitudinal_slope / 100.0) * cumulative_dist
-                            depth_at_point = max(0.0, depth_at_point)
-                            basin_bottom_elevs.append(z_existing - depth_at_point)
-                    
-                    # Calculate distance to next point
-                    if i < len(channel_coords_xy) - 1:
-                        next_x, next_y = channel_coords_xy[i + 1]
-                        seg_dist = np.sqrt((next_x - x)**2 + (next_y - y)**2)
-                        cumulative_dist += seg_dist
-            else:
-                # Sample along straight line from upstream to downstream
-                num_samples = 100
-                distances = np.linspace(0, flow_length, num_samples)
-                existing_elevs = []
-                basin_bottom_elevs = []
-                
-                for dist in distances:
-                    x = upstream_x + dist * flow_unit_x
-                    y = upstream_y + dist * flow_unit_y
-                    point = Point(x, y)
-                    
-                    if outer_poly.contains(point):
-                        # Sample existing elevation
-                        r, c = rowcol(analysis_transform, x, y)
-                        if 0 <= r < h and 0 <= c < w:
-                            z_existing = analysis_dem[r, c]
-                            if analysis_nodata is None or z_existing != analysis_nodata:
-                                existing_elevs.append(z_existing)
-                                
-                                # Calculate basin bottom elevation
-                                depth_at_point = basin_depth + (basin_longitudinal_slope / 100.0) * dist
-                                depth_at_point = max(0.0, depth_at_point)
-                                basin_bottom_elevs.append(z_existing - depth_at_point)
-                            else:
-                                existing_elevs.append(np.nan)
-                                basin_bottom_elevs.append(np.nan)
-                    else:
-                        existing_elevs.append(np.nan)
-                        basin_bottom_elevs.append(np.nan)
+            # Existing ground along the flow line (channel vertices, or straight line to the
+            # minimum elevation) comes from the cached flow field; only the design depth varies here
+            distances = basin_flow["profile_dist"]
+            existing_elevs = basin_flow["profile_z"]
+            depth_along = np.maximum(0.0, basin_depth + (basin_longitudinal_slope / 100.0) * distances)
+            basin_bottom_elevs = existing_elevs - depth_along
             
             # Calculate y-axis extent: max = max existing ground in polygon, min = min basin bottom
-            # Find max existing ground elevation within polygon boundary
-            minx, miny, maxx, maxy = outer_poly.bounds
-            row_min, col_min = rowcol(analysis_transform, minx, maxy)
-            row_max, col_max = rowcol(analysis_transform, maxx, miny)
-            
-            row_min, row_max = max(0, min(row_min, row_max)), min(h-1, max(row_min, row_max))
-            col_min, col_max = max(0, min(col_min, col_max)), min(w-1, max(col_min, col_max))
-            
-            max_existing_elev = float('-inf')
-            for r in range(row_min, row_max + 1):
-                for c in range(col_min, col_max + 1):
-                    z_val = analysis_dem[r, c]
-                    if analysis_nodata is not None and z_val == analysis_nodata:
-                        continue
-                    
-                    x, y = xy(analysis_transform, r, c)
-                    point = Point(x, y)
-                    
-                    if outer_poly.contains(point) and z_val > max_existing_elev:
-                        max_existing_elev = z_val
+            max_existing_elev = basin_aoi_stats["max_elev"] if basin_aoi_stats["max_elev"] is not None else float('-inf')
             
             # Fallback if no elevations found
             if max_existing_elev == float('-inf'):
@@ -7523,10 +9421,7 @@ UNCERTAINTY ANALYSIS (Resolution Sensitivity):
             # Convert inner polygon back to lat/lon for display
             inner_coords_latlon = None
             if inner_coords_xy is not None:
-                inner_coords_latlon = []
-                for x, y in inner_coords_xy:
-                    lon, lat = transformer_to_map.transform(x, y)
-                    inner_coords_latlon.append([lon, lat])
+                inner_coords_latlon = transform_coords(inner_coords_xy, analysis_crs, map_crs).tolist()
             
             # Calculate map center and bounds (include channel if present)
             lons = [c[0] for c in basin_coords]
@@ -7567,7 +9462,7 @@ UNCERTAINTY ANALYSIS (Resolution Sensitivity):
             
             # Add hillshade if available
             try:
-                hs = compute_hillshade(analysis_dem, abs(analysis_transform.a), abs(analysis_transform.e))
+                hs = compute_hillshade(analysis_dem, abs(analysis_transform.a), abs(analysis_transform.e), valid=analysis_valid)
                 hs_norm = ((hs - hs.min()) / (hs.max() - hs.min()) * 255).astype(np.uint8)
                 
                 # Get bounds
@@ -7583,6 +9478,7 @@ UNCERTAINTY ANALYSIS (Resolution Sensitivity):
                 ).add_to(m_basin)
             except:
                 pass
+            add_dz_overlay(m_basin)
             
             # Add outer polygon (red)
             outer_coords_for_map = [[c[1], c[0]] for c in basin_coords]  # [lat, lon]
@@ -7686,7 +9582,8 @@ UNCERTAINTY ANALYSIS (Resolution Sensitivity):
             # After first load, don't auto-zoom - let user control the map view
             
             # Display map
-            st_folium(m_basin, height=500, width=None, returned_objects=[])
+            with StageTimer("st_folium_basin"):
+                st_folium(m_basin, height=500, width=None, returned_objects=[])
             
             legend_text = (
                 "**Legend:**\n"
@@ -7713,98 +9610,66 @@ UNCERTAINTY ANALYSIS (Resolution Sensitivity):
                     )
                 with col_exp_res2:
                     # Resampling method for basin export
-                    resample_method_basin = st.selectbox(
+                    st.selectbox(
                         "Resampling Method",
                         options=["Bilinear", "Nearest", "IDW"],
                         index=0,
                         key="basin_resample_method",
                         help="Choose method to resample modified DEM to target resolution"
                     )
+                
+                col_exp_fmt1, col_exp_fmt2 = st.columns(2)
+                with col_exp_fmt1:
+                    compress_basin = st.selectbox(
+                        "Compression",
+                        options=GEOTIFF_COMPRESSION_OPTIONS,
+                        index=0,
+                        key="basin_export_compress",
+                        help="Tiled GeoTIFF compression (floating-point predictor is applied automatically)"
+                    )
+                with col_exp_fmt2:
+                    cog_basin = st.checkbox(
+                        "Cloud-Optimized GeoTIFF",
+                        value=False,
+                        key="basin_export_cog",
+                        help="Add internal overviews and write a COG layout"
+                    )
             
             # Download button
                 st.markdown("---")
                 
-                # Prepare GeoTIFF
+                # Prepare GeoTIFF (streamed to a temp file tile by tile)
                 with st.spinner("Preparing GeoTIFF..."):
-                    from rasterio.warp import reproject, Resampling
-                    from rasterio.transform import from_bounds, array_bounds
-                    from rasterio.io import MemoryFile
-                    
-                    final_dem = st.session_state.basin_modified_dem
-                    final_transform = analysis_transform
-                    
-                    # Resample if needed
                     target_res = st.session_state.get("basin_export_res_2", current_res)
-                    if abs(target_res - abs(final_transform.a)) > 0.01:
-                        bounds = array_bounds(final_dem.shape[0], final_dem.shape[1], final_transform)
-                        width = int((bounds[2] - bounds[0]) / target_res)
-                        height = int((bounds[3] - bounds[1]) / target_res)
-                        
-                        new_transform = from_bounds(bounds[0], bounds[1], bounds[2], bounds[3], width, height)
-                        
-                        resampled_dem = np.empty((height, width), dtype=np.float32)
-                        # Choose resampling method
-                        method = st.session_state.get("basin_resample_method", "Bilinear")
-                        if method == "Nearest":
-                            reproject(
-                                source=final_dem,
-                                destination=resampled_dem,
-                                src_transform=final_transform,
-                                src_crs=analysis_crs,
-                                src_nodata=analysis_nodata,
-                                dst_transform=new_transform,
-                                dst_crs=analysis_crs,
-                                dst_nodata=analysis_nodata,
-                                resampling=Resampling.nearest
-                            )
-                        elif method == "Bilinear":
-                            reproject(
-                                source=final_dem,
-                                destination=resampled_dem,
-                                src_transform=final_transform,
-                                src_crs=analysis_crs,
-                                src_nodata=analysis_nodata,
-                                dst_transform=new_transform,
-                                dst_crs=analysis_crs,
-                                dst_nodata=analysis_nodata,
-                                resampling=Resampling.bilinear
+                    try:
+                        with StageTimer("export_basin"):
+                            export_path, export_shape = cached_dem_export(
+                                session_raster_hash("basin_modified_dem"),
+                                st.session_state.basin_modified_dem, analysis_transform, analysis_crs, analysis_nodata,
+                                target_resolution=target_res,
+                                resampling=st.session_state.get("basin_resample_method", "Bilinear"),
+                                compress=compress_basin, cog=cog_basin
                             )
-                        else:
-                            # IDW resampling (neighborhood-based)
-                            resampled_dem = idw_resample(final_dem, final_transform, new_transform, height, width, src_nodata, power=2, radius=1)
-
-                        final_dem = resampled_dem
-                        final_transform = new_transform
-                    
-                    # Create GeoTIFF in memory
-                    profile_out = {
-                        'driver': 'GTiff',
-                        'height': final_dem.shape[0],
-                        'width': final_dem.shape[1],
-                        'count': 1,
-                        'dtype': 'float32',
-                        'crs': src_crs,
-                        'transform': final_transform,
-                        'nodata': src_nodata,
-                        'compress': 'lzw'
-                    }
-                    
-                    mem_out = MemoryFile()
-                    with mem_out.open(**profile_out) as dst:
-                        dst.write(final_dem.astype("float32"), 1)
-                    
-                    export_data = mem_out.read()
-                
-                st.download_button(
-                    "💾 Download Basin Modified DEM (GeoTIFF)",
-                    data=export_data,
-                    file_name=f"basin_modified_{target_res:.0f}m.tif",
-                    mime="image/tiff",
-                    use_container_width=True,
-                    type="primary"
-                )
+                    except Exception as e:
+                        export_path, export_shape = None, None
+                        st.error(f"Error writing GeoTIFF: {e}")
                 
-                st.caption(f"Resolution: {target_res:.2f}m | Size: {final_dem.shape[0]}×{final_dem.shape[1]}")
+                if export_path is not None:
+                    with open(export_path, "rb") as export_file:
+                        st.download_button(
+                            "💾 Download Basin Modified DEM (GeoTIFF)",
+                            data=export_file,
+                            file_name=f"basin_modified_{target_res:.0f}m.tif",
+                            mime="image/tiff",
+                            use_container_width=True,
+                            type="primary"
+                        )
+                    
+                    st.caption(f"Resolution: {target_res:.2f}m | Size: {export_shape[0]}×{export_shape[1]} | {os.path.getsize(export_path) / 1e6:.1f} MB")
+
+    with tab4:
+        if active_view == "Basin Design":
+            basin_design_view()
 
 # ============================================================================
 # DOWNLOAD SECTION (Profile Mode)
@@ -7838,6 +9703,25 @@ if st.session_state.design_mode == "profile" and 'samples' in locals():
             )
             st.caption("Choose interpolation method")
         
+        col_fmt1, col_fmt2 = st.columns(2, gap="large")
+        with col_fmt1:
+            export_compress = st.selectbox(
+                "Compression",
+                options=GEOTIFF_COMPRESSION_OPTIONS,
+                index=0,
+                key="export_compress",
+                help="Tiled GeoTIFF compression (floating-point predictor is applied automatically)",
+                label_visibility="collapsed"
+            )
+            st.caption("GeoTIFF compression")
+        with col_fmt2:
+            export_cog = st.checkbox(
+                "Cloud-Optimized GeoTIFF",
+                value=False,
+                key="export_cog",
+                help="Add internal overviews and write a COG layout"
+            )
+        
         # Auto-recompute if parameters changed, or compute when button clicked
         should_compute = st.button("🔄 Compute Modified DEM", type="primary", use_container_width=True)
         
@@ -7858,14 +9742,37 @@ if st.session_state.design_mode == "profile" and 'samples' in locals():
                     current_template_params = current_template_params.copy()
                     current_template_params["ditch_side"] = current_ditch_side
                 
-                new_dem, cut_vol, fill_vol = apply_corridor_to_dem(
-                    analysis_dem, analysis_transform, analysis_nodata,
-                    samples, z_design, current_template_type, current_template_params,
-                    tangents, normals, influence_width, operation_mode
-                )
+                corridor_field = cached_alignment_field(analysis_transform, analysis_dem.shape, samples, influence_width)
+                # Only station elevations edited since the last run: re-evaluate just their chainage span
+                corridor_key = json.dumps([analysis_dem_key, corridor_field["key"], current_template_type,
+                                           current_template_params, operation_mode], sort_keys=True, default=str)
+                corridor_state = st.session_state.get("corridor_state")
+                chainage_range, previous_dem = None, None
+                if (corridor_state is not None and corridor_state["key"] == corridor_key
+                        and st.session_state.modified_dem is not None
+                        and len(corridor_state["z_design"]) == len(z_design)):
+                    chainage_range = changed_chainage_range(stations, corridor_state["z_design"], z_design)
+                    previous_dem = st.session_state.modified_dem
+                    if chainage_range is None:
+                        chainage_range = (np.inf, -np.inf)  # nothing edited
+                
+                with StageTimer("apply_corridor_to_dem"):
+                    new_dem, cut_vol, fill_vol = apply_corridor_to_dem(
+                        analysis_dem, analysis_transform, analysis_nodata,
+                        samples, z_design, current_template_type, current_template_params,
+                        tangents, normals, influence_width, operation_mode,
+                        valid=analysis_valid, field=corridor_field,
+                        previous_dem=previous_dem, chainage_range=chainage_range
+                    )
                 st.session_state.modified_dem = new_dem
                 st.session_state.volumes = {"cut": cut_vol, "fill": fill_vol}
                 st.session_state.export_dem_ready = True
+                st.session_state.corridor_state = {
+                    "key": corridor_key,
+                    "z_design": np.array(z_design, dtype=np.float64),
+                    "chainage_range": chainage_range if previous_dem is not None else None,
+                    "version": (corridor_state or {}).get("version", 0) + 1,
+                }
         
         if st.session_state.modified_dem is not None:
             st.success("✅ Modified DEM computed!")
@@ -7887,107 +9794,286 @@ if st.session_state.design_mode == "profile" and 'samples' in locals():
                     st.metric("Net", f"{net:+,.0f}", label_visibility="collapsed")
                     st.caption("m³ balance")
             
+            # Mass-haul diagram from per-interval cut/fill along chainage
+            st.markdown("---")
+            st.markdown("**🚚 Mass-Haul Diagram**")
+            col_mh1, col_mh2, col_mh3 = st.columns(3, gap="medium")
+            with col_mh1:
+                mh_interval = st.number_input("Station interval (m)", 1.0, 500.0, 10.0, 1.0, key="mass_haul_interval",
+                                              help="Chainage interval for section volumes")
+            with col_mh2:
+                mh_factor = st.number_input("Cut shrink/swell factor", 0.5, 1.5, 0.9, 0.01, key="mass_haul_factor",
+                                            help="Applied to cut before placing it as fill (<1 shrink, >1 swell)")
+            with col_mh3:
+                mh_free_haul = st.number_input("Free-haul distance (m)", 0.0, 5000.0, 150.0, 10.0, key="mass_haul_free_haul")
+            
+            corridor_state = st.session_state.get("corridor_state") or {}
+            corridor_field = cached_alignment_field(analysis_transform, analysis_dem.shape, samples, influence_width)
+            sections_key = (corridor_state.get("key"), float(mh_interval))
+            sections_cache = st.session_state.get("mass_haul_sections")
+            if sections_cache is None or sections_cache["version"] != corridor_state.get("version"):
+                with StageTimer("mass_haul_sections"):
+                    # Same bins as last time: only the edited chainage span is re-binned
+                    incremental = (sections_cache is not None and sections_cache["key"] == sections_key
+                                   and corridor_state.get("chainage_range") is not None)
+                    sections = corridor_section_volumes(
+                        analysis_dem, st.session_state.modified_dem, analysis_transform, corridor_field,
+                        analysis_valid, stations, mh_interval,
+                        previous=sections_cache["sections"] if incremental else None,
+                        chainage_range=corridor_state.get("chainage_range") if incremental else None
+                    )
+                st.session_state.mass_haul_sections = {"key": sections_key, "version": corridor_state.get("version"),
+                                                       "sections": sections}
+            elif sections_cache["key"] != sections_key:
+                sections = corridor_section_volumes(analysis_dem, st.session_state.modified_dem, analysis_transform,
+                                                    corridor_field, analysis_valid, stations, mh_interval)
+                st.session_state.mass_haul_sections = {"key": sections_key, "version": corridor_state.get("version"),
+                                                       "sections": sections}
+            else:
+                sections = sections_cache["sections"]
+            
+            mass_haul = mass_haul_curve(*sections, cut_factor=mh_factor, free_haul_m=mh_free_haul)
+            fig_mh = go.Figure()
+            fig_mh.add_trace(go.Scatter(x=mass_haul["chainage"], y=mass_haul["ordinate"], mode='lines',
+                                        name='Mass Ordinate', line=dict(color='#2F6690', width=2)))
+            fig_mh.add_hline(y=0, line=dict(color='gray', width=1, dash='dot'))
+            if mass_haul["balance_points"]:
+                fig_mh.add_trace(go.Scatter(x=mass_haul["balance_points"], y=[0] * len(mass_haul["balance_points"]),
+                                            mode='markers', name='Balance Points',
+                                            marker=dict(size=9, color='#D1495B', symbol='diamond')))
+            for loop in mass_haul["free_haul"]:
+                level = loop["Overhaul Volume (m³)"] * (1 if loop["Haul"] == "forward" else -1)
+                fig_mh.add_trace(go.Scatter(x=[loop["Free-Haul Start (m)"], loop["Free-Haul End (m)"]], y=[level, level],
+                                            mode='lines', line=dict(color='#EDAE49', width=3),
+                                            name='Free-Haul Chord', showlegend=False))
+            fig_mh.update_layout(xaxis_title="Chainage (m)", yaxis_title="Cumulative Volume (m³)", height=350,
+                                 margin=dict(l=60, r=30, t=30, b=50), hovermode='x unified')
+            st.plotly_chart(fig_mh, use_container_width=True)
+            st.caption("Rising curve: cut exceeds fill (material hauled forward) • "
+                       "Falling curve: fill exceeds cut • Orange: free-haul chords")
+            
+            if mass_haul["free_haul"]:
+                st.dataframe(pd.DataFrame(mass_haul["free_haul"]).round(1), hide_index=True, use_container_width=True)
+            
+            col_mh_dl1, col_mh_dl2 = st.columns(2)
+            with col_mh_dl1:
+                st.download_button("Mass-Haul CSV", data=mass_haul["table"].to_csv(index=False).encode("utf-8"),
+                                   file_name="mass_haul.csv", mime="text/csv", use_container_width=True)
+            with col_mh_dl2:
+                st.download_button("Free-Haul Segments CSV",
+                                   data=pd.DataFrame(mass_haul["free_haul"]).to_csv(index=False).encode("utf-8"),
+                                   file_name="mass_haul_free_haul.csv", mime="text/csv", use_container_width=True,
+                                   disabled=not mass_haul["free_haul"])
+            
             st.markdown("---")
             
-            # Prepare the GeoTIFF data
+            # Prepare the GeoTIFF (reprojected to the source CRS and streamed to a temp file)
             with st.spinner("Preparing GeoTIFF..."):
-                # Reproject to source CRS if needed
-                if analysis_crs == src_crs:
-                    final_dem = st.session_state.modified_dem
-                    final_transform = analysis_transform
-                else:
-                    final_dem = np.empty_like(src_dem, dtype=np.float32)
-                    reproject(
-                        source=st.session_state.modified_dem, 
-                        destination=final_dem,
-                        src_transform=analysis_transform, 
-                        src_crs=analysis_crs, 
-                        src_nodata=src_nodata,
-                        dst_transform=src_transform, 
-                        dst_crs=src_crs, 
-                        dst_nodata=src_nodata,
-                        resampling=Resampling.bilinear
+                try:
+                    with StageTimer("export_profile"):
+                        export_path, export_shape = cached_dem_export(
+                            session_raster_hash("modified_dem"),
+                            st.session_state.modified_dem, analysis_transform, analysis_crs, analysis_nodata,
+                            dst_crs=src_crs, dst_transform=src_transform, dst_shape=src_dem.shape,
+                            target_resolution=target_resolution,
+                            resampling=st.session_state.get("export_resample_method", "Bilinear"),
+                            compress=export_compress, cog=export_cog
+                        )
+                except Exception as e:
+                    export_path, export_shape = None, None
+                    st.error(f"Error writing GeoTIFF: {e}")
+            
+            # Download button (always visible when modified DEM exists)
+            if export_path is not None:
+                with open(export_path, "rb") as export_file:
+                    st.download_button(
+                        "💾 Download Modified DEM (GeoTIFF)",
+                        data=export_file,
+                        file_name=f"terrain_modified_{target_resolution:.0f}m.tif",
+                        mime="image/tiff",
+                        use_container_width=True,
+                        type="primary"
                     )
-                    final_transform = src_transform
                 
-                # Resample to target resolution if different
-                if abs(target_resolution - abs(final_transform.a)) > 0.01:
-                    # Calculate new dimensions
-                    bounds = array_bounds(final_dem.shape[0], final_dem.shape[1], final_transform)
-                    width = int((bounds[2] - bounds[0]) / target_resolution)
-                    height = int((bounds[3] - bounds[1]) / target_resolution)
-                    
-                    # Create new transform
-                    new_transform = from_bounds(
-                        bounds[0], bounds[1], bounds[2], bounds[3],
-                        width, height
-                    )
-                    
-                    # Resample
-                    resampled_dem = np.empty((height, width), dtype=np.float32)
-                    method = st.session_state.get("export_resample_method", "Bilinear")
-                    if method == "Nearest":
-                        reproject(
-                            source=final_dem,
-                            destination=resampled_dem,
-                            src_transform=final_transform,
-                            src_crs=src_crs,
-                            src_nodata=src_nodata,
-                            dst_transform=new_transform,
-                            dst_crs=src_crs,
-                            dst_nodata=src_nodata,
-                            resampling=Resampling.nearest
+                st.caption(f"Resolution: {target_resolution:.2f}m | Size: {export_shape[0]}×{export_shape[1]} | {os.path.getsize(export_path) / 1e6:.1f} MB")
+
+# ============================================================================
+# TAB 5: PROJECT (Multiple Alignments and Basins)
+# ============================================================================
+
+with tab5:
+    st.markdown("## 🧩 Project Features")
+    st.caption("Collect several alignments and basins, each with its own template or parameters, "
+               "and composite them onto the analysis DEM in one pass.")
+    
+    project_features = st.session_state.project_features
+    current_alignment = st.session_state.get("profile_line_coords")
+    has_template = "template_type" in st.session_state and "template_params" in st.session_state
+    
+    def alignment_settings():
+        return {
+            "template_type": st.session_state.template_type,
+            "template_params": dict(st.session_state.template_params),
+            "influence_width": float(st.session_state.get("influence_width", 20.0)),
+            "operation_mode": st.session_state.get("operation_mode", "replace"),
+        }
+    
+    def basin_settings():
+        return {
+            "depth": float(st.session_state.basin_depth),
+            "side_slope": float(st.session_state.basin_side_slope),
+            "long_slope": float(st.session_state.basin_longitudinal_slope),
+        }
+    
+    col_add1, col_add2 = st.columns(2)
+    with col_add1:
+        if st.button("➕ Add Current Alignment", use_container_width=True,
+                     disabled=not (has_template and current_alignment is not None and len(current_alignment) >= 2)):
+            z_design = st.session_state.get("z_design")
+            project_features.append({
+                "name": f"Alignment {sum(f['kind'] == 'alignment' for f in project_features) + 1}",
+                "kind": "alignment", "enabled": True, "priority": len(project_features),
+                "coords": [[c[0], c[1]] for c in current_alignment],
+                "z_design": list(z_design) if z_design is not None and len(z_design) == len(current_alignment) else None,
+                **alignment_settings(),
+            })
+    with col_add2:
+        current_basin = st.session_state.get("basin_polygon_coords")
+        if st.button("➕ Add Current Basin", use_container_width=True,
+                     disabled=current_basin is None or len(current_basin) < 3):
+            channel = st.session_state.get("basin_channel_coords")
+            project_features.append({
+                "name": f"Basin {sum(f['kind'] == 'basin' for f in project_features) + 1}",
+                "kind": "basin", "enabled": True, "priority": len(project_features),
+                "coords": [[c[0], c[1]] for c in current_basin],
+                "channel": [[c[0], c[1]] for c in channel] if channel is not None and len(channel) >= 2 else None,
+                **basin_settings(),
+            })
+    
+    uploaded_features = st.file_uploader(
+        "Import features (Shapefile ZIP, KML, KMZ)", type=["zip", "kml", "kmz"], key="project_features_upload",
+        help="Every line becomes an alignment with the current template; every polygon becomes a basin with the current basin parameters."
+    )
+    if uploaded_features is not None and st.session_state.get("last_project_upload") != uploaded_features.name:
+        imported = process_uploaded_features(uploaded_features)
+        st.session_state.last_project_upload = uploaded_features.name
+        if imported:
+            skipped = 0
+            for feature in imported:
+                if feature["geom_type"] == "LineString":
+                    if not has_template:
+                        skipped += 1
+                        continue
+                    project_features.append({"name": f"{uploaded_features.name}:{feature['name']}", "kind": "alignment",
+                                             "enabled": True, "priority": len(project_features),
+                                             "coords": [[lon, lat] for lon, lat in feature["coords"]],
+                                             "z_design": None, **alignment_settings()})
+                else:
+                    project_features.append({"name": f"{uploaded_features.name}:{feature['name']}", "kind": "basin",
+                                             "enabled": True, "priority": len(project_features),
+                                             "coords": [[lon, lat] for lon, lat in feature["coords"]],
+                                             "channel": None, **basin_settings()})
+            st.success(f"✅ Imported {len(imported) - skipped} feature(s)")
+            if skipped:
+                st.warning(f"⚠️ {skipped} line(s) skipped: set up a cross-section template in the Profile tab first.")
+    
+    if not project_features:
+        st.info("Add the current alignment or basin, or import a file with several features.")
+    else:
+        def feature_summary(f):
+            if f["kind"] == "alignment":
+                design = "design profile" if f["z_design"] is not None else "existing ground"
+                return f"{f['template_type']} • {f['operation_mode']} • {f['influence_width']:.0f} m • {design}"
+            channel = "drawn channel" if f["channel"] is not None else "D8 channel"
+            return f"{f['depth']:.1f} m deep • {f['side_slope']:.1f}H:1V • {f['long_slope']:.0f}% • {channel}"
+        
+        features_df = pd.DataFrame({
+            "Enabled": [f["enabled"] for f in project_features],
+            "Name": [f["name"] for f in project_features],
+            "Kind": [f["kind"] for f in project_features],
+            "Priority": [int(f["priority"]) for f in project_features],
+            "Parameters": [feature_summary(f) for f in project_features],
+        })
+        edited_df = st.data_editor(features_df, hide_index=True, use_container_width=True,
+                                   disabled=["Kind", "Parameters"], key="project_features_editor",
+                                   column_config={"Priority": st.column_config.NumberColumn(step=1,
+                                                  help="Higher priority wins where features overlap")})
+        for f, (_, row) in zip(project_features, edited_df.iterrows()):
+            f["enabled"], f["name"], f["priority"] = bool(row["Enabled"]), str(row["Name"]), int(row["Priority"])
+        
+        col_rule, col_clear = st.columns([3, 1])
+        with col_rule:
+            overlap_rule = st.selectbox("Overlap rule", list(OVERLAP_RULES), format_func=OVERLAP_RULES.get,
+                                        key="project_overlap_rule")
+        with col_clear:
+            st.markdown("<br>", unsafe_allow_html=True)
+            if st.button("🗑️ Clear Project", use_container_width=True):
+                st.session_state.project_features = []
+                st.session_state.project_dem = None
+                st.session_state.project_volumes = None
+                st.rerun()
+        
+        enabled_features = [f for f in project_features if f["enabled"]]
+        if st.button("🧱 Composite Project", type="primary", use_container_width=True, disabled=not enabled_features):
+            def to_analysis(coords):
+                return [tuple(p) for p in transform_coords(coords, map_crs, analysis_crs).tolist()]
+            
+            analysis_features = []
+            for f in enabled_features:
+                feature = {k: v for k, v in f.items() if k not in ("coords", "channel")}
+                feature["coords_xy"] = to_analysis(f["coords"])
+                if f["kind"] == "basin":
+                    feature["channel_xy"] = to_analysis(f["channel"]) if f["channel"] is not None else None
+                analysis_features.append(feature)
+            with st.spinner(f"Compositing {len(analysis_features)} feature(s)..."):
+                try:
+                    with StageTimer("project_composite"):
+                        project_dem, project_rows, project_totals = composite_features_on_dem(
+                            analysis_dem, analysis_transform, analysis_nodata, analysis_features,
+                            overlap_rule=overlap_rule, valid=analysis_valid
                         )
-                    elif method == "Bilinear":
-                        reproject(
-                            source=final_dem,
-                            destination=resampled_dem,
-                            src_transform=final_transform,
-                            src_crs=src_crs,
-                            src_nodata=src_nodata,
-                            dst_transform=new_transform,
-                            dst_crs=src_crs,
-                            dst_nodata=src_nodata,
-                            resampling=Resampling.bilinear
+                    st.session_state.project_dem = project_dem
+                    st.session_state.project_volumes = {"rows": project_rows, "totals": project_totals}
+                except Exception as e:
+                    st.error(f"Error compositing project: {e}")
+        
+        project_volumes = st.session_state.project_volumes
+        if st.session_state.project_dem is not None and project_volumes is not None:
+            st.markdown("### 📊 Volumes")
+            col_v1, col_v2, col_v3 = st.columns(3)
+            col_v1.metric("Total Cut", f"{project_volumes['totals']['cut']:,.0f} m³")
+            col_v2.metric("Total Fill", f"{project_volumes['totals']['fill']:,.0f} m³")
+            col_v3.metric("Net (Fill − Cut)", f"{project_volumes['totals']['net']:,.0f} m³")
+            st.dataframe(pd.DataFrame(project_volumes["rows"]).round(1), hide_index=True, use_container_width=True)
+            st.caption("Cut/Fill: volume attributed to each feature after overlaps are resolved • "
+                       "Standalone: the feature applied on its own")
+            
+            col_dl1, col_dl2 = st.columns(2)
+            with col_dl1:
+                st.download_button("Volumes CSV",
+                                   data=pd.DataFrame(project_volumes["rows"]).to_csv(index=False).encode("utf-8"),
+                                   file_name="project_volumes.csv", mime="text/csv", use_container_width=True)
+            with col_dl2:
+                try:
+                    with StageTimer("export_project"):
+                        export_path, export_shape = cached_dem_export(
+                            session_raster_hash("project_dem"),
+                            st.session_state.project_dem, analysis_transform, analysis_crs, analysis_nodata,
+                            dst_crs=src_crs, dst_transform=src_transform, dst_shape=src_dem.shape
                         )
-                    else:
-                        # IDW resampling
-                        resampled_dem = idw_resample(final_dem, final_transform, new_transform, height, width, src_nodata, power=2, radius=1)
-
-                    final_dem = resampled_dem
-                    final_transform = new_transform
-                
-                # Prepare output profile
-                profile_out = {
-                    'driver': 'GTiff',
-                    'height': final_dem.shape[0],
-                    'width': final_dem.shape[1],
-                    'count': 1,
-                    'dtype': 'float32',
-                    'crs': src_crs,
-                    'transform': final_transform,
-                    'nodata': src_nodata,
-                    'compress': 'lzw'
-                }
-                
-                # Write to memory
-                mem_out = MemoryFile()
-                with mem_out.open(**profile_out) as dst:
-                    dst.write(final_dem.astype("float32"), 1)
-                
-                # Get the data bytes
-                export_data = mem_out.read()
-            
-            # Download button (always visible when modified DEM exists)
-            st.download_button(
-                "💾 Download Modified DEM (GeoTIFF)",
-                data=export_data,
-                file_name=f"terrain_modified_{target_resolution:.0f}m.tif",
-                mime="image/tiff",
-                use_container_width=True,
-                type="primary"
-            )
-            
-            st.caption(f"Resolution: {target_resolution:.2f}m | Size: {final_dem.shape[0]}×{final_dem.shape[1]}")
+                except Exception as e:
+                    export_path = None
+                    st.error(f"Error writing GeoTIFF: {e}")
+                if export_path is not None:
+                    with open(export_path, "rb") as export_file:
+                        st.download_button("💾 Download Project DEM (GeoTIFF)", data=export_file,
+                                           file_name="terrain_project.tif", mime="image/tiff",
+                                           use_container_width=True, type="primary")
 
+# ============================================================================
+# UNDO/REDO
+# ============================================================================
 
+record_history(analysis_dem_key, analysis_dem)
+render_history_controls(analysis_dem)
+render_perf_panel()